@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: Apache-2.0
+"""
+Run the benchmarks and write the results as JSON.
+
+Usage: python -m benchmarks [-k PATTERN] [--quick] [--output FILE]
+                            [--compare BASELINE] [--max-regression 0.25]
+
+With --compare the run exits with status 1 if any benchmark median got
+slower than the baseline by more than --max-regression.
+"""
+
+import argparse
+import json
+import sys
+
+from benchmarks import bench_backends  # noqa: F401
+from benchmarks import bench_cache  # noqa: F401
+from benchmarks import bench_catalog  # noqa: F401
+from benchmarks import bench_copy  # noqa: F401
+from benchmarks import bench_journal  # noqa: F401
+from benchmarks import bench_pool  # noqa: F401
+from benchmarks import bench_scheduler  # noqa: F401
+from benchmarks import harness
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog='python -m benchmarks')
+    parser.add_argument('-k', '--pattern', default='',
+                        help='only run benchmarks whose name contains this')
+    parser.add_argument('--quick', action='store_true',
+                        help='skip the largest cases and take fewer samples')
+    parser.add_argument('--repeat', type=int, default=None,
+                        help='samples per benchmark case')
+    parser.add_argument('--output', default='-',
+                        help='file to write the JSON results to')
+    parser.add_argument('--compare', metavar='BASELINE',
+                        help='JSON results of a previous run to compare to')
+    parser.add_argument('--max-regression', type=float, default=0.25,
+                        help='allowed slowdown of the median, as a fraction')
+    args = parser.parse_args(argv)
+
+    repeat = args.repeat or (20 if args.quick else 100)
+    results = harness.run(args.pattern, args.quick, repeat)
+    if args.output == '-':
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = harness.compare(
+            baseline, results, args.max_regression)
+        for r in regressions:
+            sys.stderr.write(
+                f'REGRESSION {r["key"]}: {r["baseline"] * 1e6:.1f} us -> '
+                f'{r["current"] * 1e6:.1f} us ({r["change"]:+.0%})\n')
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
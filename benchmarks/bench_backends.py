@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: Apache-2.0
+"""
+Latency of the Backend operations for each backend and volume size.
+"""
+
+from benchmarks import fixtures
+from benchmarks import harness
+
+SIZES = (fixtures.MiB, fixtures.GiB)
+
+
+@harness.benchmark(backend=fixtures.BACKENDS, size=SIZES)
+def create_volume(run, backend, size):
+    with fixtures.backend(backend) as b:
+        run(lambda: b.create_volume(size, fixtures.name()))
+
+
+@harness.benchmark(backend=fixtures.BACKENDS, count=(10, 100))
+def create_volumes(run, backend, count):
+    with fixtures.backend(backend) as b:
+        run(lambda: b.create_volumes(
+            [(fixtures.name(), fixtures.MiB) for _ in range(count)]),
+            repeat=max(1, run.repeat // count), batch=count)
+
+
+@harness.benchmark(backend=fixtures.BACKENDS, size=SIZES)
+def delete_volume(run, backend, size):
+    with fixtures.backend(backend) as b:
+        run(b.delete_volume,
+            setup=lambda: b.create_volume(size, fixtures.name()))
+
+
+@harness.benchmark(backend=fixtures.BACKENDS)
+def grow_volume(run, backend):
+    with fixtures.backend(backend) as b:
+        vol = b.create_volume(fixtures.MiB, fixtures.name())
+        run(lambda: b.grow_volume(vol, fixtures.MiB))
+
+
+@harness.benchmark(backend=fixtures.BACKENDS, size=SIZES)
+def clone_volume(run, backend, size):
+    with fixtures.backend(backend) as b:
+        vol = b.create_volume(size, fixtures.name())
+        with b.open_volume(vol) as f:
+            f.write(b'x' * fixtures.MiB)
+        run(lambda: b.clone_volume(vol, fixtures.name()))
+
+
+@harness.benchmark(backend=fixtures.BACKENDS, size=SIZES)
+def shallow_clone_volume(run, backend, size):
+    with fixtures.backend(backend) as b:
+        vol = b.create_volume(size, fixtures.name())
+        run(lambda: b.shallow_clone_volume(vol, fixtures.name()))
+
+
+@harness.benchmark(backend=fixtures.BACKENDS)
+def open_volume(run, backend):
+    """Open a volume, read its first 4 KiB and close it."""
+    with fixtures.backend(backend) as b:
+        vol = b.create_volume(fixtures.MiB, fixtures.name())
+
+        def _op():
+            with b.open_volume(vol) as f:
+                f.read(4 * fixtures.KiB)
+        run(_op)
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: Apache-2.0
+"""
+Latency of random reads of a hot working set with and without a cache.
+"""
+
+import os
+import random
+import shutil
+import tempfile
+
+from benchmarks import fixtures
+from benchmarks import harness
+from os_vol.backends import flat_file
+from os_vol import cache
+
+WORKING_SET = 8 * fixtures.MiB
+READ_SIZE = 4 * fixtures.KiB
+
+
+def _drop_page_cache(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+@harness.benchmark(policy=('none', cache.POLICY_LRU, cache.POLICY_ARC),
+                   layout=('flat', 'overlay'), page_cache=('warm', 'cold'))
+def random_read(run, policy, layout, page_cache):
+    """Read 4 KiB at a random offset of a volume or a shallow clone.
+
+    With a cold page cache the pages of the backing files are dropped
+    before each batch of reads, as happens under memory pressure.
+    """
+    path = tempfile.mkdtemp(prefix='os-vol-bench-')
+    block_cache = (
+        None if policy == 'none' else
+        cache.BlockCache(2 * WORKING_SET, policy=policy))
+    backend = flat_file.FlatFile(path, cache=block_cache)
+    try:
+        vol = backend.create_volume(WORKING_SET, fixtures.name())
+        with backend.open_volume(vol) as f:
+            f.write(b'x' * WORKING_SET)
+        paths = [vol.path]
+        if layout == 'overlay':
+            vol = backend.shallow_clone_volume(vol, fixtures.name())
+            paths.append(vol.path)
+        rand = random.Random(0)
+        offsets = [rand.randrange(0, WORKING_SET - READ_SIZE, READ_SIZE)
+                   for _ in range(1024)]
+
+        def setup():
+            if page_cache == 'cold':
+                for layer_path in paths:
+                    _drop_page_cache(layer_path)
+
+        with backend.open_handle(vol) as h:
+            for offset in offsets:
+                h.pread(READ_SIZE, offset)
+            run(lambda _: [h.pread(READ_SIZE, o) for o in offsets],
+                setup=setup, batch=len(offsets))
+    finally:
+        backend.close()
+        shutil.rmtree(path, ignore_errors=True)
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: Apache-2.0
+"""
+Time to reload a FlatFile catalog, as an agent does when it restarts.
+"""
+
+import shutil
+import tempfile
+
+from benchmarks import fixtures
+from benchmarks import harness
+from os_vol.backends import flat_file
+from os_vol.objects import storeage_pools
+from os_vol.objects import volume
+
+COUNTS = (1_000, 10_000, 100_000)
+SLOW = {'count': (100_000,)}
+
+
+def _populate(count):
+    """Return a FlatFile directory whose catalog holds count volumes."""
+    path = tempfile.mkdtemp(prefix='os-vol-bench-')
+    backend = flat_file.FlatFile(path)
+    backend.catalog.put_many(
+        volume.Volume(path=f'{path}/vol-{i}', name=f'vol-{i}',
+                      size=fixtures.MiB).to_dict()
+        for i in range(count))
+    backend.close()
+    return path
+
+
+@harness.benchmark(count=COUNTS, slow=SLOW)
+def reload(run, count):
+    """Open the backend and pool and serve the first page of volumes."""
+    path = _populate(count)
+
+    def _op():
+        backend = flat_file.FlatFile(path)
+        pool = storeage_pools.StoragePool(name='bench', backend=backend)
+        pool.list_volumes(limit=100)
+        pool.usage()
+        backend.close()
+    try:
+        run(_op, repeat=max(5, run.repeat // 10))
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+@harness.benchmark(count=COUNTS, slow=SLOW)
+def full_scan(run, count):
+    """Materialise every volume in the catalog."""
+    path = _populate(count)
+
+    def _op():
+        backend = flat_file.FlatFile(path)
+        pool = storeage_pools.StoragePool(name='bench', backend=backend)
+        for _ in pool.iter_volumes():
+            pass
+        backend.close()
+    try:
+        run(_op, repeat=max(3, run.repeat // 50), batch=count)
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
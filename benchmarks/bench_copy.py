@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: Apache-2.0
+"""
+Throughput of the copy engine for file and memory volumes.
+"""
+
+import os
+import shutil
+import tempfile
+
+from benchmarks import fixtures
+from benchmarks import harness
+from os_vol.backends import handle
+from os_vol.backends import memory
+from os_vol import copy_engine
+
+SIZE = 64 * fixtures.MiB
+
+
+@harness.benchmark(kind=('file', 'memory'), concurrency=(1, 2, 4, 8))
+def copy(run, kind, concurrency):
+    """Copy a fully allocated 64 MiB volume, the sample is per MiB."""
+    engine = copy_engine.CopyEngine(
+        chunk_size=fixtures.MiB, concurrency=concurrency)
+    data = os.urandom(fixtures.MiB) * (SIZE // fixtures.MiB)
+    if kind == 'memory':
+        src = memory.PageStore(SIZE)
+        src.write(0, data)
+        run(lambda: engine.copy(
+            memory.MemoryHandle(src),
+            memory.MemoryHandle(memory.PageStore(SIZE))),
+            repeat=max(1, run.repeat // 10), batch=SIZE // fixtures.MiB)
+        return
+    path = tempfile.mkdtemp(prefix='os-vol-bench-')
+    try:
+        src_path, dst_path = f'{path}/src', f'{path}/dst'
+        with open(src_path, 'wb') as f:
+            f.write(data)
+        open(dst_path, 'wb').close()
+        with handle.FileHandle(src_path) as src, \
+                handle.FileHandle(dst_path, SIZE) as dst:
+            run(lambda: engine.copy(src, dst),
+                repeat=max(1, run.repeat // 10), batch=SIZE // fixtures.MiB)
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
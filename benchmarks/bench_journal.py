@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: Apache-2.0
+"""
+Throughput of the operation journal with concurrent writers.
+"""
+
+from concurrent import futures
+import shutil
+import tempfile
+
+from benchmarks import harness
+from os_vol.backends import journal
+
+OPS = 256
+
+
+@harness.benchmark(threads=(1, 8, 32), sync=(True, False))
+def begin_end(run, threads, sync):
+    """Journal OPS operations on threads threads, the sample is per op."""
+    path = tempfile.mkdtemp(prefix='os-vol-bench-')
+    jrnl = journal.Journal(f'{path}/journal.log', sync)
+
+    def _op(_):
+        jrnl.end(jrnl.begin('create', volumes=[['id', f'{path}/vol']]))
+
+    try:
+        with futures.ThreadPoolExecutor(threads) as pool:
+            run(lambda: list(pool.map(_op, range(OPS))),
+                repeat=max(1, run.repeat // 10), batch=OPS)
+    finally:
+        jrnl.close()
+        shutil.rmtree(path, ignore_errors=True)
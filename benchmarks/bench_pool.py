@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: Apache-2.0
+"""
+Latency of the StoragePool queries with many volumes.
+"""
+
+from benchmarks import fixtures
+from benchmarks import harness
+
+COUNTS = (1_000, 10_000, 100_000)
+SLOW = {'count': (100_000,)}
+
+
+@harness.benchmark(backend=fixtures.BACKENDS, count=COUNTS, slow=SLOW)
+def usage(run, backend, count):
+    with fixtures.pool(backend, count) as pool:
+        run(pool.usage)
+
+
+@harness.benchmark(backend=fixtures.BACKENDS, count=COUNTS, slow=SLOW)
+def storage_summary(run, backend, count):
+    with fixtures.pool(backend, count) as pool:
+        run(pool.storage_summary)
+
+
+@harness.benchmark(backend=fixtures.BACKENDS, count=COUNTS, slow=SLOW)
+def list_volumes_page(run, backend, count):
+    """List the first 100 volumes of the pool."""
+    with fixtures.pool(backend, count) as pool:
+        run(lambda: pool.list_volumes(limit=100))
+
+
+@harness.benchmark(backend=fixtures.BACKENDS, count=COUNTS, slow=SLOW)
+def allocate_volume(run, backend, count):
+    with fixtures.pool(backend, count) as pool:
+        run(lambda: pool.allocate_volume(fixtures.name(), fixtures.MiB))
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: Apache-2.0
+"""
+Latency of placing volumes across many pools.
+"""
+
+import random
+
+from benchmarks import fixtures
+from benchmarks import harness
+from os_vol.backends import memory
+from os_vol.objects import storeage_pools
+from os_vol import scheduler
+
+WEIGHERS = {
+    'spread': scheduler.SpreadWeigher,
+    'pack': scheduler.PackWeigher,
+    'least_used': scheduler.LeastUsedWeigher,
+}
+
+
+def _scheduler(pools, weigher):
+    rand = random.Random(pools)
+    return scheduler.PoolScheduler(
+        (storeage_pools.StoragePool(
+            name=f'pool-{i}', backend=memory.Memory(
+                capacity=rand.randint(1, 1024) * fixtures.GiB))
+         for i in range(pools)),
+        weighers=[WEIGHERS[weigher]()])
+
+
+@harness.benchmark(pools=(100, 1000, 10_000), weigher=tuple(WEIGHERS),
+                   slow={'pools': (10_000,)})
+def place(run, pools, weigher):
+    sched = _scheduler(pools, weigher)
+    request = scheduler.PlacementRequest('vol', fixtures.MiB)
+    run(lambda: sched.place(request))
+
+
+@harness.benchmark(pools=(100, 1000))
+def place_volumes(run, pools):
+    """Place a batch of 100 volumes."""
+    sched = _scheduler(pools, 'spread')
+    requests = [scheduler.PlacementRequest(f'vol-{i}', fixtures.MiB)
+                for i in range(100)]
+    run(lambda: sched.place_volumes(requests),
+        repeat=max(1, run.repeat // 10), batch=len(requests))
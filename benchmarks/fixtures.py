@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: Apache-2.0
+"""
+Backends and pools for the benchmarks.
+"""
+
+import contextlib
+import itertools
+import shutil
+import tempfile
+import typing as ty
+
+from os_vol.backends import dedup
+from os_vol.backends import flat_file
+from os_vol.backends import memory
+from os_vol.objects import storeage_pools
+
+BACKENDS = ('memory', 'dedup', 'flat_file')
+
+KiB = 1024
+MiB = 1024 * KiB
+GiB = 1024 * MiB
+
+_names = itertools.count()
+
+
+def name(prefix: str = 'vol') -> str:
+    """Return a volume name that is unique within the run."""
+    return f'{prefix}-{next(_names)}'
+
+
+@contextlib.contextmanager
+def backend(kind: str, path: ty.Optional[str] = None) -> ty.Iterator[ty.Any]:
+    """Yield a fresh backend, flat_file backends live in a temp dir."""
+    if kind == 'memory':
+        yield memory.Memory(capacity=1024 * GiB)
+        return
+    if kind == 'dedup':
+        yield dedup.Dedup(capacity=1024 * GiB)
+        return
+    tempdir = None
+    if path is None:
+        path = tempdir = tempfile.mkdtemp(prefix='os-vol-bench-')
+    backend = flat_file.FlatFile(path)
+    try:
+        yield backend
+    finally:
+        backend.close()
+        if tempdir:
+            shutil.rmtree(tempdir, ignore_errors=True)
+
+
+@contextlib.contextmanager
+def pool(kind: str, count: int, size: int = MiB
+         ) -> ty.Iterator[storeage_pools.StoragePool]:
+    """Yield a pool holding count volumes."""
+    with backend(kind) as b:
+        pool = storeage_pools.StoragePool(name='bench', backend=b)
+        for start in range(0, count, 1000):
+            pool.allocate_volumes(
+                (name(), size) for _ in range(min(1000, count - start)))
+        yield pool
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: Apache-2.0
+"""
+A small stdlib benchmark harness.
+
+Benchmarks are functions registered with the benchmark decorator. Each is
+called once per combination of its parameters with a Runner, which times
+the operation passed to it and records one latency sample per call. The
+results of a run are written as JSON and can be compared with a baseline
+to fail a build on regressions.
+"""
+
+import dataclasses
+import datetime
+import itertools
+import math
+import platform
+import statistics
+import subprocess  # nosec B404
+import sys
+import time
+import typing as ty
+
+SCHEMA_VERSION = 1
+
+BENCHMARKS: ty.List['Benchmark'] = []
+
+
+@dataclasses.dataclass
+class Benchmark:
+    name: str
+    func: ty.Callable[..., None]
+    params: ty.Dict[str, ty.Sequence[ty.Any]]
+    # parameter values only used in full runs, never with --quick
+    slow: ty.Dict[str, ty.Sequence[ty.Any]]
+
+    def cases(self, quick: bool) -> ty.Iterator[ty.Dict[str, ty.Any]]:
+        names = list(self.params)
+        values = [
+            [v for v in self.params[n]
+             if not (quick and v in self.slow.get(n, ()))]
+            for n in names]
+        for combination in itertools.product(*values):
+            yield dict(zip(names, combination))
+
+
+def benchmark(name: ty.Optional[str] = None,
+              slow: ty.Optional[ty.Dict[str, ty.Sequence]] = None,
+              **params: ty.Sequence[ty.Any]) -> ty.Callable:
+    """Register a benchmark run for every combination of params."""
+    def decorator(func: ty.Callable) -> ty.Callable:
+        BENCHMARKS.append(Benchmark(
+            name or f'{func.__module__.rsplit(".", 1)[-1]}.{func.__name__}',
+            func, params, slow or {}))
+        return func
+    return decorator
+
+
+@dataclasses.dataclass
+class Result:
+    name: str
+    params: ty.Dict[str, ty.Any]
+    samples: ty.List[float] = dataclasses.field(repr=False)
+
+    @property
+    def key(self) -> str:
+        params = ','.join(f'{k}={v}' for k, v in self.params.items())
+        return f'{self.name}[{params}]' if params else self.name
+
+    def to_dict(self) -> ty.Dict[str, ty.Any]:
+        samples = sorted(self.samples)
+        mean = statistics.fmean(samples)
+        return {
+            'name': self.name,
+            'params': self.params,
+            'key': self.key,
+            'samples': len(samples),
+            'min': samples[0],
+            'max': samples[-1],
+            'mean': mean,
+            'median': statistics.median(samples),
+            'p95': samples[min(len(samples) - 1,
+                               math.ceil(len(samples) * 0.95) - 1)],
+            'stdev': statistics.stdev(samples) if len(samples) > 1 else 0.0,
+            'ops_per_sec': 1 / mean if mean else None,
+        }
+
+
+class Runner:
+    """
+    Runner times an operation and collects its latency samples.
+    """
+
+    def __init__(self, repeat: int):
+        self.repeat = repeat
+        self.samples: ty.List[float] = []
+
+    def __call__(self, op: ty.Callable, setup: ty.Optional[ty.Callable] = None,
+                 repeat: ty.Optional[int] = None, batch: int = 1) -> None:
+        """Time op repeat times.
+
+        If setup is given it is called untimed before every call and its
+        result passed to op. batch is the number of items op processes per
+        call, the recorded sample is the time per item.
+        """
+        clock = time.perf_counter
+        for _ in range(repeat or self.repeat):
+            arg = setup() if setup else None
+            start = clock()
+            if setup:
+                op(arg)
+            else:
+                op()
+            self.samples.append((clock() - start) / batch)
+
+
+def _commit() -> ty.Optional[str]:
+    try:
+        out = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+            check=True, timeout=5)  # nosec
+    except (OSError, subprocess.SubprocessError):
+        return None
+    return out.stdout.strip()
+
+
+def run(pattern: str = '', quick: bool = False, repeat: int = 100,
+        log: ty.Optional[ty.TextIO] = sys.stderr) -> ty.Dict[str, ty.Any]:
+    """Run every registered benchmark whose name contains pattern."""
+    results = []
+    for bench in BENCHMARKS:
+        if pattern not in bench.name:
+            continue
+        for params in bench.cases(quick):
+            runner = Runner(repeat)
+            bench.func(runner, **params)
+            result = Result(bench.name, params, runner.samples).to_dict()
+            results.append(result)
+            if log:
+                log.write(
+                    f'{result["key"]:<60} '
+                    f'median {result["median"] * 1e6:10.1f} us  '
+                    f'p95 {result["p95"] * 1e6:10.1f} us\n')
+    return {
+        'version': SCHEMA_VERSION,
+        'timestamp': datetime.datetime.now(
+            datetime.timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'commit': _commit(),
+        'quick': quick,
+        'results': results,
+    }
+
+
+def compare(baseline: ty.Dict[str, ty.Any], current: ty.Dict[str, ty.Any],
+            max_regression: float) -> ty.List[ty.Dict[str, ty.Any]]:
+    """Return the results whose median regressed more than max_regression.
+
+    max_regression is a fraction, 0.25 fails a benchmark that got more than
+    25% slower. Benchmarks missing from either run are ignored.
+    """
+    before = {r['key']: r for r in baseline['results']}
+    regressions = []
+    for result in current['results']:
+        old = before.get(result['key'])
+        if not old or not old['median']:
+            continue
+        change = result['median'] / old['median'] - 1
+        if change > max_regression:
+            regressions.append({
+                'key': result['key'], 'baseline': old['median'],
+                'current': result['median'], 'change': change})
+    return regressions
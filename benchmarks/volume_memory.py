@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: Apache-2.0
+"""
+Compare the memory used to track volumes with the old and new layouts.
+
+The legacy layout is the Volume dataclass with a per instance __dict__
+and uuid.UUID ids, kept in a dict like the old StoragePool allocations.
+The slotted layout is the current Volume in the same dict, and the index
+layout is a VolumeIndex with just the ids and sizes as columns.
+
+Usage: python benchmarks/volume_memory.py [COUNT ...]
+"""
+
+import dataclasses
+import gc
+import sys
+import tracemalloc
+import typing as ty
+import uuid
+
+from os_vol.objects import index
+from os_vol.objects import volume
+
+DEFAULT_COUNTS = (10_000, 100_000, 1_000_000)
+
+
+@dataclasses.dataclass
+class LegacyVolume:
+    path: str
+    name: ty.Optional[str] = None
+    volume_id: uuid.UUID = dataclasses.field(default_factory=uuid.uuid4)
+    size: int = 0
+    volume_type: str = 'base'
+    pool_ref: ty.Any = None
+    backend: ty.Any = None
+    device_path: ty.Optional[str] = None
+    clone_strategy: ty.Optional[str] = None
+    parent_id: ty.Optional[uuid.UUID] = None
+
+
+# ids are passed in as ints and converted inside each layout, so every
+# layout pays for the id objects it keeps like a real pool would.
+
+def _legacy(ids: ty.List[int]) -> ty.Any:
+    allocations = {}
+    for n, raw in enumerate(ids):
+        vol = LegacyVolume(path=f'/vols/vol-{raw:032x}', name=f'vol-{n}',
+                           volume_id=uuid.UUID(int=raw), size=n)
+        allocations[vol.volume_id] = vol
+    return allocations
+
+
+def _slotted(ids: ty.List[int]) -> ty.Any:
+    allocations = {}
+    for n, raw in enumerate(ids):
+        vol = volume.Volume(path=f'/vols/vol-{raw:032x}', name=f'vol-{n}',
+                            volume_id=uuid.UUID(int=raw), size=n)
+        allocations[vol.volume_id] = vol
+    return allocations
+
+
+def _index(ids: ty.List[int]) -> ty.Any:
+    vol_index = index.VolumeIndex()
+    for n, raw in enumerate(ids):
+        vol_index.add(uuid.UUID(int=raw), n)
+    return vol_index
+
+
+LAYOUTS = (('legacy', _legacy), ('slotted', _slotted), ('index', _index))
+
+
+def measure(build: ty.Callable, count: int) -> int:
+    """Return the bytes allocated by build for count volumes."""
+    ids = [uuid.uuid4().int for _ in range(count)]
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        result = build(ids)
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    del result
+    return after - before
+
+
+def main(argv: ty.List[str]) -> None:
+    counts = [int(arg) for arg in argv] or DEFAULT_COUNTS
+    print(f'{"volumes":>10} ' + ' '.join(
+        f'{name + " MiB":>12} {"B/vol":>7}' for name, _ in LAYOUTS))
+    for count in counts:
+        row = []
+        for _, build in LAYOUTS:
+            used = measure(build, count)
+            row.append(f'{used / 2 ** 20:12.1f} {used / count:7.0f}')
+        print(f'{count:>10} ' + ' '.join(row))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sqlite3
+from unittest import mock
+
+import fixtures
+
+from os_vol.backends import catalog
+from os_vol_tests import base_test
+
+
+def _record(volume_id, size=1024, **kwargs):
+    record = {
+        'volume_id': volume_id,
+        'name': f'vol-{volume_id}',
+        'size': size,
+        'volume_type': 'base',
+        'path': f'/tmp/vol-{volume_id}',
+        'device_path': None,
+        'clone_strategy': None,
+        'parent_id': None,
+        'provisioning': None,
+    }
+    record.update(kwargs)
+    return record
+
+
+class TestCatalog(base_test.OSVTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tempdir = self.useFixture(fixtures.TempDir())
+        self.path = os.path.join(self.tempdir.path, 'volumes.db')
+        self.catalog = catalog.Catalog(self.path)
+        self.addCleanup(self.catalog.close)
+
+    def test_wal_mode(self):
+        mode = self.catalog._conn.execute('PRAGMA journal_mode').fetchone()
+        self.assertEqual('wal', mode[0])
+
+    def test_put_get(self):
+        self.catalog.put(_record('a'))
+        self.assertEqual(_record('a'), self.catalog.get('a'))
+        self.assertEqual(_record('a'), self.catalog.get_by_name('vol-a'))
+        self.assertIn('a', self.catalog)
+        self.assertIsNone(self.catalog.get('b'))
+
+    def test_aggregates(self):
+        self.catalog.put_many([_record('a'), _record('b', size=2048)])
+        self.assertEqual(2, len(self.catalog))
+        self.assertEqual(3072, self.catalog.provisioned_bytes)
+        self.catalog.put(_record('a', size=4096))
+        self.assertEqual(2, len(self.catalog))
+        self.assertEqual(6144, self.catalog.provisioned_bytes)
+        self.catalog.delete('b')
+        self.assertEqual(1, len(self.catalog))
+        self.assertEqual(4096, self.catalog.provisioned_bytes)
+
+    def test_has_children(self):
+        self.catalog.put_many([_record('a'), _record('b', parent_id='a')])
+        self.assertTrue(self.catalog.has_children('a'))
+        self.assertFalse(self.catalog.has_children('b'))
+
+    def test_transaction_rollback(self):
+        self.catalog.put(_record('a'))
+
+        def _fail():
+            with self.catalog.transaction():
+                self.catalog.put(_record('b'))
+                self.catalog.delete('a')
+                raise RuntimeError()
+
+        self.assertRaises(RuntimeError, _fail)
+        self.assertEqual(['a'], [r['volume_id'] for r in self.catalog])
+        self.assertEqual(1, len(self.catalog))
+
+    def test_reopen(self):
+        self.catalog.put(_record('a'))
+        self.catalog.close()
+        self.catalog = catalog.Catalog(self.path)
+        self.assertEqual(_record('a'), self.catalog.get('a'))
+        self.assertEqual(1024, self.catalog.provisioned_bytes)
+
+    def test_page(self):
+        self.catalog.put_many(_record(c) for c in 'dbca')
+        page = self.catalog.page(2)
+        self.assertEqual(['a', 'b'], [r['volume_id'] for r in page])
+        page = self.catalog.page(2, marker='b')
+        self.assertEqual(['c', 'd'], [r['volume_id'] for r in page])
+        self.assertEqual([], self.catalog.page(2, marker='d'))
+        self.assertEqual(4, len(self.catalog.page()))
+
+    def test_iter_pages(self):
+        self.catalog.put_many(_record(str(i)) for i in range(5))
+        with mock.patch.object(catalog, 'PAGE_SIZE', 2):
+            self.assertEqual(
+                [str(i) for i in range(5)],
+                [r['volume_id'] for r in self.catalog])
+
+    def test_migrate(self):
+        self.catalog.close()
+        os.remove(self.path)
+        conn = sqlite3.connect(self.path)
+        conn.execute(
+            'CREATE TABLE volumes (volume_id TEXT PRIMARY KEY NOT NULL, '
+            'name TEXT, size INTEGER NOT NULL, volume_type TEXT, '
+            'path TEXT NOT NULL, device_path TEXT, clone_strategy TEXT, '
+            'parent_id TEXT)')
+        conn.execute(
+            "INSERT INTO volumes VALUES "
+            "('a', 'vol-a', 1024, 'base', '/tmp/vol-a', NULL, NULL, NULL)")
+        conn.commit()
+        conn.close()
+        self.catalog = catalog.Catalog(self.path)
+        self.assertEqual(_record('a'), self.catalog.get('a'))
+        self.catalog.put(_record('a', provisioning='zeroed'))
+        self.assertEqual('zeroed', self.catalog.get('a')['provisioning'])
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+from unittest import mock
+
+import fixtures
+
+from os_vol.backends import cbt
+from os_vol.backends import handle
+from os_vol.backends import memory
+from os_vol_tests import base_test
+
+BLOCK = cbt.BLOCK_SIZE
+
+
+class TestDirtyBitmap(base_test.OSVTestCase):
+    def test_mark(self):
+        bitmap = cbt.DirtyBitmap()
+        self.assertFalse(bitmap)
+        bitmap.mark(BLOCK - 1, 2)
+        bitmap.mark(10 * BLOCK, 0)
+        self.assertEqual([0, 1], list(bitmap))
+        self.assertIn(1, bitmap)
+        self.assertNotIn(2, bitmap)
+
+    def test_mark_range(self):
+        for first, end in [(0, 8), (3, 5), (5, 30), (7, 9), (0, 1000)]:
+            bitmap = cbt.DirtyBitmap()
+            bitmap.mark(first * BLOCK, (end - first) * BLOCK)
+            self.assertEqual(list(range(first, end)), list(bitmap))
+            self.assertEqual(end - first, len(bitmap))
+
+    def test_update(self):
+        bitmap = cbt.DirtyBitmap()
+        bitmap.mark(0, BLOCK)
+        other = cbt.DirtyBitmap()
+        other.mark(20 * BLOCK, BLOCK)
+        bitmap.update(other)
+        self.assertEqual([0, 20], list(bitmap))
+
+    def test_extents(self):
+        bitmap = cbt.DirtyBitmap()
+        bitmap.mark(0, 2 * BLOCK)
+        bitmap.mark(5 * BLOCK, 3 * BLOCK)
+        self.assertEqual(
+            [(0, 2 * BLOCK), (5 * BLOCK, 2 * BLOCK + 10)],
+            list(bitmap.extents(7 * BLOCK + 10)))
+        self.assertEqual([(0, 100)], list(bitmap.extents(100)))
+
+
+class TestChangeTracker(base_test.OSVTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tempdir = self.useFixture(fixtures.TempDir())
+        self.path = os.path.join(self.tempdir.path, 'vol.cbt')
+
+    def test_untracked_until_checkpoint(self):
+        tracker = cbt.ChangeTracker(self.path)
+        tracker.mark(0, BLOCK)
+        self.assertFalse(tracker.active)
+        self.assertFalse(os.path.exists(self.path))
+        tracker.add_checkpoint('a')
+        self.assertRaises(ValueError, tracker.add_checkpoint, 'a')
+        self.assertFalse(tracker.changed_since('a'))
+
+    def test_changed_since(self):
+        tracker = cbt.ChangeTracker()
+        tracker.add_checkpoint('a')
+        tracker.mark(0, BLOCK)
+        changed = tracker.changed_since('a', checkpoint='b')
+        self.assertEqual([0], list(changed))
+        tracker.mark(3 * BLOCK, BLOCK)
+        self.assertEqual([0, 3], list(tracker.changed_since('a')))
+        self.assertEqual([3], list(tracker.changed_since('b')))
+        self.assertEqual(['a', 'b'], tracker.names())
+        self.assertRaises(ValueError, tracker.changed_since, 'c')
+
+    def test_remove_checkpoint_keeps_changes(self):
+        tracker = cbt.ChangeTracker()
+        for name in 'abc':
+            tracker.add_checkpoint(name)
+            tracker.mark(ord(name) * BLOCK, 1)
+        tracker.remove_checkpoint('b')
+        self.assertEqual(['a', 'c'], tracker.names())
+        self.assertEqual([ord('a'), ord('b'), ord('c')],
+                         list(tracker.changed_since('a')))
+        self.assertEqual([ord('c')], list(tracker.changed_since('c')))
+        self.assertRaises(ValueError, tracker.remove_checkpoint, 'b')
+
+    def test_save_and_load(self):
+        tracker = cbt.ChangeTracker(self.path)
+        tracker.add_checkpoint('a')
+        tracker.mark(BLOCK, 1)
+        tracker.flush()
+        loaded = cbt.ChangeTracker.load(self.path, 4 * BLOCK)
+        self.assertEqual(['a'], loaded.names())
+        self.assertEqual([1], list(loaded.changed_since('a')))
+        self.assertEqual([], cbt.ChangeTracker.load(
+            self.path + '.missing', BLOCK).names())
+
+    def test_unclean_load_marks_everything(self):
+        tracker = cbt.ChangeTracker(self.path)
+        tracker.add_checkpoint('a')
+        tracker.mark(BLOCK, 1)
+        # the tracker was persisted as unclean before the write
+        with open(self.path) as f:
+            self.assertFalse(json.load(f)['clean'])
+        loaded = cbt.ChangeTracker.load(self.path, 3 * BLOCK)
+        self.assertEqual([0, 1, 2], list(loaded.changed_since('a')))
+
+    def test_delete(self):
+        tracker = cbt.ChangeTracker(self.path)
+        tracker.add_checkpoint('a')
+        tracker.delete()
+        self.assertFalse(tracker.active)
+        self.assertFalse(os.path.exists(self.path))
+
+
+class TestTracked(base_test.OSVTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tracker = cbt.ChangeTracker()
+        self.tracker.add_checkpoint('a')
+        self.store = memory.PageStore(8 * BLOCK)
+
+    def test_tracked_file(self):
+        with cbt.TrackedFile(
+                memory.MemoryFile(self.store), self.tracker) as f:
+            f.seek(2 * BLOCK)
+            f.write(b'x' * BLOCK)
+            f.seek(0)
+            self.assertEqual(bytes(BLOCK), f.read(BLOCK))
+            f.truncate(6 * BLOCK + 1)
+            self.assertEqual(BLOCK, f.tell())
+        self.assertEqual([2, 6, 7], list(self.tracker.changed_since('a')))
+
+    def test_tracked_handle(self):
+        with cbt.TrackedHandle(
+                memory.MemoryHandle(self.store), self.tracker) as h:
+            self.assertIsNone(h.fileno())
+            h.pwrite(b'x', 0)
+            h.write_zeroes(3 * BLOCK, BLOCK)
+            with h.map(5 * BLOCK, 10) as view:
+                view[:1] = b'y'
+            self.assertEqual(b'x', h.pread(1, 0))
+        self.assertEqual(b'y', self.store.read(5 * BLOCK, 1))
+        self.assertEqual([0, 3, 5], list(self.tracker.changed_since('a')))
+
+    def test_checkpoint_during_write(self):
+        inner = memory.MemoryHandle(self.store)
+
+        def pwrite(data, offset):
+            # the checkpoint is created while the write is in flight
+            self.tracker.add_checkpoint('b')
+            return len(data)
+
+        with mock.patch.object(inner, 'pwrite', side_effect=pwrite):
+            cbt.TrackedHandle(inner, self.tracker).pwrite(b'x', BLOCK)
+        self.assertEqual([1], list(self.tracker.changed_since('b')))
+
+    def test_copy_from(self):
+        tempdir = self.useFixture(fixtures.TempDir())
+        src, dst = (os.path.join(tempdir.path, name) for name in 'ab')
+        with open(src, 'wb') as f:
+            f.write(b'x' * 4 * BLOCK)
+        open(dst, 'wb').close()
+        src_fd = os.open(src, os.O_RDONLY)
+        self.addCleanup(os.close, src_fd)
+        with cbt.TrackedHandle(
+                handle.FileHandle(dst, 4 * BLOCK), self.tracker) as h:
+            self.assertIsNone(h.fileno())
+            self.assertIsNotNone(h.read_fileno())
+            self.assertEqual(BLOCK, h.copy_from(src_fd, BLOCK, BLOCK))
+        self.assertEqual([1], list(self.tracker.changed_since('a')))
+
+    def test_opened_before_checkpoint(self):
+        tracker = cbt.ChangeTracker()
+        with cbt.TrackedHandle(memory.MemoryHandle(self.store), tracker) as h:
+            h.pwrite(b'x', 0)
+            tracker.add_checkpoint('a')
+            h.pwrite(b'x', BLOCK)
+        self.assertEqual([1], list(tracker.changed_since('a')))
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+from os_vol.backends import dedup
+from os_vol.backends import memory
+from os_vol_tests import base_test
+
+BLOCK = dedup.BLOCK_SIZE
+
+
+class TestChunkStore(base_test.OSVTestCase):
+    def setUp(self):
+        super().setUp()
+        self.store = dedup.ChunkStore()
+
+    def test_put_dedups(self):
+        a = self.store.put(b'a' * 10)
+        self.assertEqual(a, self.store.put(b'a' * 10))
+        self.assertEqual(1, len(self.store))
+        self.assertEqual(2, self.store.refs(a))
+        self.assertEqual(10, self.store.stored_bytes)
+        self.assertEqual(20, self.store.referenced_bytes)
+
+    def test_collect(self):
+        a = self.store.put(b'a' * 10)
+        b = self.store.put(b'b' * 20)
+        self.store.decref([a])
+        self.assertEqual(10, self.store.garbage_bytes)
+        self.assertEqual((1, 10), self.store.collect())
+        self.assertNotIn(a, self.store)
+        self.assertIn(b, self.store)
+        self.assertEqual(20, self.store.stored_bytes)
+        self.assertEqual((0, 0), self.store.collect())
+
+    def test_put_resurrects_garbage(self):
+        a = self.store.put(b'a')
+        self.store.decref([a])
+        self.assertEqual(a, self.store.put(b'a'))
+        self.assertEqual(0, self.store.garbage_bytes)
+        self.assertEqual((0, 0), self.store.collect())
+        self.assertEqual(b'a', self.store.get(a))
+
+
+class TestBlockMap(base_test.OSVTestCase):
+    def setUp(self):
+        super().setUp()
+        self.chunks = dedup.ChunkStore()
+        self.store = dedup.BlockMap(self.chunks, 4 * BLOCK)
+
+    def test_read_holes(self):
+        self.assertEqual(bytes(100), self.store.read(BLOCK - 50, 100))
+        self.assertEqual(0, len(self.chunks))
+
+    def test_partial_write(self):
+        self.store.write(BLOCK - 2, b'abcd')
+        self.assertEqual(b'\0abcd\0', self.store.read(BLOCK - 3, 6))
+        self.assertEqual([0, 1], sorted(self.store.blocks))
+        self.assertEqual(
+            [(0, 2 * BLOCK)], list(self.store.extents()))
+
+    def test_identical_blocks_stored_once(self):
+        self.store.write(0, b'x' * 3 * BLOCK)
+        self.assertEqual(1, len(self.chunks))
+        self.assertEqual(3 * BLOCK, self.chunks.referenced_bytes)
+
+    def test_overwrite_releases_chunk(self):
+        self.store.write(0, b'x' * BLOCK)
+        old = self.store.blocks[0]
+        self.store.write(0, b'y' * BLOCK)
+        self.assertEqual(0, self.chunks.refs(old))
+        self.store.write(0, bytes(BLOCK))
+        self.assertEqual({}, self.store.blocks)
+        self.assertEqual(2 * BLOCK, self.chunks.garbage_bytes)
+
+    def test_handle_map(self):
+        self.store.write(0, b'x' * BLOCK)
+        old = self.store.blocks[0]
+        with memory.MemoryHandle(self.store) as h:
+            with h.map(BLOCK - 2, 4) as view:
+                view[2:] = b'yz'
+        # the unchanged block keeps its chunk, the hole stays a hole
+        self.assertEqual(old, self.store.blocks[0])
+        self.assertEqual(b'xxyz', self.store.read(BLOCK - 2, 4))
+        self.assertEqual([0, 1], sorted(self.store.blocks))
+        with memory.MemoryHandle(self.store) as h:
+            with h.map(2 * BLOCK, BLOCK):
+                pass
+        self.assertNotIn(2, self.store.blocks)
+
+    def test_read_during_collect(self):
+        self.store.write(0, b'x' * BLOCK)
+        get = self.chunks.get
+
+        def rewritten(digest):
+            # the block is rewritten and its old chunk collected between
+            # the digest lookup and the chunk fetch
+            self.chunks.get = get
+            self.store.write(0, b'y' * BLOCK)
+            self.chunks.collect()
+            return get(digest)
+
+        self.chunks.get = rewritten
+        self.assertEqual(b'y' * 4, self.store.read(0, 4))
+
+    def test_truncate_zeroes_tail(self):
+        self.store.write(0, b'x' * 2 * BLOCK)
+        self.store.truncate(10)
+        self.store.grow(BLOCK)
+        self.assertEqual(b'x' * 10 + bytes(BLOCK),
+                         self.store.read(0, BLOCK + 10))
+        self.assertEqual([0], list(self.store.blocks))
+
+    def test_discard(self):
+        self.store.write(0, b'x' * 2 * BLOCK)
+        self.store.discard(10, 2 * BLOCK)
+        self.assertEqual([0], list(self.store.blocks))
+        self.assertEqual(b'x' * 10 + bytes(10), self.store.read(0, 20))
+
+    def test_clone_and_release(self):
+        self.store.write(0, b'x' * BLOCK)
+        clone = self.store.clone()
+        self.assertEqual(2, self.chunks.refs(self.store.blocks[0]))
+        clone.write(0, b'y')
+        self.assertEqual(b'x', self.store.read(0, 1))
+        clone.release()
+        self.store.release()
+        self.assertEqual(self.chunks.stored_bytes, self.chunks.garbage_bytes)
+
+
+class TestDedupBackend(base_test.OSVTestCase):
+    def setUp(self):
+        super().setUp()
+        self.backend = dedup.Dedup()
+
+    def _write(self, vol, data, offset=0):
+        with self.backend.open_volume(vol) as f:
+            f.seek(offset)
+            f.write(data)
+
+    def test_create_and_delete(self):
+        vol = self.backend.create_volume(BLOCK, 'test', 'zeroed')
+        self.assertEqual('zeroed', vol.provisioning)
+        self.assertTrue(vol.path.startswith('dedup://vol-'))
+        self._write(vol, b'x' * BLOCK)
+        self.backend.delete_volume(vol)
+        self.assertNotIn(vol.volume_id, self.backend.volumes)
+        self.assertEqual(BLOCK, self.backend.chunks.garbage_bytes)
+        self.assertEqual(BLOCK, self.backend.collect_garbage())
+        self.assertEqual(0, self.backend.get_allocated())
+
+    def test_delete_collects_past_threshold(self):
+        self.backend.GC_THRESHOLD = BLOCK
+        vol = self.backend.create_volume(2 * BLOCK, 'test')
+        self._write(vol, b'x' * BLOCK + b'y' * BLOCK)
+        self.backend.delete_volume(vol)
+        self.assertEqual(0, len(self.backend.chunks))
+
+    def test_clone_is_metadata_only(self):
+        vol = self.backend.create_volume(4 * BLOCK, 'test')
+        self._write(vol, b'x' * 2 * BLOCK)
+        clone = self.backend.clone_volume(vol, 'clone')
+        self.assertEqual(dedup.CLONE_DEDUP, clone.clone_strategy)
+        self.assertEqual(BLOCK, self.backend.get_allocated())
+        self.assertEqual(2 * BLOCK, self.backend.get_volume_allocated(clone))
+        handle = self.backend.open_handle(clone)
+        handle.pwrite(b'y', 0)
+        self.assertEqual(b'y', handle.pread(1, 0))
+        self.assertEqual(b'x', self.backend.open_handle(vol).pread(1, 0))
+
+    def test_grow_and_discard(self):
+        vol = self.backend.create_volume(BLOCK, 'test')
+        self.backend.grow_volume(vol, BLOCK)
+        self.assertEqual(2 * BLOCK, vol.size)
+        self._write(vol, b'x' * 2 * BLOCK)
+        self.backend.discard_volume(vol, BLOCK)
+        self.assertEqual(BLOCK, self.backend.get_volume_allocated(vol))
+
+    def test_dedup_report(self):
+        vols = [self.backend.create_volume(4 * BLOCK, f'v{i}')
+                for i in range(2)]
+        for vol in vols:
+            self._write(vol, b'x' * 2 * BLOCK + b'y' * BLOCK)
+        report = self.backend.dedup_report()
+        self.assertEqual(2, report.volumes)
+        self.assertEqual(2, report.chunks)
+        self.assertEqual(8 * BLOCK, report.provisioned_bytes)
+        self.assertEqual(6 * BLOCK, report.logical_bytes)
+        self.assertEqual(2 * BLOCK, report.stored_bytes)
+        self.assertEqual(3.0, report.ratio)
+        self.assertEqual(1.0, dedup.Dedup().dedup_report().ratio)
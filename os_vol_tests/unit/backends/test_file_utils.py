@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+import os
+from unittest import mock
+
+import fixtures
+
+from os_vol.backends import file_utils
+from os_vol_tests import base_test
+
+MiB = 1024 * 1024
+
+
+class TestFileUtils(base_test.OSVTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tempdir = self.useFixture(fixtures.TempDir())
+        self.src = os.path.join(self.tempdir.path, 'src')
+        self.dst = os.path.join(self.tempdir.path, 'dst')
+        with open(self.src, 'wb') as f:
+            f.truncate(8 * MiB)
+            f.seek(4 * MiB)
+            f.write(b'x' * 4096)
+
+    def _read(self, path, offset, size):
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            return f.read(size)
+
+    def test_iter_extents(self):
+        fd = os.open(self.src, os.O_RDONLY)
+        self.addCleanup(os.close, fd)
+        extents = list(file_utils.iter_extents(fd, 8 * MiB))
+        self.assertEqual(4096, sum(length for _, length in extents))
+        offset, length = extents[0]
+        self.assertLessEqual(offset, 4 * MiB)
+        self.assertGreaterEqual(offset + length, 4 * MiB + 4096)
+
+    def test_iter_extents_empty_file(self):
+        with open(self.dst, 'wb') as f:
+            f.truncate(MiB)
+        fd = os.open(self.dst, os.O_RDONLY)
+        self.addCleanup(os.close, fd)
+        self.assertEqual([], list(file_utils.iter_extents(fd, MiB)))
+
+    def test_sparse_copy_preserves_holes(self):
+        with mock.patch.object(file_utils, 'reflink', return_value=False):
+            strategy = file_utils.clone_file(self.src, self.dst)
+        self.assertEqual(file_utils.CLONE_SPARSE, strategy)
+        self.assertEqual(8 * MiB, os.path.getsize(self.dst))
+        self.assertEqual(b'x' * 4096, self._read(self.dst, 4 * MiB, 4096))
+        self.assertEqual(b'\0' * 4096, self._read(self.dst, 0, 4096))
+        # only the written extent should be allocated in the destination
+        self.assertLess(os.stat(self.dst).st_blocks * 512, MiB)
+
+    def test_copy_range_without_copy_file_range(self):
+        with open(self.dst, 'wb') as f:
+            f.truncate(8 * MiB)
+        src_fd = os.open(self.src, os.O_RDONLY)
+        self.addCleanup(os.close, src_fd)
+        dst_fd = os.open(self.dst, os.O_WRONLY)
+        self.addCleanup(os.close, dst_fd)
+        with mock.patch.object(
+                file_utils.os, 'copy_file_range',
+                side_effect=OSError(file_utils.errno.EXDEV, 'xdev')):
+            copied = file_utils.copy_range(src_fd, dst_fd, 4 * MiB, 4096)
+        self.assertEqual(4096, copied)
+        self.assertEqual(b'x' * 4096, self._read(self.dst, 4 * MiB, 4096))
+
+    def test_clone_file_removes_destination_on_error(self):
+        with mock.patch.object(file_utils, 'reflink', side_effect=OSError):
+            self.assertRaises(
+                OSError, file_utils.clone_file, self.src, self.dst)
+        self.assertFalse(os.path.exists(self.dst))
+
+    def test_clone_file_keeps_existing_destination(self):
+        with open(self.dst, 'wb') as f:
+            f.write(b'keep')
+        self.assertRaises(
+            FileExistsError, file_utils.clone_file, self.src, self.dst)
+        with open(self.dst, 'rb') as f:
+            self.assertEqual(b'keep', f.read())
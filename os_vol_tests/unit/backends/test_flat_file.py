@@ -1,10 +1,19 @@
 # -*- coding: utf-8 -*-
 
 import os
+import shelve
+import shutil
+from unittest import mock
+import uuid
 
 import fixtures
 
+from os_vol.backends import cbt
+from os_vol.backends import file_utils
 from os_vol.backends import flat_file
+from os_vol.backends import overlay
+from os_vol import cache
+from os_vol import copy_engine
 from os_vol_tests import base_test
 
 
@@ -13,6 +22,7 @@ class TestFlatFileBackend(base_test.OSVTestCase):
         super().setUp()
         self.tempdir = self.useFixture(fixtures.TempDir())
         self.backend = flat_file.FlatFile(self.tempdir.path)
+        self.addCleanup(self.backend.close)
 
     def test_create_volume(self):
         vol = self.backend.create_volume(1024, 'test')
@@ -21,6 +31,267 @@ class TestFlatFileBackend(base_test.OSVTestCase):
         self.assertTrue(os.path.exists(vol.path))
         self.assertEqual(os.path.getsize(vol.path), 1024)
 
+    def test_catalog_records(self):
+        vol = self.backend.create_volume(1024, 'test')
+        record = self.backend.catalog.get(str(vol.volume_id))
+        self.assertEqual(vol.to_dict(), record)
+        self.backend.grow_volume(vol, 1024)
+        self.assertEqual(2048, self.backend.used_space)
+        self.backend.delete_volume(vol)
+        self.assertIsNone(self.backend.catalog.get(str(vol.volume_id)))
+        self.assertEqual(0, self.backend.used_space)
+
+    def test_catalog_persists(self):
+        vol = self.backend.create_volume(1024, 'test')
+        backend = flat_file.FlatFile(self.tempdir.path)
+        self.addCleanup(backend.close)
+        self.assertEqual(
+            vol.to_dict(), backend.catalog.get_by_name('test'))
+        self.assertEqual(1024, backend.used_space)
+
+    def test_import_shelve(self):
+        vol = self.backend.create_volume(1024, 'test')
+        path = os.path.join(self.tempdir.path, 'legacy')
+        os.mkdir(path)
+        with shelve.open(f'{path}/{flat_file.FlatFile.SHELVE_FILE}') as db:
+            db[str(vol.volume_id)] = vol.volume_summary()
+        backend = flat_file.FlatFile(path)
+        self.addCleanup(backend.close)
+        self.assertEqual(vol.to_dict(), backend.catalog.get(
+            str(vol.volume_id)))
+
+    def test_recover_create(self):
+        kept = self.backend.create_volume(1024, 'kept')
+        orphan = os.path.join(self.tempdir.path, str(uuid.uuid4()))
+        open(orphan, 'wb').close()
+        # the process died before either catalog record was committed
+        self.backend.journal.begin(
+            flat_file.OP_CREATE,
+            volumes=[[str(kept.volume_id), kept.path],
+                     [str(uuid.uuid4()), orphan]])
+        self.backend.close()
+        backend = flat_file.FlatFile(self.tempdir.path)
+        self.addCleanup(backend.close)
+        self.assertEqual(1, backend.count_volumes())
+        self.assertFalse(os.path.exists(orphan))
+        self.assertTrue(os.path.exists(kept.path))
+        self.assertEqual([], backend.journal.pending())
+
+    def test_recover_delete(self):
+        vol = self.backend.create_volume(1024, 'test')
+        self.backend.journal.begin(
+            flat_file.OP_DELETE, volumes=[[str(vol.volume_id), vol.path]])
+        self.backend.close()
+        backend = flat_file.FlatFile(self.tempdir.path)
+        self.addCleanup(backend.close)
+        self.assertEqual(0, backend.count_volumes())
+        self.assertFalse(os.path.exists(vol.path))
+
+    def test_create_volume_rolled_back(self):
+        with mock.patch.object(
+                self.backend.catalog, 'put', side_effect=OSError):
+            self.assertRaises(
+                OSError, self.backend.create_volume, 1024, 'test')
+        self.assertEqual([], self.backend.journal.pending())
+        self.assertEqual(
+            sorted([self.backend.CATALOG_FILE, self.backend.JOURNAL_FILE]),
+            sorted(f for f in os.listdir(self.tempdir.path)
+                   if not f.startswith(self.backend.CATALOG_FILE + '-')))
+
+    def test_catalog_opened_lazily(self):
+        backend = flat_file.FlatFile(self.tempdir.path)
+        self.addCleanup(backend.close)
+        self.assertIsNone(backend._catalog)
+        self.assertFalse(os.path.exists(
+            os.path.join(self.tempdir.path, backend.CATALOG_FILE)))
+        self.assertEqual(0, backend.count_volumes())
+        self.assertIsNotNone(backend._catalog)
+        backend.close()
+        self.assertIsNone(backend._catalog)
+
+    def test_get_and_list_volumes(self):
+        vol = self.backend.create_volume(1024, 'a')
+        clone = self.backend.shallow_clone_volume(vol, 'b')
+        self.assertEqual(2, self.backend.count_volumes())
+        got = self.backend.get_volume(clone.volume_id)
+        self.assertEqual(clone.to_dict(), got.to_dict())
+        self.assertIs(self.backend, got.backend)
+        self.assertIsNone(self.backend.get_volume(uuid.uuid4()))
+        listed = self.backend.list_volumes()
+        self.assertEqual(
+            sorted(str(v.volume_id) for v in (vol, clone)),
+            [str(v.volume_id) for v in listed])
+        first, second = listed
+        self.assertEqual(
+            [second.to_dict()],
+            [v.to_dict() for v in self.backend.list_volumes(
+                limit=1, marker=first.volume_id)])
+
+    def test_get_capacity_is_cached(self):
+        usage = shutil.disk_usage(self.tempdir.path)
+        with mock.patch.object(
+                flat_file.shutil, 'disk_usage',
+                return_value=usage) as disk_usage:
+            self.assertEqual(usage.total, self.backend.get_capacity())
+            self.assertEqual(usage.total, self.backend.get_capacity())
+            self.assertEqual(1, disk_usage.call_count)
+            self.backend._disk_usage_time -= self.backend.CAPACITY_TTL
+            self.backend.get_capacity()
+            self.assertEqual(2, disk_usage.call_count)
+
+    def test_free_space(self):
+        self.backend.create_volume(1024, 'test')
+        self.assertEqual(
+            self.backend.get_capacity() - 1024, self.backend.free_space)
+
+    def test_get_allocated(self):
+        vol = self.backend.create_volume(16 * 1024 * 1024, 'test')
+        self.assertEqual(0, self.backend.get_volume_allocated(vol))
+        with open(vol.path, 'r+b') as f:
+            f.write(b'x' * 1024 * 1024)
+        self.assertGreaterEqual(
+            self.backend.get_volume_allocated(vol), 1024 * 1024)
+        self.assertLess(
+            self.backend.get_volume_allocated(vol), 16 * 1024 * 1024)
+        self.assertEqual(
+            self.backend.get_volume_allocated(vol),
+            self.backend.get_allocated())
+        # the scan is cached like the capacity
+        with open(vol.path, 'r+b') as f:
+            f.seek(8 * 1024 * 1024)
+            f.write(b'x' * 1024 * 1024)
+        self.assertLess(self.backend.get_allocated(),
+                        self.backend.get_volume_allocated(vol))
+
+    def test_provisioning(self):
+        size = 4 * 1024 * 1024
+        for mode in ('sparse', 'preallocated', 'zeroed'):
+            vol = self.backend.create_volume(size, mode, mode)
+            self.assertEqual(mode, vol.provisioning)
+            self.assertEqual(
+                mode, self.backend.catalog.get_by_name(mode)['provisioning'])
+            allocated = self.backend.get_volume_allocated(vol)
+            if mode == 'sparse':
+                self.assertEqual(0, allocated)
+            else:
+                self.assertGreaterEqual(allocated, size)
+            self.backend.grow_volume(vol, size)
+            allocated = self.backend.get_volume_allocated(vol)
+            if mode != 'sparse':
+                self.assertGreaterEqual(allocated, 2 * size)
+            with open(vol.path, 'rb') as f:
+                self.assertEqual(bytes(2 * size), f.read())
+        self.assertRaises(
+            ValueError, self.backend.create_volume, size, 'bad', 'thick')
+
+    def test_preallocate_unsupported(self):
+        with mock.patch.object(file_utils, 'preallocate',
+                               return_value=False), \
+                mock.patch.object(file_utils, 'zero_fill') as zero_fill:
+            self.backend.create_volume(1024, 'test', 'preallocated')
+        zero_fill.assert_called_once_with(mock.ANY, 0, 1024)
+
+    def test_clone_preallocated(self):
+        vol = self.backend.create_volume(1024 * 1024, 'test', 'zeroed')
+        clone = self.backend.clone_volume(vol, 'clone')
+        self.assertEqual('preallocated', clone.provisioning)
+        self.assertGreaterEqual(
+            self.backend.get_volume_allocated(clone), 1024 * 1024)
+
+    def test_clone_preallocated_unsupported(self):
+        vol = self.backend.create_volume(1024 * 1024, 'test', 'preallocated')
+        with open(vol.path, 'r+b') as f:
+            f.seek(4096)
+            f.write(b'data')
+        with mock.patch.object(file_utils, '_FALLOCATE', None):
+            clone = self.backend.clone_volume(vol, 'clone')
+        self.assertEqual('preallocated', clone.provisioning)
+        with open(clone.path, 'rb') as f:
+            self.assertEqual(
+                bytes(4096) + b'data' + bytes(1024 * 1024 - 4100), f.read())
+
+    def test_alignment(self):
+        self.backend.SIZE_ALIGNMENT = 4096
+        vol = self.backend.create_volume(1000, 'test')
+        self.assertEqual(4096, vol.size)
+        self.backend.grow_volume(vol, 1)
+        self.assertEqual(8192, vol.size)
+        self.assertEqual(8192, os.path.getsize(vol.path))
+
+    def test_discard_volume(self):
+        size = 4 * 1024 * 1024
+        vol = self.backend.create_volume(size, 'test', 'preallocated')
+        self.backend.discard_volume(vol, 1024 * 1024)
+        self.assertLess(self.backend.get_volume_allocated(vol), size)
+        self.assertEqual(size, os.path.getsize(vol.path))
+        self.assertEqual('sparse', vol.provisioning)
+        self.assertEqual(
+            'sparse', self.backend.catalog.get_by_name('test')['provisioning'])
+
+    def test_discard_parent(self):
+        vol = self.backend.create_volume(1024 * 1024, 'test')
+        self._write(vol, 0, b'base')
+        clone = self.backend.shallow_clone_volume(vol, 'clone')
+        self.assertRaises(ValueError, self.backend.discard_volume, vol)
+        self.assertEqual(b'base', self._read(clone, 0, 4))
+
+    def test_create_volumes(self):
+        results = self.backend.create_volumes(
+            [('a', 1024), ('b', 2048), ('a', 4096)])
+        self.assertEqual([True, True, False], [r.ok for r in results])
+        self.assertIsInstance(results[2].error, ValueError)
+        self.assertEqual(('b', 2048), results[1].item[:2])
+        for result in results[:2]:
+            self.assertTrue(os.path.exists(result.volume.path))
+            self.assertIn(str(result.volume.volume_id), self.backend.catalog)
+        self.assertEqual(3072, self.backend.used_space)
+
+    def test_create_volumes_catalog_failure(self):
+        with mock.patch.object(
+                self.backend.catalog, 'put_many', side_effect=OSError):
+            results = self.backend.create_volumes([('a', 1024)])
+        self.assertFalse(results[0].ok)
+        self.assertEqual(
+            sorted([self.backend.CATALOG_FILE, self.backend.JOURNAL_FILE]),
+            sorted(f for f in os.listdir(self.tempdir.path)
+                   if not f.startswith(self.backend.CATALOG_FILE + '-')))
+
+    def test_delete_volumes(self):
+        base = self.backend.create_volume(1024, 'base')
+        clone = self.backend.shallow_clone_volume(base, 'clone')
+        other = self.backend.create_volume(1024, 'other')
+        results = self.backend.delete_volumes([base, other])
+        self.assertEqual([False, True], [r.ok for r in results])
+        self.assertTrue(os.path.exists(base.path))
+        self.assertFalse(os.path.exists(other.path))
+        self.assertEqual(2, len(self.backend.catalog))
+        results = self.backend.delete_volumes([base, clone])
+        self.assertEqual([True, True], [r.ok for r in results])
+        self.assertEqual(0, len(self.backend.catalog))
+
+    def test_delete_volumes_clone_failure(self):
+        base = self.backend.create_volume(1024, 'base')
+        clone = self.backend.shallow_clone_volume(base, 'clone')
+        nested = self.backend.shallow_clone_volume(clone, 'nested')
+        remove_files = self.backend._remove_files
+
+        def _remove_files(volume):
+            if volume.volume_id == nested.volume_id:
+                raise OSError('eio')
+            remove_files(volume)
+
+        with mock.patch.object(self.backend, '_remove_files',
+                               side_effect=_remove_files):
+            results = self.backend.delete_volumes([base, clone, nested])
+        self.assertEqual([False, False, False], [r.ok for r in results])
+        self.assertIsInstance(results[0].error, ValueError)
+        self.assertIsInstance(results[2].error, OSError)
+        # the chain is left whole and readable
+        self.assertEqual(3, len(self.backend.catalog))
+        self.assertTrue(os.path.exists(base.path))
+        self.assertEqual(bytes(4), self._read(nested, 0, 4))
+        self.assertEqual([], self.backend.journal.pending())
+
     def test_delete_volume(self):
         vol = self.backend.create_volume(1024, 'test')
         self.assertTrue(os.path.exists(vol.path))
@@ -47,6 +318,175 @@ class TestFlatFileBackend(base_test.OSVTestCase):
         self.assertTrue(os.path.exists(clone.path))
         self.assertEqual(os.path.getsize(clone.path), 1024)
 
+    def test_clone_volume_copies_data(self):
+        vol = self.backend.create_volume(1024 * 1024, 'test')
+        with self.backend.open_volume(vol) as f:
+            f.seek(512 * 1024)
+            f.write(b'test')
+        clone = self.backend.clone_volume(vol, 'clone')
+        self.assertIn(clone.clone_strategy,
+                      (file_utils.CLONE_REFLINK, file_utils.CLONE_SPARSE))
+        with open(clone.path, 'rb') as f:
+            f.seek(512 * 1024)
+            self.assertEqual(f.read(4), b'test')
+        self.assertEqual(os.path.getsize(clone.path), 1024 * 1024)
+
+    def test_clone_volume_parallel_copy(self):
+        copier = copy_engine.CopyEngine(chunk_size=4096, concurrency=4)
+        backend = flat_file.FlatFile(self.tempdir.path, copier=copier)
+        self.addCleanup(backend.close)
+        vol = backend.create_volume(1024 * 1024, 'test')
+        data = os.urandom(64 * 1024)
+        with backend.open_volume(vol) as f:
+            f.seek(256 * 1024)
+            f.write(data)
+        with mock.patch.object(file_utils, 'reflink', return_value=False), \
+                mock.patch.object(copier, 'run', wraps=copier.run) as run:
+            clone = backend.clone_volume(vol, 'clone')
+        self.assertEqual(file_utils.CLONE_SPARSE, clone.clone_strategy)
+        run.assert_called_once()
+        with open(clone.path, 'rb') as f:
+            f.seek(256 * 1024)
+            self.assertEqual(data, f.read(len(data)))
+
+    def _write(self, vol, offset, data):
+        with self.backend.open_volume(vol) as f:
+            f.seek(offset)
+            f.write(data)
+
+    def _read(self, vol, offset, size):
+        with self.backend.open_volume(vol) as f:
+            f.seek(offset)
+            return f.read(size)
+
+    def test_shallow_clone_volume(self):
+        vol = self.backend.create_volume(1024 * 1024, 'base')
+        self._write(vol, 4096, b'base')
+        clone = self.backend.shallow_clone_volume(vol, 'clone')
+        self.assertEqual(vol.volume_id, clone.parent_id)
+        self.assertEqual(overlay.CLONE_OVERLAY, clone.clone_strategy)
+        self.assertEqual(1024 * 1024, clone.size)
+        # the overlay starts with no data of its own
+        self.assertEqual(0, os.stat(clone.path).st_blocks)
+        self.assertEqual(b'base', self._read(clone, 4096, 4))
+
+        self._write(clone, 4098, b'CE')
+        self.assertEqual(b'baCE', self._read(clone, 4096, 4))
+        self.assertEqual(b'base', self._read(vol, 4096, 4))
+
+    def test_shallow_clone_chain(self):
+        vol = self.backend.create_volume(1024 * 1024, 'base')
+        self._write(vol, 0, b'a')
+        mid = self.backend.shallow_clone_volume(vol, 'mid')
+        self._write(mid, 1, b'b')
+        top = self.backend.shallow_clone_volume(mid, 'top')
+        self._write(top, 2, b'c')
+        self.assertEqual(b'abc\0', self._read(top, 0, 4))
+        self.assertEqual(b'ab\0\0', self._read(mid, 0, 4))
+
+        full = self.backend.clone_volume(top, 'full')
+        self.assertIsNone(full.parent_id)
+        self.assertEqual(b'abc\0', self._read(full, 0, 4))
+
+    def test_flatten_volume(self):
+        vol = self.backend.create_volume(1024 * 1024, 'base')
+        self._write(vol, 512 * 1024, b'data')
+        clone = self.backend.shallow_clone_volume(vol, 'clone')
+        self.backend.flatten_volume(clone)
+        self.assertIsNone(clone.parent_id)
+        self.assertFalse(os.path.exists(overlay.map_path(clone.path)))
+        self.backend.delete_volume(vol)
+        self.assertEqual(b'data', self._read(clone, 512 * 1024, 4))
+
+    def test_shallow_clone_flattens_deep_chain(self):
+        self.backend.MAX_CHAIN_DEPTH = 2
+        vol = self.backend.create_volume(1024, 'base')
+        mid = self.backend.shallow_clone_volume(vol, 'mid')
+        top = self.backend.shallow_clone_volume(mid, 'top')
+        self.backend.shallow_clone_volume(top, 'deep')
+        self.assertIsNone(top.parent_id)
+
+    def test_shallow_clone_parent_read_only(self):
+        vol = self.backend.create_volume(1024 * 1024, 'base')
+        self._write(vol, 0, b'base')
+        clone = self.backend.shallow_clone_volume(vol, 'clone')
+        with self.backend.open_handle(vol) as h:
+            self.assertEqual(b'base', h.pread(4, 0))
+            self.assertRaises(OSError, h.pwrite, b'X', 0)
+            with h.map(0, 4) as view:
+                self.assertTrue(view.readonly)
+        with self.backend.open_volume(vol) as f:
+            self.assertRaises(OSError, f.write, b'X')
+        self.assertRaises(
+            ValueError, self.backend.grow_volume, vol, 1024)
+        with mock.patch.object(self.backend.loop, 'attach') as attach:
+            self.assertRaises(ValueError, self.backend.host_attach, vol)
+        attach.assert_not_called()
+        # a clone of a clone makes the middle layer read-only too
+        self.backend.shallow_clone_volume(clone, 'clone2')
+        with self.backend.open_handle(clone) as h:
+            self.assertRaises(OSError, h.pwrite, b'X', 0)
+        self.assertEqual(b'base', self._read(clone, 0, 4))
+        vol.device_path = '/dev/loop0'
+        self.assertRaises(
+            ValueError, self.backend.shallow_clone_volume, vol, 'clone3')
+
+    def test_clone_existing_name(self):
+        vol = self.backend.create_volume(1024 * 1024, 'base')
+        other = self.backend.create_volume(1024 * 1024, 'other')
+        self._write(vol, 0, b'base')
+        self._write(other, 0, b'other')
+        for clone in (self.backend.clone_volume,
+                      self.backend.shallow_clone_volume):
+            self.assertRaises(ValueError, clone, vol, 'base')
+            self.assertRaises(ValueError, clone, vol, 'other')
+        self.assertEqual(b'base', self._read(vol, 0, 4))
+        self.assertEqual(b'other', self._read(other, 0, 5))
+        self.assertEqual(2, len(self.backend.catalog))
+
+    def test_shallow_clone_two_handles(self):
+        block = overlay.BLOCK_SIZE
+        vol = self.backend.create_volume(4 * block, 'base')
+        self._write(vol, 0, b'p' * 4 * block)
+        clone = self.backend.shallow_clone_volume(vol, 'clone')
+        first = self.backend.open_handle(clone)
+        second = self.backend.open_volume(clone)
+        first.pwrite(b'a' * block, 0)
+        second.seek(2 * block)
+        second.write(b'b' * block)
+        # each sees the blocks written through the other
+        self.assertEqual(b'b', first.pread(1, 2 * block))
+        second.seek(0)
+        self.assertEqual(b'a', second.read(1))
+        first.close()
+        second.close()
+        self.assertEqual(0, len(self.backend._block_maps))
+        self.assertEqual(b'a', self._read(clone, 0, 1))
+        self.assertEqual(b'p', self._read(clone, block, 1))
+        self.assertEqual(b'b', self._read(clone, 2 * block, 1))
+
+    def test_delete_volume_with_shallow_clones(self):
+        vol = self.backend.create_volume(1024, 'base')
+        self.backend.shallow_clone_volume(vol, 'clone')
+        self.assertRaises(ValueError, self.backend.delete_volume, vol)
+        self.assertTrue(os.path.exists(vol.path))
+
+    def test_open_handle(self):
+        vol = self.backend.create_volume(1024 * 1024, 'test')
+        with self.backend.open_handle(vol) as h:
+            self.assertIsNotNone(h.read_fileno())
+            h.pwrite(b'data', 4096)
+        self.assertEqual(b'data', self._read(vol, 4096, 4))
+
+    def test_open_handle_shallow_clone(self):
+        vol = self.backend.create_volume(1024 * 1024, 'base')
+        self._write(vol, 0, b'base')
+        clone = self.backend.shallow_clone_volume(vol, 'clone')
+        with self.backend.open_handle(clone) as h:
+            h.pwrite(b'CL', 0)
+            self.assertEqual(b'CLse', h.pread(4, 0))
+        self.assertEqual(b'base', self._read(vol, 0, 4))
+
     def test_create_vol_with_data(self):
         vol = self.backend.create_volume(1024, 'test-file')
         with self.backend.open_volume(vol) as f:
@@ -61,3 +501,108 @@ class TestFlatFileBackend(base_test.OSVTestCase):
         print(device)
         self.addCleanup(self.backend.host_detach, vol)
         self.assertTrue(os.path.exists(device))
+
+    def test_nested_attach_reuses_device(self):
+        vol = self.backend.create_volume(1024, 'test')
+        loop_manager = self.backend.loop
+        with mock.patch.object(
+                loop_manager, 'available', return_value=True), \
+                mock.patch.object(
+                    loop_manager, '_bind', return_value='/dev/loop9'
+                ) as mock_bind, \
+                mock.patch.object(loop_manager, '_unbind') as mock_unbind:
+            with self.backend.attach(vol) as device:
+                with self.backend.attach(vol) as nested:
+                    self.assertEqual(device, nested)
+                record = self.backend.catalog.get(str(vol.volume_id))
+                self.assertEqual('/dev/loop9', record['device_path'])
+                mock_unbind.assert_not_called()
+        mock_bind.assert_called_once_with(vol.path)
+        mock_unbind.assert_called_once_with('/dev/loop9')
+        self.assertIsNone(vol.device_path)
+
+    def test_changed_block_tracking(self):
+        block = cbt.BLOCK_SIZE
+        vol = self.backend.create_volume(8 * block, 'test')
+        with self.backend.open_handle(vol) as h:
+            h.pwrite(b'x', 0)
+            self.assertFalse(os.path.exists(cbt.tracker_path(vol.path)))
+            # a handle opened before the checkpoint is tracked after it
+            self.backend.create_checkpoint(vol, 'full')
+            self.assertTrue(os.path.exists(cbt.tracker_path(vol.path)))
+            h.pwrite(b'a' * block, block)
+        with self.backend.open_volume(vol) as f:
+            f.seek(5 * block)
+            f.write(b'b')
+        self.assertEqual(
+            [(block, b'a' * block), (5 * block, b'b' + bytes(block - 1))],
+            list(self.backend.export_incremental(vol, 'full', 'inc')))
+        self.assertEqual([], list(self.backend.export_incremental(vol, 'inc')))
+        self.backend.delete_checkpoint(vol, 'full')
+        # checkpoints survive reopening the backend
+        backend = flat_file.FlatFile(self.tempdir.path)
+        self.addCleanup(backend.close)
+        self.assertEqual(['inc'], backend.list_checkpoints(vol))
+        self.backend.delete_volume(vol)
+        self.assertFalse(os.path.exists(cbt.tracker_path(vol.path)))
+
+    def test_changed_block_tracking_open_file(self):
+        block = cbt.BLOCK_SIZE
+        vol = self.backend.create_volume(4 * block, 'test')
+        self.backend.create_checkpoint(vol, 'c0')
+        with self.backend.open_volume(vol) as f:
+            f.seek(block)
+            f.write(b'x' * 10)
+            # exported while the file is still open
+            self.assertEqual(
+                [(block, b'x' * 10 + bytes(block - 10))],
+                list(self.backend.export_incremental(vol, 'c0', 'c1')))
+        self.assertEqual(
+            [], list(self.backend.export_incremental(vol, 'c1', 'c2')))
+
+    def test_changed_block_tracking_shallow_clone(self):
+        block = cbt.BLOCK_SIZE
+        vol = self.backend.create_volume(4 * block, 'test')
+        clone = self.backend.shallow_clone_volume(vol, 'clone')
+        self.backend.create_checkpoint(clone, 'a')
+        with self.backend.open_handle(clone) as h:
+            h.pwrite(b'x', 2 * block)
+        self.assertEqual(
+            [2], list(self.backend.get_tracker(clone).changed_since('a')))
+
+    def test_host_attach_marks_tracked_volume(self):
+        vol = self.backend.create_volume(4 * cbt.BLOCK_SIZE, 'test')
+        self.backend.create_checkpoint(vol, 'a')
+        with mock.patch.object(self.backend.loop, 'attach',
+                               return_value='/dev/loop9'):
+            self.backend.host_attach(vol)
+        self.assertEqual(
+            [0, 1, 2, 3],
+            list(self.backend.get_tracker(vol).changed_since('a')))
+
+    def test_block_cache(self):
+        block_cache = cache.BlockCache(1024 * 1024)
+        backend = flat_file.FlatFile(self.tempdir.path, cache=block_cache)
+        self.addCleanup(backend.close)
+        vol = backend.create_volume(4 * cache.BLOCK_SIZE, 'test')
+        with backend.open_volume(vol) as f:
+            f.write(b'a' * cache.BLOCK_SIZE)
+            f.seek(0)
+            self.assertEqual(b'a' * 10, f.read(10))
+        clones = [backend.shallow_clone_volume(vol, f'clone{i}')
+                  for i in range(2)]
+        with backend.open_handle(clones[0]) as h:
+            self.assertEqual(b'a' * 10, h.pread(10, 0))
+        with backend.open_handle(clones[1]) as h:
+            self.assertEqual(b'a' * 10, h.pread(10, 0))
+            h.pwrite(b'b', 0)
+            self.assertEqual(b'ba', h.pread(2, 0))
+        # the clone reads and the copy up for the write hit the block of the
+        # parent cached by the first read
+        self.assertEqual(3, block_cache.stats().hits)
+        self.assertRaises(
+            ValueError, backend.grow_volume, vol, cache.BLOCK_SIZE)
+        backend.delete_volumes(clones)
+        backend.grow_volume(vol, cache.BLOCK_SIZE)
+        self.assertNotIn(
+            vol.path, [key for key, _ in block_cache._entries.keys()])
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+
+import io
+import os
+
+import fixtures
+
+from os_vol.backends import handle
+from os_vol.backends import memory
+from os_vol_tests import base_test
+
+MiB = 1024 * 1024
+
+
+class TestFileHandle(base_test.OSVTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tempdir = self.useFixture(fixtures.TempDir())
+        self.path = os.path.join(self.tempdir.path, 'vol')
+        with open(self.path, 'wb') as f:
+            f.truncate(4 * MiB)
+        self.handle = handle.FileHandle(self.path)
+        self.addCleanup(self.handle.close)
+
+    def test_pread_pwrite(self):
+        self.assertEqual(4 * MiB, self.handle.size)
+        self.assertEqual(4, self.handle.pwrite(b'data', MiB))
+        self.assertEqual(b'\0data\0', self.handle.pread(6, MiB - 1))
+        buf = bytearray(4)
+        self.assertEqual(4, self.handle.readinto(buf, MiB))
+        self.assertEqual(b'data', buf)
+
+    def test_map(self):
+        with self.handle.map(MiB + 10, 4) as view:
+            self.assertEqual(4, len(view))
+            view[:] = b'mmap'
+        with open(self.path, 'rb') as f:
+            f.seek(MiB + 10)
+            self.assertEqual(b'mmap', f.read(4))
+        with self.handle.map(MiB, 0) as view:
+            self.assertEqual(0, len(view))
+
+    def test_extents(self):
+        self.handle.pwrite(b'x' * 4096, 2 * MiB)
+        extents = list(self.handle.extents())
+        self.assertEqual(4096, sum(length for _, length in extents))
+
+    def test_write_zeroes(self):
+        self.handle.pwrite(b'x' * 3 * MiB, 0)
+        self.handle.write_zeroes(MiB, MiB)
+        self.assertEqual(b'x\0', self.handle.pread(2, MiB - 1))
+        self.assertEqual(b'\0x', self.handle.pread(2, 2 * MiB - 1))
+        self.assertEqual(
+            2 * MiB, sum(length for _, length in self.handle.extents()))
+
+    def test_copy_between_files(self):
+        self.handle.pwrite(b'data', MiB)
+        dst_path = os.path.join(self.tempdir.path, 'dst')
+        with open(dst_path, 'wb') as f:
+            f.truncate(4 * MiB)
+        with handle.FileHandle(dst_path) as dst:
+            self.assertEqual(
+                8, handle.copy(self.handle, dst, MiB - 4, 8))
+            self.assertEqual(b'\0\0\0\0data', dst.pread(8, MiB - 4))
+
+    def test_copy_to_other_offset(self):
+        self.handle.pwrite(b'data', 0)
+        handle.copy(self.handle, self.handle, 0, 4, dst_offset=MiB)
+        self.assertEqual(b'data', self.handle.pread(4, MiB))
+
+    def test_sendfile(self):
+        self.handle.pwrite(b'data', MiB)
+        out_path = os.path.join(self.tempdir.path, 'out')
+        fd = os.open(out_path, os.O_WRONLY | os.O_CREAT)
+        try:
+            self.assertEqual(4, handle.sendfile(self.handle, fd, MiB, 4))
+        finally:
+            os.close(fd)
+        with open(out_path, 'rb') as f:
+            self.assertEqual(b'data', f.read())
+
+
+class TestFileObjectHandle(base_test.OSVTestCase):
+
+    def test_pread_pwrite(self):
+        h = handle.FileObjectHandle(io.BytesIO(bytes(16)), 16)
+        h.pwrite(b'ab', 4)
+        self.assertEqual(b'\0ab\0', h.pread(4, 3))
+        self.assertEqual(b'\0', h.pread(10, 15))
+
+    def test_map_writes_back(self):
+        fileobj = io.BytesIO(bytes(16))
+        with handle.FileObjectHandle(fileobj, 16) as h:
+            with h.map(2, 2) as view:
+                view[:] = b'hi'
+            self.assertEqual(b'\0\0hi', h.pread(4, 0))
+
+    def test_write_zeroes(self):
+        h = handle.FileObjectHandle(io.BytesIO(b'x' * 16), 16)
+        h.write_zeroes(4, 8)
+        self.assertEqual(b'x' * 4 + bytes(8) + b'x' * 4, h.pread(16, 0))
+
+    def test_copy_memory_to_file(self):
+        store = memory.PageStore(memory.PAGE_SIZE * 2)
+        store.write(memory.PAGE_SIZE - 2, b'data')
+        src = memory.MemoryHandle(store)
+        dst = handle.FileObjectHandle(io.BytesIO(), store.size)
+        self.assertEqual(store.size, handle.copy(src, dst))
+        self.assertEqual(b'data', dst.pread(4, memory.PAGE_SIZE - 2))
+
+
+class TestHandleFile(base_test.OSVTestCase):
+    def test_read_write(self):
+        store = memory.PageStore(8)
+        with handle.HandleFile(memory.MemoryHandle(store)) as f:
+            self.assertEqual(2, f.write(b'ab'))
+            self.assertEqual(8, f.seek(0, io.SEEK_END))
+            self.assertEqual(b'', f.read(4))
+            f.seek(1)
+            self.assertEqual(b'b' + bytes(6), f.read())
+            self.assertRaises(ValueError, f.seek, -1)
+            self.assertRaises(io.UnsupportedOperation, f.truncate, 4)
+        self.assertEqual(b'ab', store.read(0, 2))
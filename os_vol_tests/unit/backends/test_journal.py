@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+import os
+import threading
+import time
+from unittest import mock
+
+import fixtures
+
+from os_vol.backends import journal
+from os_vol_tests import base_test
+
+
+class TestJournal(base_test.OSVTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tempdir = self.useFixture(fixtures.TempDir())
+        self.path = os.path.join(self.tempdir.path, 'journal.log')
+
+    def _journal(self, **kwargs):
+        jrnl = journal.Journal(self.path, **kwargs)
+        self.addCleanup(jrnl.close)
+        return jrnl
+
+    def test_replay(self):
+        jrnl = journal.Journal(self.path)
+        a = jrnl.begin('create', volumes=[['a', '/a']])
+        b = jrnl.begin('delete', volumes=[['b', '/b']])
+        jrnl.end(a)
+        self.assertEqual([b], jrnl.pending())
+        jrnl.close()
+        jrnl = self._journal()
+        self.assertEqual([b], jrnl.pending())
+        # ids keep increasing across restarts
+        self.assertGreater(jrnl.begin('create').op_id, b.op_id)
+
+    def test_lost_end(self):
+        jrnl = journal.Journal(self.path)
+        entry = jrnl.begin('create')
+        jrnl.end(entry)
+        # the end record is only buffered until the next write
+        self.assertEqual([entry], self._journal().pending())
+        jrnl.close()
+        self.assertEqual([], self._journal().pending())
+
+    def test_torn_record(self):
+        jrnl = journal.Journal(self.path)
+        first = jrnl.begin('create')
+        jrnl.close()
+        with open(self.path, 'ab') as f:
+            f.write(b'0badcafe {"id": 2')
+        jrnl = self._journal()
+        self.assertEqual([first], jrnl.pending())
+        # the torn record is cut off so later records can be read back
+        second = jrnl.begin('delete')
+        jrnl.close()
+        self.assertEqual([first, second], self._journal().pending())
+
+    def test_corrupt_record(self):
+        jrnl = journal.Journal(self.path)
+        jrnl.begin('create')
+        jrnl.close()
+        with open(self.path, 'r+b') as f:
+            f.seek(12)
+            f.write(b'X')
+        self.assertEqual([], self._journal().pending())
+
+    def test_group_commit(self):
+        jrnl = self._journal()
+        syncs = []
+
+        def fdatasync(fd):
+            syncs.append(fd)
+            time.sleep(0.01)
+
+        with mock.patch.object(os, 'fdatasync', side_effect=fdatasync):
+            threads = [threading.Thread(target=jrnl.begin, args=('create',))
+                       for _ in range(16)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(16, len(jrnl))
+        self.assertLess(len(syncs), 16)
+
+    def test_no_sync(self):
+        jrnl = self._journal(sync=False)
+        with mock.patch.object(os, 'fdatasync') as fdatasync:
+            jrnl.end(jrnl.begin('create'))
+        fdatasync.assert_not_called()
+
+    def test_compact(self):
+        jrnl = journal.Journal(self.path)
+        jrnl.COMPACT_SIZE = 1024
+        kept = jrnl.begin('create', volumes=[['kept', '/kept']])
+        for i in range(100):
+            jrnl.end(jrnl.begin('create', volumes=[[str(i), f'/{i}']]))
+        self.assertLess(os.path.getsize(self.path), 2048)
+        jrnl.close()
+        self.assertEqual([kept], self._journal().pending())
+
+    def test_write_error(self):
+        jrnl = self._journal(sync=False)
+        with mock.patch.object(os, 'write', side_effect=OSError('eio')):
+            self.assertRaises(OSError, jrnl.begin, 'create')
+        self.assertEqual([], jrnl.pending())
+        # records may have been lost, the journal can't be trusted any more
+        self.assertRaises(OSError, jrnl.begin, 'create')
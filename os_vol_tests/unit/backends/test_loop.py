@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+
+import errno
+from unittest import mock
+
+from os_vol.backends import loop
+from os_vol_tests import base_test
+
+
+class FakeKernel:
+    """Emulates loop-control and loop devices for the ioctl calls."""
+
+    def __init__(self, existing=1):
+        self.devices = {n: None for n in range(existing)}
+        self.fds = {}
+        self.calls = []
+        self.configure_errno = None
+
+    def open(self, path, flags):
+        fd = 100 + len(self.fds)
+        self.fds[fd] = path
+        return fd
+
+    def close(self, fd):
+        pass
+
+    def _number(self, fd):
+        return int(self.fds[fd][len('/dev/loop'):])
+
+    def ioctl(self, fd, request, arg=0):
+        self.calls.append(request)
+        if request == loop.LOOP_CTL_GET_FREE:
+            free = [n for n, f in sorted(self.devices.items()) if f is None]
+            if free:
+                return free[0]
+            number = max(self.devices, default=-1) + 1
+            self.devices[number] = None
+            return number
+        if request == loop.LOOP_CTL_ADD:
+            if arg in self.devices:
+                raise OSError(errno.EEXIST, 'exists')
+            self.devices[arg] = None
+            return arg
+        number = self._number(fd)
+        if request == loop.LOOP_GET_STATUS64:
+            if self.devices[number] is None:
+                raise OSError(errno.ENXIO, 'unbound')
+            return arg
+        if request == loop.LOOP_CONFIGURE:
+            if self.configure_errno:
+                raise OSError(self.configure_errno, 'configure')
+            backing_fd = loop.LOOP_CONFIG.unpack(arg)[0]
+            return self._set_fd(number, backing_fd)
+        if request == loop.LOOP_SET_FD:
+            return self._set_fd(number, arg)
+        if request == loop.LOOP_CLR_FD:
+            self.devices[number] = None
+        return 0
+
+    def _set_fd(self, number, backing_fd):
+        if self.devices[number] is not None:
+            raise OSError(errno.EBUSY, 'busy')
+        self.devices[number] = self.fds[backing_fd]
+        return 0
+
+
+class TestLoopManager(base_test.OSVTestCase):
+    def setUp(self):
+        super().setUp()
+        self.kernel = FakeKernel()
+        for name, func in [('open', self.kernel.open),
+                           ('close', self.kernel.close),
+                           ('access', lambda path, mode: True)]:
+            patcher = mock.patch.object(loop.os, name, side_effect=func)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(
+            loop.fcntl, 'ioctl', side_effect=self.kernel.ioctl)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.manager = loop.LoopManager(pool_size=2)
+
+    def test_struct_sizes(self):
+        self.assertEqual(232, loop.LOOP_INFO64.size)
+        self.assertEqual(304, loop.LOOP_CONFIG.size)
+        info = loop.LOOP_INFO64.unpack(
+            loop.loop_info('/x/vol', loop.LO_FLAGS_PARTSCAN))
+        self.assertEqual(loop.LO_FLAGS_PARTSCAN, info[8])
+        self.assertEqual(b'/x/vol', info[9].rstrip(b'\0'))
+
+    def test_attach_detach(self):
+        device = self.manager.attach('/x/vol')
+        self.assertEqual('/dev/loop0', device)
+        self.assertEqual('/x/vol', self.kernel.devices[0])
+        self.assertEqual(device, self.manager.device_for('/x/vol'))
+        # the rest of the warm pool was created ahead of time
+        self.assertEqual([1], self.manager._pool)
+        self.assertIn(1, self.kernel.devices)
+        self.assertEqual(0, self.manager.detach('/x/vol'))
+        self.assertIsNone(self.kernel.devices[0])
+        self.assertIsNone(self.manager.device_for('/x/vol'))
+        self.assertEqual([1, 0], self.manager._pool)
+
+    def test_nested_attach_reuses_device(self):
+        device = self.manager.attach('/x/vol')
+        self.assertEqual(device, self.manager.attach('/x/vol'))
+        self.assertEqual(1, len(self.manager))
+        self.assertEqual(1, self.manager.detach('/x/vol'))
+        self.assertEqual('/x/vol', self.kernel.devices[0])
+        self.assertEqual(0, self.manager.detach('/x/vol'))
+        self.assertIsNone(self.kernel.devices[0])
+
+    def test_attach_many(self):
+        devices = [self.manager.attach(f'/x/vol{i}') for i in range(5)]
+        self.assertEqual(5, len(set(devices)))
+        self.assertEqual(
+            [f'/x/vol{i}' for i in range(5)],
+            [self.kernel.devices[int(d[len('/dev/loop'):])] for d in devices])
+
+    def test_attach_skips_busy_device(self):
+        self.manager.warm()
+        self.kernel.devices[0] = '/other'
+        self.assertEqual('/dev/loop1', self.manager.attach('/x/vol'))
+
+    def test_attach_without_loop_configure(self):
+        self.kernel.configure_errno = errno.EINVAL
+        self.manager.direct_io = True
+        self.manager.attach('/x/vol')
+        self.assertEqual('/x/vol', self.kernel.devices[0])
+        self.assertIn(loop.LOOP_SET_STATUS64, self.kernel.calls)
+        self.assertIn(loop.LOOP_SET_DIRECT_IO, self.kernel.calls)
+
+    def test_direct_io_flag(self):
+        self.manager.direct_io = True
+        self.assertEqual(
+            loop.LO_FLAGS_PARTSCAN | loop.LO_FLAGS_DIRECT_IO,
+            self.manager.flags)
+
+    def test_detach_unknown_device(self):
+        self.kernel.devices[0] = '/x/vol'
+        self.assertEqual(0, self.manager.detach('/x/vol', '/dev/loop0'))
+        self.assertIsNone(self.kernel.devices[0])
+
+    @mock.patch.object(loop.subprocess, 'run')
+    def test_losetup_fallback(self, mock_run):
+        mock_run.return_value.stdout = '/dev/loop7\n'
+        with mock.patch.object(loop.os, 'access', return_value=False):
+            self.assertEqual('/dev/loop7', self.manager.attach('/x/vol'))
+            self.assertEqual('/dev/loop7', self.manager.attach('/x/vol'))
+            self.manager.detach('/x/vol')
+            self.manager.detach('/x/vol')
+        self.assertEqual(2, mock_run.call_count)
+        self.assertEqual(
+            ['sudo', 'losetup', '-d', '/dev/loop7'],
+            mock_run.call_args_list[1][0][0])
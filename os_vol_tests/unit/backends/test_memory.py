@@ -1,4 +1,7 @@
 # -*- coding: utf-8 -*-
+from unittest import mock
+
+from os_vol.backends import cbt
 from os_vol.backends import memory
 from os_vol_tests import base_test
 
@@ -27,6 +30,58 @@ class TestMemoryBackend(base_test.OSVTestCase):
             len(self.backend.volumes[vol.volume_id].getvalue()),
             2048)
 
+    def test_provisioning(self):
+        vol = self.backend.create_volume(1024, 'test', 'zeroed')
+        self.assertEqual('zeroed', vol.provisioning)
+        self.assertEqual(
+            'zeroed', self.backend.clone_volume(vol, 'clone').provisioning)
+        self.assertRaises(
+            ValueError, self.backend.create_volume, 1024, 'bad', 'thick')
+
+    def test_discard_volume(self):
+        vol = self.backend.create_volume(4 * memory.PAGE_SIZE, 'test')
+        with self.backend.open_volume(vol) as f:
+            f.write(b'x' * 4 * memory.PAGE_SIZE)
+        self.backend.discard_volume(vol, memory.PAGE_SIZE)
+        self.assertEqual(
+            memory.PAGE_SIZE, self.backend.get_volume_allocated(vol))
+        self.assertEqual(
+            b'x' * memory.PAGE_SIZE + bytes(3 * memory.PAGE_SIZE),
+            self.backend.volumes[vol.volume_id].getvalue())
+
+    def test_get_capacity(self):
+        self.assertGreater(self.backend.get_capacity(), 0)
+        backend = memory.Memory(capacity=1024)
+        self.assertEqual(1024, backend.get_capacity())
+
+    def test_get_allocated(self):
+        vol = self.backend.create_volume(4 * memory.PAGE_SIZE, 'test')
+        self.assertEqual(0, self.backend.get_allocated())
+        with self.backend.open_volume(vol) as f:
+            f.write(b'x' * memory.PAGE_SIZE * 2)
+        clone = self.backend.clone_volume(vol, 'clone')
+        self.assertEqual(
+            2 * memory.PAGE_SIZE, self.backend.get_volume_allocated(clone))
+        # shared pages are only counted once
+        self.assertEqual(2 * memory.PAGE_SIZE, self.backend.get_allocated())
+        self.assertEqual(8 * memory.PAGE_SIZE,
+                         self.backend.get_provisioned())
+
+    def test_create_volumes(self):
+        with mock.patch.object(
+                self.backend, 'create_volume',
+                side_effect=[ValueError, mock.sentinel.vol]):
+            results = self.backend.create_volumes([('a', 1), ('b', 2)])
+        self.assertIsInstance(results[0].error, ValueError)
+        self.assertIs(mock.sentinel.vol, results[1].volume)
+
+    def test_delete_volumes(self):
+        vols = [self.backend.create_volume(1024, f'v{i}') for i in range(2)]
+        self.backend.delete_volume(vols[0])
+        results = self.backend.delete_volumes(vols)
+        self.assertEqual([False, True], [r.ok for r in results])
+        self.assertEqual({}, self.backend.volumes)
+
     def test_clone_volume(self):
         vol = self.backend.create_volume(1024, 'test')
         new_vol = self.backend.clone_volume(vol, 'clone')
@@ -34,3 +89,131 @@ class TestMemoryBackend(base_test.OSVTestCase):
         self.assertEqual(vol.size, new_vol.size)
         self.assertEqual(new_vol.name, 'clone')
         self.assertIn(new_vol.volume_id, self.backend.volumes)
+
+    def test_create_volume_is_sparse(self):
+        vol = self.backend.create_volume(1024 ** 3, 'big')
+        self.assertEqual({}, self.backend.volumes[vol.volume_id].pages)
+        with self.backend.open_volume(vol) as f:
+            f.seek(1024 ** 3 - 4)
+            self.assertEqual(b'\0' * 4, f.read())
+
+    def test_open_volume_binary(self):
+        vol = self.backend.create_volume(memory.PAGE_SIZE * 4, 'test')
+        with self.backend.open_volume(vol) as f:
+            f.seek(memory.PAGE_SIZE - 2)
+            f.write(b'data')
+        with self.backend.open_volume(vol) as f:
+            f.seek(memory.PAGE_SIZE - 3)
+            self.assertEqual(b'\0data\0', f.read(6))
+        self.assertEqual(
+            [0, 1], sorted(self.backend.volumes[vol.volume_id].pages))
+
+    def test_grow_volume_is_lazy(self):
+        vol = self.backend.create_volume(1024, 'test')
+        self.backend.grow_volume(vol, 1024 ** 3)
+        self.assertEqual(1024 ** 3 + 1024, vol.size)
+        self.assertEqual({}, self.backend.volumes[vol.volume_id].pages)
+
+    def test_clone_volume_copy_on_write(self):
+        vol = self.backend.create_volume(1024, 'test')
+        with self.backend.open_volume(vol) as f:
+            f.write(b'base')
+        new_vol = self.backend.clone_volume(vol, 'clone')
+        self.assertEqual(memory.CLONE_COW, new_vol.clone_strategy)
+        src = self.backend.volumes[vol.volume_id]
+        dst = self.backend.volumes[new_vol.volume_id]
+        self.assertIs(src.pages[0], dst.pages[0])
+        with self.backend.open_volume(new_vol) as f:
+            f.write(b'CL')
+        with self.backend.open_volume(vol) as f:
+            f.write(b'BA')
+        self.assertEqual(b'BAse', src.read(0, 4))
+        self.assertEqual(b'CLse', dst.read(0, 4))
+
+    def test_open_handle(self):
+        vol = self.backend.create_volume(memory.PAGE_SIZE * 8, 'test')
+        with self.backend.open_handle(vol) as h:
+            h.pwrite(b'data', memory.PAGE_SIZE * 2 - 2)
+            h.pwrite(b'x', memory.PAGE_SIZE * 5)
+            self.assertEqual(b'data', h.pread(4, memory.PAGE_SIZE * 2 - 2))
+            self.assertEqual([
+                (memory.PAGE_SIZE, memory.PAGE_SIZE * 2),
+                (memory.PAGE_SIZE * 5, memory.PAGE_SIZE),
+            ], list(h.extents()))
+
+    def test_handle_map(self):
+        vol = self.backend.create_volume(memory.PAGE_SIZE * 4, 'test')
+        store = self.backend.volumes[vol.volume_id]
+        with self.backend.open_handle(vol) as h:
+            # a region within a page is the page itself
+            with h.map(10, 4) as view:
+                view[:] = b'page'
+                self.assertEqual(b'page', store.read(10, 4))
+                clone = self.backend.clone_volume(vol, 'clone')
+                view[:] = b'PAGE'
+            self.assertEqual(b'PAGE', store.read(10, 4))
+            # the clone was taken while the page was mapped
+            self.assertEqual(
+                b'page', self.backend.volumes[clone.volume_id].read(10, 4))
+            # larger regions are copied, only changed pages are written back
+            with h.map(memory.PAGE_SIZE - 2, memory.PAGE_SIZE * 2) as view:
+                view[:4] = b'span'
+            self.assertEqual(b'span', h.pread(4, memory.PAGE_SIZE - 2))
+            self.assertNotIn(2, store.pages)
+            with h.map(0, 0) as view:
+                self.assertEqual(0, len(view))
+            # the size of the handle follows the volume
+            self.backend.grow_volume(vol, memory.PAGE_SIZE)
+            self.assertEqual(memory.PAGE_SIZE * 5, h.size)
+
+    def test_changed_block_tracking(self):
+        vol = self.backend.create_volume(4 * memory.PAGE_SIZE, 'test')
+        self.assertRaises(
+            ValueError, self.backend.export_incremental, vol, 'a')
+        with self.backend.open_volume(vol) as f:
+            f.write(b'y')
+            self.backend.create_checkpoint(vol, 'a')
+            f.seek(memory.PAGE_SIZE)
+            f.write(b'x')
+        self.assertEqual(
+            [(memory.PAGE_SIZE, b'x' + bytes(cbt.BLOCK_SIZE - 1))],
+            list(self.backend.export_incremental(vol, 'a')))
+        self.backend.delete_volume(vol)
+        self.assertNotIn(vol.volume_id, self.backend.trackers)
+
+
+class TestPageStore(base_test.OSVTestCase):
+
+    def test_view_discard(self):
+        store = memory.PageStore(memory.PAGE_SIZE)
+        with store.view(0, 4) as view:
+            store.discard(0, memory.PAGE_SIZE)
+            view[:] = b'kept'
+        self.assertEqual(b'kept', store.read(0, 4))
+        self.assertRaises(ValueError, store.view(
+            memory.PAGE_SIZE - 2, 4).__enter__)
+
+    def test_read_past_end(self):
+        store = memory.PageStore(10)
+        self.assertEqual(b'\0' * 10, store.read(0, 100))
+        self.assertEqual(b'', store.read(20, 10))
+
+    def test_truncate_zeroes_tail(self):
+        store = memory.PageStore(memory.PAGE_SIZE * 2)
+        store.write(memory.PAGE_SIZE - 4, b'x' * 8)
+        store.truncate(memory.PAGE_SIZE - 2)
+        self.assertEqual([0], list(store.pages))
+        store.truncate(memory.PAGE_SIZE * 2)
+        self.assertEqual(
+            b'xx' + b'\0' * 6, store.read(memory.PAGE_SIZE - 4, 8))
+
+    def test_discard(self):
+        store = memory.PageStore(memory.PAGE_SIZE * 3)
+        store.write(0, b'x' * memory.PAGE_SIZE * 3)
+        clone = store.clone()
+        clone.discard(memory.PAGE_SIZE - 2, memory.PAGE_SIZE + 4)
+        self.assertEqual([0, 2], sorted(clone.pages))
+        self.assertEqual(
+            b'xx' + bytes(memory.PAGE_SIZE + 4) + b'xx',
+            clone.read(memory.PAGE_SIZE - 4, memory.PAGE_SIZE + 8))
+        self.assertEqual(b'x' * memory.PAGE_SIZE * 3, store.getvalue())
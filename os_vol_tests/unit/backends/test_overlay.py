@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+import fixtures
+
+from os_vol.backends import overlay
+from os_vol_tests import base_test
+
+BLOCK = overlay.BLOCK_SIZE
+
+
+class TestBlockMap(base_test.OSVTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tempdir = self.useFixture(fixtures.TempDir())
+        self.path = os.path.join(self.tempdir.path, 'map')
+
+    def test_add_and_contains(self):
+        block_map = overlay.BlockMap(self.path)
+        self.assertNotIn(10, block_map)
+        block_map.add(10)
+        block_map.add(3)
+        self.assertIn(10, block_map)
+        self.assertIn(3, block_map)
+        self.assertNotIn(4, block_map)
+        self.assertEqual([3, 10], list(block_map))
+        self.assertEqual(2, len(block_map))
+        self.assertTrue(block_map.dirty)
+
+    def test_add_range_and_truncate(self):
+        block_map = overlay.BlockMap(self.path)
+        block_map.add_range(3, 21)
+        self.assertEqual(list(range(3, 21)), list(block_map))
+        block_map.truncate(10)
+        self.assertEqual(list(range(3, 10)), list(block_map))
+        block_map.truncate(2)
+        self.assertEqual([], list(block_map))
+
+    def test_save_and_load(self):
+        block_map = overlay.BlockMap(self.path)
+        block_map.add(42)
+        block_map.save()
+        self.assertFalse(block_map.dirty)
+        self.assertEqual([42], list(overlay.BlockMap.load(self.path)))
+
+
+class TestOverlayFile(base_test.OSVTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tempdir = self.useFixture(fixtures.TempDir())
+        self.base = os.path.join(self.tempdir.path, 'base')
+        self.top = os.path.join(self.tempdir.path, 'top')
+        self.size = 4 * BLOCK
+        with open(self.base, 'wb') as f:
+            f.write(b'b' * self.size)
+        overlay.create(self.top, self.size)
+
+    def _open(self, readonly=False):
+        layers = [
+            overlay.Layer(
+                self.top,
+                overlay.BlockMap.load(overlay.map_path(self.top))),
+            overlay.Layer(self.base, None),
+        ]
+        return overlay.OverlayFile(layers, self.size, readonly=readonly)
+
+    def test_read_falls_through(self):
+        with self._open() as f:
+            self.assertEqual(b'b' * self.size, f.read())
+
+    def test_partial_write_copies_up_block(self):
+        with self._open() as f:
+            f.seek(BLOCK + 10)
+            f.write(b'tt')
+        with self._open() as f:
+            self.assertEqual([1], list(f.block_map))
+            f.seek(BLOCK)
+            data = f.read(BLOCK)
+        self.assertEqual(b'b' * 10 + b'tt' + b'b' * (BLOCK - 12), data)
+        with open(self.base, 'rb') as f:
+            self.assertEqual(b'b' * self.size, f.read())
+
+    def test_write_spanning_blocks(self):
+        with self._open() as f:
+            f.seek(BLOCK - 1)
+            f.write(b'xy')
+            f.seek(BLOCK - 2)
+            self.assertEqual(b'bxyb', f.read(4))
+            self.assertEqual([0, 1], list(f.block_map))
+
+    def test_truncate(self):
+        with self._open() as f:
+            f.seek(3 * BLOCK)
+            f.write(b't')
+            f.truncate(BLOCK + 10)
+            self.assertEqual([], list(f.block_map))
+            f.truncate(self.size)
+            self.assertEqual([1, 2, 3], list(f.block_map))
+            f.seek(0)
+            # the range cut off reads as zeros rather than from the base
+            self.assertEqual(
+                b'b' * (BLOCK + 10) + bytes(3 * BLOCK - 10), f.read())
+
+    def test_readonly(self):
+        with self._open(readonly=True) as f:
+            self.assertFalse(f.writable())
+            self.assertEqual(b'bb', f.read(2))
+            self.assertRaises(OSError, f.write, b'x')
+            self.assertRaises(OSError, f.truncate, 0)
+
+    def test_materialise(self):
+        with self._open() as f:
+            f.write(b'top')
+            f.materialise()
+        os.remove(self.base)
+        with open(self.top, 'rb') as f:
+            self.assertEqual(b'top' + b'b' * (self.size - 3), f.read())
+
+    def test_copy_layers(self):
+        with self._open() as f:
+            f.seek(2 * BLOCK)
+            f.write(b'top')
+        dst = os.path.join(self.tempdir.path, 'dst')
+        with open(self.base, 'rb') as src, open(dst, 'wb') as f:
+            f.write(src.read())
+        layers = [
+            overlay.Layer(
+                self.top,
+                overlay.BlockMap.load(overlay.map_path(self.top))),
+            overlay.Layer(self.base, None),
+        ]
+        self.assertEqual(BLOCK, overlay.copy_layers(layers, dst, self.size))
+        with open(dst, 'rb') as f:
+            f.seek(2 * BLOCK - 1)
+            self.assertEqual(b'btopb', f.read(5))
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+
+import uuid
+
+from os_vol.objects import index
+from os_vol_tests import base_test
+
+
+class TestVolumeIndex(base_test.OSVTestCase):
+    def setUp(self):
+        super().setUp()
+        self.index = index.VolumeIndex()
+        self.ids = [uuid.uuid4() for _ in range(5)]
+        for i, volume_id in enumerate(self.ids):
+            self.index.add(volume_id, (i + 1) * 10)
+
+    def test_add(self):
+        self.assertEqual(5, len(self.index))
+        self.assertEqual(150, self.index.total_size)
+        self.assertEqual(self.ids, self.index.ids())
+        self.assertIn(self.ids[0], self.index)
+        self.assertNotIn(uuid.uuid4(), self.index)
+        # adding an indexed volume updates its size
+        self.index.add(self.ids[0], 20)
+        self.assertEqual(5, len(self.index))
+        self.assertEqual(160, self.index.total_size)
+
+    def test_remove(self):
+        self.index.remove(self.ids[1])
+        self.index.remove(uuid.uuid4())
+        self.assertEqual(4, len(self.index))
+        self.assertEqual(130, self.index.total_size)
+        self.assertNotIn(self.ids[1], self.index)
+        self.assertEqual(
+            sorted(self.ids[:1] + self.ids[2:]), sorted(self.index.ids()))
+        # the last row moved into the gap keeps its size
+        self.assertEqual(50, self.index.size(self.ids[4]))
+        for volume_id in self.ids:
+            self.index.remove(volume_id)
+        self.assertEqual(0, len(self.index))
+        self.assertEqual(0, self.index.total_size)
+
+    def test_resize(self):
+        self.index.resize(self.ids[0], 100)
+        self.assertEqual(100, self.index.size(self.ids[0]))
+        self.assertEqual(240, self.index.total_size)
+        self.assertRaises(KeyError, self.index.resize, uuid.uuid4(), 1)
+
+    def test_queries(self):
+        self.assertEqual(self.ids[1:4], self.index.select(20, 40))
+        self.assertEqual(self.ids[3:], self.index.select(40))
+        self.assertEqual(
+            [(self.ids[4], 50), (self.ids[3], 40)], self.index.largest(2))
+        self.assertEqual([10, 20, 30, 40, 50], list(self.index.sizes()))
+
+    def test_page(self):
+        ids = sorted(self.ids)
+        self.assertEqual(ids, self.index.page())
+        self.assertEqual(ids[2:4], self.index.page(2, ids[1]))
+        # the sorted ids are kept up to date once built
+        self.index.remove(ids[1])
+        self.assertEqual(ids[2:4], self.index.page(2, ids[1]))
+        new = uuid.uuid4()
+        self.index.add(new, 10)
+        self.assertEqual(
+            sorted(ids[:1] + ids[2:] + [new]), self.index.page())
+        self.assertEqual([], self.index.page(marker=max(ids + [new])))
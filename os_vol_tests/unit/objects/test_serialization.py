@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+import json
+import uuid
+
+from os_vol.objects import serialization
+from os_vol.objects import volume
+from os_vol_tests import base_test
+
+
+class TestSerialization(base_test.OSVTestCase):
+    def setUp(self):
+        super().setUp()
+        self.volume = volume.Volume(
+            path='/vols/vol-1', name='vol-é', size=2 ** 40,
+            parent_id=uuid.uuid4(), clone_strategy='overlay')
+        self.pool_record = {
+            'name': 'pool', 'pool_type': 'fake', 'volumes': 3,
+            'capacity': 2 ** 50, 'usage': 1024,
+        }
+
+    def test_volume_round_trip(self):
+        for fmt in serialization.SERIALIZERS:
+            data = self.volume.serialize(fmt)
+            self.assertEqual(self.volume.to_dict(), serialization.loads(data))
+            self.assertEqual(
+                self.volume, volume.Volume.from_summary(data))
+
+    def test_binary_is_smaller(self):
+        self.assertLess(
+            len(self.volume.serialize(serialization.FORMAT_BINARY)),
+            len(self.volume.serialize(serialization.FORMAT_JSON)) // 2)
+
+    def test_binary_dumps_matches_dump_volume(self):
+        serializer = serialization.get_serializer(
+            serialization.FORMAT_BINARY)
+        self.assertEqual(
+            serializer.dump_volume(self.volume),
+            serializer.dumps(self.volume.to_dict()))
+        self.volume.parent_id = None
+        self.assertEqual(
+            serializer.dump_volume(self.volume),
+            serializer.dumps(self.volume.to_dict()))
+
+    def test_from_summary(self):
+        backend = object()
+        vol = volume.Volume.from_summary(
+            self.volume.volume_summary(), backend=backend)
+        self.assertIs(backend, vol.backend)
+        self.assertEqual(self.volume.to_dict(), vol.to_dict())
+
+    def test_pool_round_trip(self):
+        for fmt in serialization.SERIALIZERS:
+            data = serialization.dumps(
+                self.pool_record, fmt, serialization.KIND_POOL)
+            self.assertEqual(self.pool_record, serialization.loads(data))
+
+    def test_versioning(self):
+        data = bytearray(self.volume.serialize())
+        data[2] = serialization.VERSION + 1
+        self.assertRaises(ValueError, serialization.loads, bytes(data))
+        data[2], data[3] = serialization.VERSION, 99
+        self.assertRaises(ValueError, serialization.loads, bytes(data))
+        serializer = serialization.get_serializer(
+            serialization.FORMAT_BINARY)
+        self.assertRaises(ValueError, serializer.loads, b'XX\x01\x01')
+
+    def test_version_1(self):
+        self.volume.provisioning = 'zeroed'
+        data = self.volume.serialize()
+        # version 1 records end before the provisioning string
+        old = bytearray(data[:-len('zeroed') - 2])
+        old[2] = 1
+        record = serialization.loads(bytes(old))
+        self.assertIsNone(record['provisioning'])
+        self.assertEqual(
+            dict(self.volume.to_dict(), provisioning=None), record)
+
+    def test_json_versioning(self):
+        serializer = serialization.get_serializer(serialization.FORMAT_JSON)
+        envelope = json.loads(self.volume.serialize(serialization.FORMAT_JSON))
+        self.assertEqual(serialization.VERSION, envelope['version'])
+        self.assertEqual(serialization.KIND_VOLUME, envelope['kind'])
+        envelope['version'] = serialization.VERSION + 1
+        self.assertRaises(
+            ValueError, serialization.loads, json.dumps(envelope))
+        envelope['version'], envelope['kind'] = 1, 99
+        self.assertRaises(
+            ValueError, serialization.loads, json.dumps(envelope))
+        # version 1 records have no provisioning
+        envelope['kind'] = serialization.KIND_VOLUME
+        del envelope['record']['provisioning']
+        self.assertIsNone(
+            serializer.loads(json.dumps(envelope))['provisioning'])
+        self.assertRaises(
+            ValueError, serializer.dumps, self.pool_record, 99)
+        # unversioned records, such as volume summaries, are read as is
+        self.assertEqual(
+            self.volume.to_dict(),
+            serialization.loads(self.volume.volume_summary()))
+
+    def test_unknown_format(self):
+        self.assertRaises(
+            ValueError, serialization.get_serializer, 'msgpack')
+        self.assertRaises(ValueError, self.volume.serialize, 'msgpack')
+
+    def test_long_string(self):
+        self.volume.path = 'x' * 70000
+        self.assertRaises(ValueError, self.volume.serialize)
@@ -0,0 +1,481 @@
+# -*- coding: utf-8 -*-
+from concurrent import futures
+import contextlib
+import os
+import random
+import threading
+from unittest import mock
+
+import fixtures
+
+from os_vol.backends import cbt
+from os_vol.backends import flat_file
+from os_vol.backends import memory
+from os_vol.objects import serialization
+from os_vol.objects import storeage_pools
+from os_vol_tests import base_test
+
+
+class TestStoragePool(base_test.OSVTestCase):
+    def setUp(self):
+        super().setUp()
+        self.backend = memory.Memory(capacity=1024 * 1024)
+        self.pool = storeage_pools.StoragePool(
+            name='test', backend=self.backend)
+
+    def test_allocate_volume(self):
+        vol = self.pool.allocate_volume('test', 1024)
+        self.assertIs(self.pool, vol.pool_ref)
+        self.assertIn(vol.volume_id, self.pool.allocations)
+        self.assertEqual(1024, self.pool.usage())
+
+    def test_allocate_volume_rolled_back(self):
+        with mock.patch.object(
+                self.pool, '_add', side_effect=RuntimeError):
+            self.assertRaises(
+                RuntimeError, self.pool.allocate_volume, 'test', 1024)
+        self.assertEqual({}, self.backend.volumes)
+        self.assertEqual(0, self.pool.usage())
+
+    def test_deallocate_volume(self):
+        vol = self.pool.allocate_volume('test', 1024)
+        vol.delete()
+        self.assertNotIn(vol.volume_id, self.pool.allocations)
+        self.assertEqual(0, self.pool.usage())
+
+    def test_allocate_volumes(self):
+        with mock.patch.object(
+                self.backend, 'create_volume',
+                side_effect=[ValueError, self.backend.create_volume(10, 'b')]):
+            results = self.pool.allocate_volumes([('a', 1), ('b', 10)])
+        self.assertFalse(results[0].ok)
+        self.assertTrue(results[1].ok)
+        self.assertEqual([results[1].volume], self.pool.list_volumes())
+        self.assertEqual(10, self.pool.usage())
+
+    def test_deallocate_volumes(self):
+        results = self.pool.allocate_volumes([('a', 1), ('b', 10)])
+        vols = [r.volume for r in results]
+        results = self.pool.deallocate_volumes(vols)
+        self.assertTrue(all(r.ok for r in results))
+        self.assertEqual({}, self.pool.allocations)
+        self.assertEqual(0, self.pool.usage())
+
+    def test_grow_volume(self):
+        vol = self.pool.allocate_volume('test', 1024)
+        vol.grow(1024)
+        self.assertEqual(2048, self.pool.usage())
+
+    def test_clone_volume(self):
+        vol = self.pool.allocate_volume('test', 1024)
+        clone = vol.clone('clone')
+        self.assertIs(self.pool, clone.pool_ref)
+        self.assertEqual(2048, self.pool.usage())
+        self.assertEqual(2, len(self.pool.list_volumes()))
+
+    def test_usage_matches_allocations(self):
+        for i in range(10):
+            self.pool.allocate_volume(f'vol-{i}', 1024 * (i + 1))
+        for vol in self.pool.list_volumes()[::2]:
+            vol.grow(10)
+        for vol in self.pool.list_volumes()[1::3]:
+            vol.delete()
+        self.assertEqual(
+            sum(v.size for v in self.pool.allocations.values()),
+            self.pool.usage())
+
+    def test_snapshot(self):
+        self.pool.allocate_volume('test', 1024)
+        snapshot = self.pool.snapshot()
+        self.assertEqual(
+            storeage_pools.PoolSnapshot(
+                name='test', capacity=1024 * 1024, used=1024,
+                free=1024 * 1024 - 1024, volumes=1),
+            snapshot)
+
+    def test_overcommit(self):
+        self.pool.overcommit_ratio = 2.0
+        self.pool.allocate_volume('a', 1024 * 1024)
+        vol = self.pool.allocate_volume('b', 1024 * 1024 - 1024)
+        self.assertRaises(storeage_pools.InsufficientCapacity,
+                          self.pool.allocate_volume, 'c', 2048)
+        self.assertRaises(storeage_pools.InsufficientCapacity,
+                          vol.grow, 2048)
+        self.assertRaises(storeage_pools.InsufficientCapacity,
+                          vol.clone, 'clone')
+        self.assertRaises(storeage_pools.InsufficientCapacity,
+                          self.pool.allocate_volumes, [('c', 1024)] * 2)
+        self.pool.allocate_volume('c', 1024)
+        self.assertEqual(2 * 1024 * 1024, self.pool.usage())
+        self.assertEqual(3, len(self.pool.list_volumes()))
+
+    def test_reservations(self):
+        self.pool.overcommit_ratio = 1.0
+        reservation = self.pool.reserve(1024 * 1024 - 1024)
+        self.assertEqual(1024 * 1024 - 1024, self.pool.reserved())
+        self.assertEqual(1024, self.pool.snapshot().available)
+        self.assertRaises(storeage_pools.InsufficientCapacity,
+                          self.pool.allocate_volume, 'a', 2048)
+        self.pool.allocate_volume('a', 4096, reservation)
+        self.assertFalse(reservation.active)
+        self.assertEqual(0, self.pool.reserved())
+        self.assertRaises(ValueError, self.pool.allocate_volume, 'b', 1024,
+                          reservation)
+        with self.pool.reserve(1024) as reservation:
+            self.assertEqual(1024, self.pool.reserved())
+        self.assertEqual(0, self.pool.reserved())
+        reservation.release()
+        self.assertEqual(0, self.pool.reserved())
+
+    def test_reservation_released_on_error(self):
+        self.pool.overcommit_ratio = 1.0
+        with mock.patch.object(self.backend, 'create_volume',
+                               side_effect=OSError):
+            self.assertRaises(
+                OSError, self.pool.allocate_volume, 'a', 1024)
+        self.assertEqual(0, self.pool.reserved())
+
+    def test_thin_snapshot(self):
+        self.pool.overcommit_ratio = 4.0
+        vol = self.pool.allocate_volume('test', 2 * memory.PAGE_SIZE)
+        with vol.open() as f:
+            f.write(b'x')
+        # the allocated bytes cost a scan of the backend, only on request
+        with mock.patch.object(self.backend, 'get_allocated') as allocated:
+            self.assertIsNone(self.pool.snapshot().allocated)
+            self.pool.storage_summary()
+        allocated.assert_not_called()
+        snapshot = self.pool.snapshot(allocated=True)
+        self.assertEqual(2 * memory.PAGE_SIZE, snapshot.used)
+        self.assertEqual(memory.PAGE_SIZE, snapshot.allocated)
+        self.assertEqual(4 * 1024 * 1024, snapshot.limit)
+        self.assertEqual(4 * 1024 * 1024 - 2 * memory.PAGE_SIZE,
+                         snapshot.available)
+
+    def test_bulk_queries(self):
+        vols = [self.pool.allocate_volume(f'vol-{i}', 1024 * (i + 1))
+                for i in range(4)]
+        vols[0].grow(4096)
+        vols[1].delete()
+        self.assertEqual(
+            sorted(v.volume_id for v in vols if v is not vols[1]),
+            sorted(self.pool.volume_ids()))
+        self.assertEqual(
+            [vols[2].volume_id], self.pool.select_volumes(2048, 3072))
+        self.assertEqual(
+            [(vols[0].volume_id, 5120), (vols[3].volume_id, 4096)],
+            self.pool.largest_volumes(2))
+
+    def test_storage_summary(self):
+        self.pool.allocate_volume('test', 1024)
+        self.assertEqual({
+            'name': 'test',
+            'pool_type': 'fake',
+            'volumes': 1,
+            'capacity': 1024 * 1024,
+            'usage': 1024,
+        }, self.pool.storage_summary())
+
+    def test_serialize(self):
+        self.pool.allocate_volume('test', 1024)
+        self.assertEqual(
+            self.pool.storage_summary(),
+            serialization.loads(self.pool.serialize()))
+
+    def _target(self):
+        return storeage_pools.StoragePool(
+            name='target', backend=memory.Memory(capacity=1024 * 1024))
+
+    def _write(self, vol, offset, data):
+        with vol.backend.open_handle(vol) as h:
+            h.pwrite(data, offset)
+
+    def _read(self, vol):
+        with vol.backend.open_handle(vol) as h:
+            return h.pread(vol.size, 0)
+
+    def test_migrate_volume(self):
+        target = self._target()
+        vol = self.pool.allocate_volume('test', 256 * 1024)
+        self._write(vol, 64 * 1024, b'x' * 100)
+        data = self._read(vol)
+        paused = []
+
+        @contextlib.contextmanager
+        def quiesce():
+            paused.append(vol.volume_id in self.pool.allocations)
+            yield
+            paused.append(vol.volume_id in self.pool.allocations)
+
+        new = self.pool.migrate_volume(vol, target, quiesce=quiesce)
+        # the allocations moved while writes were paused
+        self.assertEqual([True, False], paused)
+        self.assertIs(target, new.pool_ref)
+        self.assertEqual(data, self._read(new))
+        self.assertEqual({}, self.pool.allocations)
+        self.assertEqual([new], target.list_volumes())
+        self.assertEqual((0, 256 * 1024), (self.pool.usage(), target.usage()))
+        self.assertNotIn(vol.volume_id, self.backend.volumes)
+        self.assertRaises(ValueError, target.migrate_volume, new, target)
+
+    def test_migrate_volume_catches_up(self):
+        self.pool.MIGRATION_CUTOVER_BYTES = 0
+        self.pool.MIGRATION_PASSES = 2
+        block = cbt.BLOCK_SIZE
+        vol = self.pool.allocate_volume('test', 8 * block)
+        self._write(vol, 0, b'a' * block)
+        writes = iter([(block, b'b'), (3 * block, b'c'), (5 * block, b'd')])
+        passes = []
+
+        def progress(stats):
+            passes.append(stats.copied)
+            # the guest keeps writing until the final pass
+            for offset, data in [next(writes, (0, b''))]:
+                self._write(vol, offset, data)
+
+        new = self.pool.migrate_volume(
+            vol, self._target(), progress=progress)
+        # the bulk copy, two catch-up passes and the final pass
+        self.assertEqual([block, 2 * block, 3 * block, 4 * block], passes)
+        self.assertEqual(b''.join([
+            b'a' * block, b'b', bytes(2 * block - 1), b'c',
+            bytes(2 * block - 1), b'd', bytes(3 * block - 1)]),
+            self._read(new))
+
+    def test_migrate_volume_open_handle(self):
+        self.pool.MIGRATION_CUTOVER_BYTES = 0
+        vol = self.pool.allocate_volume('test', 256 * 1024)
+        self._write(vol, 0, b'A' * 10)
+        writes = [b'B' * 10]
+        # the guest opened its handle before the migration started
+        with vol.backend.open_handle(vol) as h:
+
+            def progress(stats):
+                if writes:
+                    h.pwrite(writes.pop(), 0)
+
+            new = self.pool.migrate_volume(
+                vol, self._target(), progress=progress)
+        self.assertEqual(b'B' * 10, self._read(new)[:10])
+
+    def test_migrate_volume_cancel(self):
+        target = self._target()
+        vol = self.pool.allocate_volume('test', 1024)
+        cancel = threading.Event()
+        self.assertRaises(
+            futures.CancelledError, self.pool.migrate_volume, vol, target,
+            progress=lambda stats: cancel.set(), cancel=cancel)
+        self.assertEqual([vol], self.pool.list_volumes())
+        self.assertEqual([], self.backend.list_checkpoints(vol))
+        self.assertEqual({}, target.backend.volumes)
+        self.assertEqual(0, target.usage())
+
+    def test_migrate_attached_volume(self):
+        vol = self.pool.allocate_volume('test', 1024)
+        vol.device_path = '/dev/loop0'
+        self.assertRaises(
+            ValueError, self.pool.migrate_volume, vol, self._target())
+
+
+class TestStoragePoolConcurrency(base_test.OSVTestCase):
+    """Hammer a shared pool with allocate/grow/clone/delete from threads."""
+
+    THREADS = 8
+    ITERATIONS = 25
+
+    def _stress(self, pool):
+        errors = []
+
+        def _worker(worker):
+            rand = random.Random(worker)
+            mine = []
+            try:
+                for i in range(self.ITERATIONS):
+                    op = rand.choice(['allocate', 'grow', 'clone', 'delete'])
+                    if op == 'allocate' or not mine:
+                        mine.append(
+                            pool.allocate_volume(f'w{worker}-{i}', 4096))
+                    elif op == 'grow':
+                        rand.choice(mine).grow(4096)
+                    elif op == 'clone':
+                        mine.append(
+                            rand.choice(mine).clone(f'w{worker}-c{i}'))
+                    else:
+                        mine.pop(rand.randrange(len(mine))).delete()
+            except Exception as e:  # pragma: no cover
+                errors.append(e)
+
+        threads = [
+            threading.Thread(target=_worker, args=(w,))
+            for w in range(self.THREADS)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual([], errors)
+        volumes = pool.list_volumes()
+        snapshot = pool.snapshot()
+        self.assertEqual(len(volumes), snapshot.volumes)
+        self.assertEqual(sum(v.size for v in volumes), snapshot.used)
+        return volumes
+
+    def test_memory_pool(self):
+        backend = memory.Memory(capacity=1024 ** 3)
+        pool = storeage_pools.StoragePool(name='test', backend=backend)
+        volumes = self._stress(pool)
+        self.assertEqual(
+            {v.volume_id for v in volumes}, set(backend.volumes))
+
+    def test_flat_file_pool(self):
+        tempdir = self.useFixture(fixtures.TempDir())
+        backend = flat_file.FlatFile(tempdir.path)
+        self.addCleanup(backend.close)
+        pool = storeage_pools.StoragePool(name='test', backend=backend)
+        volumes = self._stress(pool)
+        self.assertEqual(len(volumes), len(backend.catalog))
+        self.assertEqual(
+            sum(v.size for v in volumes), backend.used_space)
+
+
+class TestPersistentStoragePool(base_test.OSVTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tempdir = self.useFixture(fixtures.TempDir())
+        self.backend = flat_file.FlatFile(self.tempdir.path)
+        self.addCleanup(self.backend.close)
+        self.pool = storeage_pools.StoragePool(
+            name='test', backend=self.backend)
+
+    def _restart(self):
+        backend = flat_file.FlatFile(self.tempdir.path)
+        self.addCleanup(backend.close)
+        return storeage_pools.StoragePool(name='test', backend=backend)
+
+    def test_snapshot(self):
+        self.pool.allocate_volume('test', 1024)
+        with mock.patch.object(self.backend.catalog, '_query',
+                               wraps=self.backend.catalog._query) as query:
+            snapshot = self.pool.snapshot()
+        # the count and usage come from one catalog read
+        query.assert_called_once()
+        self.assertEqual(1, snapshot.volumes)
+        self.assertEqual(self.backend._align(1024), snapshot.used)
+
+    def test_allocations_are_lazy(self):
+        self.assertIsInstance(
+            self.pool.allocations, storeage_pools.VolumeMap)
+        self.assertIsNone(self.backend._catalog)
+
+    def test_restart(self):
+        vols = [self.pool.allocate_volume(f'vol-{i}', 1024 * (i + 1))
+                for i in range(5)]
+        vols[0].grow(1024)
+        pool = self._restart()
+        self.assertEqual(16 * 1024, pool.usage())
+        self.assertEqual(5, pool.snapshot().volumes)
+        listed = pool.list_volumes()
+        self.assertEqual(
+            sorted(str(v.volume_id) for v in vols),
+            [str(v.volume_id) for v in listed])
+        self.assertTrue(all(v.pool_ref is pool for v in listed))
+        vol = pool.allocations[vols[0].volume_id]
+        self.assertEqual(2048, vol.size)
+        self.assertIs(vol, pool.allocations[vols[0].volume_id])
+        vol.delete()
+        self.assertNotIn(vol.volume_id, pool.allocations)
+        self.assertEqual(4, len(pool.allocations))
+        self.assertEqual(14 * 1024, pool.usage())
+
+    def test_pagination(self):
+        for i in range(5):
+            self.pool.allocate_volume(f'vol-{i}', 1024)
+        everything = self.pool.list_volumes()
+        self.assertEqual(
+            sorted(v.volume_id for v in everything),
+            [v.volume_id for v in everything])
+        page = self.pool.list_volumes(limit=2, marker=everything[1].volume_id)
+        self.assertEqual(everything[2:4], page)
+        self.assertEqual(everything, list(self.pool.iter_volumes(2)))
+        self.assertEqual(
+            {v.volume_id for v in everything}, set(self.pool.allocations))
+
+    def test_bulk_queries(self):
+        vols = [self.pool.allocate_volume(f'vol-{i}', 1024 * (i + 1))
+                for i in range(3)]
+        pool = self._restart()
+        self.assertIsNone(pool._index)
+        self.assertEqual(
+            [(vols[2].volume_id, 3072)], pool.largest_volumes(1))
+        vol = pool.allocate_volume('vol-3', 8192)
+        pool.allocations[vols[0].volume_id].delete()
+        self.assertEqual(
+            [vol.volume_id, vols[2].volume_id],
+            [i for i, _ in pool.largest_volumes(2)])
+        self.assertEqual(3, len(pool.volume_ids()))
+
+    def test_migrate_volume(self):
+        vol = self.pool.allocate_volume('test', 1024 * 1024)
+        target = storeage_pools.StoragePool(
+            name='target', backend=memory.Memory())
+        with vol.backend.open_volume(vol) as f:
+            f.seek(4096)
+            f.write(b'x' * 4096)
+            f.flush()
+
+            def progress(stats):
+                # written through a file opened before the migration
+                if stats.passes == 1:
+                    f.seek(8192)
+                    f.write(b'y' * 4096)
+                    f.flush()
+
+            new = self.pool.migrate_volume(vol, target, progress=progress)
+        self.assertNotIn(vol.volume_id, self.pool.allocations)
+        self.assertEqual(0, self.pool.usage())
+        self.assertFalse(os.path.exists(vol.path))
+        # and back again, copied from memory into a file
+        vol = new.migrate(self.pool)
+        self.assertEqual([vol], self.pool.list_volumes())
+        self.assertFalse(os.path.exists(cbt.tracker_path(vol.path)))
+        with open(vol.path, 'rb') as f:
+            self.assertEqual(
+                bytes(4096) + b'x' * 4096 + b'y' * 4096 +
+                bytes(1024 * 1024 - 12288),
+                f.read())
+
+    def test_migrate_volume_with_shallow_clones(self):
+        vol = self.pool.allocate_volume('test', 1024 * 1024)
+        clone = self.backend.shallow_clone_volume(vol, 'clone')
+        target = storeage_pools.StoragePool(
+            name='target', backend=memory.Memory())
+        self.assertRaises(
+            ValueError, self.pool.migrate_volume, vol, target)
+        # refused before anything was copied
+        self.assertIn(vol.volume_id, self.pool.allocations)
+        self.assertTrue(os.path.exists(vol.path))
+        self.assertEqual({}, target.allocations)
+        self.assertEqual({}, target.backend.volumes)
+        self.assertEqual(0, target.usage())
+        # and allowed once the clone no longer reads through it
+        self.backend.flatten_volume(clone)
+        new = self.pool.migrate_volume(vol, target)
+        self.assertEqual([new], target.list_volumes())
+        self.assertNotIn(vol.volume_id, self.pool.allocations)
+
+    def test_memory_pool_pagination(self):
+        pool = storeage_pools.StoragePool(
+            name='test', backend=memory.Memory())
+        vols = sorted(
+            (pool.allocate_volume(f'vol-{i}', 1024) for i in range(5)),
+            key=lambda v: v.volume_id)
+        self.assertEqual(
+            vols[2:4], pool.list_volumes(limit=2, marker=vols[1].volume_id))
+        self.assertEqual(vols, list(pool.iter_volumes(2)))
+        # paging carries on after the marker volume is deleted
+        vols[1].delete()
+        self.assertEqual(
+            vols[2:4], pool.list_volumes(limit=2, marker=vols[1].volume_id))
+        vol = pool.allocate_volume('vol-5', 1024)
+        self.assertEqual(
+            sorted(vols[:1] + vols[2:] + [vol], key=lambda v: v.volume_id),
+            pool.list_volumes())
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+
+import uuid
+import weakref
+
+from os_vol.objects import volume
+from os_vol_tests import base_test
+
+
+class TestVolume(base_test.OSVTestCase):
+
+    def test_slotted(self):
+        vol = volume.Volume(path='/x', name='test')
+        self.assertFalse(hasattr(vol, '__dict__'))
+        self.assertRaises(AttributeError, setattr, vol, 'other', 1)
+        self.assertIs(vol, weakref.ref(vol)())
+
+    def test_ids(self):
+        volume_id, parent_id = uuid.uuid4(), uuid.uuid4()
+        vol = volume.Volume(
+            path='/x', volume_id=volume_id, parent_id=parent_id)
+        self.assertEqual(volume_id, vol.volume_id)
+        self.assertIsInstance(vol.volume_id, uuid.UUID)
+        self.assertEqual(parent_id, vol.parent_id)
+        vol.parent_id = None
+        self.assertIsNone(vol.parent_id)
+        vol.parent_id = str(parent_id)
+        self.assertEqual(parent_id, vol.parent_id)
+        self.assertIsInstance(volume.Volume(path='/x').volume_id, uuid.UUID)
+        # the UUID is made once and kept until the id changes
+        vol.volume_id = str(volume_id)
+        self.assertIs(vol.volume_id, vol.volume_id)
+        vol.volume_id = parent_id.int
+        self.assertEqual(parent_id, vol.volume_id)
+
+    def test_to_dict(self):
+        volume_id = uuid.uuid4()
+        vol = volume.Volume(path='/x', name='test', volume_id=volume_id,
+                            size=10)
+        self.assertEqual({
+            'name': 'test',
+            'volume_id': str(volume_id),
+            'size': 10,
+            'volume_type': 'base',
+            'path': '/x',
+            'device_path': None,
+            'clone_strategy': None,
+            'parent_id': None,
+            'provisioning': None,
+        }, vol.to_dict())
+
+    def test_eq(self):
+        volume_id = uuid.uuid4()
+        vol = volume.Volume(path='/x', volume_id=volume_id, size=10)
+        self.assertEqual(
+            volume.Volume(path='/x', volume_id=volume_id, size=10), vol)
+        self.assertNotEqual(
+            volume.Volume(path='/x', volume_id=volume_id, size=20), vol)
+        self.assertNotEqual('/x', vol)
+        self.assertRaises(TypeError, hash, vol)
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import threading
+import time
+from unittest import mock
+
+from os_vol import aio
+from os_vol.backends import memory
+from os_vol import metrics
+from os_vol.objects import storeage_pools
+from os_vol_tests import base_test
+
+
+class _SlowMemory(memory.Memory):
+    """Memory backend that records how many grows overlap."""
+
+    def __init__(self):
+        super().__init__()
+        self.lock = threading.Lock()
+        self.active = 0
+        self.max_active = 0
+
+    def grow_volume(self, volume, size):
+        with self.lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        time.sleep(0.05)
+        super().grow_volume(volume, size)
+        with self.lock:
+            self.active -= 1
+
+
+class TestVolumeLocks(base_test.OSVTestCase):
+
+    def test_locks_are_dropped(self):
+        locks = aio.VolumeLocks()
+
+        async def _test():
+            async with locks.hold('a', 'b'):
+                self.assertEqual(2, len(locks))
+            self.assertEqual(0, len(locks))
+
+        asyncio.run(_test())
+
+    def test_same_key_serialises(self):
+        locks = aio.VolumeLocks()
+        order = []
+
+        async def _worker(name):
+            async with locks.hold('a'):
+                order.append(f'{name}-start')
+                await asyncio.sleep(0.01)
+                order.append(f'{name}-end')
+
+        async def _test():
+            await asyncio.gather(_worker(1), _worker(2))
+
+        asyncio.run(_test())
+        self.assertEqual(['1-start', '1-end', '2-start', '2-end'], order)
+
+
+class TestAsyncBackend(base_test.OSVTestCase):
+    def setUp(self):
+        super().setUp()
+        self.backend = _SlowMemory()
+        self.async_backend = aio.AsyncBackend(self.backend, max_workers=4)
+        self.addCleanup(self.async_backend.close)
+
+    def test_operations(self):
+        async def _test():
+            vol = await self.async_backend.create_volume(1024, 'test')
+            await self.async_backend.grow_volume(vol, 1024)
+            clone = await self.async_backend.clone_volume(vol, 'clone')
+            await self.async_backend.delete_volume(vol)
+            return vol, clone
+
+        vol, clone = asyncio.run(_test())
+        self.assertEqual(2048, clone.size)
+        self.assertEqual([clone.volume_id], list(self.backend.volumes))
+
+    def test_different_volumes_run_in_parallel(self):
+        vols = [self.backend.create_volume(1, f'v{i}') for i in range(4)]
+
+        async def _test():
+            await asyncio.gather(*[
+                self.async_backend.grow_volume(v, 1) for v in vols])
+
+        asyncio.run(_test())
+        self.assertGreater(self.backend.max_active, 1)
+
+    def test_same_volume_serialises(self):
+        vol = self.backend.create_volume(1, 'test')
+
+        async def _test():
+            await asyncio.gather(*[
+                self.async_backend.grow_volume(vol, 1) for _ in range(4)])
+
+        asyncio.run(_test())
+        self.assertEqual(1, self.backend.max_active)
+        self.assertEqual(5, vol.size)
+
+    def test_attach(self):
+        vol = self.backend.create_volume(1, 'test')
+
+        async def _test():
+            async with self.async_backend.attach(vol) as device:
+                return device
+
+        with mock.patch.object(
+                self.backend, 'host_attach',
+                return_value='/dev/loop0') as attach, mock.patch.object(
+                self.backend, 'host_detach') as detach:
+            self.assertEqual('/dev/loop0', asyncio.run(_test()))
+        attach.assert_called_once_with(vol)
+        detach.assert_called_once_with(vol)
+
+
+class TestAsyncStoragePool(base_test.OSVTestCase):
+    def setUp(self):
+        super().setUp()
+        self.pool = storeage_pools.StoragePool(
+            name='test', backend=memory.Memory(capacity=1024 * 1024))
+        self.async_pool = aio.AsyncStoragePool(self.pool)
+        self.addCleanup(self.async_pool.close)
+
+    def test_allocate_grow_deallocate(self):
+        async def _test():
+            vols = await asyncio.gather(*[
+                self.async_pool.allocate_volume(f'v{i}', 1024)
+                for i in range(8)])
+            await asyncio.gather(*[
+                self.async_pool.grow_volume(v, 1024) for v in vols])
+            await self.async_pool.deallocate_volume(vols[0])
+            clone = await self.async_pool.clone_volume(vols[1], 'clone')
+            return clone
+
+        clone = asyncio.run(_test())
+        self.assertIs(self.pool, clone.pool_ref)
+        self.assertEqual(8, len(self.pool.allocations))
+        self.assertEqual(8 * 2048, self.async_pool.usage())
+        self.assertEqual(8, self.async_pool.snapshot().volumes)
+
+    def test_allocate_volumes(self):
+        async def _test():
+            return await self.async_pool.allocate_volumes(
+                [('a', 1), ('b', 2)])
+
+        results = asyncio.run(_test())
+        self.assertTrue(all(r.ok for r in results))
+        self.assertEqual(3, self.pool.usage())
+
+    def test_pool_locks_and_metrics(self):
+        metrics.REGISTRY.clear()
+        self.addCleanup(metrics.REGISTRY.clear)
+        self.addCleanup(metrics.disable)
+        metrics.enable()
+        vol = asyncio.run(self.async_pool.allocate_volume('a', 1024))
+        self.assertEqual(1, metrics.LATENCY.labels(
+            'pool', 'test', 'allocate_volume').count)
+        # a thread working on the volume through the pool holds it off
+        grown = threading.Thread(target=asyncio.run, args=(
+            self.async_pool.grow_volume(vol, 1024),))
+        with self.pool._volume_locks.hold(vol.volume_id):
+            grown.start()
+            time.sleep(0.05)
+            self.assertEqual(1024, vol.size)
+        grown.join()
+        self.assertEqual(2048, vol.size)
+
+    def test_track_failure_deletes_volume(self):
+        vol = asyncio.run(self.async_pool.allocate_volume('a', 1024))
+
+        async def _test():
+            with self.assertRaises(RuntimeError):
+                await self.async_pool.allocate_volume('b', 1024)
+            with self.assertRaises(RuntimeError):
+                await self.async_pool.clone_volume(vol, 'c')
+            return await self.async_pool.allocate_volumes([('d', 1)])
+
+        with mock.patch.object(
+                self.pool, '_add', side_effect=RuntimeError):
+            results = asyncio.run(_test())
+        self.assertIsInstance(results[0].error, RuntimeError)
+        self.assertEqual([vol.volume_id], list(self.pool.backend.volumes))
+        self.assertEqual(1024, self.pool.usage())
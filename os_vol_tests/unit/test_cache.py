@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+from unittest import mock
+
+from os_vol.backends import memory
+from os_vol import cache
+from os_vol_tests import base_test
+
+BLOCK = 4
+
+
+def _pread(data):
+    return mock.Mock(side_effect=lambda n, off: data[off:off + n])
+
+
+class TestBlockCache(base_test.OSVTestCase):
+    def _cache(self, blocks, policy=cache.POLICY_LRU):
+        return cache.BlockCache(blocks * BLOCK, BLOCK, policy)
+
+    def _read(self, c, key, offset, length, pread):
+        buf = bytearray(length)
+        n = c.readinto(key, buf, offset, pread)
+        return bytes(buf[:n])
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, cache.BlockCache, 1024, policy='fifo')
+        self.assertRaises(ValueError, cache.BlockCache, 10, block_size=64)
+
+    def test_readinto_coalesces_misses(self):
+        c = self._cache(8)
+        pread = _pread(b'abcdefghij')
+        self.assertEqual(b'cdefghi', self._read(c, 'f', 2, 7, pread))
+        pread.assert_called_once_with(3 * BLOCK, 0)
+        self.assertEqual(b'efgh', self._read(c, 'f', 4, 4, pread))
+        # the short last block marks the end of the file
+        self.assertEqual(b'ij', self._read(c, 'f', 8, 10, pread))
+        self.assertEqual(1, pread.call_count)
+        stats = c.stats()
+        self.assertEqual((2, 3, 3, 10), (
+            stats.hits, stats.misses, stats.blocks, stats.size))
+        self.assertEqual(0.4, stats.hit_ratio)
+
+    def test_lru_eviction(self):
+        c = self._cache(2)
+        for block in (0, 1, 0, 2):
+            c.put('f', block, b'x', c.generation('f'))
+            c.get('f', block)
+        self.assertIsNone(c.get('f', 1))
+        self.assertIsNotNone(c.get('f', 0))
+        self.assertEqual(1, c.stats().evictions)
+
+    def test_arc_resists_scans(self):
+        for policy, kept in ((cache.POLICY_LRU, 0), (cache.POLICY_ARC, 4)):
+            c = self._cache(8, policy)
+            # a hot set read twice, then a long scan read once
+            for _ in range(2):
+                for block in range(4):
+                    if c.get('hot', block) is None:
+                        c.put('hot', block, b'x', 0)
+            for block in range(100):
+                c.put('scan', block, b'x', 0)
+            self.assertEqual(kept, sum(
+                c.get('hot', block) is not None for block in range(4)))
+            self.assertEqual(8, len(c))
+
+    def test_arc_ghost_hits(self):
+        c = self._cache(4, cache.POLICY_ARC)
+        for block in range(4):
+            c.put('f', block, b'x', 0)
+        c.get('f', 0)
+        c.get('f', 1)
+        # evicts block 2 from t1 to the b1 ghost list
+        c.put('f', 4, b'x', 0)
+        self.assertIn(('f', 2), c._entries.b1)
+        c.put('f', 2, b'x', 0)
+        self.assertEqual(1, c._entries.p)
+        self.assertIn(('f', 2), c._entries.t2)
+        self.assertIn(('f', 3), c._entries.b1)
+        self.assertEqual(4, len(c))
+
+    def test_invalidate(self):
+        c = self._cache(8)
+        pread = _pread(b'abcdefghijkl')
+        self._read(c, 'f', 0, 12, pread)
+        self._read(c, 'g', 0, 4, pread)
+        c.invalidate('f', 5, 2)
+        self.assertEqual([('f', 0), ('f', 2), ('g', 0)],
+                         sorted(c._entries.keys()))
+        c.invalidate('f')
+        self.assertEqual([('g', 0)], c._entries.keys())
+        self.assertEqual(2, c.stats().invalidations)
+
+    def test_stale_put_is_dropped(self):
+        c = self._cache(8)
+        generation = c.generation('f')
+        c.invalidate('f', 0, BLOCK)
+        c.put('f', 0, b'old!', generation)
+        self.assertIsNone(c.get('f', 0))
+
+
+class TestCachedHandle(base_test.OSVTestCase):
+    def test_write_through(self):
+        store = memory.PageStore(64)
+        store.write(0, b'a' * 64)
+        c = cache.BlockCache(64, 16)
+        h = cache.CachedHandle(memory.MemoryHandle(store), c, 'vol')
+        self.assertIsNone(h.fileno())
+        self.assertEqual(b'a' * 4, h.pread(4, 14))
+        h.pwrite(b'b', 15)
+        self.assertEqual(b'ab', h.pread(2, 14))
+        h.write_zeroes(0, 16)
+        self.assertEqual(bytes(16), h.pread(16, 0))
+        with h.map(32, 2) as view:
+            view[:] = b'cc'
+        self.assertEqual(b'cca', h.pread(3, 32))
+        self.assertEqual(b'a', h.pread(10, 63))
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+from concurrent import futures
+import os
+import threading
+from unittest import mock
+
+import fixtures
+
+from os_vol.backends import handle
+from os_vol.backends import memory
+from os_vol import copy_engine
+from os_vol_tests import base_test
+
+KiB = 1024
+
+
+class TestThrottle(base_test.OSVTestCase):
+    def test_consume(self):
+        clock = mock.Mock(return_value=10.0)
+        sleep = mock.Mock()
+        throttle = copy_engine.Throttle(100, clock, sleep)
+        throttle.consume(50)
+        sleep.assert_not_called()
+        # the next half second is taken by the first 50 bytes
+        throttle.consume(100)
+        sleep.assert_called_once_with(0.5)
+        clock.return_value = 20.0
+        throttle.consume(100)
+        sleep.assert_called_once_with(0.5)
+
+    def test_unlimited(self):
+        sleep = mock.Mock()
+        throttle = copy_engine.Throttle(None, sleep=sleep)
+        for _ in range(10):
+            throttle.consume(1 << 30)
+        sleep.assert_not_called()
+
+
+class TestCopyEngine(base_test.OSVTestCase):
+    def setUp(self):
+        super().setUp()
+        self.src = memory.PageStore(64 * KiB)
+        self.src.write(4 * KiB, b'a' * 10 * KiB)
+        self.src.write(40 * KiB, b'b' * KiB)
+        self.dst = memory.PageStore(64 * KiB)
+
+    def _copy(self, engine, **kwargs):
+        return engine.copy(memory.MemoryHandle(self.src),
+                           memory.MemoryHandle(self.dst), **kwargs)
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, copy_engine.CopyEngine, chunk_size=0)
+        self.assertRaises(ValueError, copy_engine.CopyEngine, concurrency=0)
+
+    def test_copy(self):
+        for concurrency in (1, 4):
+            self.dst = memory.PageStore(64 * KiB)
+            progress = mock.Mock()
+            stats = self._copy(
+                copy_engine.CopyEngine(4 * KiB, concurrency),
+                progress=progress)
+            self.assertEqual(self.src.getvalue(), self.dst.getvalue())
+            self.assertTrue(stats.done)
+            self.assertEqual(stats.total, stats.copied)
+            self.assertEqual(stats.chunks, progress.call_count)
+
+    def test_copy_extents(self):
+        engine = copy_engine.CopyEngine(4 * KiB)
+        stats = self._copy(engine, extents=[(8 * KiB, 8 * KiB)])
+        self.assertEqual(8 * KiB, stats.copied)
+        self.assertEqual(2, stats.chunks)
+        self.assertEqual(b'a' * 6 * KiB, self.dst.read(8 * KiB, 6 * KiB))
+        self.assertEqual(bytes(8 * KiB), self.dst.read(0, 8 * KiB))
+
+    def test_copy_past_end(self):
+        engine = copy_engine.CopyEngine(4 * KiB)
+        stats = self._copy(engine, extents=[(62 * KiB, 8 * KiB)])
+        self.assertEqual(2 * KiB, stats.copied)
+
+    def test_cancel(self):
+        cancel = threading.Event()
+        engine = copy_engine.CopyEngine(KiB, 2)
+
+        def progress(stats):
+            cancel.set()
+
+        self.assertRaises(futures.CancelledError, self._copy, engine,
+                          progress=progress, cancel=cancel)
+        # queued chunks are dropped, only those already started finish
+        self.assertLess(
+            self.dst.getvalue().count(b'a'), 10 * KiB)
+
+    def test_error(self):
+        engine = copy_engine.CopyEngine(KiB, 4)
+        chunk_copy = mock.Mock(side_effect=[KiB, OSError('eio')] + [KiB] * 8)
+        self.assertRaises(
+            OSError, engine.run, [(0, 10 * KiB)], chunk_copy)
+
+    def test_rate_limit(self):
+        engine = copy_engine.CopyEngine(4 * KiB, 4, rate_limit=100 * KiB)
+        with mock.patch.object(engine.throttle, '_sleep') as sleep:
+            self._copy(engine, extents=[(0, 16 * KiB)])
+        # four chunks, only the first goes straight away
+        self.assertEqual(3, sleep.call_count)
+        engine.rate_limit = None
+        self.assertIsNone(engine.throttle.rate)
+
+
+class TestCopyEngineFiles(base_test.OSVTestCase):
+    def setUp(self):
+        super().setUp()
+        tempdir = self.useFixture(fixtures.TempDir())
+        self.src = os.path.join(tempdir.path, 'src')
+        self.dst = os.path.join(tempdir.path, 'dst')
+        with open(self.src, 'wb') as f:
+            f.truncate(4 * 1024 * KiB)
+            f.seek(KiB * KiB)
+            f.write(os.urandom(256 * KiB))
+        open(self.dst, 'wb').close()
+
+    def test_sparse_copy(self):
+        engine = copy_engine.CopyEngine(64 * KiB)
+        src_fd = os.open(self.src, os.O_RDONLY)
+        dst_fd = os.open(self.dst, os.O_WRONLY)
+        try:
+            copied = engine.sparse_copy(src_fd, dst_fd, 4 * 1024 * KiB)
+        finally:
+            os.close(src_fd)
+            os.close(dst_fd)
+        self.assertLessEqual(256 * KiB, copied)
+        with open(self.src, 'rb') as a, open(self.dst, 'rb') as b:
+            self.assertEqual(a.read(), b.read())
+
+    def test_copy_file_handles(self):
+        engine = copy_engine.CopyEngine(64 * KiB)
+        with handle.FileHandle(self.src) as src, \
+                handle.FileHandle(self.dst, src.size) as dst:
+            stats = engine.copy(src, dst)
+        self.assertEqual(stats.total, stats.copied)
+        with open(self.src, 'rb') as a, open(self.dst, 'rb') as b:
+            self.assertEqual(a.read(KiB * KiB + 256 * KiB),
+                             b.read(KiB * KiB + 256 * KiB))
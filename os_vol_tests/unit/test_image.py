@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+
+import gzip
+import io
+import os
+from unittest import mock
+
+import fixtures
+
+from os_vol.backends import flat_file
+from os_vol.backends import memory
+from os_vol import copy_engine
+from os_vol import image
+from os_vol_tests import base_test
+
+MiB = 1024 * 1024
+
+
+class TestImage(base_test.OSVTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tempdir = self.useFixture(fixtures.TempDir())
+        self.backend = flat_file.FlatFile(self.tempdir.path)
+        self.addCleanup(self.backend.close)
+        # data, a zero block, data and a trailing zero block
+        self.data = b''.join([
+            b'a' * MiB, bytes(MiB), b'b' * (MiB - 1) + b'\0', bytes(MiB)])
+
+    def _path(self, name):
+        return os.path.join(self.tempdir.path, name)
+
+    def _read(self, vol):
+        with open(vol.path, 'rb') as f:
+            return f.read()
+
+    def test_import_skips_zero_blocks(self):
+        vol = self.backend.create_volume(4 * MiB, 'test')
+        progress = mock.Mock()
+        stats = image.import_image(
+            vol, io.BytesIO(self.data), progress=progress)
+        self.assertEqual(self.data, self._read(vol))
+        self.assertEqual(2 * MiB, stats.transferred)
+        self.assertEqual(2 * MiB, stats.skipped)
+        self.assertEqual(4 * MiB, stats.offset)
+        self.assertTrue(stats.done)
+        self.assertGreater(stats.bytes_per_second, 0)
+        progress.assert_called_with(stats)
+        with vol.backend.open_handle(vol) as h:
+            allocated = sum(length for _, length in h.extents())
+        self.assertEqual(2 * MiB, allocated)
+
+    def test_import_punches_holes_in_old_data(self):
+        vol = self.backend.create_volume(4 * MiB, 'test')
+        with open(vol.path, 'r+b') as f:
+            f.write(b'x' * 4 * MiB)
+        image.import_image(vol, io.BytesIO(self.data))
+        self.assertEqual(self.data, self._read(vol))
+
+    def test_import_memory(self):
+        backend = memory.Memory()
+        vol = backend.create_volume(4 * MiB, 'test')
+        path = self._path('image.raw')
+        with open(path, 'wb') as f:
+            f.write(self.data)
+        image.import_image(vol, path)
+        store = backend.volumes[vol.volume_id]
+        self.assertEqual(self.data, store.getvalue())
+        self.assertEqual(2 * MiB // memory.PAGE_SIZE, len(store.pages))
+
+    def test_import_resume(self):
+        vol = self.backend.create_volume(4 * MiB, 'test')
+        stats = image.import_image(vol, io.BytesIO(self.data), offset=MiB)
+        self.assertEqual(MiB, stats.transferred)
+        self.assertEqual(bytes(MiB) + self.data[MiB:], self._read(vol))
+
+    def test_import_too_large(self):
+        vol = self.backend.create_volume(MiB, 'test')
+        self.assertRaises(
+            ValueError, image.import_image, vol, io.BytesIO(self.data))
+
+    def test_import_gzip(self):
+        vol = self.backend.create_volume(4 * MiB, 'test')
+        source = io.BytesIO(gzip.compress(self.data))
+        image.import_image(vol, source, compression=image.COMPRESSION_GZIP)
+        self.assertEqual(self.data, self._read(vol))
+
+    def test_compression_checks(self):
+        vol = self.backend.create_volume(4 * MiB, 'test')
+        self.assertRaises(
+            ValueError, image.export_image, vol, io.BytesIO(),
+            compression='lz4')
+        self.assertRaises(
+            ValueError, image.export_image, vol, io.BytesIO(), offset=MiB,
+            compression=image.COMPRESSION_GZIP)
+        with mock.patch.object(image, 'zstandard', None):
+            self.assertRaises(
+                ValueError, image.export_image, vol, io.BytesIO(),
+                compression=image.COMPRESSION_ZSTD)
+
+    def test_export_sparse_file(self):
+        vol = self.backend.create_volume(4 * MiB, 'test')
+        image.import_image(vol, io.BytesIO(self.data))
+        path = self._path('image.raw')
+        stats = image.export_image(vol, path)
+        with open(path, 'rb') as f:
+            self.assertEqual(self.data, f.read())
+        self.assertEqual(2 * MiB, stats.transferred)
+        self.assertEqual(2 * MiB, stats.skipped)
+        self.assertLessEqual(
+            os.stat(path).st_blocks * 512, 2 * MiB + 64 * 1024)
+
+    def test_export_parallel(self):
+        vol = self.backend.create_volume(4 * MiB, 'test')
+        image.import_image(vol, io.BytesIO(self.data))
+        path = self._path('image.raw')
+        progress = mock.Mock()
+        stats = image.export_image(
+            vol, path, progress=progress,
+            copier=copy_engine.CopyEngine(chunk_size=MiB // 2))
+        with open(path, 'rb') as f:
+            self.assertEqual(self.data, f.read())
+        self.assertEqual((2 * MiB, 2 * MiB, 4 * MiB), (
+            stats.transferred, stats.skipped, stats.offset))
+        # once per chunk and once at the end
+        self.assertEqual(5, progress.call_count)
+
+    def test_export_memory_stream(self):
+        backend = memory.Memory()
+        vol = backend.create_volume(4 * MiB, 'test')
+        image.import_image(vol, io.BytesIO(self.data))
+        sink = io.BytesIO()
+        stats = image.export_image(vol, sink)
+        self.assertEqual(self.data, sink.getvalue())
+        self.assertEqual(2 * MiB, stats.transferred)
+
+    def test_export_resume(self):
+        vol = self.backend.create_volume(4 * MiB, 'test')
+        image.import_image(vol, io.BytesIO(self.data))
+        path = self._path('image.raw')
+        with open(path, 'wb') as f:
+            f.write(self.data[:MiB])
+        image.export_image(vol, path, offset=MiB)
+        with open(path, 'rb') as f:
+            self.assertEqual(self.data, f.read())
+
+    def test_export_gzip(self):
+        vol = self.backend.create_volume(4 * MiB, 'test')
+        image.import_image(vol, io.BytesIO(self.data))
+        sink = io.BytesIO()
+        stats = image.export_image(
+            vol, sink, compression=image.COMPRESSION_GZIP)
+        self.assertEqual(self.data, gzip.decompress(sink.getvalue()))
+        self.assertEqual(4 * MiB, stats.transferred)
+
+    def test_export_incremental(self):
+        vol = self.backend.create_volume(4 * MiB, 'test')
+        image.import_image(vol, io.BytesIO(self.data))
+        self.backend.create_checkpoint(vol, 'full')
+        path = self._path('image.raw')
+        image.export_image(vol, path)
+        with vol.backend.open_handle(vol) as h:
+            h.pwrite(b'c' * 10, MiB + 5)
+        self.backend.grow_volume(vol, MiB)
+        stats = image.export_incremental(vol, path, 'full', 'inc')
+        expected = bytearray(self.data + bytes(MiB))
+        expected[MiB + 5:MiB + 15] = b'c' * 10
+        with open(path, 'rb') as f:
+            self.assertEqual(bytes(expected), f.read())
+        self.assertEqual(64 * 1024, stats.transferred)
+        self.assertEqual(5 * MiB, stats.offset)
+        self.assertEqual(['full', 'inc'], self.backend.list_checkpoints(vol))
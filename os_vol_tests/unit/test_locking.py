@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+
+from os_vol import locking
+from os_vol_tests import base_test
+
+
+class TestVolumeLocks(base_test.OSVTestCase):
+    def setUp(self):
+        super().setUp()
+        self.locks = locking.VolumeLocks()
+
+    def test_locks_are_dropped(self):
+        with self.locks.hold('a', 'b'):
+            self.assertEqual(2, len(self.locks))
+        self.assertEqual(0, len(self.locks))
+
+    def test_reentrant(self):
+        with self.locks.hold('a'):
+            with self.locks.hold('a', 'b'):
+                self.assertEqual(2, len(self.locks))
+            self.assertEqual(1, len(self.locks))
+
+    def test_same_key_serialises(self):
+        active = []
+        overlaps = []
+
+        def _worker(key):
+            with self.locks.hold(key):
+                active.append(key)
+                overlaps.append(active.count(key))
+                time.sleep(0.01)
+                active.remove(key)
+
+        threads = [
+            threading.Thread(target=_worker, args=(k,))
+            for k in ['a', 'b'] * 4]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual([1] * 8, overlaps)
+        self.assertEqual(0, len(self.locks))
+
+
+class TestLockTable(base_test.OSVTestCase):
+    def test_checkout(self):
+        table = locking.LockTable(threading.Lock)
+        keys, locks = table.checkout(['b', locking.name_key('a'), 'b'])
+        self.assertEqual(['b', ('name', 'a')], keys)
+        self.assertEqual(2, len(set(map(id, locks))))
+        # a second checkout shares the locks until both are checked in
+        self.assertIs(locks[0], table.checkout(['b'])[1][0])
+        table.checkin(keys)
+        self.assertEqual(1, len(table))
+        table.checkin(['b'])
+        self.assertEqual(0, len(table))
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+
+import contextlib
+from unittest import mock
+
+import fixtures
+
+from os_vol.backends import file_utils
+from os_vol.backends import flat_file
+from os_vol.backends import memory
+from os_vol import metrics
+from os_vol.objects import storeage_pools
+from os_vol_tests import base_test
+
+MiB = 1024 * 1024
+
+
+class TestMetrics(base_test.OSVTestCase):
+    def setUp(self):
+        super().setUp()
+        metrics.REGISTRY.clear()
+        self.addCleanup(metrics.REGISTRY.clear)
+        self.addCleanup(metrics.disable)
+        self.backend = memory.Memory(capacity=1024 * MiB)
+        self.pool = storeage_pools.StoragePool(
+            name='pool1', backend=self.backend)
+
+    def _count(self, layer, name, operation):
+        return metrics.LATENCY.labels(layer, name, operation).count
+
+    def test_disabled(self):
+        self.pool.allocate_volume('vol1', MiB)
+        self.assertEqual('', metrics.exposition().split('\n', 6)[-1])
+        self.assertEqual(
+            0, self._count('backend', 'Memory', 'create_volume'))
+
+    def test_latency(self):
+        metrics.enable()
+        vol = self.pool.allocate_volume('vol1', MiB)
+        self.pool.grow_volume(vol, MiB)
+        self.assertEqual(1, self._count('backend', 'Memory', 'create_volume'))
+        self.assertEqual(1, self._count('pool', 'pool1', 'allocate_volume'))
+        self.assertEqual(1, self._count('backend', 'Memory', 'grow_volume'))
+
+    def test_nested_operations_counted_once(self):
+        metrics.enable()
+        self.backend.create_volumes([('vol1', MiB), ('vol2', MiB)])
+        self.assertEqual(
+            1, self._count('backend', 'Memory', 'create_volumes'))
+        self.assertEqual(0, self._count('backend', 'Memory', 'create_volume'))
+
+    def test_errors(self):
+        metrics.enable()
+        vol = self.pool.allocate_volume('vol1', MiB)
+        with mock.patch.object(memory.PageStore, 'grow',
+                               side_effect=OSError('boom')):
+            self.assertRaises(OSError, self.backend.grow_volume, vol, MiB)
+        self.assertEqual(1, metrics.ERRORS.labels(
+            'backend', 'Memory', 'grow_volume', 'OSError').value)
+        self.assertEqual(1, self._count('backend', 'Memory', 'grow_volume'))
+
+    def test_bytes_copied(self):
+        metrics.enable()
+        vol = self.pool.allocate_volume('vol1', MiB)
+        self.pool.clone_volume(vol, 'vol2')
+        # copy-on-write clones share pages, they copy nothing
+        self.assertEqual(0, metrics.BYTES_COPIED.labels(
+            'backend', 'Memory', 'clone_volume').value)
+
+    def test_bytes_copied_sparse_clone(self):
+        metrics.enable()
+        tempdir = self.useFixture(fixtures.TempDir())
+        backend = flat_file.FlatFile(tempdir.path)
+        self.addCleanup(backend.close)
+        vol = backend.create_volume(MiB, 'vol1')
+        with backend.open_volume(vol) as f:
+            f.write(b'x' * 4096)
+        with mock.patch.object(file_utils, 'reflink', return_value=False):
+            backend.clone_volume(vol, 'vol2')
+        # only the allocated extent is copied, not the whole volume
+        copied = metrics.BYTES_COPIED.labels(
+            'backend', 'FlatFile', 'clone_volume').value
+        self.assertGreaterEqual(copied, 4096)
+        self.assertLess(copied, MiB)
+
+    def test_span_hooks(self):
+        spans = []
+
+        @contextlib.contextmanager
+        def hook(name, attributes):
+            spans.append((name, attributes['os_vol.name']))
+            yield
+
+        metrics.add_span_hook(hook)
+        self.addCleanup(metrics.remove_span_hook, hook)
+        self.pool.allocate_volume('vol1', MiB)
+        self.assertEqual(
+            [('os_vol.pool.allocate_volume', 'pool1'),
+             ('os_vol.backend.create_volume', 'Memory')], spans)
+        # spans do not enable metrics
+        self.assertEqual(0, self._count('pool', 'pool1', 'allocate_volume'))
+
+    def test_otel_hook(self):
+        tracer = mock.MagicMock()
+        hook = metrics.otel_hook(tracer)
+        metrics.add_span_hook(hook)
+        self.addCleanup(metrics.remove_span_hook, hook)
+        self.backend.create_volume(MiB, 'vol1')
+        tracer.start_as_current_span.assert_called_once_with(
+            'os_vol.backend.create_volume', attributes={
+                'os_vol.layer': 'backend', 'os_vol.name': 'Memory',
+                'os_vol.operation': 'create_volume'})
+
+    def test_exposition(self):
+        registry = metrics.Registry()
+        hist = registry.register(metrics.Histogram(
+            'op_seconds', 'Op latency.', ('op',), buckets=(0.1, 1)))
+        counter = registry.register(metrics.Counter(
+            'op_errors_total', 'Op errors.', ('op',)))
+        hist.labels('create').observe(0.05)
+        hist.labels('create').observe(0.5)
+        counter.labels('a"b').inc(2)
+        self.assertEqual(
+            '# HELP op_seconds Op latency.\n'
+            '# TYPE op_seconds histogram\n'
+            'op_seconds_bucket{op="create",le="0.1"} 1\n'
+            'op_seconds_bucket{op="create",le="1"} 2\n'
+            'op_seconds_bucket{op="create",le="+Inf"} 2\n'
+            'op_seconds_sum{op="create"} 0.55\n'
+            'op_seconds_count{op="create"} 2\n'
+            '# HELP op_errors_total Op errors.\n'
+            '# TYPE op_errors_total counter\n'
+            'op_errors_total{op="a\\"b"} 2\n',
+            metrics.exposition(registry))
+
+    def test_labels(self):
+        self.assertRaises(ValueError, metrics.ERRORS.labels, 'backend')
+        self.assertRaises(
+            ValueError, metrics.BYTES_COPIED.labels('a', 'b', 'c').inc, -1)
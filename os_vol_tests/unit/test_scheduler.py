@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+
+import threading
+from unittest import mock
+
+from os_vol.backends import memory
+from os_vol.objects import storeage_pools
+from os_vol import scheduler
+from os_vol_tests import base_test
+
+MiB = 1024 * 1024
+
+
+def _pool(name, capacity, pool_type='fake', **kwargs):
+    return storeage_pools.StoragePool(
+        name=name, pool_type=pool_type,
+        backend=memory.Memory(capacity=capacity), **kwargs)
+
+
+class TestPoolScheduler(base_test.OSVTestCase):
+    def setUp(self):
+        super().setUp()
+        self.pools = [_pool('small', 10 * MiB), _pool('medium', 20 * MiB),
+                      _pool('large', 40 * MiB, pool_type='ssd')]
+        self.scheduler = scheduler.PoolScheduler(self.pools)
+
+    def test_spread(self):
+        vol = self.scheduler.allocate_volume('vol1', MiB)
+        self.assertEqual('large', vol.pool_ref.name)
+        placed = self.scheduler.place_volumes(
+            scheduler.PlacementRequest(f'vol-{i}', 10 * MiB)
+            for i in range(4))
+        self.assertEqual(['large', 'large', 'medium', 'large'],
+                         [p.name for p in placed])
+
+    def test_pack(self):
+        self.scheduler.weighers = [scheduler.PackWeigher()]
+        self.assertEqual('small', self.scheduler.allocate_volume(
+            'vol1', MiB).pool_ref.name)
+        self.assertEqual('medium', self.scheduler.allocate_volume(
+            'vol2', 10 * MiB).pool_ref.name)
+
+    def test_least_used(self):
+        self.scheduler.weighers = [scheduler.LeastUsedWeigher()]
+        self.pools[2].allocate_volume('big', 30 * MiB)
+        self.pools[1].allocate_volume('mid', 5 * MiB)
+        self.scheduler.refresh()
+        self.assertEqual('small', self.scheduler.allocate_volume(
+            'vol1', MiB).pool_ref.name)
+
+    def test_combined_weighers(self):
+        self.scheduler.weighers = [
+            scheduler.LeastUsedWeigher(multiplier=0.1),
+            scheduler.PackWeigher()]
+        self.assertEqual(
+            'small', self.scheduler.place(
+                scheduler.PlacementRequest('vol1', MiB)).name)
+
+    def test_pool_type(self):
+        placed = self.scheduler.place(
+            scheduler.PlacementRequest('vol1', MiB, pool_type='fake'))
+        self.assertEqual('medium', placed.name)
+        self.assertRaises(
+            scheduler.InsufficientCapacity, self.scheduler.place,
+            scheduler.PlacementRequest('vol2', MiB, pool_type='nvme'))
+
+    def test_filters(self):
+        # half of each pool must stay free
+        self.scheduler.filters.append(scheduler.FreeSpaceFilter(0.5))
+        self.assertRaises(
+            scheduler.InsufficientCapacity, self.scheduler.place,
+            scheduler.PlacementRequest('vol1', 21 * MiB))
+        self.assertEqual('large', self.scheduler.place(
+            scheduler.PlacementRequest('vol1', 20 * MiB)).name)
+        self.scheduler.filters = [scheduler.OvercommitFilter(2.0)]
+        self.assertRaises(
+            scheduler.InsufficientCapacity, self.scheduler.place,
+            scheduler.PlacementRequest('vol2', 81 * MiB))
+
+    def test_batch_is_all_or_nothing(self):
+        requests = [scheduler.PlacementRequest(f'vol-{i}', 20 * MiB)
+                    for i in range(4)]
+        self.assertRaises(scheduler.InsufficientCapacity,
+                          self.scheduler.place_volumes, requests)
+        self.assertEqual(
+            ['large', 'medium', 'large'],
+            [p.name for p in self.scheduler.place_volumes(requests[:3])])
+
+    def test_allocate_volumes(self):
+        results = self.scheduler.allocate_volumes(
+            scheduler.PlacementRequest(f'vol-{i}', 10 * MiB)
+            for i in range(4))
+        self.assertTrue(all(r.ok for r in results))
+        self.assertEqual(['large', 'large', 'medium', 'large'],
+                         [r.volume.pool_ref.name for r in results])
+        self.assertEqual(30 * MiB, self.pools[2].usage())
+
+    def test_retry_when_pool_is_full(self):
+        self.pools[2].overcommit_ratio = 1.0
+        # the large pool fills up behind the back of the scheduler
+        self.pools[2].allocate_volume('other', 39 * MiB)
+        vol = self.scheduler.allocate_volume('vol1', 5 * MiB)
+        self.assertEqual('medium', vol.pool_ref.name)
+
+    def test_release_on_error(self):
+        with mock.patch.object(self.pools[2], 'allocate_volume',
+                               side_effect=OSError):
+            self.assertRaises(
+                OSError, self.scheduler.allocate_volume, 'vol1', MiB)
+        self.assertEqual(40 * MiB, self.scheduler._states['large'].free)
+
+    def test_stale_snapshot(self):
+        self.pools[2].allocate_volume('other', 35 * MiB)
+        self.scheduler.SNAPSHOT_TTL = 0
+        self.assertEqual('medium', self.scheduler.place(
+            scheduler.PlacementRequest('vol1', MiB)).name)
+
+    def test_full_pool_refreshed(self):
+        pool = _pool('only', 10 * MiB)
+        with mock.patch.object(scheduler.time, 'monotonic',
+                               return_value=100.0) as clock:
+            sched = scheduler.PoolScheduler([pool])
+            vol = sched.allocate_volume('vol1', 10 * MiB)
+            vol.delete()
+            request = scheduler.PlacementRequest('vol2', MiB)
+            self.assertRaises(
+                scheduler.InsufficientCapacity, sched.place, request)
+            # the pool is not a candidate, but its snapshot expires anyway
+            clock.return_value += sched.SNAPSHOT_TTL
+            self.assertIs(pool, sched.place(request))
+
+    def test_snapshot_outside_lock(self):
+        placed = []
+
+        def snapshot():
+            # placements go on while a pool is slow to answer
+            thread = threading.Thread(target=lambda: placed.append(
+                self.scheduler.place(scheduler.PlacementRequest('v', MiB))))
+            thread.start()
+            thread.join(5)
+            return real_snapshot()
+
+        self.scheduler.weighers = [scheduler.PackWeigher()]
+        real_snapshot = self.pools[0].snapshot
+        with mock.patch.object(self.pools[0], 'snapshot',
+                               side_effect=snapshot):
+            self.scheduler.refresh('small')
+        self.assertEqual([self.pools[0]], placed)
+        # the placement made meanwhile is counted in the new snapshot
+        self.assertEqual(9 * MiB, self.scheduler._states['small'].free)
+
+    def test_add_remove_pool(self):
+        self.scheduler.add_pool(_pool('huge', 100 * MiB))
+        self.assertEqual(4, len(self.scheduler))
+        self.assertEqual('huge', self.scheduler.place(
+            scheduler.PlacementRequest('vol1', MiB)).name)
+        self.scheduler.remove_pool('huge')
+        self.assertEqual(
+            [(10 * MiB, 'small'), (20 * MiB, 'medium'), (40 * MiB, 'large')],
+            self.scheduler._index)
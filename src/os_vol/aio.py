@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: Apache-2.0
+"""
+asyncio front-end for backends and storage pools.
+
+Backend operations block, sometimes for minutes, so the wrappers here run
+them on a bounded thread pool. Operations are serialised per volume:
+operations on different volumes run in parallel while conflicting
+operations on the same volume wait for each other.
+
+Operations on different volumes run on several threads at once, so the
+backend must be safe for multithreaded use, as described in
+os_vol.locking. The FlatFile catalog, for one, shares a single
+connection between threads and guards it with a lock.
+"""
+
+import asyncio
+from concurrent import futures
+import contextlib
+import functools
+import typing as ty
+import uuid
+
+from os_vol.backends import api
+from os_vol import locking
+from os_vol.objects import storeage_pools
+from os_vol.objects import types
+from os_vol.objects import volume
+
+DEFAULT_MAX_WORKERS = 8
+
+
+class VolumeLocks:
+    """
+    VolumeLocks hands out an asyncio lock per key.
+
+    The locks are kept in a locking.LockTable, so they are keyed and
+    ordered the same way as the thread locks of pools and backends.
+    """
+
+    def __init__(self):
+        self._table = locking.LockTable(asyncio.Lock)
+
+    def __len__(self) -> int:
+        return len(self._table)
+
+    @contextlib.asynccontextmanager
+    async def hold(self, *keys: ty.Hashable) -> ty.AsyncIterator[None]:
+        """Hold the locks for all keys, acquired in a stable order."""
+        keys, locks = self._table.checkout(keys)
+        acquired = []
+        try:
+            for lock in locks:
+                await lock.acquire()
+                acquired.append(lock)
+            yield
+        finally:
+            for lock in reversed(acquired):
+                lock.release()
+            self._table.checkin(keys)
+
+
+class AsyncBackend:
+    """
+    AsyncBackend exposes the Backend API as coroutines.
+    """
+
+    def __init__(self, backend: api.Backend,
+                 max_workers: int = DEFAULT_MAX_WORKERS,
+                 executor: ty.Optional[futures.Executor] = None):
+        self.backend = backend
+        self._own_executor = executor is None
+        self.executor = executor or futures.ThreadPoolExecutor(
+            max_workers, thread_name_prefix='os-vol')
+        self.locks = VolumeLocks()
+
+    async def _run(self, keys: ty.Iterable[ty.Hashable],
+                   func: ty.Callable, *args) -> ty.Any:
+        loop = asyncio.get_running_loop()
+        async with self.locks.hold(*keys):
+            future = loop.run_in_executor(
+                self.executor, functools.partial(func, *args))
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                # the blocking call can't be interrupted, keep the volume
+                # locked until it has actually finished.
+                await asyncio.wait([future])
+                raise
+
+    def close(self) -> None:
+        if self._own_executor:
+            self.executor.shutdown(wait=True)
+
+    async def create_volume(
+            self, size: types.SIZE_BYTES, name: str,
+            provisioning: str = api.PROVISION_SPARSE) -> volume.Volume:
+        return await self._run(
+            [locking.name_key(name)], self.backend.create_volume, size, name,
+            provisioning)
+
+    async def create_volumes(
+            self, specs: ty.Iterable[ty.Tuple[str, types.SIZE_BYTES]]
+    ) -> ty.List[api.BatchResult]:
+        specs = [api.VolumeSpec(*spec) for spec in specs]
+        return await self._run(
+            [locking.name_key(spec.name) for spec in specs],
+            self.backend.create_volumes, specs)
+
+    async def delete_volume(self, volume: volume.Volume) -> None:
+        return await self._run(
+            [volume.volume_id], self.backend.delete_volume, volume)
+
+    async def delete_volumes(
+            self, volumes: ty.Iterable[volume.Volume]
+    ) -> ty.List[api.BatchResult]:
+        volumes = list(volumes)
+        return await self._run(
+            [v.volume_id for v in volumes],
+            self.backend.delete_volumes, volumes)
+
+    async def grow_volume(
+            self, volume: volume.Volume, size: types.SIZE_BYTES) -> None:
+        return await self._run(
+            [volume.volume_id], self.backend.grow_volume, volume, size)
+
+    async def clone_volume(
+            self, volume: volume.Volume, name: str) -> volume.Volume:
+        return await self._run(
+            [volume.volume_id, locking.name_key(name)],
+            self.backend.clone_volume, volume, name)
+
+    async def shallow_clone_volume(
+            self, volume: volume.Volume, name: str) -> volume.Volume:
+        return await self._run(
+            [volume.volume_id, locking.name_key(name)],
+            self.backend.shallow_clone_volume, volume, name)
+
+    async def flatten_volume(self, volume: volume.Volume) -> None:
+        return await self._run(
+            [volume.volume_id], self.backend.flatten_volume, volume)
+
+    async def open_volume(self, volume: volume.Volume) -> ty.IO:
+        return await self._run(
+            [volume.volume_id], self.backend.open_volume, volume)
+
+    async def host_attach(self, volume: volume.Volume) -> str:
+        return await self._run(
+            [volume.volume_id], self.backend.host_attach, volume)
+
+    async def host_detach(self, volume: volume.Volume) -> None:
+        return await self._run(
+            [volume.volume_id], self.backend.host_detach, volume)
+
+    @contextlib.asynccontextmanager
+    async def attach(self, volume: volume.Volume) -> ty.AsyncIterator[str]:
+        """Attach a volume to the host for the duration of the context."""
+        device = await self.host_attach(volume)
+        try:
+            yield device
+        finally:
+            await self.host_detach(volume)
+
+
+class AsyncStoragePool:
+    """
+    AsyncStoragePool exposes the StoragePool API as coroutines.
+
+    The StoragePool methods run on the executor of an AsyncBackend, under
+    its locks for the volumes involved, so they take the thread locks of
+    the pool, are timed and clean up after failures just as when they are
+    called directly.
+    """
+
+    def __init__(self, pool: storeage_pools.StoragePool,
+                 max_workers: int = DEFAULT_MAX_WORKERS,
+                 executor: ty.Optional[futures.Executor] = None):
+        self.pool = pool
+        self.backend = AsyncBackend(pool.backend, max_workers, executor)
+
+    def close(self) -> None:
+        self.backend.close()
+
+    async def allocate_volume(
+            self, volume_name: str, size: types.SIZE_MB,
+            reservation: ty.Optional[storeage_pools.Reservation] = None,
+            provisioning: str = api.PROVISION_SPARSE) -> volume.Volume:
+        return await self.backend._run(
+            [locking.name_key(volume_name)], self.pool.allocate_volume,
+            volume_name, size, reservation, provisioning)
+
+    async def allocate_volumes(
+            self, specs: ty.Iterable[ty.Tuple[str, types.SIZE_MB]]
+    ) -> ty.List[api.BatchResult]:
+        specs = list(specs)
+        return await self.backend._run(
+            [locking.name_key(spec[0]) for spec in specs],
+            self.pool.allocate_volumes, specs)
+
+    async def deallocate_volume(self, volume: volume.Volume) -> None:
+        return await self.backend._run(
+            [volume.volume_id], self.pool.deallocate_volume, volume)
+
+    async def deallocate_volumes(
+            self, volumes: ty.Iterable[volume.Volume]
+    ) -> ty.List[api.BatchResult]:
+        volumes = list(volumes)
+        return await self.backend._run(
+            [v.volume_id for v in volumes],
+            self.pool.deallocate_volumes, volumes)
+
+    async def grow_volume(
+            self, volume: volume.Volume, size: types.SIZE_MB) -> None:
+        return await self.backend._run(
+            [volume.volume_id], self.pool.grow_volume, volume, size)
+
+    async def clone_volume(
+            self, volume: volume.Volume, name: str) -> volume.Volume:
+        return await self.backend._run(
+            [volume.volume_id, locking.name_key(name)],
+            self.pool.clone_volume, volume, name)
+
+    async def open_volume(self, volume: volume.Volume) -> ty.IO:
+        return await self.backend.open_volume(volume)
+
+    def attach(self, volume: volume.Volume) -> ty.AsyncContextManager[str]:
+        return self.backend.attach(volume)
+
+    def list_volumes(
+            self, limit: ty.Optional[int] = None,
+            marker: ty.Optional[uuid.UUID] = None) -> ty.List[volume.Volume]:
+        return self.pool.list_volumes(limit, marker)
+
+    def usage(self) -> types.SIZE_MB:
+        return self.pool.usage()
+
+    def reserve(self, size: types.SIZE_MB) -> storeage_pools.Reservation:
+        return self.pool.reserve(size)
+
+    def snapshot(
+            self, allocated: bool = False) -> storeage_pools.PoolSnapshot:
+        return self.pool.snapshot(allocated)
+
+    def storage_summary(self) -> ty.Dict[str, ty.Any]:
+        return self.pool.storage_summary()
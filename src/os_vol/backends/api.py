@@ -1,11 +1,56 @@
 # -*- coding: utf-8 -*-
 import abc
 import contextlib
+import dataclasses
 import typing as ty
+import uuid
 
+from os_vol.backends import cbt
+from os_vol.backends import handle
+from os_vol import metrics
 from os_vol.objects import types
 from os_vol.objects import volume
 
+# provisioning modes, how the storage of a volume is allocated
+# blocks are allocated when first written
+PROVISION_SPARSE = 'sparse'
+# blocks are reserved up front without being written
+PROVISION_PREALLOCATED = 'preallocated'
+# blocks are allocated and written with zeros up front
+PROVISION_ZEROED = 'zeroed'
+PROVISIONING_MODES = (
+    PROVISION_SPARSE, PROVISION_PREALLOCATED, PROVISION_ZEROED)
+
+
+def check_provisioning(provisioning: str) -> None:
+    if provisioning not in PROVISIONING_MODES:
+        raise ValueError(f'unknown provisioning mode {provisioning}')
+
+
+class VolumeSpec(ty.NamedTuple):
+    """The name, size in bytes and provisioning of a volume to create."""
+    name: str
+    size: types.SIZE_BYTES
+    provisioning: str = PROVISION_SPARSE
+
+
+@dataclasses.dataclass
+class BatchResult:
+    """
+    BatchResult is the outcome of one item of a batch operation.
+
+    item is the spec or volume that was passed in, volume is the resulting
+    volume if any and error the exception raised if the item failed.
+    """
+
+    item: ty.Any
+    volume: 'ty.Optional[volume.Volume]' = None
+    error: ty.Optional[Exception] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
 
 class Backend(abc.ABC):
     """
@@ -14,15 +59,123 @@ class Backend(abc.ABC):
     A storage backend is responsible for managing the storage for volumes
     within a storage pool.
     """
+    # backends whose volumes outlive the process record them in a catalog,
+    # pools load their volumes from it with the listing methods below.
+    PERSISTENT = False
+    # operations timed by os_vol.metrics, every subclass has its own
+    # implementations of them wrapped when it is defined
+    INSTRUMENTED = (
+        'create_volume', 'delete_volume', 'create_volumes', 'delete_volumes',
+        'grow_volume', 'clone_volume', 'shallow_clone_volume',
+        'flatten_volume', 'discard_volume', 'open_volume', 'open_handle',
+        'host_attach', 'host_detach', 'create_checkpoint', 'delete_checkpoint',
+    )
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # the bytes a clone copies depend on its strategy, backends that
+        # copy data count it themselves with metrics.add_bytes.
+        metrics.instrument_class(
+            cls, metrics.LAYER_BACKEND, cls.INSTRUMENTED)
+
+    def get_capacity(self) -> types.SIZE_BYTES:
+        """Return the total capacity of the backend in bytes.
+
+        Implementations are expected to make this cheap enough to poll, for
+        example by caching the value.
+        """
+        raise NotImplementedError
+
+    def get_provisioned(self) -> types.SIZE_BYTES:
+        """Return the sum of the sizes of all volumes in bytes."""
+        raise NotImplementedError
+
+    def get_allocated(self) -> types.SIZE_BYTES:
+        """Return the bytes of storage physically allocated to volumes.
+
+        Volumes are thin provisioned, this is usually well below the
+        provisioned size. Like get_capacity it may be cached.
+        """
+        raise NotImplementedError
+
+    def get_volume_allocated(self, volume: volume.Volume) -> types.SIZE_BYTES:
+        """Return the bytes of storage physically allocated to a volume."""
+        raise NotImplementedError
+
+    def get_volume(
+            self, volume_id: uuid.UUID) -> ty.Optional[volume.Volume]:
+        """Return the volume with volume_id, or None if there is none."""
+        raise NotImplementedError
+
+    def list_volumes(
+            self, limit: ty.Optional[int] = None,
+            marker: ty.Optional[uuid.UUID] = None) -> ty.List[volume.Volume]:
+        """Return up to limit volumes ordered by id.
+
+        Listing starts after the volume with id marker so a caller can page
+        through all volumes by passing the id of the last volume it got.
+        """
+        raise NotImplementedError
+
+    def count_volumes(self) -> int:
+        """Return the number of volumes in the backend."""
+        raise NotImplementedError
+
+    def get_totals(self) -> ty.Tuple[int, types.SIZE_BYTES]:
+        """Return the number of volumes and the provisioned bytes.
+
+        Backends that can should read both at once so they agree.
+        """
+        return self.count_volumes(), self.get_provisioned()
+
     @abc.abstractmethod
     def create_volume(
-            self, size: types.SIZE_BYTES,  name: str) -> volume.Volume:
+            self, size: types.SIZE_BYTES,  name: str,
+            provisioning: str = PROVISION_SPARSE) -> volume.Volume:
+        """Create a volume, allocating its storage as provisioning says.
+
+        The mode is recorded on the volume and also applies when it grows.
+        """
         pass
 
     @abc.abstractmethod
     def delete_volume(self, volume: volume.Volume):
         pass
 
+    def create_volumes(
+            self, specs: ty.Iterable[ty.Tuple[str, types.SIZE_BYTES]]
+    ) -> ty.List[BatchResult]:
+        """Create a volume for each (name, size[, provisioning]) spec.
+
+        A failure only affects its own item, the result for each spec is
+        returned in order. Backends can override this to batch the work.
+        """
+        results = []
+        for spec in specs:
+            spec = VolumeSpec(*spec)
+            try:
+                vol = self.create_volume(
+                    spec.size, spec.name, spec.provisioning)
+            except Exception as e:
+                results.append(BatchResult(spec, error=e))
+            else:
+                results.append(BatchResult(spec, vol))
+        return results
+
+    def delete_volumes(
+            self, volumes: ty.Iterable[volume.Volume]
+    ) -> ty.List[BatchResult]:
+        """Delete each volume, returning the result for each in order."""
+        results = []
+        for vol in volumes:
+            try:
+                self.delete_volume(vol)
+            except Exception as e:
+                results.append(BatchResult(vol, vol, e))
+            else:
+                results.append(BatchResult(vol, vol))
+        return results
+
     @abc.abstractmethod
     def grow_volume(self, volume: volume.Volume, size: types.SIZE_BYTES):
         """Grow a volume by size in byets."""
@@ -46,11 +199,105 @@ class Backend(abc.ABC):
         """
         return self.clone_volume(volume, name)
 
+    def flatten_volume(self, volume: volume.Volume) -> None:
+        """Copy all data shared with a parent volume into the volume.
+
+        After flattening the volume no longer depends on the volume it was
+        shallow cloned from. Backends without shallow clones have nothing to
+        flatten.
+        """
+        pass
+
+    def has_shallow_clones(self, volume: volume.Volume) -> bool:
+        """Return whether other volumes are shallow clones of a volume.
+
+        Such a volume can't be deleted until its clones are flattened.
+        Backends without shallow clones never have any.
+        """
+        return False
+
+    def discard_volume(self, volume: volume.Volume, offset: int = 0,
+                       length: ty.Optional[int] = None) -> None:
+        """Discard a range of a volume so it reads as zeros.
+
+        Backends that can deallocate the range release its storage, so
+        this reclaims the space of data that is no longer needed. The
+        default discards through a handle.
+        """
+        if length is None:
+            length = volume.size - offset
+        with self.open_handle(volume) as f:
+            f.write_zeroes(offset, length)
+
     @abc.abstractmethod
     def open_volume(self, volume: volume.Volume) -> ty.IO:
         """Open a volume for reading and writing in binary mode."""
         pass
 
+    def open_handle(self, volume: volume.Volume) -> handle.VolumeHandle:
+        """Open a volume for positional I/O.
+
+        The default adapts the file object returned by open_volume, backends
+        override this to provide zero-copy access.
+        """
+        return handle.FileObjectHandle(self.open_volume(volume), volume.size)
+
+    def get_tracker(self, volume: volume.Volume) -> cbt.ChangeTracker:
+        """Return the changed block tracker of a volume.
+
+        Backends that track changes return the same tracker for a volume
+        until it is deleted and record in it every write made through the
+        file objects and handles they open.
+        """
+        raise NotImplementedError
+
+    def create_checkpoint(self, volume: volume.Volume, name: str) -> None:
+        """Create a named checkpoint to track changes from.
+
+        Writes are tracked from the first checkpoint of a volume on,
+        including those through file objects and handles opened before it.
+        """
+        self.get_tracker(volume).add_checkpoint(name)
+
+    def delete_checkpoint(self, volume: volume.Volume, name: str) -> None:
+        """Delete a checkpoint, later checkpoints are not affected."""
+        self.get_tracker(volume).remove_checkpoint(name)
+
+    def list_checkpoints(self, volume: volume.Volume) -> ty.List[str]:
+        """Return the names of the checkpoints of a volume, oldest first."""
+        return self.get_tracker(volume).names()
+
+    def export_incremental(
+            self, volume: volume.Volume, since: str,
+            checkpoint: ty.Optional[str] = None
+    ) -> ty.Iterator[ty.Tuple[int, bytes]]:
+        """Return the data changed since a checkpoint as (offset, data).
+
+        Only the blocks written since the checkpoint since are read, so the
+        cost is proportional to the changes rather than the volume size.
+        If checkpoint is given it is created before anything is read, the
+        next incremental export can start from it without missing a write.
+
+        :raises ValueError: if since is not a checkpoint of the volume.
+        """
+        changed = self.get_tracker(volume).changed_since(since, checkpoint)
+        return self._read_extents(volume, changed.extents(volume.size))
+
+    def _read_extents(
+            self, volume: volume.Volume,
+            extents: ty.Iterable[ty.Tuple[int, int]]
+    ) -> ty.Iterator[ty.Tuple[int, bytes]]:
+        with self.open_handle(volume) as src:
+            for offset, length in extents:
+                end = offset + length
+                while offset < end:
+                    data = src.pread(
+                        min(handle.COPY_BUFFER_SIZE, end - offset), offset)
+                    if not data:
+                        break
+                    yield offset, data
+                    offset += len(data)
+
     @abc.abstractmethod
     def host_attach(self, volume: volume.Volume) -> str:
         """Attach a volume as a block device to the host."""
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: Apache-2.0
+"""
+SQLite backed catalog of volume metadata.
+
+The catalog keeps one row per volume with indexes on the columns used for
+lookups. Aggregates such as the volume count and provisioned bytes are kept
+in a single row maintained by triggers, so they are updated in the same
+transaction as the volume rows and reading them is O(1).
+"""
+
+import contextlib
+import sqlite3
+import threading
+import typing as ty
+
+Record = ty.Dict[str, ty.Any]
+
+# rows fetched per query when iterating over the whole catalog
+PAGE_SIZE = 1000
+
+COLUMNS = (
+    'volume_id', 'name', 'size', 'volume_type', 'path', 'device_path',
+    'clone_strategy', 'parent_id', 'provisioning',
+)
+
+# columns added after the first release, added to older catalogs on open
+_MIGRATIONS = (
+    ('provisioning', 'TEXT'),
+)
+
+_SCHEMA = """
+BEGIN IMMEDIATE;
+CREATE TABLE IF NOT EXISTS volumes (
+    volume_id TEXT PRIMARY KEY NOT NULL,
+    name TEXT,
+    size INTEGER NOT NULL,
+    volume_type TEXT,
+    path TEXT NOT NULL,
+    device_path TEXT,
+    clone_strategy TEXT,
+    parent_id TEXT,
+    provisioning TEXT
+);
+CREATE INDEX IF NOT EXISTS volumes_name ON volumes (name);
+CREATE INDEX IF NOT EXISTS volumes_parent_id ON volumes (parent_id);
+
+CREATE TABLE IF NOT EXISTS stats (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    volumes INTEGER NOT NULL,
+    provisioned INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO stats (id, volumes, provisioned) VALUES (0, 0, 0);
+
+CREATE TRIGGER IF NOT EXISTS volumes_insert AFTER INSERT ON volumes
+BEGIN
+    UPDATE stats SET volumes = volumes + 1,
+                     provisioned = provisioned + NEW.size WHERE id = 0;
+END;
+CREATE TRIGGER IF NOT EXISTS volumes_delete AFTER DELETE ON volumes
+BEGIN
+    UPDATE stats SET volumes = volumes - 1,
+                     provisioned = provisioned - OLD.size WHERE id = 0;
+END;
+CREATE TRIGGER IF NOT EXISTS volumes_resize AFTER UPDATE OF size ON volumes
+BEGIN
+    UPDATE stats SET provisioned = provisioned - OLD.size + NEW.size
+        WHERE id = 0;
+END;
+COMMIT;
+"""
+
+_UPSERT = (
+    f'INSERT INTO volumes ({", ".join(COLUMNS)}) '
+    f'VALUES ({", ".join("?" for _ in COLUMNS)}) '
+    'ON CONFLICT (volume_id) DO UPDATE SET ' +
+    ', '.join(f'{c} = excluded.{c}' for c in COLUMNS[1:])
+)
+
+
+class Catalog:
+    """
+    Catalog stores volume records in a SQLite database in WAL mode.
+
+    Every write runs in a transaction so a crash leaves the catalog either
+    before or after the change, never part way through it. The connection is
+    shared between threads and guarded by a lock that is held for the
+    duration of each query or transaction.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        # autocommit mode, transactions are managed explicitly below
+        self._conn = sqlite3.connect(
+            path, isolation_level=None, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute('PRAGMA journal_mode = WAL')
+        # with WAL, NORMAL keeps the database consistent across crashes and
+        # only risks losing the last transactions on power loss.
+        self._conn.execute('PRAGMA synchronous = NORMAL')
+        self._depth = 0
+        self._lock = threading.RLock()
+        self._conn.executescript(_SCHEMA)
+        self._migrate()
+
+    def _migrate(self) -> None:
+        columns = {row['name'] for row in self._conn.execute(
+            'PRAGMA table_info(volumes)')}
+        missing = [(c, t) for c, t in _MIGRATIONS if c not in columns]
+        if not missing:
+            return
+        with self.transaction() as conn:
+            for column, column_type in missing:
+                conn.execute(
+                    f'ALTER TABLE volumes ADD COLUMN {column} {column_type}')
+
+    def close(self) -> None:
+        self._conn.close()
+
+    @contextlib.contextmanager
+    def transaction(self) -> ty.Iterator[sqlite3.Connection]:
+        """Group catalog writes into a single atomic transaction.
+
+        Transactions may be nested, only the outermost one commits. Other
+        threads are blocked from the catalog until it does.
+        """
+        with self._lock:
+            if self._depth == 0:
+                self._conn.execute('BEGIN IMMEDIATE')
+            self._depth += 1
+            try:
+                yield self._conn
+            except BaseException:
+                self._depth -= 1
+                if self._depth == 0:
+                    self._conn.execute('ROLLBACK')
+                raise
+            self._depth -= 1
+            if self._depth == 0:
+                self._conn.execute('COMMIT')
+
+    def _query(self, sql: str, params: ty.Sequence = ()) -> ty.List[tuple]:
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def put(self, record: Record) -> None:
+        """Insert or replace the record for record['volume_id']."""
+        with self.transaction() as conn:
+            conn.execute(_UPSERT, [record.get(c) for c in COLUMNS])
+
+    def put_many(self, records: ty.Iterable[Record]) -> None:
+        with self.transaction() as conn:
+            conn.executemany(
+                _UPSERT, ([r.get(c) for c in COLUMNS] for r in records))
+
+    def delete(self, volume_id: str) -> None:
+        with self.transaction() as conn:
+            conn.execute(
+                'DELETE FROM volumes WHERE volume_id = ?', (volume_id,))
+
+    def delete_many(self, volume_ids: ty.Iterable[str]) -> None:
+        with self.transaction() as conn:
+            conn.executemany(
+                'DELETE FROM volumes WHERE volume_id = ?',
+                ((volume_id,) for volume_id in volume_ids))
+
+    def get(self, volume_id: str) -> ty.Optional[Record]:
+        rows = self._query(
+            'SELECT * FROM volumes WHERE volume_id = ?', (volume_id,))
+        return dict(rows[0]) if rows else None
+
+    def get_by_name(self, name: str) -> ty.Optional[Record]:
+        rows = self._query('SELECT * FROM volumes WHERE name = ?', (name,))
+        return dict(rows[0]) if rows else None
+
+    def has_children(self, volume_id: str) -> bool:
+        """Return True if any volume is a shallow clone of volume_id."""
+        return bool(self._query(
+            'SELECT 1 FROM volumes WHERE parent_id = ? LIMIT 1',
+            (volume_id,)))
+
+    def children(self, volume_id: str) -> ty.List[str]:
+        """Return the ids of the shallow clones of volume_id."""
+        return [row[0] for row in self._query(
+            'SELECT volume_id FROM volumes WHERE parent_id = ?',
+            (volume_id,))]
+
+    def __contains__(self, volume_id: str) -> bool:
+        return self.get(volume_id) is not None
+
+    def __len__(self) -> int:
+        return self._query('SELECT volumes FROM stats WHERE id = 0')[0][0]
+
+    def __iter__(self) -> ty.Iterator[Record]:
+        marker = None
+        while True:
+            records = self.page(PAGE_SIZE, marker)
+            yield from records
+            if len(records) < PAGE_SIZE:
+                return
+            marker = records[-1]['volume_id']
+
+    def page(self, limit: ty.Optional[int] = None,
+             marker: ty.Optional[str] = None) -> ty.List[Record]:
+        """Return up to limit records ordered by volume_id after marker.
+
+        Pages are found through the primary key index, so fetching a page
+        costs the same wherever it is in the catalog.
+        """
+        sql = 'SELECT * FROM volumes'
+        params: ty.List[ty.Any] = []
+        if marker is not None:
+            sql += ' WHERE volume_id > ?'
+            params.append(marker)
+        sql += ' ORDER BY volume_id'
+        if limit is not None:
+            sql += ' LIMIT ?'
+            params.append(limit)
+        return [dict(row) for row in self._query(sql, params)]
+
+    def totals(self) -> ty.Tuple[int, int]:
+        """Return the volume count and provisioned bytes in one read."""
+        row = self._query(
+            'SELECT volumes, provisioned FROM stats WHERE id = 0')[0]
+        return row[0], row[1]
+
+    @property
+    def provisioned_bytes(self) -> int:
+        """The sum of the size of all volumes in the catalog."""
+        return self._query(
+            'SELECT provisioned FROM stats WHERE id = 0')[0][0]
@@ -0,0 +1,420 @@
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: Apache-2.0
+"""
+Changed block tracking for incremental backups.
+
+A ChangeTracker records which blocks of a volume are written after each of
+its named checkpoints, in one DirtyBitmap per checkpoint holding the blocks
+changed between it and the next one. The blocks changed since a checkpoint
+are the union of its bitmap and those of the checkpoints after it, so only
+they need to be read for an incremental backup.
+
+Writes are tracked by wrapping every file object and handle a backend
+opens in TrackedFile and TrackedHandle, whether or not the volume has a
+checkpoint yet. Whether a write is recorded is decided when it is made,
+so handles opened before the first checkpoint are tracked from it on and
+wrapping costs a single check per write while there is none. A tracker
+with a path persists its checkpoints there. It is marked unclean before
+the first write after a save, so if the process dies before the next save
+every block is treated as changed when it is loaded again, rather than
+changes being lost.
+
+The wrappers mark a write both before and after it. A checkpoint created
+while a write is in flight then holds the write in the bitmaps on both
+sides of it, so a reader that copies the blocks changed since the earlier
+checkpoint after creating the later one, as a live migration does, can't
+read a block before the write lands and then lose track of it.
+"""
+
+import base64
+import contextlib
+import io
+import json
+import os
+import re
+import threading
+import typing as ty
+import zlib
+
+from os_vol.backends import handle
+
+BLOCK_SIZE = 64 * 1024
+SUFFIX = '.cbt'
+FORMAT_VERSION = 1
+
+_NONZERO = re.compile(rb'[^\x00]+')
+
+
+def tracker_path(path: str) -> str:
+    return f'{path}{SUFFIX}'
+
+
+class DirtyBitmap:
+    """
+    DirtyBitmap is a growable bitmap of changed blocks.
+    """
+
+    def __init__(self, bits: ty.Optional[bytearray] = None):
+        self.bits = bits if bits is not None else bytearray()
+
+    def __contains__(self, block: int) -> bool:
+        byte = block >> 3
+        return byte < len(self.bits) and bool(
+            self.bits[byte] & (1 << (block & 7)))
+
+    def __iter__(self) -> ty.Iterator[int]:
+        # runs of zero bytes are skipped by the regex engine, so iterating
+        # a large, mostly clean bitmap is cheap
+        for run in _NONZERO.finditer(self.bits):
+            for byte in range(run.start(), run.end()):
+                value = self.bits[byte]
+                for bit in range(8):
+                    if value & (1 << bit):
+                        yield (byte << 3) | bit
+
+    def __len__(self) -> int:
+        return sum(bin(b).count('1') for b in self.bits)
+
+    def __bool__(self) -> bool:
+        return any(self.bits)
+
+    def _set(self, first: int, end: int) -> None:
+        """Set the bits of blocks first to end, exclusive."""
+        if first >= end:
+            return
+        last_byte = (end - 1) >> 3
+        if last_byte >= len(self.bits):
+            self.bits.extend(bytes(last_byte + 1 - len(self.bits)))
+        first_byte = first >> 3
+        if first_byte == last_byte:
+            for block in range(first, end):
+                self.bits[first_byte] |= 1 << (block & 7)
+            return
+        self.bits[first_byte] |= (0xff << (first & 7)) & 0xff
+        self.bits[first_byte + 1:last_byte] = (
+            b'\xff' * (last_byte - first_byte - 1))
+        self.bits[last_byte] |= 0xff >> (7 - ((end - 1) & 7))
+
+    def mark(self, offset: int, length: int) -> None:
+        """Mark the blocks overlapping a byte range as changed."""
+        if length > 0:
+            self._set(offset // BLOCK_SIZE,
+                      -(-(offset + length) // BLOCK_SIZE))
+
+    def update(self, other: 'DirtyBitmap') -> None:
+        """Add the blocks marked in other."""
+        if len(other.bits) > len(self.bits):
+            self.bits.extend(bytes(len(other.bits) - len(self.bits)))
+        for run in _NONZERO.finditer(other.bits):
+            for byte in range(run.start(), run.end()):
+                self.bits[byte] |= other.bits[byte]
+
+    def copy(self) -> 'DirtyBitmap':
+        return DirtyBitmap(bytearray(self.bits))
+
+    def extents(self, size: int) -> ty.Iterator[ty.Tuple[int, int]]:
+        """Yield (offset, length) for each run of changed blocks.
+
+        Runs are clipped to size so blocks past the end of a volume that
+        shrank are not reported.
+        """
+        start = end = None
+        for block in self:
+            if block * BLOCK_SIZE >= size:
+                break
+            if block != end:
+                if start is not None:
+                    yield start * BLOCK_SIZE, (end - start) * BLOCK_SIZE
+                start = block
+            end = block + 1
+        if start is not None:
+            yield start * BLOCK_SIZE, min(
+                end * BLOCK_SIZE, size) - start * BLOCK_SIZE
+
+
+class ChangeTracker:
+    """
+    ChangeTracker holds the checkpoints of a volume and their bitmaps.
+
+    Writes are only recorded while the volume has a checkpoint. All methods
+    are thread safe, a single tracker is shared by every open handle of its
+    volume.
+    """
+
+    def __init__(self, path: ty.Optional[str] = None,
+                 checkpoints: ty.Optional[
+                     ty.List[ty.Tuple[str, DirtyBitmap]]] = None):
+        self.path = path
+        # (name, blocks changed after it up to the next checkpoint), oldest
+        # first, writes go to the bitmap of the last one
+        self.checkpoints = checkpoints if checkpoints is not None else []
+        self.lock = threading.Lock()
+        # true when writes were marked since the last save
+        self.dirty = False
+
+    @classmethod
+    def load(cls, path: str, size: int) -> 'ChangeTracker':
+        """Load a tracker, an empty one if path does not exist.
+
+        If the tracker was not saved cleanly every block of the volume is
+        marked as changed since the last checkpoint.
+        """
+        try:
+            with open(path, 'rb') as f:
+                data = json.loads(f.read())
+        except FileNotFoundError:
+            return cls(path)
+        tracker = cls(path, [
+            (name, DirtyBitmap(bytearray(
+                zlib.decompress(base64.b64decode(bits)))))
+            for name, bits in data['checkpoints']])
+        if not data['clean'] and tracker.checkpoints:
+            tracker.checkpoints[-1][1].mark(0, size)
+            tracker.save()
+        return tracker
+
+    def _save(self, clean: bool) -> None:
+        # called with the lock held
+        if self.path is None:
+            return
+        data = json.dumps({
+            'version': FORMAT_VERSION,
+            'block_size': BLOCK_SIZE,
+            'clean': clean,
+            'checkpoints': [
+                (name, base64.b64encode(
+                    zlib.compress(bytes(bitmap.bits))).decode('ascii'))
+                for name, bitmap in self.checkpoints],
+        })
+        tmp = f'{self.path}.tmp'
+        with open(tmp, 'w') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+    def save(self) -> None:
+        """Atomically persist the checkpoints, marking them clean."""
+        with self.lock:
+            self._save(clean=True)
+            self.dirty = False
+
+    def flush(self) -> None:
+        """Save the tracker if writes were marked since the last save."""
+        if self.dirty:
+            self.save()
+
+    def delete(self) -> None:
+        """Drop every checkpoint and remove the persisted tracker."""
+        with self.lock:
+            self.checkpoints = []
+            self.dirty = False
+            if self.path is not None:
+                try:
+                    os.remove(self.path)
+                except FileNotFoundError:
+                    pass
+
+    @property
+    def active(self) -> bool:
+        return bool(self.checkpoints)
+
+    def names(self) -> ty.List[str]:
+        return [name for name, _ in self.checkpoints]
+
+    def mark(self, offset: int, length: int) -> None:
+        """Record a write, call this before and after the data is written."""
+        # checked again under the lock, a checkpoint created after this
+        # check is seen by the mark made after the write
+        if not self.checkpoints:
+            return
+        with self.lock:
+            if not self.checkpoints:
+                return
+            if not self.dirty:
+                # persist that the tracker is out of date before the write
+                # can land, so a crash can not lose it
+                self._save(clean=False)
+                self.dirty = True
+            self.checkpoints[-1][1].mark(offset, length)
+
+    def mark_all(self, size: int) -> None:
+        """Record that any block up to size may have changed."""
+        self.mark(0, size)
+
+    def _index(self, name: str) -> int:
+        for i, (checkpoint, _) in enumerate(self.checkpoints):
+            if checkpoint == name:
+                return i
+        raise ValueError(f'unknown checkpoint {name}')
+
+    def add_checkpoint(self, name: str) -> None:
+        with self.lock:
+            self._add_checkpoint(name)
+
+    def _add_checkpoint(self, name: str) -> None:
+        if name in self.names():
+            raise ValueError(f'checkpoint {name} already exists')
+        self.checkpoints.append((name, DirtyBitmap()))
+        self._save(clean=not self.dirty)
+
+    def remove_checkpoint(self, name: str) -> None:
+        """Remove a checkpoint, its changes are kept by the one before."""
+        with self.lock:
+            i = self._index(name)
+            _, bitmap = self.checkpoints.pop(i)
+            if i:
+                self.checkpoints[i - 1][1].update(bitmap)
+            self._save(clean=not self.dirty)
+
+    def changed_since(self, name: str,
+                      checkpoint: ty.Optional[str] = None) -> DirtyBitmap:
+        """Return the blocks changed since the checkpoint name.
+
+        If checkpoint is given it is created at the same time, so no write
+        is missed between the two.
+        """
+        with self.lock:
+            i = self._index(name)
+            changed = self.checkpoints[i][1].copy()
+            for _, bitmap in self.checkpoints[i + 1:]:
+                changed.update(bitmap)
+            if checkpoint is not None:
+                self._add_checkpoint(checkpoint)
+            return changed
+
+
+class TrackedFile(io.RawIOBase):
+    """
+    TrackedFile wraps a binary file object, recording writes in a tracker.
+
+    The file object must be unbuffered: a write is marked again once it
+    returns, which only covers it if the data has reached the volume.
+    """
+
+    def __init__(self, fileobj: ty.Any, tracker: ChangeTracker):
+        super().__init__()
+        self.fileobj = fileobj
+        self.tracker = tracker
+
+    def readable(self) -> bool:
+        return True
+
+    def writable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.fileobj.tell()
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        return self.fileobj.seek(offset, whence)
+
+    def readinto(self, buf) -> int:
+        return self.fileobj.readinto(buf)
+
+    def write(self, buf) -> int:
+        offset = self.fileobj.tell()
+        self.tracker.mark(offset, memoryview(buf).nbytes)
+        n = self.fileobj.write(buf)
+        self.tracker.mark(offset, memoryview(buf).nbytes)
+        return n
+
+    def truncate(self, size: ty.Optional[int] = None) -> int:
+        pos = self.fileobj.tell()
+        size = pos if size is None else size
+        end = self.fileobj.seek(0, io.SEEK_END)
+        self.fileobj.seek(pos)
+        # blocks cut off read back as zeros if the file grows again
+        self.tracker.mark(size, end - size)
+        size = self.fileobj.truncate(size)
+        self.tracker.mark(size, end - size)
+        return size
+
+    def flush(self) -> None:
+        if not self.closed:
+            self.fileobj.flush()
+            self.tracker.flush()
+        super().flush()
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        try:
+            # flushes the tracker along with the file
+            super().close()
+        finally:
+            self.fileobj.close()
+
+
+class TrackedHandle(handle.VolumeHandle):
+    """
+    TrackedHandle wraps a VolumeHandle, recording writes in a tracker.
+
+    It has no fileno, so nothing can write to it behind the tracker's back.
+    Copies still use the descriptor of the inner handle through read_fileno
+    and copy_from, which records the range like pwrite does.
+    """
+
+    def __init__(self, inner: handle.VolumeHandle, tracker: ChangeTracker):
+        super().__init__()
+        self.inner = inner
+        self.tracker = tracker
+
+    @property
+    def size(self) -> int:
+        return self.inner.size
+
+    def pread(self, size: int, offset: int) -> bytes:
+        return self.inner.pread(size, offset)
+
+    def readinto(self, buf, offset: int) -> int:
+        return self.inner.readinto(buf, offset)
+
+    def pwrite(self, data, offset: int) -> int:
+        length = len(data) if isinstance(data, bytes) else (
+            memoryview(data).nbytes)
+        self.tracker.mark(offset, length)
+        n = self.inner.pwrite(data, offset)
+        self.tracker.mark(offset, length)
+        return n
+
+    def write_zeroes(self, offset: int, length: int) -> None:
+        self.tracker.mark(offset, length)
+        self.inner.write_zeroes(offset, length)
+        self.tracker.mark(offset, length)
+
+    def read_fileno(self) -> ty.Optional[int]:
+        return self.inner.read_fileno()
+
+    def copy_from(self, src_fd: int, offset: int, length: int) -> int:
+        self.tracker.mark(offset, length)
+        n = self.inner.copy_from(src_fd, offset, length)
+        self.tracker.mark(offset, length)
+        return n
+
+    def extents(self) -> ty.Iterator[ty.Tuple[int, int]]:
+        return self.inner.extents()
+
+    @contextlib.contextmanager
+    def map(self, offset: int = 0,
+            length: ty.Optional[int] = None) -> ty.Iterator[memoryview]:
+        length = self.size - offset if length is None else length
+        self.tracker.mark(offset, length)
+        with self.inner.map(offset, length) as view:
+            yield view
+        self.tracker.mark(offset, length)
+
+    def flush(self) -> None:
+        self.inner.flush()
+        self.tracker.flush()
+
+    def close(self) -> None:
+        if not self.closed:
+            try:
+                self.tracker.flush()
+            finally:
+                self.inner.close()
+        super().close()
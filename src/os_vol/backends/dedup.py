@@ -0,0 +1,365 @@
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: Apache-2.0
+"""
+Deduplicating in-memory backend.
+
+Volumes are maps of fixed size blocks to the SHA-256 digests of their
+contents, the contents are kept once per digest in a refcounted
+ChunkStore shared by all volumes of the backend. Identical blocks in any
+volume are stored once, clones only copy the block map and blocks that are
+all zeros are not stored at all.
+
+Chunks whose last reference is dropped are kept as garbage until the next
+collection, so data written again before then is not copied again.
+"""
+
+import dataclasses
+import hashlib
+import threading
+import typing as ty
+import uuid
+
+from os_vol.backends import api
+from os_vol.backends import memory
+
+BLOCK_SIZE = 64 * 1024
+CLONE_DEDUP = 'dedup'
+
+_ZERO_BLOCK = bytes(BLOCK_SIZE)
+
+
+def _digest(data) -> bytes:
+    return hashlib.sha256(data).digest()
+
+
+class ChunkStore:
+    """
+    ChunkStore holds chunks by digest and counts references to them.
+
+    The counters behind DedupReport are maintained on every update, so
+    reports are O(1). All methods are thread safe.
+    """
+
+    def __init__(self):
+        self._chunks: ty.Dict[bytes, bytes] = {}
+        self._refs: ty.Dict[bytes, int] = {}
+        # chunks with no references, removed by collect
+        self._garbage: ty.Set[bytes] = set()
+        self._lock = threading.Lock()
+        self.stored_bytes = 0
+        self.referenced_bytes = 0
+        self.garbage_bytes = 0
+
+    def __len__(self) -> int:
+        return len(self._chunks)
+
+    def __contains__(self, digest: bytes) -> bool:
+        return digest in self._chunks
+
+    def _incref(self, digest: bytes, length: int) -> None:
+        # called with the lock held
+        refs = self._refs[digest]
+        if not refs:
+            self._garbage.discard(digest)
+            self.garbage_bytes -= length
+        self._refs[digest] = refs + 1
+        self.referenced_bytes += length
+
+    def put(self, data) -> bytes:
+        """Store data if no identical chunk exists and reference it."""
+        digest = _digest(data)
+        with self._lock:
+            if digest not in self._chunks:
+                self._chunks[digest] = bytes(data)
+                self._refs[digest] = 0
+                self._garbage.add(digest)
+                self.stored_bytes += len(data)
+                self.garbage_bytes += len(data)
+            self._incref(digest, len(data))
+        return digest
+
+    def get(self, digest: bytes) -> bytes:
+        return self._chunks[digest]
+
+    def refs(self, digest: bytes) -> int:
+        return self._refs.get(digest, 0)
+
+    def incref(self, digests: ty.Iterable[bytes]) -> None:
+        with self._lock:
+            for digest in digests:
+                self._incref(digest, len(self._chunks[digest]))
+
+    def decref(self, digests: ty.Iterable[bytes]) -> None:
+        with self._lock:
+            for digest in digests:
+                length = len(self._chunks[digest])
+                refs = self._refs[digest] - 1
+                self._refs[digest] = refs
+                self.referenced_bytes -= length
+                if not refs:
+                    self._garbage.add(digest)
+                    self.garbage_bytes += length
+
+    def collect(self) -> ty.Tuple[int, int]:
+        """Remove the chunks nothing references.
+
+        :returns: the number of chunks and bytes freed.
+        """
+        with self._lock:
+            freed = len(self._garbage)
+            freed_bytes = self.garbage_bytes
+            for digest in self._garbage:
+                del self._chunks[digest]
+                del self._refs[digest]
+            self._garbage.clear()
+            self.stored_bytes -= freed_bytes
+            self.garbage_bytes = 0
+        return freed, freed_bytes
+
+
+class BlockMap:
+    """
+    BlockMap is the contents of a volume as digests of BLOCK_SIZE blocks.
+
+    Blocks that are not mapped read as zeros. A block is rewritten as a
+    whole, so a partial write reads its block, patches it and stores the
+    result as a new chunk. BlockMap has the interface of a PageStore, so it
+    is read and written through MemoryFile and MemoryHandle.
+    """
+
+    def __init__(self, chunks: ChunkStore, size: int = 0,
+                 blocks: ty.Optional[ty.Dict[int, bytes]] = None):
+        self.chunks = chunks
+        self.size = size
+        self.blocks: ty.Dict[int, bytes] = blocks if blocks else {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return self.size
+
+    def _block(self, index: int) -> bytes:
+        # reads don't take the lock, a digest is only released once it is
+        # out of the map, so if its chunk was collected in the meantime the
+        # map already holds the new digest of the block.
+        while True:
+            digest = self.blocks.get(index)
+            if digest is None:
+                return _ZERO_BLOCK
+            try:
+                return self.chunks.get(digest)
+            except KeyError:
+                continue
+
+    def _set(self, index: int, block) -> None:
+        # called with the lock held, the new chunk is referenced before the
+        # old one is released so rewriting a block with the same data does
+        # not turn its chunk into garbage
+        if block != _ZERO_BLOCK:
+            old = self.blocks.get(index)
+            self.blocks[index] = self.chunks.put(block)
+        else:
+            old = self.blocks.pop(index, None)
+        if old is not None:
+            self.chunks.decref([old])
+
+    def readinto(self, offset: int, buf) -> int:
+        view = memoryview(buf).cast('B')
+        length = max(0, min(len(view), self.size - offset))
+        done = 0
+        while done < length:
+            index, start = divmod(offset + done, BLOCK_SIZE)
+            count = min(BLOCK_SIZE - start, length - done)
+            view[done:done + count] = self._block(index)[start:start + count]
+            done += count
+        return done
+
+    def read(self, offset: int, length: int) -> bytes:
+        buf = bytearray(max(0, min(length, self.size - offset)))
+        self.readinto(offset, buf)
+        return bytes(buf)
+
+    def write(self, offset: int, data) -> int:
+        view = memoryview(data).cast('B')
+        done = 0
+        with self._lock:
+            while done < len(view):
+                index, start = divmod(offset + done, BLOCK_SIZE)
+                count = min(BLOCK_SIZE - start, len(view) - done)
+                if count == BLOCK_SIZE:
+                    block = view[done:done + count]
+                else:
+                    block = bytearray(self._block(index))
+                    block[start:start + count] = view[done:done + count]
+                self._set(index, block)
+                done += count
+            self.size = max(self.size, offset + done)
+        return done
+
+    def update(self, offset: int, data) -> int:
+        """Write data, leaving alone the blocks it would not change."""
+        view = memoryview(data).cast('B')
+        done = 0
+        with self._lock:
+            while done < len(view):
+                index, start = divmod(offset + done, BLOCK_SIZE)
+                count = min(BLOCK_SIZE - start, len(view) - done)
+                block = self._block(index)
+                if block[start:start + count] != view[done:done + count]:
+                    block = bytearray(block)
+                    block[start:start + count] = view[done:done + count]
+                    self._set(index, block)
+                done += count
+            self.size = max(self.size, offset + done)
+        return done
+
+    def truncate(self, size: int) -> None:
+        with self._lock:
+            if size < self.size:
+                last = -(-size // BLOCK_SIZE)
+                dropped = [i for i in self.blocks if i >= last]
+                self.chunks.decref(self.blocks.pop(i) for i in dropped)
+                start = size % BLOCK_SIZE
+                if start and last - 1 in self.blocks:
+                    block = bytearray(self._block(last - 1))
+                    block[start:] = bytes(BLOCK_SIZE - start)
+                    self._set(last - 1, block)
+            self.size = size
+
+    def discard(self, offset: int, length: int) -> None:
+        """Zero a range, unmapping the blocks it covers completely."""
+        end = min(offset + length, self.size)
+        with self._lock:
+            while offset < end:
+                index, start = divmod(offset, BLOCK_SIZE)
+                count = min(BLOCK_SIZE - start, end - offset)
+                if index in self.blocks:
+                    if count == BLOCK_SIZE:
+                        self.chunks.decref([self.blocks.pop(index)])
+                    else:
+                        block = bytearray(self._block(index))
+                        block[start:start + count] = bytes(count)
+                        self._set(index, block)
+                offset += count
+
+    def grow(self, size: int) -> int:
+        with self._lock:
+            self.size += size
+            return self.size
+
+    def clone(self) -> 'BlockMap':
+        """Return a copy referencing the same chunks."""
+        with self._lock:
+            blocks = dict(self.blocks)
+            self.chunks.incref(blocks.values())
+            return BlockMap(self.chunks, self.size, blocks)
+
+    def release(self) -> None:
+        """Drop the references to all chunks, emptying the map."""
+        with self._lock:
+            blocks, self.blocks = self.blocks, {}
+            self.chunks.decref(blocks.values())
+
+    def getvalue(self) -> bytes:
+        return self.read(0, self.size)
+
+    def extents(self) -> ty.Iterator[ty.Tuple[int, int]]:
+        """Yield (offset, length) for each run of mapped blocks."""
+        start = end = None
+        for index in sorted(self.blocks):
+            if index * BLOCK_SIZE >= self.size:
+                break
+            if index != end:
+                if start is not None:
+                    yield start * BLOCK_SIZE, (end - start) * BLOCK_SIZE
+                start = index
+            end = index + 1
+        if start is not None:
+            yield start * BLOCK_SIZE, min(
+                (end - start) * BLOCK_SIZE, self.size - start * BLOCK_SIZE)
+
+
+@dataclasses.dataclass(frozen=True)
+class DedupReport:
+    """
+    DedupReport summarises the space saved by deduplication.
+
+    logical_bytes is the data referenced by all volumes, as it would be
+    stored without deduplication, and stored_bytes what is held in chunks,
+    including garbage_bytes not yet collected.
+    """
+
+    volumes: int
+    chunks: int
+    provisioned_bytes: int
+    logical_bytes: int
+    stored_bytes: int
+    garbage_bytes: int
+
+    @property
+    def ratio(self) -> float:
+        """logical_bytes per byte of live stored data."""
+        live = self.stored_bytes - self.garbage_bytes
+        return self.logical_bytes / live if live else 1.0
+
+
+@dataclasses.dataclass
+class Dedup(memory.Memory):
+    """
+    Dedup is an in-memory backend that stores each distinct block once.
+
+    Clones copy the block map of their source and never copy data. Garbage
+    is collected once more than GC_THRESHOLD bytes of it build up after a
+    delete, or on demand with collect_garbage.
+    """
+
+    # bytes of unreferenced chunks tolerated before deletes collect them
+    GC_THRESHOLD = 64 * 1024 * 1024
+
+    chunks: ChunkStore = dataclasses.field(default_factory=ChunkStore)
+
+    def get_allocated(self) -> int:
+        return self.chunks.stored_bytes
+
+    def get_volume_allocated(self, volume) -> int:
+        return len(self.volumes[volume.volume_id].blocks) * BLOCK_SIZE
+
+    def create_volume(self, size: int, name: str,
+                      provisioning: str = api.PROVISION_SPARSE
+                      ) -> 'api.volume.Volume':
+        # zero blocks are never stored, the mode is only recorded
+        api.check_provisioning(provisioning)
+        vol_id = uuid.uuid4()
+        vol = api.volume.Volume(
+            path=f'dedup://vol-{vol_id}', name=name, volume_id=vol_id,
+            size=size, backend=self, provisioning=provisioning)
+        self.volumes[vol.volume_id] = BlockMap(self.chunks, size)
+        return vol
+
+    def delete_volume(self, volume):
+        store = self.volumes[volume.volume_id]
+        super().delete_volume(volume)
+        store.release()
+        if self.chunks.garbage_bytes > self.GC_THRESHOLD:
+            self.collect_garbage()
+
+    def clone_volume(self, volume, name):
+        vol_id = uuid.uuid4()
+        new_vol = api.volume.Volume(
+            path=f'dedup://vol-{vol_id}', name=name, volume_id=vol_id,
+            size=volume.size, backend=self, clone_strategy=CLONE_DEDUP,
+            provisioning=volume.provisioning)
+        self.volumes[vol_id] = self.volumes[volume.volume_id].clone()
+        return new_vol
+
+    def collect_garbage(self) -> int:
+        """Free the chunks no volume references, returning the bytes."""
+        return self.chunks.collect()[1]
+
+    def dedup_report(self) -> DedupReport:
+        volumes = list(self.volumes.values())
+        return DedupReport(
+            volumes=len(volumes), chunks=len(self.chunks),
+            provisioned_bytes=sum(len(v) for v in volumes),
+            logical_bytes=self.chunks.referenced_bytes,
+            stored_bytes=self.chunks.stored_bytes,
+            garbage_bytes=self.chunks.garbage_bytes)
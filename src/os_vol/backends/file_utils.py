@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: Apache-2.0
+"""
+Helpers for copying the backing files of file based volumes.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import os
+import shutil
+import typing as ty
+
+# FICLONE from linux/fs.h: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+# fallocate modes from linux/falloc.h
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+
+CLONE_REFLINK = 'reflink'
+CLONE_SPARSE = 'sparse'
+
+COPY_CHUNK_SIZE = 8 * 1024 * 1024
+
+# errnos that mean "this filesystem or kernel can't do that", as opposed to
+# a real I/O error that should be propagated to the caller.
+_UNSUPPORTED = frozenset([
+    errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL, errno.ENOSYS,
+    errno.EBADF,
+])
+
+
+def reflink(src_fd: int, dst_fd: int) -> bool:
+    """Share all extents of src_fd with dst_fd using the FICLONE ioctl.
+
+    :returns: True if the reflink succeeded, False if the filesystem does
+        not support it.
+    """
+    try:
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+    except OSError as e:
+        if e.errno in _UNSUPPORTED:
+            return False
+        raise
+    return True
+
+
+def _fallocate() -> ty.Optional[ty.Callable]:
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        func = libc.fallocate
+    except (OSError, AttributeError):
+        return None
+    func.argtypes = [
+        ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+    func.restype = ctypes.c_int
+    return func
+
+
+_FALLOCATE = _fallocate()
+
+
+def _call_fallocate(fd: int, mode: int, offset: int, length: int) -> bool:
+    if _FALLOCATE is None:
+        return False
+    if _FALLOCATE(fd, mode, offset, length) != 0:
+        err = ctypes.get_errno()
+        if err in _UNSUPPORTED:
+            return False
+        raise OSError(err, os.strerror(err))
+    return True
+
+
+def punch_hole(fd: int, offset: int, length: int) -> bool:
+    """Deallocate a range of fd so it reads as zeros, keeping the size.
+
+    :returns: True if the range was deallocated, False if the platform or
+        filesystem does not support punching holes.
+    """
+    return _call_fallocate(
+        fd, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE, offset, length)
+
+
+def preallocate(fd: int, offset: int, length: int) -> bool:
+    """Allocate the blocks of a range of fd without writing them.
+
+    Data already in the range is kept and unallocated blocks read as
+    zeros. The file is extended if the range ends past its size.
+
+    :returns: True if the range was allocated, False if the platform or
+        filesystem does not support fallocate.
+    """
+    return _call_fallocate(fd, 0, offset, length)
+
+
+def zero_fill(fd: int, offset: int, length: int) -> None:
+    """Write zeros over a range of fd, allocating all of its blocks."""
+    zeros = memoryview(bytes(min(COPY_CHUNK_SIZE, length)))
+    end = offset + length
+    while offset < end:
+        offset += os.pwrite(fd, zeros[:min(len(zeros), end - offset)], offset)
+
+
+def iter_extents(
+        fd: int, size: int) -> ty.Iterator[ty.Tuple[int, int]]:
+    """Yield (offset, length) for each allocated data extent of fd.
+
+    Holes are skipped using SEEK_DATA/SEEK_HOLE. On platforms without
+    SEEK_DATA the whole file is reported as a single extent.
+    """
+    if not hasattr(os, 'SEEK_DATA'):
+        if size:
+            yield 0, size
+        return
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                # no data after offset, the rest of the file is a hole
+                return
+            raise
+        if start >= size:
+            return
+        end = min(os.lseek(fd, start, os.SEEK_HOLE), size)
+        yield start, end - start
+        offset = end
+
+
+def copy_range(src_fd: int, dst_fd: int, offset: int, length: int) -> int:
+    """Copy length bytes at offset from src_fd to the same offset in dst_fd.
+
+    os.copy_file_range is used when available so the data never passes
+    through userspace, otherwise this falls back to pread/pwrite.
+
+    :returns: the number of bytes copied.
+    """
+    copied = 0
+    use_cfr = hasattr(os, 'copy_file_range')
+    while copied < length:
+        pos = offset + copied
+        count = min(COPY_CHUNK_SIZE, length - copied)
+        if use_cfr:
+            try:
+                n = os.copy_file_range(src_fd, dst_fd, count, pos, pos)
+            except OSError as e:
+                if e.errno not in _UNSUPPORTED:
+                    raise
+                use_cfr = False
+                continue
+        else:
+            data = os.pread(src_fd, count, pos)
+            n = os.pwrite(dst_fd, data, pos) if data else 0
+        if n == 0:
+            # source is shorter than expected, the remainder reads as zero
+            break
+        copied += n
+    return copied
+
+
+def sparse_copy(src_fd: int, dst_fd: int, size: int) -> int:
+    """Copy only the allocated extents of src_fd into dst_fd.
+
+    The destination is truncated to size first so every region that is a
+    hole in the source stays a hole in the destination.
+
+    :returns: the number of bytes copied.
+    """
+    os.ftruncate(dst_fd, size)
+    copied = 0
+    for offset, length in iter_extents(src_fd, size):
+        copied += copy_range(src_fd, dst_fd, offset, length)
+    return copied
+
+
+def clone_file(src_path: str, dst_path: str,
+               copy: ty.Callable[[int, int, int], int] = sparse_copy) -> str:
+    """Clone src_path to dst_path using the cheapest available strategy.
+
+    A reflink is attempted first, falling back to an extent aware sparse
+    copy. The cost of either is proportional to the allocated data in the
+    source, not its apparent size.
+
+    :param copy: the sparse copy used when reflinks are not supported,
+        called as copy(src_fd, dst_fd, size).
+
+    :returns: the strategy used, CLONE_REFLINK or CLONE_SPARSE.
+    :raises FileExistsError: if dst_path already exists.
+    """
+    src_fd = os.open(src_path, os.O_RDONLY)
+    try:
+        # never replace an existing file, so the error path below only
+        # ever removes a file this call created
+        dst_fd = os.open(
+            dst_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        try:
+            if reflink(src_fd, dst_fd):
+                strategy = CLONE_REFLINK
+            else:
+                copy(src_fd, dst_fd, os.fstat(src_fd).st_size)
+                strategy = CLONE_SPARSE
+        except BaseException:
+            os.close(dst_fd)
+            os.remove(dst_path)
+            raise
+        os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+    shutil.copymode(src_path, dst_path)
+    return strategy
@@ -1,92 +1,736 @@
 # -*- coding: utf-8 -*-
+from concurrent import futures
+import contextlib
 import dataclasses
+import glob
 import os
 import shelve
 import shutil
-import subprocess  # nosec B404
+import threading
+import time
 import typing as ty
 import uuid
 
 from os_vol.backends import api
+from os_vol.backends import catalog
+from os_vol.backends import cbt
+from os_vol.backends import file_utils
+from os_vol.backends import handle
+from os_vol.backends import journal
+from os_vol.backends import loop
+from os_vol.backends import overlay
+from os_vol import cache
+from os_vol import copy_engine
+from os_vol import locking
+from os_vol import metrics
+from os_vol.objects import serialization
 from os_vol.objects import types
 
+# operations recorded in the journal
+OP_CREATE = 'create'
+OP_DELETE = 'delete'
+
+
+def _allocated(stat: os.stat_result) -> int:
+    # st_blocks is always in 512 byte units
+    return stat.st_blocks * 512
+
 
 @dataclasses.dataclass
 class FlatFile(api.Backend):
     """
     FlatFile Stores data in flat files on disk.
+
+    FlatFile is safe to use from multiple threads. Operations on different
+    volumes run concurrently, operations on the same volume, or that create
+    a volume with the same name, are serialised by per volume locks. The
+    catalog is guarded by its own short lock. Data written through handles
+    returned by open_volume is not synchronised.
+
+    The catalog is opened on first use so creating a backend is O(1)
+    whatever the number of volumes.
+
+    Creating and deleting volumes touches both files and the catalog, so
+    these operations are recorded in a journal first. When the catalog is
+    opened the operations the journal holds as unfinished are recovered,
+    creates are rolled back and deletes rolled forward, so a crash leaves
+    neither orphan files nor records without files, and recovery only
+    looks at the volumes that were in flight.
+
+    Changed blocks are tracked for volumes with checkpoints, the tracker of
+    a volume is persisted next to its backing file. Every file object and
+    handle is opened tracked, so writes through those opened before the
+    first checkpoint are not missed.
+
+    Reads go through the optional cache, which is keyed by backing file and
+    so shared by all handles of a volume and by the shallow clones of a
+    parent. The cache is invalidated by writes through this backend, data
+    written to a host attached device is dropped from it on detach.
+
+    Clones that can't be reflinked are copied in parallel by copier, whose
+    rate limit keeps them from starving the I/O of attached volumes.
     """
+    PERSISTENT = True
+    CATALOG_FILE = 'volumes.db'
+    JOURNAL_FILE = 'journal.log'
+    # sync journal records so operations survive losing power, not only
+    # the process dying
+    JOURNAL_SYNC = True
+    # metadata location used before the catalog, imported on first open
     SHELVE_FILE = 'volumes.shelve'
     FLAT_FILE_DOMAIN = uuid.UUID('5D9B6527-52FF-4F7A-9674-8ADA17026129')
+    # shallow cloning a volume with this many overlays below it flattens it
+    # first so reads never have to walk an unbounded chain.
+    MAX_CHAIN_DEPTH = 16
+    # seconds a shutil.disk_usage result is reused for capacity queries
+    CAPACITY_TTL = 30.0
+    # threads used to create or remove backing files in batch operations
+    BATCH_WORKERS = 8
+    # free loop devices kept ready for host_attach
+    LOOP_POOL_SIZE = 4
+    # attach volumes with loop devices in direct I/O mode, bypassing the
+    # page cache of the host for the backing files
+    LOOP_DIRECT_IO = False
+    # sizes of created and grown volumes are rounded up to a multiple of
+    # this, 4096 keeps them usable with O_DIRECT and 4K sector devices
+    SIZE_ALIGNMENT = 1
+    # threads copying the data of a clone when it can't be reflinked
+    COPY_WORKERS = copy_engine.DEFAULT_CONCURRENCY
 
-    def __init__(self, path: str):
+    def __init__(self, path: str,
+                 cache: ty.Optional[cache.BlockCache] = None,
+                 copier: ty.Optional[copy_engine.CopyEngine] = None):
         self.path = path
-        self.volumes = shelve.open(f'{self.path}/{self.SHELVE_FILE}')
-        total, _, _ = shutil.disk_usage(self.path)
-        self.capasity: types.SIZE_MB = total
+        self.cache = cache
+        self.copier = copier or copy_engine.CopyEngine(
+            concurrency=self.COPY_WORKERS)
+        self.locks = locking.VolumeLocks()
+        self.loop = loop.LoopManager(self.LOOP_POOL_SIZE, self.LOOP_DIRECT_IO)
+        self._catalog: ty.Optional[catalog.Catalog] = None
+        self._journal: ty.Optional[journal.Journal] = None
+        self._catalog_lock = threading.Lock()
+        self._disk_usage: ty.Optional[ty.Any] = None
+        self._disk_usage_time = 0.0
+        self._allocated: ty.Optional[int] = None
+        self._allocated_time = 0.0
+        self._trackers: ty.Dict[uuid.UUID, cbt.ChangeTracker] = {}
+        self._trackers_lock = threading.Lock()
+        # shared by every file open on an overlay so none loses the blocks
+        # written through another
+        self._block_maps = overlay.BlockMaps()
+
+    @property
+    def catalog(self) -> catalog.Catalog:
+        """The volume catalog, opened on first use."""
+        if self._catalog is None:
+            self._open()
+        return self._catalog
+
+    @property
+    def journal(self) -> journal.Journal:
+        """The operation journal, opened along with the catalog."""
+        if self._catalog is None:
+            self._open()
+        return self._journal
+
+    def _open(self) -> None:
+        with self._catalog_lock:
+            if self._catalog is not None:
+                return
+            db = catalog.Catalog(f'{self.path}/{self.CATALOG_FILE}')
+            self._import_shelve(db)
+            ops = journal.Journal(
+                f'{self.path}/{self.JOURNAL_FILE}', self.JOURNAL_SYNC)
+            for entry in ops.pending():
+                self._recover(db, entry)
+                ops.end(entry)
+            self._journal = ops
+            self._catalog = db
+
+    def _recover(self, db: 'catalog.Catalog',
+                 entry: 'journal.Entry') -> None:
+        """Finish an operation that was interrupted.
+
+        A create is undone unless its catalog record was committed, a
+        delete is completed.
+        """
+        for vol_id, path in entry.data['volumes']:
+            if entry.op == OP_CREATE and vol_id in db:
+                continue
+            for leftover in (path, overlay.map_path(path),
+                             cbt.tracker_path(path)):
+                try:
+                    os.remove(leftover)
+                except FileNotFoundError:
+                    pass
+            if entry.op == OP_DELETE:
+                db.delete(vol_id)
+
+    @contextlib.contextmanager
+    def _journaled(self, op: str,
+                   volumes: ty.Iterable[ty.Tuple[uuid.UUID, str]]
+                   ) -> ty.Iterator[None]:
+        """Record an operation on volumes in the journal while it runs.
+
+        If it fails it is recovered straight away. Should that fail too it
+        is left in the journal and recovered when the catalog is opened
+        next.
+        """
+        entry = self.journal.begin(
+            op, volumes=[[str(vol_id), path] for vol_id, path in volumes])
+        try:
+            yield
+        except BaseException:
+            try:
+                self._recover(self.catalog, entry)
+            except Exception:
+                pass
+            else:
+                self.journal.end(entry)
+            raise
+        self.journal.end(entry)
+
+    def _import_shelve(self, db: 'catalog.Catalog') -> None:
+        shelve_path = f'{self.path}/{self.SHELVE_FILE}'
+        if len(db) or not glob.glob(f'{shelve_path}*'):
+            return
+        with shelve.open(shelve_path, flag='r') as volumes:
+            db.put_many(
+                serialization.loads(summary) for summary in volumes.values())
+
+    def close(self) -> None:
+        with self._catalog_lock:
+            if self._catalog is not None:
+                self._journal.close()
+                self._catalog.close()
+                self._catalog = None
+                self._journal = None
+
+    def disk_usage(self) -> ty.Any:
+        """Return shutil.disk_usage for the pool directory.
+
+        The result is cached for CAPACITY_TTL seconds so capacity can be
+        polled without a statvfs call each time.
+        """
+        now = time.monotonic()
+        if (self._disk_usage is None or
+                now - self._disk_usage_time >= self.CAPACITY_TTL):
+            self._disk_usage = shutil.disk_usage(self.path)
+            self._disk_usage_time = now
+        return self._disk_usage
+
+    def get_capacity(self) -> types.SIZE_BYTES:
+        return self.disk_usage().total
+
+    @property
+    def capasity(self) -> types.SIZE_BYTES:
+        return self.get_capacity()
+
+    def get_provisioned(self) -> types.SIZE_BYTES:
+        return self.catalog.provisioned_bytes
+
+    def get_allocated(self) -> types.SIZE_BYTES:
+        """Return the bytes allocated on disk to the volume files.
+
+        The allocated blocks of every file are summed, so extents shared
+        by reflinked clones are counted once per volume. The result is
+        cached for CAPACITY_TTL seconds like disk_usage.
+        """
+        now = time.monotonic()
+        if (self._allocated is None or
+                now - self._allocated_time >= self.CAPACITY_TTL):
+            with os.scandir(self.path) as entries:
+                self._allocated = sum(
+                    _allocated(entry.stat(follow_symlinks=False))
+                    for entry in entries if entry.name.startswith('vol-'))
+            self._allocated_time = now
+        return self._allocated
+
+    def get_volume_allocated(self, volume) -> types.SIZE_BYTES:
+        allocated = _allocated(os.stat(volume.path))
+        if volume.parent_id:
+            allocated += _allocated(os.stat(overlay.map_path(volume.path)))
+        return allocated
 
     @property
     def used_space(self) -> types.SIZE_MB:
-        return sum([len(vol) for vol in self.volumes.values()])
+        return self.get_provisioned()
 
     @property
     def free_space(self) -> types.SIZE_MB:
-        return self.capasity - self.used_space
+        return self.get_capacity() - self.used_space
 
-    def create_volume(
-            self, size: types.SIZE_BYTES, name: str) -> 'api.volume.Volume':
+    def _volume(self, record: 'catalog.Record') -> 'api.volume.Volume':
+        parent_id = record['parent_id']
+        return api.volume.Volume(
+            path=record['path'], name=record['name'],
+            volume_id=uuid.UUID(record['volume_id']), size=record['size'],
+            volume_type=record['volume_type'], backend=self,
+            device_path=record['device_path'],
+            clone_strategy=record['clone_strategy'],
+            parent_id=uuid.UUID(parent_id) if parent_id else None,
+            provisioning=record['provisioning'])
+
+    def get_volume(self, volume_id):
+        record = self.catalog.get(str(volume_id))
+        return self._volume(record) if record else None
+
+    def list_volumes(self, limit=None, marker=None):
+        marker = str(marker) if marker is not None else None
+        return [self._volume(r) for r in self.catalog.page(limit, marker)]
+
+    def count_volumes(self):
+        return len(self.catalog)
+
+    def get_totals(self):
+        return self.catalog.totals()
+
+    def _align(self, size: types.SIZE_BYTES) -> types.SIZE_BYTES:
+        return -(-size // self.SIZE_ALIGNMENT) * self.SIZE_ALIGNMENT
+
+    @staticmethod
+    def _provision(fd: int, offset: int, length: int,
+                   provisioning: ty.Optional[str]) -> None:
+        """Allocate a range of a backing file according to its mode."""
+        if not length or provisioning in (None, api.PROVISION_SPARSE):
+            return
+        if (provisioning == api.PROVISION_ZEROED or
+                not file_utils.preallocate(fd, offset, length)):
+            file_utils.zero_fill(fd, offset, length)
+
+    @classmethod
+    def _provision_holes(cls, fd: int, size: int,
+                         provisioning: ty.Optional[str]) -> None:
+        """Allocate the holes of a backing file, keeping its data."""
+        offset = 0
+        # the holes are found before any of them is filled in
+        for start, length in list(file_utils.iter_extents(fd, size)):
+            cls._provision(fd, offset, start - offset, provisioning)
+            offset = start + length
+        cls._provision(fd, offset, size - offset, provisioning)
+
+    def _new_volume(self, name: str) -> ty.Tuple[uuid.UUID, str]:
+        """Return the id and backing file path of a volume named name."""
         vol_id = uuid.uuid5(self.FLAT_FILE_DOMAIN, name)
-        vol_path = f'{self.path}/vol-{vol_id}'
+        return vol_id, f'{self.path}/vol-{vol_id}'
+
+    def _check_name_free(self, vol_id: uuid.UUID, vol_path: str,
+                         name: str) -> None:
+        # called with the name lock held, before the journal entry whose
+        # recovery would remove whatever is at vol_path
+        if str(vol_id) in self.catalog or os.path.lexists(vol_path):
+            raise ValueError(f'a volume named {name} already exists')
+
+    def _create_file(
+            self, size: types.SIZE_BYTES, name: str,
+            provisioning: str = api.PROVISION_SPARSE
+    ) -> 'api.volume.Volume':
+        api.check_provisioning(provisioning)
+        size = self._align(size)
+        vol_id, vol_path = self._new_volume(name)
         with open(vol_path, 'w+b') as f:
             f.truncate(size)
-        vol = api.volume.Volume(path=vol_path, name=name, volume_id=vol_id,
-                                size=size, backend=self)
-        self.volumes[str(vol.volume_id)] = vol.volume_summary()
-        return vol
+            try:
+                self._provision(f.fileno(), 0, size, provisioning)
+            except OSError:
+                os.remove(vol_path)
+                raise
+        return api.volume.Volume(path=vol_path, name=name, volume_id=vol_id,
+                                 size=size, backend=self,
+                                 provisioning=provisioning)
+
+    def create_volume(
+            self, size: types.SIZE_BYTES, name: str,
+            provisioning: str = api.PROVISION_SPARSE
+    ) -> 'api.volume.Volume':
+        """Create a volume backed by a file.
+
+        Sparse volumes are created with truncate and allocate blocks as they
+        are written. Preallocated volumes reserve their blocks with
+        fallocate, which avoids fragmentation under random writes, and
+        zeroed volumes are also written with zeros so no write has to
+        convert unwritten extents. Without fallocate support preallocated
+        volumes are zeroed.
+        """
+        with self.locks.hold(locking.name_key(name)), \
+                self._journaled(OP_CREATE, [self._new_volume(name)]):
+            vol = self._create_file(size, name, provisioning)
+            self.catalog.put(vol.to_dict())
+            return vol
+
+    def create_volumes(self, specs):
+        """Create many volumes with one catalog transaction.
+
+        The backing files are created in parallel on a thread pool and the
+        catalog records for all successfully created volumes are committed
+        together. If that commit fails the new files are removed and every
+        item is reported as failed.
+        """
+        specs = [api.VolumeSpec(*spec) for spec in specs]
+        with self.locks.hold(*[locking.name_key(s.name) for s in specs]), \
+                self._journaled(OP_CREATE, {
+                    self._new_volume(s.name) for s in specs}):
+            return self._create_volumes(specs)
+
+    def _create_volumes(self, specs):
+        results = [api.BatchResult(spec) for spec in specs]
+        names = set()
+        with futures.ThreadPoolExecutor(self.BATCH_WORKERS) as executor:
+            pending = []
+            for result in results:
+                spec = result.item
+                if spec.name in names:
+                    result.error = ValueError(
+                        f'duplicate volume name {spec.name} in batch')
+                    continue
+                names.add(spec.name)
+                pending.append((result, executor.submit(
+                    self._create_file, spec.size, spec.name,
+                    spec.provisioning)))
+            for result, future in pending:
+                try:
+                    result.volume = future.result()
+                except Exception as e:
+                    result.error = e
+        created = [r for r in results if r.ok]
+        try:
+            self.catalog.put_many(r.volume.to_dict() for r in created)
+        except Exception as e:
+            for result in created:
+                os.remove(result.volume.path)
+                result.volume, result.error = None, e
+        return results
 
     def delete_volume(self, volume):
+        with self.locks.hold(volume.volume_id):
+            self._check_no_children(volume)
+            with self._journaled(
+                    OP_DELETE, [(volume.volume_id, volume.path)]):
+                self._remove_files(volume)
+                self.catalog.delete(str(volume.volume_id))
+
+    def delete_volumes(self, volumes):
+        """Delete many volumes with one catalog transaction.
+
+        The backing files are removed in parallel, the catalog records of
+        the volumes whose files were removed are deleted together. A volume
+        can be deleted along with all of its shallow clones in one batch,
+        the clones are deleted first and if any of them fails the volume is
+        kept and reported as failed too.
+        """
+        volumes = list(volumes)
+        with self.locks.hold(*[v.volume_id for v in volumes]):
+            return self._delete_volumes(volumes)
+
+    def _delete_volumes(self, volumes):
+        results = [api.BatchResult(vol, vol) for vol in volumes]
+        # clones deleted in the same batch don't block deleting the parent
+        batch_ids = {str(r.item.volume_id) for r in results}
+        for result in results:
+            vol_id = str(result.item.volume_id)
+            if set(self.catalog.children(vol_id)) - batch_ids:
+                result.error = ValueError(
+                    f'volume {vol_id} has shallow clones, '
+                    'flatten them before deleting it')
+        # clones are deleted before their parents, a round at a time, and
+        # a parent is only deleted once the catalog shows no clones left
+        pending = [r for r in results if r.ok]
+        while pending:
+            ready = [r for r in pending if not self.catalog.has_children(
+                str(r.item.volume_id))]
+            if not ready:
+                for result in pending:
+                    result.error = ValueError(
+                        f'volume {result.item.volume_id} has shallow '
+                        'clones that could not be deleted')
+                break
+            self._delete_round(ready)
+            pending = [r for r in pending if r not in ready]
+        return results
+
+    def _delete_round(self, results) -> None:
+        """Delete volumes none of which is the parent of another."""
+        with self._journaled(OP_DELETE, [
+                (r.item.volume_id, r.item.path) for r in results]), \
+                futures.ThreadPoolExecutor(self.BATCH_WORKERS) as executor:
+            pending = [
+                (result, executor.submit(self._remove_files, result.item))
+                for result in results]
+            for result, future in pending:
+                result.error = future.exception()
+            self.catalog.delete_many(
+                str(r.item.volume_id) for r in results if r.ok)
+
+    def has_shallow_clones(self, volume) -> bool:
+        return self.catalog.has_children(str(volume.volume_id))
+
+    def _check_no_children(self, volume, action: str = 'deleting') -> None:
+        if self.has_shallow_clones(volume):
+            raise ValueError(
+                f'volume {volume.volume_id} has shallow clones, '
+                f'flatten them before {action} it')
+
+    def _remove_files(self, volume) -> None:
         os.remove(volume.path)
-        del self.volumes[str(volume.volume_id)]
+        if volume.parent_id:
+            os.remove(overlay.map_path(volume.path))
+        self._invalidate(volume)
+        tracker = self._trackers.pop(volume.volume_id, None)
+        if tracker is not None:
+            tracker.delete()
+        else:
+            try:
+                os.remove(cbt.tracker_path(volume.path))
+            except FileNotFoundError:
+                pass
 
     def grow_volume(self, volume, size):
-        with open(volume.path, 'r+b') as f:
-            f.truncate(volume.size + size)
-        volume.size += size
-        self.volumes[str(volume.volume_id)] = volume.volume_summary()
+        """Grow a volume, the new range is provisioned like the volume."""
+        with self.locks.hold(volume.volume_id):
+            self._check_no_children(volume, 'growing')
+            new_size = self._align(volume.size + size)
+            with open(volume.path, 'r+b') as f:
+                f.truncate(new_size)
+                self._provision(f.fileno(), volume.size,
+                                new_size - volume.size, volume.provisioning)
+            # the cached last block may be short
+            self._invalidate(volume)
+            volume.size = new_size
+            self.catalog.put(volume.to_dict())
 
     def clone_volume(self, volume, name):
-        vol_id = uuid.uuid5(self.FLAT_FILE_DOMAIN, name)
-        vol_path = f'{self.path}/vol-{vol_id}'
-        shutil.copy(volume.path, vol_path)
-        new_vol = api.volume.Volume(path=vol_path, name=name, volume_id=vol_id,
-                                    size=volume.size, backend=self)
-        self.volumes[str(new_vol.volume_id)] = new_vol.volume_summary()
-        return new_vol
+        """Clone a volume with a new name.
+
+        The backing file is reflinked if the filesystem supports it, otherwise
+        only its allocated extents are copied, in parallel by the copier, and
+        holes are preserved. The strategy used is recorded in
+        `clone_strategy` on the new volume, and the bytes copied are counted
+        in the bytes copied metric, nothing for a reflink.
+        Cloning a shallow clone produces a flat copy of the whole chain.
+        Clones of preallocated or zeroed volumes have their holes
+        preallocated, so they are recorded as preallocated. Raises
+        ValueError if a volume named name already exists.
+        """
+        vol_id, vol_path = self._new_volume(name)
+        with self.locks.hold(volume.volume_id, locking.name_key(name)):
+            self._check_name_free(vol_id, vol_path, name)
+            with self._journaled(OP_CREATE, [(vol_id, vol_path)]):
+                layers = self._layers(volume)
+                copied = 0
+
+                def sparse_copy(src_fd, dst_fd, size):
+                    nonlocal copied
+                    copied = self.copier.sparse_copy(src_fd, dst_fd, size)
+                    return copied
+
+                try:
+                    strategy = file_utils.clone_file(
+                        layers[-1].path, vol_path, sparse_copy)
+                    if len(layers) > 1:
+                        copied += overlay.copy_layers(
+                            layers, vol_path, volume.size)
+                finally:
+                    self._block_maps.release(layers)
+                provisioning = api.PROVISION_SPARSE
+                if volume.provisioning not in (None, api.PROVISION_SPARSE):
+                    provisioning = api.PROVISION_PREALLOCATED
+                    fd = os.open(vol_path, os.O_RDWR)
+                    try:
+                        self._provision_holes(fd, volume.size, provisioning)
+                    finally:
+                        os.close(fd)
+                new_vol = api.volume.Volume(
+                    path=vol_path, name=name, volume_id=vol_id,
+                    size=volume.size, backend=self, clone_strategy=strategy,
+                    provisioning=provisioning)
+                self.catalog.put(new_vol.to_dict())
+            metrics.add_bytes(metrics.LAYER_BACKEND, type(self).__name__,
+                              'clone_volume', copied)
+            return new_vol
+
+    def shallow_clone_volume(self, volume, name):
+        """Create a copy-on-write overlay on top of volume.
+
+        The new volume starts as an empty sparse file and block map so the
+        cost is independent of the size of the parent. Reads of blocks that
+        have not been written fall through to the parent chain, so from
+        then on the parent is opened read-only and can't be grown,
+        discarded or attached until its clones are deleted or flattened.
+        File objects and handles of the parent opened before must not be
+        written to. A volume attached to the host can't be cloned, nor can
+        a clone take the name of an existing volume.
+        """
+        if volume.device_path:
+            raise ValueError(
+                f'volume {volume.volume_id} is attached to the host, '
+                'detach it before cloning it')
+        with self.locks.hold(volume.volume_id, locking.name_key(name)):
+            vol_id, vol_path = self._new_volume(name)
+            self._check_name_free(vol_id, vol_path, name)
+            if self._chain_depth(volume) + 1 > self.MAX_CHAIN_DEPTH:
+                self.flatten_volume(volume)
+            with self._journaled(OP_CREATE, [(vol_id, vol_path)]):
+                overlay.create(vol_path, volume.size)
+                new_vol = api.volume.Volume(
+                    path=vol_path, name=name, volume_id=vol_id,
+                    size=volume.size, backend=self,
+                    clone_strategy=overlay.CLONE_OVERLAY,
+                    parent_id=volume.volume_id,
+                    provisioning=api.PROVISION_SPARSE)
+                self.catalog.put(new_vol.to_dict())
+                return new_vol
+
+    def flatten_volume(self, volume):
+        """Copy the data shared with the parent chain into the overlay.
+
+        The volume keeps its content but becomes a plain flat file with no
+        parent, collapsing the chain below it.
+        """
+        with self.locks.hold(volume.volume_id):
+            if volume.parent_id is None:
+                return
+            with self._open_overlay(volume) as f:
+                f.materialise()
+            os.remove(overlay.map_path(volume.path))
+            volume.parent_id = None
+            self.catalog.put(volume.to_dict())
+
+    def _layers(self, volume) -> ty.List[overlay.Layer]:
+        """Return the overlay chain of a volume, top first.
+
+        The block maps are shared with the other files open on the chain,
+        they must be released with self._block_maps.release(layers).
+        """
+        layers = []
+        path, parent_id = volume.path, volume.parent_id
+        try:
+            while parent_id:
+                layers.append(overlay.Layer(
+                    path, self._block_maps.acquire(path)))
+                parent = self.catalog.get(str(parent_id))
+                path, parent_id = parent['path'], parent['parent_id']
+        except BaseException:
+            self._block_maps.release(layers)
+            raise
+        layers.append(overlay.Layer(path, None))
+        return layers
+
+    def _open_overlay(self, volume,
+                      readonly: bool = False) -> overlay.OverlayFile:
+        layers = self._layers(volume)
+        try:
+            return overlay.OverlayFile(layers, volume.size, self.cache,
+                                       readonly, self._block_maps)
+        except BaseException:
+            self._block_maps.release(layers)
+            raise
+
+    def _chain_depth(self, volume) -> int:
+        depth = 0
+        parent_id = volume.parent_id
+        while parent_id:
+            depth += 1
+            parent_id = self.catalog.get(str(parent_id))['parent_id']
+        return depth
+
+    def discard_volume(self, volume, offset=0, length=None):
+        """Punch a hole over a range of a volume to reclaim its space.
+
+        A volume with shallow clones can't be discarded as they read the
+        range from it. A preallocated or zeroed volume is recorded as sparse
+        afterwards, as it is no longer fully allocated.
+        """
+        with self.locks.hold(volume.volume_id):
+            self._check_no_children(volume, 'discarding')
+            super().discard_volume(volume, offset, length)
+            if volume.provisioning not in (None, api.PROVISION_SPARSE):
+                volume.provisioning = api.PROVISION_SPARSE
+                self.catalog.put(volume.to_dict())
+
+    def get_tracker(self, volume) -> cbt.ChangeTracker:
+        with self._trackers_lock:
+            tracker = self._trackers.get(volume.volume_id)
+            if tracker is None:
+                tracker = cbt.ChangeTracker.load(
+                    cbt.tracker_path(volume.path), volume.size)
+                self._trackers[volume.volume_id] = tracker
+            return tracker
+
+    def _invalidate(self, volume) -> None:
+        if self.cache is not None:
+            self.cache.invalidate(volume.path)
+
+    def _readonly(self, volume) -> bool:
+        # the shallow clones of a volume read through it, so writing to it
+        # would change them
+        return self.catalog.has_children(str(volume.volume_id))
 
     def open_volume(self, volume) -> ty.IO:
-        return open(volume.path, 'r+b')
+        """Open a volume, read-only if it has shallow clones."""
+        readonly = self._readonly(volume)
+        if volume.parent_id:
+            f = self._open_overlay(volume, readonly)
+        elif self.cache is not None:
+            f = handle.HandleFile(cache.CachedHandle(
+                handle.FileHandle(volume.path, volume.size, readonly),
+                self.cache, volume.path))
+        else:
+            # unbuffered, so a write has reached the file by the time the
+            # tracker marks it, as the other file objects here do
+            f = open(volume.path, 'rb' if readonly else 'r+b', buffering=0)
+        return cbt.TrackedFile(f, self.get_tracker(volume))
+
+    def open_handle(self, volume) -> handle.VolumeHandle:
+        """Open a volume handle, read-only if it has shallow clones."""
+        readonly = self._readonly(volume)
+        if volume.parent_id:
+            h = handle.FileObjectHandle(
+                self._open_overlay(volume, readonly), volume.size)
+        else:
+            h = handle.FileHandle(volume.path, volume.size, readonly)
+            if self.cache is not None:
+                h = cache.CachedHandle(h, self.cache, volume.path)
+        return cbt.TrackedHandle(h, self.get_tracker(volume))
 
     def host_attach(self, volume) -> str:
         """Attach a volume as a block device to the host.
 
         The flat file backend uses a loopback device to attach the backing file
-        to the host.
+        to the host. Shallow clones must be flattened before they can be
+        attached as the loopback device can only see the top overlay file.
+        Attaching a volume that is already attached reuses its device, each
+        attach must be paired with a host_detach. Writes to the device are
+        not tracked, so a tracked volume is marked as wholly changed.
         """
-
-        out = subprocess.run(
-            ['sudo', 'losetup', '-fP', '--show', volume.path],
-            check=True, capture_output=True, text=True, timeout=5)  # nosec
-        device = out.stdout.strip()
-        volume.device_path = device
-        self.volumes[str(volume.volume_id)] = volume.volume_summary()
-        return device
+        with self.locks.hold(volume.volume_id):
+            if volume.parent_id:
+                raise ValueError(
+                    f'volume {volume.volume_id} is a shallow clone, '
+                    'flatten it before attaching it to the host')
+            self._check_no_children(volume, 'attaching')
+            self._device_written(volume)
+            device = self.loop.attach(volume.path)
+            if volume.device_path != device:
+                volume.device_path = device
+                self.catalog.put(volume.to_dict())
+            return device
 
     def host_detach(self, volume) -> None:
         """Detach a volume from the host.
 
-        The flat file backend uses a loopback device
+        The loopback device is released by the last detach.
         """
-        subprocess.run(
-            ['sudo', 'losetup', '-d', volume.device_path], check=True)  # nosec
-        volume.device_path = None
-        self.volumes[str(volume.volume_id)] = volume.volume_summary()
+        with self.locks.hold(volume.volume_id):
+            self._device_written(volume)
+            if self.loop.detach(volume.path, volume.device_path):
+                return
+            volume.device_path = None
+            self.catalog.put(volume.to_dict())
+
+    def _device_written(self, volume) -> None:
+        # the device was or is about to be written behind our back
+        self._invalidate(volume)
+        tracker = self.get_tracker(volume)
+        if tracker.active:
+            tracker.mark_all(volume.size)
+            tracker.flush()
@@ -0,0 +1,356 @@
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: Apache-2.0
+"""
+Positional, zero-copy I/O handles for volumes.
+
+A VolumeHandle offers pread/pwrite style access at explicit offsets so
+several users can share a handle without fighting over a file position,
+plus helpers that move data between volumes without copying it through
+Python buffers where the backend allows it.
+"""
+
+import abc
+import contextlib
+import errno
+import io
+import mmap
+import os
+import threading
+import typing as ty
+
+from os_vol.backends import file_utils
+
+COPY_BUFFER_SIZE = 4 * 1024 * 1024
+
+
+class VolumeHandle(abc.ABC):
+    """
+    VolumeHandle is an open volume supporting I/O at explicit offsets.
+    """
+
+    def __init__(self, size: ty.Optional[int] = None):
+        # handles whose size follows their volume define a size property
+        if size is not None:
+            self.size = size
+        self.closed = False
+
+    def __enter__(self) -> 'VolumeHandle':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    @abc.abstractmethod
+    def pread(self, size: int, offset: int) -> bytes:
+        """Read up to size bytes at offset."""
+        pass
+
+    @abc.abstractmethod
+    def pwrite(self, data, offset: int) -> int:
+        """Write data at offset, returning the number of bytes written."""
+        pass
+
+    def readinto(self, buf, offset: int) -> int:
+        """Read into a writable buffer at offset, returning the bytes read."""
+        view = memoryview(buf).cast('B')
+        data = self.pread(len(view), offset)
+        view[:len(data)] = data
+        return len(data)
+
+    def write_zeroes(self, offset: int, length: int) -> None:
+        """Make a range read as zeros, deallocating it where possible.
+
+        The default writes zeros, backends that can punch holes override
+        this so the range stops using space.
+        """
+        zeros = memoryview(bytes(min(COPY_BUFFER_SIZE, length)))
+        done = 0
+        while done < length:
+            count = min(len(zeros), length - done)
+            done += self.pwrite(zeros[:count], offset + done)
+
+    def fileno(self) -> ty.Optional[int]:
+        """Return the file descriptor backing the handle if there is one."""
+        return None
+
+    def read_fileno(self) -> ty.Optional[int]:
+        """Return a file descriptor the handle can be read through.
+
+        Handles whose writes must go through pwrite, such as tracked ones,
+        have no fileno but may still offer this for copies out of them.
+        """
+        return self.fileno()
+
+    def copy_from(self, src_fd: int, offset: int, length: int) -> int:
+        """Copy a range of src_fd to the same offset, in the kernel.
+
+        Only called on handles with a read_fileno, the default copies into
+        that descriptor. Handles that track writes override this so the
+        copy is recorded like a pwrite.
+
+        :returns: the number of bytes copied.
+        """
+        return file_utils.copy_range(
+            src_fd, self.read_fileno(), offset, length)
+
+    def extents(self) -> ty.Iterator[ty.Tuple[int, int]]:
+        """Yield (offset, length) for each region that may contain data.
+
+        Regions that are not reported read as zeros. The default reports
+        the whole volume.
+        """
+        if self.size:
+            yield 0, self.size
+
+    @contextlib.contextmanager
+    def map(self, offset: int = 0,
+            length: ty.Optional[int] = None) -> ty.Iterator[memoryview]:
+        """Expose a region of the volume as a writable memoryview.
+
+        The default copies the region into a buffer and writes it back on
+        exit, backends that can map their storage override this to avoid
+        the copies.
+        """
+        length = self.size - offset if length is None else length
+        buf = bytearray(length)
+        self.readinto(buf, offset)
+        view = memoryview(buf)
+        try:
+            yield view
+        finally:
+            view.release()
+        self.pwrite(buf, offset)
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self.closed = True
+
+
+class FileHandle(VolumeHandle):
+    """
+    FileHandle is a VolumeHandle over a file descriptor.
+
+    A readonly handle opens the file for reading only, its regions are
+    mapped read-only and writes raise OSError with EROFS.
+    """
+
+    def __init__(self, path: str, size: ty.Optional[int] = None,
+                 readonly: bool = False):
+        self.path = path
+        self.readonly = readonly
+        self.fd = os.open(path, os.O_RDONLY if readonly else os.O_RDWR)
+        super().__init__(os.fstat(self.fd).st_size if size is None else size)
+
+    def _check_writable(self) -> None:
+        if self.readonly:
+            raise OSError(errno.EROFS, 'volume is read-only', self.path)
+
+    def pread(self, size: int, offset: int) -> bytes:
+        return os.pread(self.fd, size, offset)
+
+    def pwrite(self, data, offset: int) -> int:
+        self._check_writable()
+        return os.pwrite(self.fd, data, offset)
+
+    def readinto(self, buf, offset: int) -> int:
+        return os.preadv(self.fd, [buf], offset)
+
+    def write_zeroes(self, offset: int, length: int) -> None:
+        self._check_writable()
+        if not file_utils.punch_hole(self.fd, offset, length):
+            super().write_zeroes(offset, length)
+
+    def copy_from(self, src_fd: int, offset: int, length: int) -> int:
+        self._check_writable()
+        return super().copy_from(src_fd, offset, length)
+
+    def fileno(self) -> int:
+        return self.fd
+
+    def extents(self) -> ty.Iterator[ty.Tuple[int, int]]:
+        return file_utils.iter_extents(self.fd, self.size)
+
+    @contextlib.contextmanager
+    def map(self, offset: int = 0,
+            length: ty.Optional[int] = None) -> ty.Iterator[memoryview]:
+        """Map a region of the file with mmap, writes go straight to it."""
+        length = self.size - offset if length is None else length
+        if not length:
+            # mmap takes a length of 0 to mean the whole file
+            yield memoryview(bytearray())
+            return
+        # mmap offsets must be aligned to the allocation granularity
+        start = offset - offset % mmap.ALLOCATIONGRANULARITY
+        mapping = mmap.mmap(
+            self.fd, length + offset - start, offset=start,
+            access=mmap.ACCESS_READ if self.readonly else mmap.ACCESS_WRITE)
+        base = memoryview(mapping)
+        view = base[offset - start:]
+        try:
+            yield view
+        finally:
+            view.release()
+            base.release()
+            mapping.flush()
+            mapping.close()
+
+    def flush(self) -> None:
+        os.fsync(self.fd)
+
+    def close(self) -> None:
+        if not self.closed:
+            os.close(self.fd)
+        super().close()
+
+
+class FileObjectHandle(VolumeHandle):
+    """
+    FileObjectHandle adapts a seekable binary file object to a VolumeHandle.
+
+    This is used for volumes that are not a single file on disk. Access is
+    serialised as the underlying object has a single position.
+    """
+
+    def __init__(self, fileobj: ty.IO, size: int):
+        super().__init__(size)
+        self.fileobj = fileobj
+        self._lock = threading.Lock()
+
+    def pread(self, size: int, offset: int) -> bytes:
+        with self._lock:
+            self.fileobj.seek(offset)
+            return self.fileobj.read(max(0, min(size, self.size - offset)))
+
+    def pwrite(self, data, offset: int) -> int:
+        with self._lock:
+            self.fileobj.seek(offset)
+            return self.fileobj.write(data)
+
+    def flush(self) -> None:
+        self.fileobj.flush()
+
+    def close(self) -> None:
+        if not self.closed:
+            self.fileobj.close()
+        super().close()
+
+
+class HandleFile(io.RawIOBase):
+    """
+    HandleFile is a binary file object over a VolumeHandle.
+
+    It is the inverse of FileObjectHandle, for volumes whose handles add
+    behaviour, such as caching, that their file objects should share. The
+    file can not be truncated, volumes are resized by their backend.
+    """
+
+    def __init__(self, handle: VolumeHandle):
+        super().__init__()
+        self.handle = handle
+        self._pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def writable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self.handle.size
+        if offset < 0:
+            raise ValueError(f'negative seek position {offset}')
+        self._pos = offset
+        return self._pos
+
+    def readinto(self, buf) -> int:
+        view = memoryview(buf).cast('B')
+        length = max(0, min(len(view), self.handle.size - self._pos))
+        n = self.handle.readinto(view[:length], self._pos)
+        self._pos += n
+        return n
+
+    def write(self, buf) -> int:
+        n = self.handle.pwrite(buf, self._pos)
+        self._pos += n
+        if self._pos > self.handle.size:
+            self.handle.size = self._pos
+        return n
+
+    def flush(self) -> None:
+        if not self.closed:
+            self.handle.flush()
+        super().flush()
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        try:
+            super().close()
+        finally:
+            self.handle.close()
+
+
+def copy(src: VolumeHandle, dst: VolumeHandle, offset: int = 0,
+         length: ty.Optional[int] = None,
+         dst_offset: ty.Optional[int] = None) -> int:
+    """Copy a range of src to dst.
+
+    When both handles are backed by file descriptors the copy is done with
+    os.copy_file_range so the data stays in the kernel. Otherwise a single
+    buffer is reused with readinto so no per block objects are allocated.
+
+    :returns: the number of bytes copied.
+    """
+    length = src.size - offset if length is None else length
+    dst_offset = offset if dst_offset is None else dst_offset
+    src_fd = src.read_fileno()
+    if (src_fd is not None and dst.read_fileno() is not None and
+            dst_offset == offset):
+        return dst.copy_from(src_fd, offset, length)
+    buf = bytearray(min(COPY_BUFFER_SIZE, length))
+    view = memoryview(buf)
+    copied = 0
+    while copied < length:
+        count = min(len(buf), length - copied)
+        n = src.readinto(view[:count], offset + copied)
+        if not n:
+            break
+        dst.pwrite(view[:n], dst_offset + copied)
+        copied += n
+    return copied
+
+
+def sendfile(src: VolumeHandle, out_fd: int, offset: int = 0,
+             length: ty.Optional[int] = None) -> int:
+    """Stream a range of src to a file descriptor such as a socket.
+
+    os.sendfile is used when the handle has a file descriptor, otherwise
+    the data is read and written in chunks.
+
+    :returns: the number of bytes sent.
+    """
+    length = src.size - offset if length is None else length
+    src_fd = src.read_fileno()
+    sent = 0
+    while sent < length:
+        count = min(COPY_BUFFER_SIZE, length - sent)
+        if src_fd is not None:
+            n = os.sendfile(out_fd, src_fd, offset + sent, count)
+        else:
+            data = src.pread(count, offset + sent)
+            n = os.write(out_fd, data) if data else 0
+        if not n:
+            break
+        sent += n
+    return sent
@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: Apache-2.0
+"""
+A write-ahead journal of multi-step metadata operations.
+
+An operation that touches several things, such as a backing file and the
+catalog, is recorded with begin before its first step and with end after
+its last. If the process dies in between the operation is still pending
+when the journal is opened again, and the owner of the journal can roll
+it forward or back by looking at just the things it names, rather than
+scanning everything for leftovers.
+
+begin returns once its record is durable. Records of concurrent callers
+are written and synced together by whichever of them gets to the file
+first, a group commit, so many operations in flight share each fsync.
+End records are not waited for, an operation whose end was lost is found
+to be complete when it is recovered. Once the journal grows past
+COMPACT_SIZE it is rewritten with only the pending operations, so it and
+the time to replay it stay proportional to the operations in flight.
+"""
+
+import dataclasses
+import json
+import os
+import threading
+import typing as ty
+import zlib
+
+
+@dataclasses.dataclass
+class Entry:
+    """
+    Entry is an operation recorded in a journal.
+    """
+
+    op_id: int
+    op: str
+    data: ty.Dict[str, ty.Any]
+
+
+def _record(payload: ty.Dict[str, ty.Any]) -> bytes:
+    data = json.dumps(payload, separators=(',', ':')).encode('utf-8')
+    return b'%08x %s\n' % (zlib.crc32(data), data)
+
+
+def _parse(line: bytes) -> ty.Optional[ty.Dict[str, ty.Any]]:
+    # a torn or corrupt record marks the end of the journal
+    if not line.endswith(b'\n') or len(line) < 10 or line[8:9] != b' ':
+        return None
+    data = line[9:-1]
+    try:
+        if int(line[:8], 16) != zlib.crc32(data):
+            return None
+        return json.loads(data)
+    except ValueError:
+        return None
+
+
+class Journal:
+    """
+    Journal is an append-only log of operations at path.
+
+    Opening a journal replays it, the operations that were begun but never
+    ended are returned by pending until they are ended. With sync False
+    records are written but not synced, which survives the process dying
+    but not the host losing power.
+    """
+
+    # rewrite the journal with only the pending operations past this size
+    COMPACT_SIZE = 1024 * 1024
+
+    def __init__(self, path: str, sync: bool = True):
+        self.path = path
+        self.sync = sync
+        self._cond = threading.Condition()
+        self._pending: ty.Dict[int, Entry] = {}
+        self._next_id = 1
+        self._buffer: ty.List[bytes] = []
+        self._appended = 0
+        self._durable = 0
+        self._flushing = False
+        self._error: ty.Optional[BaseException] = None
+        created = not os.path.exists(path)
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        try:
+            self._size = self._replay()
+            if created:
+                self._sync_dir()
+        except BaseException:
+            os.close(self._fd)
+            raise
+
+    def _replay(self) -> int:
+        size = 0
+        with open(self._fd, 'rb', closefd=False) as f:
+            for line in f:
+                payload = _parse(line)
+                if payload is None:
+                    break
+                size += len(line)
+                op_id = payload['id']
+                if payload.get('end'):
+                    self._pending.pop(op_id, None)
+                else:
+                    self._pending[op_id] = Entry(
+                        op_id, payload['op'], payload['data'])
+                self._next_id = max(self._next_id, op_id + 1)
+        # appending after a torn record would hide everything after it
+        os.ftruncate(self._fd, size)
+        return size
+
+    def _sync_dir(self) -> None:
+        if not self.sync:
+            return
+        fd = os.open(os.path.dirname(os.path.abspath(self.path)),
+                     os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def close(self) -> None:
+        with self._cond:
+            if self._fd < 0:
+                return
+            if self._error is None:
+                # end records are buffered, and a write may be running
+                self._wait(self._appended)
+            os.close(self._fd)
+            self._fd = -1
+
+    def __len__(self) -> int:
+        with self._cond:
+            return len(self._pending)
+
+    def pending(self) -> ty.List[Entry]:
+        """Return the operations begun and not yet ended, oldest first."""
+        with self._cond:
+            return sorted(self._pending.values(), key=lambda e: e.op_id)
+
+    def begin(self, op: str, **data: ty.Any) -> Entry:
+        """Record that an operation is starting, once it is durable."""
+        with self._cond:
+            entry = Entry(self._next_id, op, data)
+            self._next_id += 1
+            self._pending[entry.op_id] = entry
+            self._append({'id': entry.op_id, 'op': op, 'data': data})
+            try:
+                self._wait(self._appended)
+            except BaseException:
+                self._pending.pop(entry.op_id, None)
+                raise
+            return entry
+
+    def end(self, entry: Entry) -> None:
+        """Record that an operation finished, it is written lazily."""
+        with self._cond:
+            if self._pending.pop(entry.op_id, None) is not None:
+                self._append({'id': entry.op_id, 'end': True})
+
+    def _append(self, payload: ty.Dict[str, ty.Any]) -> None:
+        # called with the lock held
+        self._buffer.append(_record(payload))
+        self._appended += 1
+
+    def _wait(self, seq: int) -> None:
+        """Return once the first seq records are durable.
+
+        Called with the lock held. The first waiter to find no write in
+        progress writes everything buffered so far, the others wait for it
+        and find their records already written.
+        """
+        while self._durable < seq:
+            if self._error is not None:
+                raise OSError(
+                    f'journal {self.path} failed') from self._error
+            if self._flushing:
+                self._cond.wait()
+                continue
+            self._flushing = True
+            batch, target = self._buffer, self._appended
+            self._buffer = []
+            compact = self._size > self.COMPACT_SIZE
+            if compact:
+                batch = [
+                    _record({'id': e.op_id, 'op': e.op, 'data': e.data})
+                    for e in self._pending.values()]
+            self._cond.release()
+            try:
+                if compact:
+                    size = self._rewrite(batch)
+                else:
+                    size = self._size + self._write(self._fd, batch)
+            except BaseException as e:
+                self._cond.acquire()
+                self._error = e
+                self._flushing = False
+                self._cond.notify_all()
+                raise
+            self._cond.acquire()
+            self._size = size
+            self._durable = target
+            self._flushing = False
+            self._cond.notify_all()
+
+    def _write(self, fd: int, batch: ty.List[bytes]) -> int:
+        data = b''.join(batch)
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+        if self.sync:
+            os.fdatasync(fd)
+        return len(data)
+
+    def _rewrite(self, batch: ty.List[bytes]) -> int:
+        tmp = f'{self.path}.tmp'
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_APPEND,
+                     0o644)
+        try:
+            size = self._write(fd, batch)
+            os.replace(tmp, self.path)
+        except BaseException:
+            os.close(fd)
+            raise
+        self._sync_dir()
+        os.close(self._fd)
+        self._fd = fd
+        return size
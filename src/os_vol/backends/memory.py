@@ -1,46 +1,367 @@
 # -*- coding: utf-8 -*-
-import copy
+import collections
+import contextlib
 import dataclasses
 import io
+import os
+import threading
 import typing as ty
 import uuid
 
 from os_vol.backends import api
+from os_vol.backends import cbt
+from os_vol.backends import handle
+
+PAGE_SIZE = 64 * 1024
+CLONE_COW = 'cow'
+
+_ZERO_PAGE = bytes(PAGE_SIZE)
+
+
+class PageStore:
+    """
+    PageStore is a sparse bytes store made of fixed size pages.
+
+    Pages are only allocated when first written, missing pages read as
+    zeros. Clones share pages with their source and a page is copied the
+    first time either side writes to it. Writes, truncation and cloning are
+    serialised by a per store lock.
+
+    A page can be mapped to be written in place, it then stays private to
+    the store: clones get a copy of it and discards zero it rather than
+    dropping it.
+    """
+
+    def __init__(self, size: int = 0,
+                 pages: ty.Optional[ty.Dict[int, bytearray]] = None):
+        self.size = size
+        self.pages: ty.Dict[int, bytearray] = pages if pages else {}
+        # pages this store may modify in place, all others may be shared
+        self._owned: ty.Set[int] = set()
+        # map counts of the pages mapped by view
+        self._mapped: ty.Counter[int] = collections.Counter()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return self.size
+
+    def _writable_page(self, index: int) -> bytearray:
+        if index in self._owned:
+            return self.pages[index]
+        page = self.pages.get(index)
+        page = bytearray(page) if page is not None else bytearray(PAGE_SIZE)
+        self.pages[index] = page
+        self._owned.add(index)
+        return page
+
+    def readinto(self, offset: int, buf) -> int:
+        view = memoryview(buf).cast('B')
+        length = max(0, min(len(view), self.size - offset))
+        done = 0
+        while done < length:
+            index, start = divmod(offset + done, PAGE_SIZE)
+            count = min(PAGE_SIZE - start, length - done)
+            page = self.pages.get(index)
+            if page is None:
+                view[done:done + count] = bytes(count)
+            else:
+                view[done:done + count] = page[start:start + count]
+            done += count
+        return done
+
+    def read(self, offset: int, length: int) -> bytes:
+        buf = bytearray(max(0, min(length, self.size - offset)))
+        self.readinto(offset, buf)
+        return bytes(buf)
+
+    def write(self, offset: int, data) -> int:
+        view = memoryview(data).cast('B')
+        done = 0
+        with self._lock:
+            while done < len(view):
+                index, start = divmod(offset + done, PAGE_SIZE)
+                count = min(PAGE_SIZE - start, len(view) - done)
+                page = self._writable_page(index)
+                page[start:start + count] = view[done:done + count]
+                done += count
+            self.size = max(self.size, offset + done)
+        return done
+
+    def update(self, offset: int, data) -> int:
+        """Write data, leaving alone the pages it would not change.
+
+        Unchanged pages stay shared with clones, or unallocated.
+        """
+        view = memoryview(data).cast('B')
+        done = 0
+        with self._lock:
+            while done < len(view):
+                index, start = divmod(offset + done, PAGE_SIZE)
+                count = min(PAGE_SIZE - start, len(view) - done)
+                page = self.pages.get(index, _ZERO_PAGE)
+                if page[start:start + count] != view[done:done + count]:
+                    page = self._writable_page(index)
+                    page[start:start + count] = view[done:done + count]
+                done += count
+            self.size = max(self.size, offset + done)
+        return done
+
+    @contextlib.contextmanager
+    def view(self, offset: int, length: int) -> ty.Iterator[memoryview]:
+        """Expose a range within one page as a view of the page itself."""
+        index, start = divmod(offset, PAGE_SIZE)
+        if start + length > PAGE_SIZE:
+            raise ValueError(f'{length} bytes at {offset} span pages')
+        with self._lock:
+            page = self._writable_page(index)
+            self._mapped[index] += 1
+        view = memoryview(page)[start:start + length]
+        try:
+            yield view
+        finally:
+            view.release()
+            with self._lock:
+                self._mapped[index] -= 1
+                if not self._mapped[index]:
+                    del self._mapped[index]
+
+    def truncate(self, size: int) -> None:
+        """Resize the store, this only touches pages when shrinking."""
+        with self._lock:
+            if size < self.size:
+                last = -(-size // PAGE_SIZE)
+                for index in [i for i in self.pages if i >= last]:
+                    del self.pages[index]
+                    self._owned.discard(index)
+                start = size % PAGE_SIZE
+                if start and last - 1 in self.pages:
+                    page = self._writable_page(last - 1)
+                    page[start:] = bytes(PAGE_SIZE - start)
+            self.size = size
+
+    def discard(self, offset: int, length: int) -> None:
+        """Zero a range, dropping the pages it covers completely."""
+        end = min(offset + length, self.size)
+        with self._lock:
+            while offset < end:
+                index, start = divmod(offset, PAGE_SIZE)
+                count = min(PAGE_SIZE - start, end - offset)
+                if count == PAGE_SIZE and index not in self._mapped:
+                    self.pages.pop(index, None)
+                    self._owned.discard(index)
+                elif index in self.pages:
+                    page = self._writable_page(index)
+                    page[start:start + count] = bytes(count)
+                offset += count
+
+    def grow(self, size: int) -> int:
+        """Grow the store by size bytes, returning the new size."""
+        with self._lock:
+            self.size += size
+            return self.size
+
+    def clone(self) -> 'PageStore':
+        """Return a copy-on-write clone sharing all pages with this store."""
+        with self._lock:
+            pages = dict(self.pages)
+            # mapped pages may be written to at any time, so they are
+            # copied rather than shared
+            for index in self._mapped:
+                pages[index] = bytearray(pages[index])
+            self._owned.intersection_update(self._mapped)
+            clone = PageStore(self.size, pages)
+            clone._owned.update(self._mapped)
+            return clone
+
+    def getvalue(self) -> bytes:
+        return self.read(0, self.size)
+
+    def extents(self) -> ty.Iterator[ty.Tuple[int, int]]:
+        """Yield (offset, length) for each run of allocated pages."""
+        start = end = None
+        for index in sorted(self.pages):
+            if index * PAGE_SIZE >= self.size:
+                break
+            if index != end:
+                if start is not None:
+                    yield start * PAGE_SIZE, (end - start) * PAGE_SIZE
+                start = index
+            end = index + 1
+        if start is not None:
+            yield start * PAGE_SIZE, min(
+                (end - start) * PAGE_SIZE, self.size - start * PAGE_SIZE)
+
+
+class MemoryFile(io.RawIOBase):
+    """
+    MemoryFile is a binary file object over a PageStore.
+    """
+
+    def __init__(self, store: PageStore):
+        super().__init__()
+        self.store = store
+        self._pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def writable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self.store.size
+        if offset < 0:
+            raise ValueError(f'negative seek position {offset}')
+        self._pos = offset
+        return self._pos
+
+    def readinto(self, buf) -> int:
+        n = self.store.readinto(self._pos, buf)
+        self._pos += n
+        return n
+
+    def write(self, buf) -> int:
+        n = self.store.write(self._pos, buf)
+        self._pos += n
+        return n
+
+    def truncate(self, size: ty.Optional[int] = None) -> int:
+        size = self._pos if size is None else size
+        self.store.truncate(size)
+        return size
+
+
+class MemoryHandle(handle.VolumeHandle):
+    """
+    MemoryHandle is a VolumeHandle over a PageStore.
+
+    Its size is always that of the store, so it follows the volume as it is
+    written past its end or grown.
+    """
+
+    def __init__(self, store: PageStore):
+        super().__init__()
+        self.store = store
+
+    @property
+    def size(self) -> int:
+        return self.store.size
+
+    def pread(self, size: int, offset: int) -> bytes:
+        return self.store.read(offset, size)
+
+    def pwrite(self, data, offset: int) -> int:
+        return self.store.write(offset, data)
+
+    def readinto(self, buf, offset: int) -> int:
+        return self.store.readinto(offset, buf)
+
+    def write_zeroes(self, offset: int, length: int) -> None:
+        self.store.discard(offset, length)
+
+    def extents(self) -> ty.Iterator[ty.Tuple[int, int]]:
+        return self.store.extents()
+
+    @contextlib.contextmanager
+    def map(self, offset: int = 0,
+            length: ty.Optional[int] = None) -> ty.Iterator[memoryview]:
+        """Expose a region of the volume as a writable memoryview.
+
+        A region of a PageStore within one page is a view of the page, so
+        it is not copied. Pages are not contiguous, so larger regions are
+        copied into a buffer and only the pages changed through it are
+        written back on exit.
+        """
+        length = self.size - offset if length is None else length
+        if (isinstance(self.store, PageStore) and
+                offset % PAGE_SIZE + length <= PAGE_SIZE and
+                0 < length <= self.size - offset):
+            with self.store.view(offset, length) as view:
+                yield view
+            return
+        buf = bytearray(length)
+        self.store.readinto(offset, buf)
+        view = memoryview(buf)
+        try:
+            yield view
+        finally:
+            view.release()
+        self.store.update(offset, buf)
 
 
 @dataclasses.dataclass
 class Memory(api.Backend):
     """
     Memory is a fake storage backend that stores volumes in memory.
+
+    Volume data is kept in sparse PageStores so only written pages use
+    memory and clones share pages until they are written. Each store
+    serialises its own updates, so all operations are safe to call from
+    multiple threads.
     """
 
-    volumes: ty.Dict[uuid.UUID, ty.IO] = dataclasses.field(
+    volumes: ty.Dict[uuid.UUID, PageStore] = dataclasses.field(
         default_factory=dict)
+    # defaults to the physical memory of the host
+    capacity: ty.Optional[int] = None
+    trackers: ty.Dict[uuid.UUID, cbt.ChangeTracker] = dataclasses.field(
+        default_factory=dict)
+
+    def get_capacity(self) -> int:
+        if self.capacity is None:
+            self.capacity = (
+                os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES'))
+        return self.capacity
+
+    def get_provisioned(self) -> int:
+        return sum(len(store) for store in list(self.volumes.values()))
+
+    def get_allocated(self) -> int:
+        # pages shared by clones are only counted once
+        pages = {id(page) for store in list(self.volumes.values())
+                 for page in list(store.pages.values())}
+        return len(pages) * PAGE_SIZE
 
-    def create_volume(self, size: int,  name: str) -> 'api.volume.Volume':
+    def get_volume_allocated(self, volume) -> int:
+        return len(self.volumes[volume.volume_id].pages) * PAGE_SIZE
+
+    def create_volume(self, size: int,  name: str,
+                      provisioning: str = api.PROVISION_SPARSE
+                      ) -> 'api.volume.Volume':
+        # pages are always allocated on write, the mode is only recorded
+        api.check_provisioning(provisioning)
         backend = self
         vol_id = uuid.uuid4()
         vol_path = f'mem://vol-{vol_id}'
         vol = api.volume.Volume(path=vol_path, name=name, volume_id=vol_id,
-                                size=size, backend=backend)
-        self.volumes[vol.volume_id] = io.StringIO('\0' * size)
+                                size=size, backend=backend,
+                                provisioning=provisioning)
+        self.volumes[vol.volume_id] = PageStore(size)
         return vol
 
     def delete_volume(self, volume):
         del self.volumes[volume.volume_id]
+        self.trackers.pop(volume.volume_id, None)
 
     def grow_volume(self, volume, size):
-        data = self.volumes[volume.volume_id]
-        data.seek(volume.size)
-        data.write('\0' * size)
-        volume.size = len(data.getvalue())
-        self.volumes[volume.volume_id] = data
+        volume.size = self.volumes[volume.volume_id].grow(size)
 
     def clone_volume(self, volume, name):
         kwargs = {
             'name': name,
             'backend': self,
             'size': volume.size,
+            'clone_strategy': CLONE_COW,
+            'provisioning': volume.provisioning,
         }
         vol_id = uuid.uuid4()
         kwargs['volume_id'] = vol_id
@@ -48,11 +369,20 @@ class Memory(api.Backend):
         kwargs['path'] = vol_path
         new_vol = api.volume.Volume(**kwargs)
         self.volumes[new_vol.volume_id] = (
-            copy.deepcopy(self.volumes[volume.volume_id]))
+            self.volumes[volume.volume_id].clone())
         return new_vol
 
+    def get_tracker(self, volume) -> cbt.ChangeTracker:
+        return self.trackers.setdefault(
+            volume.volume_id, cbt.ChangeTracker())
+
     def open_volume(self, volume) -> ty.IO:
-        return self.volumes[volume.volume_id]
+        return cbt.TrackedFile(MemoryFile(self.volumes[volume.volume_id]),
+                               self.get_tracker(volume))
+
+    def open_handle(self, volume) -> handle.VolumeHandle:
+        return cbt.TrackedHandle(MemoryHandle(self.volumes[volume.volume_id]),
+                                 self.get_tracker(volume))
 
     def host_attach(self, volume):
         raise NotImplementedError
@@ -0,0 +1,395 @@
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: Apache-2.0
+"""
+Copy-on-write overlay files for shallow clones.
+
+An overlay is a sparse file the same size as the volume plus a block map
+recording which blocks have been written to the overlay. Blocks that are
+not in the map are read from the parent, which may itself be an overlay,
+so a chain of overlays behaves like a single volume.
+"""
+
+import collections
+import errno
+import functools
+import io
+import os
+import threading
+import typing as ty
+
+from os_vol.backends import file_utils
+from os_vol import cache
+
+BLOCK_SIZE = 64 * 1024
+MAP_SUFFIX = '.map'
+CLONE_OVERLAY = 'overlay'
+
+_ZERO_BLOCK = bytes(BLOCK_SIZE)
+
+
+def map_path(path: str) -> str:
+    return f'{path}{MAP_SUFFIX}'
+
+
+class BlockMap:
+    """
+    BlockMap is a bitmap of the blocks present in an overlay file.
+
+    Updates and saves are serialised by a lock, so the files open on an
+    overlay can share its map, see BlockMaps.
+    """
+
+    def __init__(self, path: str, bits: ty.Optional[bytearray] = None):
+        self.path = path
+        self.bits = bits if bits is not None else bytearray()
+        self.dirty = False
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path: str) -> 'BlockMap':
+        with open(path, 'rb') as f:
+            return cls(path, bytearray(f.read()))
+
+    def save(self) -> None:
+        """Atomically replace the map file with the in memory bitmap."""
+        with self._lock:
+            tmp = f'{self.path}.tmp'
+            with open(tmp, 'wb') as f:
+                f.write(self.bits)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+            self.dirty = False
+
+    def __contains__(self, block: int) -> bool:
+        byte = block >> 3
+        return byte < len(self.bits) and bool(
+            self.bits[byte] & (1 << (block & 7)))
+
+    def add(self, block: int) -> None:
+        byte = block >> 3
+        with self._lock:
+            if byte >= len(self.bits):
+                self.bits.extend(bytes(byte + 1 - len(self.bits)))
+            self.bits[byte] |= 1 << (block & 7)
+            self.dirty = True
+
+    def add_range(self, first: int, end: int) -> None:
+        """Add the blocks first to end, exclusive."""
+        if first >= end:
+            return
+        last_byte = (end - 1) >> 3
+        first_byte = first >> 3
+        with self._lock:
+            if last_byte >= len(self.bits):
+                self.bits.extend(bytes(last_byte + 1 - len(self.bits)))
+            if first_byte == last_byte:
+                for block in range(first, end):
+                    self.bits[first_byte] |= 1 << (block & 7)
+            else:
+                self.bits[first_byte] |= (0xff << (first & 7)) & 0xff
+                self.bits[first_byte + 1:last_byte] = (
+                    b'\xff' * (last_byte - first_byte - 1))
+                self.bits[last_byte] |= 0xff >> (7 - ((end - 1) & 7))
+            self.dirty = True
+
+    def truncate(self, blocks: int) -> None:
+        """Remove every block from blocks on."""
+        byte, bit = divmod(blocks, 8)
+        with self._lock:
+            if byte < len(self.bits):
+                self.bits[byte] &= (1 << bit) - 1
+                del self.bits[byte + 1:]
+                self.dirty = True
+
+    def __iter__(self) -> ty.Iterator[int]:
+        for byte, value in enumerate(self.bits):
+            if not value:
+                continue
+            for bit in range(8):
+                if value & (1 << bit):
+                    yield (byte << 3) | bit
+
+    def __len__(self) -> int:
+        return sum(bin(b).count('1') for b in self.bits)
+
+
+class Layer(ty.NamedTuple):
+    """A file in an overlay chain and its block map, None for the base."""
+    path: str
+    block_map: ty.Optional[BlockMap]
+
+
+class BlockMaps:
+    """
+    BlockMaps hands out one shared BlockMap per overlay file.
+
+    Every file open on an overlay must see the blocks written through the
+    others, and saving a private copy of the map would drop them. Maps are
+    loaded on first use and dropped once the last user releases them.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._maps: ty.Dict[str, BlockMap] = {}
+        self._users: ty.Counter[str] = collections.Counter()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._maps)
+
+    def acquire(self, path: str) -> BlockMap:
+        """Return the map of the overlay at path, to be released after."""
+        with self._lock:
+            block_map = self._maps.get(path)
+            if block_map is None:
+                block_map = BlockMap.load(map_path(path))
+                self._maps[path] = block_map
+            self._users[path] += 1
+            return block_map
+
+    def release(self, layers: ty.Iterable[Layer]) -> None:
+        """Release the maps of the overlays among layers."""
+        with self._lock:
+            for layer in layers:
+                if layer.block_map is None:
+                    continue
+                self._users[layer.path] -= 1
+                if not self._users[layer.path]:
+                    del self._users[layer.path]
+                    del self._maps[layer.path]
+
+
+def create(path: str, size: int) -> None:
+    """Create an empty overlay of size bytes at path, which must not exist."""
+    with open(path, 'xb') as f:
+        f.truncate(size)
+    BlockMap(map_path(path)).save()
+
+
+def _data_blocks(path: str, size: int) -> ty.Iterator[int]:
+    """Yield the index of every block of path that contains data."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        for offset, length in file_utils.iter_extents(fd, size):
+            yield from range(
+                offset // BLOCK_SIZE, -(-(offset + length) // BLOCK_SIZE))
+    finally:
+        os.close(fd)
+
+
+def copy_layers(layers: ty.Sequence[Layer], dst_path: str, size: int) -> int:
+    """Apply the blocks of the overlay layers onto a copy of their base.
+
+    dst_path must already hold a copy of the base layer, layers[-1]. The
+    mapped blocks of each overlay are copied on top, bottom up, so dst_path
+    ends up with the same content as reading through the chain.
+
+    :returns: the number of bytes written to dst_path.
+    """
+    copied = 0
+    dst_fd = os.open(dst_path, os.O_WRONLY)
+    try:
+        os.ftruncate(dst_fd, size)
+        for layer in reversed(layers[:-1]):
+            src_fd = os.open(layer.path, os.O_RDONLY)
+            try:
+                for block in layer.block_map:
+                    offset = block * BLOCK_SIZE
+                    if offset >= size:
+                        continue
+                    length = min(BLOCK_SIZE, size - offset)
+                    if not file_utils.copy_range(
+                            src_fd, dst_fd, offset, length):
+                        # mapped but never allocated, so it reads as zero
+                        os.pwrite(dst_fd, _ZERO_BLOCK[:length], offset)
+                    copied += length
+            finally:
+                os.close(src_fd)
+    finally:
+        os.close(dst_fd)
+    return copied
+
+
+class OverlayFile(io.RawIOBase):
+    """
+    OverlayFile exposes a chain of overlay layers as one binary file.
+
+    layers are ordered from the top, the only writable layer, down to the
+    base. Writes that do not cover a whole block first copy the rest of
+    the block up from the layers below. The block map of the top layer is
+    persisted on flush and close.
+
+    With a cache, blocks are cached per layer file, so overlays sharing a
+    parent share its cached blocks. A readonly file opens no layer for
+    writing, for overlays that are themselves the parent of others. The
+    maps of layers acquired from maps are released when the file is closed.
+    """
+
+    def __init__(self, layers: ty.Sequence[Layer], size: int,
+                 cache: ty.Optional[cache.BlockCache] = None,
+                 readonly: bool = False,
+                 maps: ty.Optional[BlockMaps] = None):
+        super().__init__()
+        self.layers = list(layers)
+        self.size = size
+        self.cache = cache
+        self.readonly = readonly
+        self.maps = maps
+        self._pos = 0
+        self._fds = [
+            os.open(layers[0].path,
+                    os.O_RDONLY if readonly else os.O_RDWR)] + [
+            os.open(layer.path, os.O_RDONLY) for layer in layers[1:]]
+
+    @property
+    def block_map(self) -> BlockMap:
+        return self.layers[0].block_map
+
+    def readable(self) -> bool:
+        return True
+
+    def writable(self) -> bool:
+        return not self.readonly
+
+    def _check_writable(self) -> None:
+        if self.readonly:
+            raise OSError(errno.EROFS, 'overlay is read-only',
+                          self.layers[0].path)
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError(f'negative seek position {offset}')
+        self._pos = offset
+        return self._pos
+
+    def read_block(self, block: int, start: int, length: int) -> bytes:
+        """Read part of a block from the first layer that holds it."""
+        offset = block * BLOCK_SIZE + start
+        for layer, fd in zip(self.layers, self._fds):
+            if layer.block_map is None or block in layer.block_map:
+                if self.cache is None:
+                    data = os.pread(fd, length, offset)
+                else:
+                    data = self.cache.read(
+                        layer.path, length, offset,
+                        functools.partial(os.pread, fd))
+                return data + bytes(length - len(data))
+        return bytes(length)
+
+    def readinto(self, buf) -> int:
+        view = memoryview(buf).cast('B')
+        end = min(self._pos + len(view), self.size)
+        done = 0
+        while self._pos < end:
+            block, start = divmod(self._pos, BLOCK_SIZE)
+            length = min(BLOCK_SIZE - start, end - self._pos)
+            view[done:done + length] = self.read_block(block, start, length)
+            done += length
+            self._pos += length
+        return done
+
+    def write(self, buf) -> int:
+        self._check_writable()
+        view = memoryview(buf).cast('B')
+        done = 0
+        while done < len(view):
+            block, start = divmod(self._pos, BLOCK_SIZE)
+            length = min(BLOCK_SIZE - start, len(view) - done)
+            data = view[done:done + length]
+            # the last block of the volume may be shorter than BLOCK_SIZE
+            full = min(BLOCK_SIZE, max(self.size, self._pos + length) -
+                       block * BLOCK_SIZE)
+            if block not in self.block_map and length != full:
+                merged = bytearray(self.read_block(block, 0, full))
+                merged[start:start + length] = data
+                data = merged
+                start = 0
+            os.pwrite(self._fds[0], data, block * BLOCK_SIZE + start)
+            self._invalidate(block * BLOCK_SIZE + start, len(data))
+            self.block_map.add(block)
+            done += length
+            self._pos += length
+        self.size = max(self.size, self._pos)
+        return done
+
+    def materialise(self) -> None:
+        """Copy every block with data in a lower layer into the top layer.
+
+        Only blocks allocated in one of the lower files are visited, so the
+        cost scales with the data in the chain rather than the volume size.
+        """
+        self._check_writable()
+        blocks = set()
+        for layer in self.layers[1:]:
+            blocks.update(_data_blocks(layer.path, self.size))
+        for block in sorted(blocks):
+            if block in self.block_map:
+                continue
+            offset = block * BLOCK_SIZE
+            if offset >= self.size:
+                continue
+            length = min(BLOCK_SIZE, self.size - offset)
+            data = self.read_block(block, 0, length)
+            if data != _ZERO_BLOCK[:length]:
+                os.pwrite(self._fds[0], data, offset)
+                self._invalidate(offset, length)
+            self.block_map.add(block)
+
+    def _invalidate(self, offset: int, length: ty.Optional[int]) -> None:
+        if self.cache is not None:
+            self.cache.invalidate(self.layers[0].path, offset, length)
+
+    def truncate(self, size: ty.Optional[int] = None) -> int:
+        """Resize the overlay, the range past the old size reads as zeros.
+
+        Blocks cut off are removed from the block map. When growing, the new
+        blocks are added to it so they are read from the top layer, where
+        they are holes, rather than from the parent.
+        """
+        self._check_writable()
+        size = self._pos if size is None else size
+        old = self.size
+        tail = old % BLOCK_SIZE
+        if size > old and tail and old // BLOCK_SIZE not in self.block_map:
+            # copy up the start of the last block, its end reads as zeros
+            block = old // BLOCK_SIZE
+            os.pwrite(self._fds[0], self.read_block(block, 0, tail),
+                      block * BLOCK_SIZE)
+            self.block_map.add(block)
+        os.ftruncate(self._fds[0], size)
+        self._invalidate(0, None)
+        if size < old:
+            self.block_map.truncate(-(-size // BLOCK_SIZE))
+        else:
+            self.block_map.add_range(
+                -(-old // BLOCK_SIZE), -(-size // BLOCK_SIZE))
+        self.size = size
+        return size
+
+    def flush(self) -> None:
+        if not self.closed and not self.readonly and self.block_map.dirty:
+            self.block_map.save()
+        super().flush()
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        try:
+            self.flush()
+        finally:
+            for fd in self._fds:
+                os.close(fd)
+            if self.maps is not None:
+                self.maps.release(self.layers)
+            super().close()
@@ -0,0 +1,404 @@
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: Apache-2.0
+"""
+A memory bounded cache of volume blocks.
+
+A BlockCache holds fixed size blocks of backing files keyed by a file key,
+usually the path of the file, and the index of the block. Blocks are
+evicted least recently used first, or with the adaptive replacement cache
+policy, ARC, which also keeps blocks that are used often and so resists
+being flushed by a single large scan.
+
+Readers go through the cache with readinto and writers call invalidate
+after writing. Each invalidate bumps a generation of the key, a block read
+before a write to its key is not cached when its generation is stale, so
+a reader racing a writer can not leave stale data behind.
+
+CachedHandle puts a cache in front of any VolumeHandle. Backends key the
+blocks by backing file, so every handle of a volume shares its cached
+blocks, and shallow clones share the cached blocks of their parents.
+"""
+
+import collections
+import contextlib
+import dataclasses
+import threading
+import typing as ty
+
+from os_vol.backends import handle
+
+BLOCK_SIZE = 64 * 1024
+POLICY_LRU = 'lru'
+POLICY_ARC = 'arc'
+POLICIES = (POLICY_LRU, POLICY_ARC)
+# misses are read from the backend in runs of up to this many blocks
+MAX_READ_BLOCKS = 16
+
+Key = ty.Tuple[ty.Hashable, int]
+Pread = ty.Callable[[int, int], bytes]
+
+
+@dataclasses.dataclass(frozen=True)
+class CacheStats:
+    """
+    CacheStats is a snapshot of the counters of a BlockCache.
+    """
+
+    hits: int
+    misses: int
+    evictions: int
+    invalidations: int
+    blocks: int
+    size: int
+    capacity: int
+
+    @property
+    def hit_ratio(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+class _LRU:
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.entries: 'collections.OrderedDict[Key, bytes]' = (
+            collections.OrderedDict())
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, key: Key) -> ty.Optional[bytes]:
+        data = self.entries.get(key)
+        if data is not None:
+            self.entries.move_to_end(key)
+        return data
+
+    def put(self, key: Key, data: bytes) -> int:
+        """Insert a block, returning the number of blocks evicted."""
+        self.entries[key] = data
+        self.entries.move_to_end(key)
+        evicted = 0
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+            evicted += 1
+        return evicted
+
+    def pop(self, key: Key) -> None:
+        self.entries.pop(key, None)
+
+    def keys(self) -> ty.List[Key]:
+        return list(self.entries)
+
+    def values(self) -> ty.Iterator[bytes]:
+        return iter(self.entries.values())
+
+    def clear(self) -> None:
+        self.entries.clear()
+
+
+class _ARC:
+    """
+    Adaptive replacement, as described by Megiddo and Modha.
+
+    t1 holds blocks seen once recently and t2 blocks seen at least twice,
+    b1 and b2 remember the keys recently evicted from each. A hit on one
+    of those ghosts moves the target size p of t1 towards the list that
+    would have kept the block.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.p = 0
+        self.t1: 'collections.OrderedDict[Key, bytes]' = (
+            collections.OrderedDict())
+        self.t2: 'collections.OrderedDict[Key, bytes]' = (
+            collections.OrderedDict())
+        self.b1: 'collections.OrderedDict[Key, None]' = (
+            collections.OrderedDict())
+        self.b2: 'collections.OrderedDict[Key, None]' = (
+            collections.OrderedDict())
+
+    def __len__(self) -> int:
+        return len(self.t1) + len(self.t2)
+
+    def get(self, key: Key) -> ty.Optional[bytes]:
+        data = self.t1.pop(key, None)
+        if data is not None:
+            self.t2[key] = data
+            return data
+        data = self.t2.get(key)
+        if data is not None:
+            self.t2.move_to_end(key)
+        return data
+
+    def _replace(self, in_b2: bool) -> None:
+        if self.t1 and (not self.t2 or len(self.t1) > self.p or
+                        (in_b2 and len(self.t1) == self.p)):
+            key, _ = self.t1.popitem(last=False)
+            self.b1[key] = None
+        else:
+            key, _ = self.t2.popitem(last=False)
+            self.b2[key] = None
+
+    def put(self, key: Key, data: bytes) -> int:
+        """Insert a block, returning the number of blocks evicted."""
+        c = self.capacity
+        if key in self.t1 or key in self.t2:
+            # raced with another reader, refresh the data
+            self.t1.pop(key, None)
+            self.t2[key] = data
+            return 0
+        before = len(self)
+        if key in self.b1:
+            self.p = min(c, self.p + max(len(self.b2) // len(self.b1), 1))
+            del self.b1[key]
+            if len(self) >= c:
+                self._replace(False)
+            self.t2[key] = data
+        elif key in self.b2:
+            self.p = max(0, self.p - max(len(self.b1) // len(self.b2), 1))
+            del self.b2[key]
+            if len(self) >= c:
+                self._replace(True)
+            self.t2[key] = data
+        else:
+            l1 = len(self.t1) + len(self.b1)
+            total = l1 + len(self.t2) + len(self.b2)
+            # invalidated blocks leave the cache below capacity, only
+            # replace a block when it is full
+            if l1 >= c:
+                if len(self.t1) < c:
+                    self.b1.popitem(last=False)
+                    if len(self) >= c:
+                        self._replace(False)
+                else:
+                    self.t1.popitem(last=False)
+            elif total >= c:
+                if total >= 2 * c and self.b2:
+                    self.b2.popitem(last=False)
+                if len(self) >= c:
+                    self._replace(False)
+            self.t1[key] = data
+        return before + 1 - len(self)
+
+    def pop(self, key: Key) -> None:
+        for entries in (self.t1, self.t2, self.b1, self.b2):
+            entries.pop(key, None)
+
+    def keys(self) -> ty.List[Key]:
+        return list(self.t1) + list(self.t2)
+
+    def values(self) -> ty.Iterator[bytes]:
+        yield from self.t1.values()
+        yield from self.t2.values()
+
+    def clear(self) -> None:
+        for entries in (self.t1, self.t2, self.b1, self.b2):
+            entries.clear()
+        self.p = 0
+
+
+class BlockCache:
+    """
+    BlockCache caches blocks of backing files within a size budget.
+
+    :param size: the budget in bytes, at most size // block_size blocks are
+        kept.
+    :param policy: POLICY_LRU or POLICY_ARC.
+
+    All methods are thread safe.
+    """
+
+    def __init__(self, size: int, block_size: int = BLOCK_SIZE,
+                 policy: str = POLICY_ARC):
+        if policy not in POLICIES:
+            raise ValueError(f'unknown cache policy {policy}')
+        if size < block_size:
+            raise ValueError(
+                f'cache size {size} is smaller than a block')
+        self.block_size = block_size
+        self.policy = policy
+        self.capacity = size // block_size
+        self._entries = (_ARC if policy == POLICY_ARC else _LRU)(
+            self.capacity)
+        self._generations: ty.Dict[ty.Hashable, int] = {}
+        self._lock = threading.Lock()
+        self._hits = self._misses = 0
+        self._evictions = self._invalidations = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def generation(self, key: ty.Hashable) -> int:
+        """Return the generation of key, to pass to put after a read."""
+        return self._generations.get(key, 0)
+
+    def get(self, key: ty.Hashable, block: int) -> ty.Optional[bytes]:
+        with self._lock:
+            data = self._entries.get((key, block))
+            if data is None:
+                self._misses += 1
+            else:
+                self._hits += 1
+            return data
+
+    def put(self, key: ty.Hashable, block: int, data: bytes,
+            generation: int) -> None:
+        """Cache a block read while key was at generation."""
+        with self._lock:
+            if self._generations.get(key, 0) != generation:
+                return
+            self._evictions += self._entries.put((key, block), data)
+
+    def invalidate(self, key: ty.Hashable, offset: int = 0,
+                   length: ty.Optional[int] = None) -> None:
+        """Drop the cached blocks of a byte range, all of key by default."""
+        with self._lock:
+            self._generations[key] = self._generations.get(key, 0) + 1
+            self._invalidations += 1
+            if length is None:
+                for entry in self._entries.keys():
+                    if entry[0] == key:
+                        self._entries.pop(entry)
+                return
+            first = offset // self.block_size
+            end = -(-(offset + length) // self.block_size)
+            if end - first > len(self._entries):
+                # cheaper to scan the cache than every block of the range
+                for entry in self._entries.keys():
+                    if entry[0] == key and first <= entry[1] < end:
+                        self._entries.pop(entry)
+                return
+            for block in range(first, end):
+                self._entries.pop((key, block))
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> CacheStats:
+        with self._lock:
+            return CacheStats(
+                hits=self._hits, misses=self._misses,
+                evictions=self._evictions,
+                invalidations=self._invalidations,
+                blocks=len(self._entries),
+                size=sum(len(data) for data in self._entries.values()),
+                capacity=self.capacity * self.block_size)
+
+    def read(self, key: ty.Hashable, size: int, offset: int,
+             pread: Pread) -> bytes:
+        """Read up to size bytes at offset, loading blocks with pread."""
+        block, start = divmod(offset, self.block_size)
+        if start + size > self.block_size:
+            buf = bytearray(size)
+            return bytes(buf[:self.readinto(key, buf, offset, pread)])
+        # most reads are within a block, slice it without a copy to a buffer
+        data = self.get(key, block)
+        if data is None:
+            data, _ = self._load(key, block, offset + size, pread)
+        return data[start:start + size]
+
+    def readinto(self, key: ty.Hashable, buf, offset: int,
+                 pread: Pread) -> int:
+        """Read into buf at offset, loading missing blocks with pread.
+
+        pread(size, offset) reads the backing file of key. Consecutive
+        missing blocks are loaded with a single call.
+
+        :returns: the number of bytes read, short at the end of the file.
+        """
+        view = memoryview(buf).cast('B')
+        bs = self.block_size
+        done = 0
+        while done < len(view):
+            block, start = divmod(offset + done, bs)
+            data = self.get(key, block)
+            # a block shorter than the block size is the end of the file
+            eof = data is not None and len(data) < bs
+            if data is None:
+                data, eof = self._load(key, block, offset + len(view), pread)
+            count = min(len(data) - start, len(view) - done)
+            if count > 0:
+                view[done:done + count] = memoryview(data)[
+                    start:start + count]
+                done += count
+            if eof or count <= 0:
+                break
+        return done
+
+    def _load(self, key: ty.Hashable, block: int, end: int,
+              pread: Pread) -> ty.Tuple[bytes, bool]:
+        # read the missing block along with the following blocks up to end,
+        # at most MAX_READ_BLOCKS, they are counted as misses too
+        bs = self.block_size
+        count = min(MAX_READ_BLOCKS, max(1, -(-end // bs) - block))
+        generation = self.generation(key)
+        data = pread(count * bs, block * bs)
+        view = memoryview(data)
+        for i in range(0, len(data), bs):
+            self.put(key, block + i // bs, bytes(view[i:i + bs]), generation)
+        with self._lock:
+            self._misses += count - 1
+        return data, len(data) < count * bs
+
+
+class CachedHandle(handle.VolumeHandle):
+    """
+    CachedHandle reads a VolumeHandle through a BlockCache.
+
+    Writes go straight to the inner handle and then invalidate the blocks
+    they touched. The handle has no file descriptor so copies into it go
+    through pwrite, which keeps the cache coherent.
+    """
+
+    def __init__(self, inner: handle.VolumeHandle, cache: BlockCache,
+                 key: ty.Hashable):
+        super().__init__(inner.size)
+        self.inner = inner
+        self.cache = cache
+        self.key = key
+
+    def pread(self, size: int, offset: int) -> bytes:
+        return self.cache.read(
+            self.key, max(0, min(size, self.size - offset)), offset,
+            self.inner.pread)
+
+    def readinto(self, buf, offset: int) -> int:
+        view = memoryview(buf).cast('B')
+        length = max(0, min(len(view), self.size - offset))
+        return self.cache.readinto(
+            self.key, view[:length], offset, self.inner.pread)
+
+    def pwrite(self, data, offset: int) -> int:
+        try:
+            return self.inner.pwrite(data, offset)
+        finally:
+            self.cache.invalidate(self.key, offset, memoryview(data).nbytes)
+
+    def write_zeroes(self, offset: int, length: int) -> None:
+        try:
+            self.inner.write_zeroes(offset, length)
+        finally:
+            self.cache.invalidate(self.key, offset, length)
+
+    def extents(self) -> ty.Iterator[ty.Tuple[int, int]]:
+        return self.inner.extents()
+
+    @contextlib.contextmanager
+    def map(self, offset: int = 0,
+            length: ty.Optional[int] = None) -> ty.Iterator[memoryview]:
+        length = self.size - offset if length is None else length
+        try:
+            with self.inner.map(offset, length) as view:
+                yield view
+        finally:
+            self.cache.invalidate(self.key, offset, length)
+
+    def flush(self) -> None:
+        self.inner.flush()
+
+    def close(self) -> None:
+        if not self.closed:
+            self.inner.close()
+        super().close()
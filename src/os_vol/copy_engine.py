@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: Apache-2.0
+"""
+Parallel, chunked copies between volumes and files.
+
+A CopyEngine splits the ranges to copy into chunks and copies them on a
+pool of threads. Between file descriptors chunks are moved with
+os.copy_file_range, so the data stays in the kernel, otherwise with
+readinto and pwrite through a buffer per thread. The threads release the
+GIL while they wait for I/O so several chunks are in flight at once, which
+is what keeps deep device queues and network filesystems busy.
+
+Copies can be limited to a rate in bytes per second, shared by every copy
+of an engine, so background clones and migrations leave bandwidth for the
+guests. A copy is cancelled by setting the threading.Event passed to it,
+and progress is reported after every chunk as a CopyStats.
+"""
+
+from concurrent import futures
+import dataclasses
+import functools
+import os
+import threading
+import time
+import typing as ty
+
+from os_vol.backends import file_utils
+from os_vol.backends import handle
+
+DEFAULT_CHUNK_SIZE = file_utils.COPY_CHUNK_SIZE
+DEFAULT_CONCURRENCY = 4
+
+Extents = ty.Iterable[ty.Tuple[int, int]]
+ChunkCopy = ty.Callable[[int, int], int]
+ProgressCallback = ty.Callable[['CopyStats'], None]
+
+
+@dataclasses.dataclass
+class CopyStats:
+    """
+    CopyStats records the progress of a copy.
+
+    Chunks complete out of order, so copied counts bytes rather than
+    marking a position that the copy has reached.
+    """
+
+    total: int
+    copied: int = 0
+    chunks: int = 0
+    start_time: float = dataclasses.field(default_factory=time.monotonic)
+    end_time: ty.Optional[float] = None
+
+    @property
+    def elapsed(self) -> float:
+        end = self.end_time if self.end_time is not None else time.monotonic()
+        return end - self.start_time
+
+    @property
+    def bytes_per_second(self) -> float:
+        elapsed = self.elapsed
+        return self.copied / elapsed if elapsed > 0 else 0.0
+
+    @property
+    def done(self) -> bool:
+        return self.end_time is not None
+
+
+class Throttle:
+    """
+    Throttle limits the rate of bytes passed to consume across threads.
+
+    Each caller reserves the next slot of rate bytes per second and sleeps
+    until it starts, so a burst is at most one chunk per thread. A rate of
+    None disables the limit, the rate can be changed while copies run.
+    """
+
+    def __init__(self, rate: ty.Optional[float] = None,
+                 clock: ty.Callable[[], float] = time.monotonic,
+                 sleep: ty.Callable[[float], None] = time.sleep):
+        self.rate = rate
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._next = 0.0
+
+    def consume(self, n: int) -> None:
+        rate = self.rate
+        if not rate:
+            return
+        with self._lock:
+            now = self._clock()
+            start = max(self._next, now)
+            self._next = start + n / rate
+        if start > now:
+            self._sleep(start - now)
+
+
+class CopyEngine:
+    """
+    CopyEngine copies ranges in chunks of chunk_size on concurrency threads.
+
+    An engine can be shared, every copy gets its own threads and the rate
+    limit applies to all of them together.
+    """
+
+    # chunks queued per thread, bounds the memory used by huge copies
+    QUEUE_DEPTH = 2
+
+    def __init__(self, chunk_size: int = DEFAULT_CHUNK_SIZE,
+                 concurrency: int = DEFAULT_CONCURRENCY,
+                 rate_limit: ty.Optional[float] = None):
+        if chunk_size <= 0:
+            raise ValueError(f'chunk size must be positive, not {chunk_size}')
+        if concurrency <= 0:
+            raise ValueError(
+                f'concurrency must be positive, not {concurrency}')
+        self.chunk_size = chunk_size
+        self.concurrency = concurrency
+        self.throttle = Throttle(rate_limit)
+        self._buffers = threading.local()
+
+    @property
+    def rate_limit(self) -> ty.Optional[float]:
+        return self.throttle.rate
+
+    @rate_limit.setter
+    def rate_limit(self, rate: ty.Optional[float]) -> None:
+        self.throttle.rate = rate
+
+    def copy(self, src: handle.VolumeHandle, dst: handle.VolumeHandle,
+             extents: ty.Optional[Extents] = None,
+             progress: ty.Optional[ProgressCallback] = None,
+             cancel: ty.Optional[threading.Event] = None) -> CopyStats:
+        """Copy ranges of src to the same offsets in dst.
+
+        :param extents: (offset, length) ranges to copy, by default the
+            extents of src, so holes in src are not copied. Ranges past
+            the end of src copy nothing.
+        :param progress: called with the CopyStats after every chunk.
+        :param cancel: stop the copy once this event is set.
+        :returns: the final CopyStats.
+        :raises concurrent.futures.CancelledError: if cancel was set.
+        """
+        if extents is None:
+            extents = src.extents()
+        src_fd = src.read_fileno()
+        if src_fd is not None and dst.read_fileno() is not None:
+            chunk_copy = functools.partial(dst.copy_from, src_fd)
+        else:
+            chunk_copy = functools.partial(self._copy_chunk, src, dst)
+        return self.run(extents, chunk_copy, progress, cancel)
+
+    def copy_fds(self, src_fd: int, dst_fd: int, extents: Extents,
+                 progress: ty.Optional[ProgressCallback] = None,
+                 cancel: ty.Optional[threading.Event] = None) -> CopyStats:
+        """Copy ranges of src_fd to the same offsets in dst_fd."""
+        return self.run(
+            extents, functools.partial(file_utils.copy_range, src_fd, dst_fd),
+            progress, cancel)
+
+    def sparse_copy(self, src_fd: int, dst_fd: int, size: int) -> int:
+        """A parallel file_utils.sparse_copy.
+
+        :returns: the number of bytes copied.
+        """
+        os.ftruncate(dst_fd, size)
+        return self.copy_fds(
+            src_fd, dst_fd, file_utils.iter_extents(src_fd, size)).copied
+
+    def run(self, extents: Extents, chunk_copy: ChunkCopy,
+            progress: ty.Optional[ProgressCallback] = None,
+            cancel: ty.Optional[threading.Event] = None) -> CopyStats:
+        """Call chunk_copy(offset, length) for every chunk of extents.
+
+        chunk_copy returns the number of bytes it copied and is called from
+        the threads of the engine, progress is called from the caller's.
+
+        :returns: the final CopyStats.
+        :raises concurrent.futures.CancelledError: if cancel was set.
+        """
+        extents = list(extents)
+        stats = CopyStats(total=sum(length for _, length in extents))
+        chunks = self._chunks(extents)
+        # starting threads costs more than a single chunk takes to copy
+        if self.concurrency == 1 or stats.total <= self.chunk_size:
+            for offset, length in chunks:
+                self._check(cancel)
+                self._record(stats, self._run_chunk(
+                    chunk_copy, offset, length), progress)
+        else:
+            self._run_parallel(chunks, chunk_copy, stats, progress, cancel)
+        self._check(cancel)
+        stats.end_time = time.monotonic()
+        return stats
+
+    def _run_parallel(self, chunks: ty.Iterator[ty.Tuple[int, int]],
+                      chunk_copy: ChunkCopy, stats: CopyStats,
+                      progress: ty.Optional[ProgressCallback],
+                      cancel: ty.Optional[threading.Event]) -> None:
+        pending: ty.Set[futures.Future] = set()
+        with futures.ThreadPoolExecutor(
+                self.concurrency, thread_name_prefix='os-vol-copy') as pool:
+            try:
+                for offset, length in chunks:
+                    self._check(cancel)
+                    if len(pending) >= self.concurrency * self.QUEUE_DEPTH:
+                        pending = self._wait(pending, stats, progress)
+                    pending.add(pool.submit(
+                        self._run_chunk, chunk_copy, offset, length))
+                while pending:
+                    pending = self._wait(pending, stats, progress)
+            except BaseException:
+                # don't start queued chunks, the pool waits for running ones
+                for future in pending:
+                    future.cancel()
+                raise
+
+    def _wait(self, pending: ty.Set[futures.Future], stats: CopyStats,
+              progress: ty.Optional[ProgressCallback]
+              ) -> ty.Set[futures.Future]:
+        done, pending = futures.wait(
+            pending, return_when=futures.FIRST_COMPLETED)
+        for future in done:
+            self._record(stats, future.result(), progress)
+        return pending
+
+    @staticmethod
+    def _record(stats: CopyStats, copied: int,
+                progress: ty.Optional[ProgressCallback]) -> None:
+        stats.copied += copied
+        stats.chunks += 1
+        if progress is not None:
+            progress(stats)
+
+    @staticmethod
+    def _check(cancel: ty.Optional[threading.Event]) -> None:
+        if cancel is not None and cancel.is_set():
+            raise futures.CancelledError()
+
+    def _chunks(self, extents: ty.List[ty.Tuple[int, int]]
+                ) -> ty.Iterator[ty.Tuple[int, int]]:
+        for offset, length in extents:
+            end = offset + length
+            while offset < end:
+                count = min(self.chunk_size, end - offset)
+                yield offset, count
+                offset += count
+
+    def _run_chunk(self, chunk_copy: ChunkCopy, offset: int,
+                   length: int) -> int:
+        self.throttle.consume(length)
+        return chunk_copy(offset, length)
+
+    def _copy_chunk(self, src: handle.VolumeHandle, dst: handle.VolumeHandle,
+                    offset: int, length: int) -> int:
+        buf = getattr(self._buffers, 'buf', None)
+        if buf is None or len(buf) < length:
+            buf = self._buffers.buf = bytearray(self.chunk_size)
+        view = memoryview(buf)[:length]
+        copied = 0
+        while copied < length:
+            n = src.readinto(view[copied:], offset + copied)
+            if not n:
+                # src is shorter than the range, the rest reads as zero
+                break
+            copied += n
+        done = 0
+        while done < copied:
+            done += dst.pwrite(view[done:copied], offset + done)
+        return copied
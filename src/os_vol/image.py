@@ -0,0 +1,435 @@
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: Apache-2.0
+"""
+Streaming import and export of raw images to and from volumes.
+
+Data is moved through a single large page aligned buffer. Blocks that are
+all zeros are not written on import, they are left as holes, and holes in
+the volume are skipped on export when the sink can represent them.
+Transfers can be resumed from an offset and report their progress as a
+TransferStats. An exported image can be brought up to date by writing only
+the blocks changed since a checkpoint with export_incremental. Exports
+from a file volume to a sparse file can be run in parallel by a
+CopyEngine.
+"""
+
+import bisect
+import contextlib
+import dataclasses
+import gzip
+import io
+import mmap
+import os
+import time
+import typing as ty
+
+from os_vol.backends import file_utils
+from os_vol.backends import handle
+from os_vol import copy_engine
+from os_vol import metrics
+from os_vol.objects import volume
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSION_GZIP = 'gzip'
+COMPRESSION_ZSTD = 'zstd'
+COMPRESSIONS = (COMPRESSION_GZIP, COMPRESSION_ZSTD)
+
+# granularity of zero detection, a block is skipped only if it is all zeros
+BLOCK_SIZE = 1024 * 1024
+BUFFER_SIZE = 8 * BLOCK_SIZE
+_ZERO_BLOCK = bytes(BLOCK_SIZE)
+
+Source = ty.Union[str, os.PathLike, ty.BinaryIO]
+ProgressCallback = ty.Callable[['TransferStats'], None]
+
+
+@dataclasses.dataclass
+class TransferStats:
+    """
+    TransferStats records the progress of an import or export.
+
+    offset is the next position in the volume to transfer, so a failed
+    transfer can be resumed by passing it back as the offset.
+    """
+
+    total: int
+    offset: int = 0
+    # bytes of data moved, excluding skipped zeros and holes
+    transferred: int = 0
+    skipped: int = 0
+    start_time: float = dataclasses.field(default_factory=time.monotonic)
+    end_time: ty.Optional[float] = None
+
+    @property
+    def elapsed(self) -> float:
+        end = self.end_time if self.end_time is not None else time.monotonic()
+        return end - self.start_time
+
+    @property
+    def bytes_per_second(self) -> float:
+        elapsed = self.elapsed
+        done = self.transferred + self.skipped
+        return done / elapsed if elapsed > 0 else 0.0
+
+    @property
+    def done(self) -> bool:
+        return self.offset >= self.total
+
+
+def _check_compression(compression: ty.Optional[str], offset: int) -> None:
+    if compression is None:
+        return
+    if compression not in COMPRESSIONS:
+        raise ValueError(f'unsupported compression {compression}')
+    if compression == COMPRESSION_ZSTD and zstandard is None:
+        raise ValueError('zstd compression requires the zstandard package')
+    if offset:
+        raise ValueError('compressed transfers can not be resumed')
+
+
+def _is_zero(view: memoryview) -> bool:
+    # most data blocks fail on the first or last byte, only copy the block
+    # to compare it when they are both zero.
+    if view[0] or view[-1]:
+        return False
+    if len(view) == BLOCK_SIZE:
+        return view.tobytes() == _ZERO_BLOCK
+    return not view.tobytes().strip(b'\0')
+
+
+def _overlaps(extents: ty.List[ty.Tuple[int, int]], offset: int,
+              length: int) -> bool:
+    index = bisect.bisect_right(extents, (offset, float('inf'))) - 1
+    if index >= 0 and sum(extents[index]) > offset:
+        return True
+    return (index + 1 < len(extents) and
+            extents[index + 1][0] < offset + length)
+
+
+@contextlib.contextmanager
+def _aligned_buffer(size: int) -> ty.Iterator[memoryview]:
+    # anonymous maps are page aligned, as O_DIRECT and the page cache like
+    buf = mmap.mmap(-1, size)
+    view = memoryview(buf)
+    try:
+        yield view
+    finally:
+        view.release()
+        try:
+            buf.close()
+        except BufferError:
+            # a slice is still referenced from a traceback, let it be
+            # collected with the traceback instead.
+            pass
+
+
+def _readfull(fileobj: ty.BinaryIO, view: memoryview) -> int:
+    filled = 0
+    while filled < len(view):
+        n = fileobj.readinto(view[filled:])
+        if not n:
+            break
+        filled += n
+    return filled
+
+
+def _report(stats: TransferStats,
+            progress: ty.Optional[ProgressCallback]) -> None:
+    if progress is not None:
+        progress(stats)
+
+
+def _open_source(source: Source, compression: ty.Optional[str],
+                 offset: int) -> ty.Tuple[ty.BinaryIO, ty.List[ty.Any]]:
+    to_close = []
+    if isinstance(source, (str, os.PathLike)):
+        source = open(source, 'rb', buffering=0)
+        to_close.append(source)
+    if compression == COMPRESSION_GZIP:
+        source = gzip.GzipFile(fileobj=source, mode='rb')
+        to_close.insert(0, source)
+    elif compression == COMPRESSION_ZSTD:
+        source = zstandard.ZstdDecompressor().stream_reader(
+            source, closefd=False)
+        to_close.insert(0, source)
+    elif offset:
+        source.seek(offset)
+    return source, to_close
+
+
+def _open_sink(sink: Source, compression: ty.Optional[str],
+               offset: int) -> ty.Tuple[ty.BinaryIO, ty.List[ty.Any]]:
+    to_close = []
+    if isinstance(sink, (str, os.PathLike)):
+        mode = 'r+b' if offset and os.path.exists(sink) else 'wb'
+        sink = open(sink, mode, buffering=0)
+        to_close.append(sink)
+    if compression == COMPRESSION_GZIP:
+        sink = gzip.GzipFile(fileobj=sink, mode='wb')
+        to_close.insert(0, sink)
+    elif compression == COMPRESSION_ZSTD:
+        sink = zstandard.ZstdCompressor().stream_writer(sink, closefd=False)
+        to_close.insert(0, sink)
+    elif offset:
+        sink.seek(offset)
+    return sink, to_close
+
+
+def _sparse_sink(sink: ty.BinaryIO) -> bool:
+    try:
+        return sink.seekable()
+    except (AttributeError, ValueError):
+        return False
+
+
+def _fileno(fileobj: ty.BinaryIO) -> ty.Optional[int]:
+    try:
+        return fileobj.fileno()
+    except (AttributeError, OSError, ValueError):
+        return None
+
+
+def _backend_name(volume: volume.Volume) -> str:
+    return type(volume.backend).__name__
+
+
+@metrics.instrumented(metrics.LAYER_IMAGE, 'import', _backend_name)
+def import_image(volume: volume.Volume, source: Source, offset: int = 0,
+                 compression: ty.Optional[str] = None,
+                 progress: ty.Optional[ProgressCallback] = None
+                 ) -> TransferStats:
+    """Write a raw image from source into the volume.
+
+    :param source: a path or a readable binary file object.
+    :param offset: resume the import at this offset in the image and the
+        volume, as reported by TransferStats.offset.
+    :param compression: decompress the source with gzip or zstd.
+    :param progress: called with the TransferStats after every buffer.
+    :returns: the final TransferStats.
+    :raises ValueError: if the image is larger than the volume.
+    """
+    _check_compression(compression, offset)
+    stats = TransferStats(total=volume.size, offset=offset)
+    source, to_close = _open_source(source, compression, offset)
+    try:
+        with _aligned_buffer(BUFFER_SIZE) as view, \
+                volume.backend.open_handle(volume) as dst:
+            # only ranges that may hold data need zeroing, the rest of a
+            # fresh volume is already a hole.
+            extents = list(dst.extents())
+            while True:
+                filled = _readfull(source, view)
+                if not filled:
+                    break
+                if stats.offset + filled > volume.size:
+                    raise ValueError(
+                        f'image is larger than volume {volume.name}')
+                _write_blocks(dst, view[:filled], stats, extents)
+                _report(stats, progress)
+            dst.flush()
+    finally:
+        for fileobj in to_close:
+            fileobj.close()
+    stats.end_time = time.monotonic()
+    metrics.add_bytes(metrics.LAYER_IMAGE, _backend_name(volume), 'import',
+                      stats.transferred)
+    return stats
+
+
+def _write_blocks(dst: handle.VolumeHandle, data: memoryview,
+                  stats: TransferStats,
+                  extents: ty.List[ty.Tuple[int, int]]) -> None:
+    pos = 0
+    while pos < len(data):
+        block = data[pos:pos + BLOCK_SIZE]
+        offset = stats.offset + pos
+        if _is_zero(block):
+            if _overlaps(extents, offset, len(block)):
+                dst.write_zeroes(offset, len(block))
+            stats.skipped += len(block)
+        else:
+            dst.pwrite(block, offset)
+            stats.transferred += len(block)
+        pos += len(block)
+    stats.offset += len(data)
+
+
+@metrics.instrumented(metrics.LAYER_IMAGE, 'export', _backend_name)
+def export_image(volume: volume.Volume, sink: Source, offset: int = 0,
+                 compression: ty.Optional[str] = None,
+                 progress: ty.Optional[ProgressCallback] = None,
+                 copier: ty.Optional[copy_engine.CopyEngine] = None
+                 ) -> TransferStats:
+    """Write the contents of the volume to sink as a raw image.
+
+    Holes and zero blocks are seeked over when the sink is a seekable,
+    uncompressed file, so the image stays sparse. When both the volume and
+    the sink are files the data is copied in the kernel.
+
+    :param sink: a path or a writable binary file object.
+    :param offset: resume the export at this offset in the volume and the
+        image, as reported by TransferStats.offset.
+    :param compression: compress the image with gzip or zstd.
+    :param progress: called with the TransferStats after every buffer.
+    :param copier: copy the extents of the volume in parallel when both
+        the volume and the sink are files. The chunks complete out of
+        order, so TransferStats.offset only moves once the copy is done.
+    :returns: the final TransferStats.
+    """
+    _check_compression(compression, offset)
+    stats = TransferStats(total=volume.size, offset=offset)
+    sink, to_close = _open_sink(sink, compression, offset)
+    sparse = compression is None and _sparse_sink(sink)
+    try:
+        with _aligned_buffer(BUFFER_SIZE) as view, \
+                volume.backend.open_handle(volume) as src:
+            ranges = _export_ranges(src, offset, sparse)
+            if (copier is not None and sparse and
+                    src.read_fileno() is not None and
+                    _fileno(sink) is not None):
+                _export_parallel(src, sink, ranges, copier, stats, progress)
+            else:
+                for start, length in ranges:
+                    _export_range(src, sink, start, length, view, stats,
+                                  sparse, progress)
+            if sparse:
+                _extend(sink, volume.size)
+            stats.skipped += volume.size - stats.offset
+            stats.offset = volume.size
+            _report(stats, progress)
+    finally:
+        for fileobj in to_close:
+            fileobj.close()
+    stats.end_time = time.monotonic()
+    metrics.add_bytes(metrics.LAYER_IMAGE, _backend_name(volume), 'export',
+                      stats.transferred)
+    return stats
+
+
+def _export_ranges(src: handle.VolumeHandle, offset: int,
+                   sparse: bool) -> ty.Iterator[ty.Tuple[int, int]]:
+    if not sparse:
+        # a stream must contain every byte, holes included
+        yield offset, src.size - offset
+        return
+    for start, length in src.extents():
+        end = start + length
+        if end > offset:
+            start = max(start, offset)
+            yield start, end - start
+
+
+def _export_range(src: handle.VolumeHandle, sink: ty.BinaryIO, start: int,
+                  length: int, view: memoryview, stats: TransferStats,
+                  sparse: bool,
+                  progress: ty.Optional[ProgressCallback]) -> None:
+    # everything between the previous range and this one is a hole
+    stats.skipped += start - stats.offset
+    stats.offset = start
+    src_fd, sink_fd = src.read_fileno(), _fileno(sink)
+    end = start + length
+    while stats.offset < end:
+        count = min(len(view), end - stats.offset)
+        if sparse and src_fd is not None and sink_fd is not None:
+            n = file_utils.copy_range(src_fd, sink_fd, stats.offset, count)
+            stats.transferred += n
+        else:
+            n = src.readinto(view[:count], stats.offset)
+            _write_stream(sink, view[:n], stats, sparse)
+        if not n:
+            break
+        stats.offset += n
+        _report(stats, progress)
+
+
+def _export_parallel(src: handle.VolumeHandle, sink: ty.BinaryIO,
+                     ranges: ty.Iterator[ty.Tuple[int, int]],
+                     copier: copy_engine.CopyEngine, stats: TransferStats,
+                     progress: ty.Optional[ProgressCallback]) -> None:
+    transferred = stats.transferred
+
+    def report(copy_stats: copy_engine.CopyStats) -> None:
+        stats.transferred = transferred + copy_stats.copied
+        _report(stats, progress)
+
+    copied = copier.copy_fds(
+        src.read_fileno(), _fileno(sink), ranges, report).copied
+    # everything that was not copied is a hole
+    stats.skipped += src.size - stats.offset - copied
+    stats.offset = src.size
+
+
+def _extend(sink: ty.BinaryIO, size: int) -> None:
+    # trailing holes are not written, extend the image to the volume size.
+    # Not every file object extends on truncate, BytesIO for one.
+    sink.truncate(size)
+    if size and sink.seek(0, io.SEEK_END) < size:
+        sink.seek(size - 1)
+        sink.write(b'\0')
+
+
+def _write_stream(sink: ty.BinaryIO, data: memoryview,
+                  stats: TransferStats, sparse: bool) -> None:
+    if not sparse:
+        sink.write(data)
+        stats.transferred += len(data)
+        return
+    for pos in range(0, len(data), BLOCK_SIZE):
+        block = data[pos:pos + BLOCK_SIZE]
+        if _is_zero(block):
+            stats.skipped += len(block)
+        else:
+            sink.seek(stats.offset + pos)
+            sink.write(block)
+            stats.transferred += len(block)
+
+
+@metrics.instrumented(metrics.LAYER_IMAGE, 'export_incremental',
+                      _backend_name)
+def export_incremental(volume: volume.Volume, sink: Source, since: str,
+                       checkpoint: ty.Optional[str] = None,
+                       progress: ty.Optional[ProgressCallback] = None
+                       ) -> TransferStats:
+    """Bring an earlier raw export of the volume up to date.
+
+    Only the blocks changed since the checkpoint since are read and written
+    over the image in place, then the image is resized to the volume, so
+    the cost is proportional to the changes rather than the volume size.
+
+    :param sink: a path or a seekable binary file object holding the image
+        exported at the checkpoint since.
+    :param checkpoint: create this checkpoint before reading, to start the
+        next incremental export from.
+    :param progress: called with the TransferStats after every write.
+    :returns: the final TransferStats.
+    :raises ValueError: if since is not a checkpoint of the volume.
+    """
+    stats = TransferStats(total=volume.size)
+    to_close = []
+    if isinstance(sink, (str, os.PathLike)):
+        sink = open(sink, 'r+b', buffering=0)
+        to_close.append(sink)
+    try:
+        for offset, data in volume.backend.export_incremental(
+                volume, since, checkpoint):
+            stats.skipped += offset - stats.offset
+            sink.seek(offset)
+            sink.write(data)
+            stats.transferred += len(data)
+            stats.offset = offset + len(data)
+            _report(stats, progress)
+        _extend(sink, volume.size)
+        stats.skipped += volume.size - stats.offset
+        stats.offset = volume.size
+        _report(stats, progress)
+    finally:
+        for fileobj in to_close:
+            fileobj.close()
+    stats.end_time = time.monotonic()
+    metrics.add_bytes(metrics.LAYER_IMAGE, _backend_name(volume),
+                      'export_incremental', stats.transferred)
+    return stats
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: Apache-2.0
+"""
+Per volume locks for multithreaded use of pools and backends.
+"""
+
+import collections
+import contextlib
+import threading
+import typing as ty
+
+
+def name_key(name: str) -> ty.Tuple[str, str]:
+    """Return the lock key for a volume name.
+
+    Volumes are locked by id, operations that create a volume lock the name
+    they are about to claim.
+    """
+    return ('name', name)
+
+
+class LockTable:
+    """
+    LockTable maps keys to locks made by factory on demand.
+
+    A lock is dropped once nobody holds or waits for it, so the table only
+    grows with the number of in-flight operations. Keys are checked out in
+    a stable order so locks taken in that order can't deadlock. The table
+    itself is guarded by a short internal lock, it is shared by the thread
+    and asyncio VolumeLocks.
+    """
+
+    def __init__(self, factory: ty.Callable[[], ty.Any]):
+        self._factory = factory
+        self._lock = threading.Lock()
+        self._locks: ty.Dict[ty.Hashable, ty.Any] = {}
+        self._users: ty.Counter[ty.Hashable] = collections.Counter()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._locks)
+
+    def checkout(
+            self, keys: ty.Iterable[ty.Hashable]
+    ) -> ty.Tuple[ty.List[ty.Hashable], ty.List[ty.Any]]:
+        """Return the keys in lock order and their locks.
+
+        Every checkout must be followed by a checkin of the keys returned.
+        """
+        keys = sorted(set(keys), key=repr)
+        with self._lock:
+            locks = []
+            for key in keys:
+                self._users[key] += 1
+                lock = self._locks.get(key)
+                if lock is None:
+                    lock = self._locks[key] = self._factory()
+                locks.append(lock)
+        return keys, locks
+
+    def checkin(self, keys: ty.Iterable[ty.Hashable]) -> None:
+        """Drop the locks of keys nobody else has checked out."""
+        with self._lock:
+            for key in keys:
+                self._users[key] -= 1
+                if not self._users[key]:
+                    del self._users[key]
+                    del self._locks[key]
+
+
+class VolumeLocks:
+    """
+    VolumeLocks hands out a reentrant lock per key.
+
+    Locks are created on demand and dropped once nobody holds or waits for
+    them, see LockTable.
+    """
+
+    def __init__(self):
+        self._table = LockTable(threading.RLock)
+
+    def __len__(self) -> int:
+        return len(self._table)
+
+    @contextlib.contextmanager
+    def hold(self, *keys: ty.Hashable) -> ty.Iterator[None]:
+        """Hold the locks for all keys, acquired in a stable order."""
+        keys, locks = self._table.checkout(keys)
+        acquired = []
+        try:
+            for lock in locks:
+                lock.acquire()
+                acquired.append(lock)
+            yield
+        finally:
+            for lock in reversed(acquired):
+                lock.release()
+            self._table.checkin(keys)
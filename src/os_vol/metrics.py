@@ -0,0 +1,366 @@
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: Apache-2.0
+"""
+Operation metrics and tracing hooks.
+
+Backend and StoragePool operations are timed into latency histograms and
+count their errors and the bytes they copy. Span hooks are called around
+each operation so it can be traced, an OpenTelemetry tracer is adapted
+with otel_hook. The metrics can be scraped with exposition, which renders
+them in the Prometheus text format.
+
+Instrumentation is off by default and an instrumented call then costs a
+single global lookup. Call enable to record metrics; adding a span hook
+traces operations whether or not metrics are enabled.
+"""
+
+import bisect
+import contextlib
+import functools
+import threading
+import time
+import typing as ty
+
+SpanHook = ty.Callable[[str, ty.Dict[str, str]], ty.ContextManager]
+
+LAYER_BACKEND = 'backend'
+LAYER_POOL = 'pool'
+LAYER_IMAGE = 'image'
+
+# latency buckets in seconds, from sub millisecond metadata updates to
+# multi second copies of large volumes
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+    2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class _Metric:
+    type_name: str
+
+    def __init__(self, name: str, documentation: str,
+                 labelnames: ty.Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: ty.Dict[ty.Tuple[str, ...], ty.Any] = {}
+        self._lock = threading.Lock()
+
+    def _new_child(self) -> ty.Any:
+        raise NotImplementedError
+
+    def labels(self, *values: str) -> ty.Any:
+        """Return the child of the metric for the given label values."""
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(
+                    f'{self.name} expects labels {self.labelnames}')
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def clear(self) -> None:
+        with self._lock:
+            self._children.clear()
+
+    def samples(self) -> ty.Iterator[
+            ty.Tuple[str, ty.Dict[str, str], float]]:
+        """Yield the (name, labels, value) samples of the metric."""
+        raise NotImplementedError
+
+
+class _CounterChild:
+    __slots__ = ('value', '_lock')
+
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1) -> None:
+        if amount < 0:
+            raise ValueError('counters can only be incremented')
+        with self._lock:
+            self.value += amount
+
+
+class Counter(_Metric):
+    """
+    Counter is a monotonically increasing value per set of labels.
+    """
+
+    type_name = 'counter'
+
+    def _new_child(self) -> _CounterChild:
+        return _CounterChild()
+
+    def samples(self) -> ty.Iterator[
+            ty.Tuple[str, ty.Dict[str, str], float]]:
+        for values, child in sorted(self._children.items()):
+            yield self.name, dict(zip(self.labelnames, values)), child.value
+
+
+class _HistogramChild:
+    __slots__ = ('upper_bounds', 'counts', 'sum', '_lock')
+
+    def __init__(self, upper_bounds: ty.Sequence[float]):
+        self.upper_bounds = upper_bounds
+        # the last count is the +Inf bucket
+        self.counts = [0] * (len(upper_bounds) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        i = bisect.bisect_left(self.upper_bounds, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts)
+
+
+class Histogram(_Metric):
+    """
+    Histogram counts observed values into buckets per set of labels.
+    """
+
+    type_name = 'histogram'
+
+    def __init__(self, name: str, documentation: str,
+                 labelnames: ty.Sequence[str] = (),
+                 buckets: ty.Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self) -> _HistogramChild:
+        return _HistogramChild(self.buckets)
+
+    def samples(self) -> ty.Iterator[
+            ty.Tuple[str, ty.Dict[str, str], float]]:
+        for values, child in sorted(self._children.items()):
+            labels = dict(zip(self.labelnames, values))
+            with child._lock:
+                counts, total = list(child.counts), child.sum
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                yield (f'{self.name}_bucket',
+                       dict(labels, le=_format_value(bound)), cumulative)
+            yield f'{self.name}_sum', labels, total
+            yield f'{self.name}_count', labels, cumulative
+
+
+class Registry:
+    """
+    Registry holds the metrics rendered by exposition.
+    """
+
+    def __init__(self):
+        self._metrics: ty.Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f'metric {metric.name} already registered')
+            self._metrics[metric.name] = metric
+        return metric
+
+    def get(self, name: str) -> ty.Optional[_Metric]:
+        return self._metrics.get(name)
+
+    def clear(self) -> None:
+        """Reset every metric, mostly useful in tests."""
+        for metric in list(self._metrics.values()):
+            metric.clear()
+
+    def __iter__(self) -> ty.Iterator[_Metric]:
+        return iter(list(self._metrics.values()))
+
+
+REGISTRY = Registry()
+
+LATENCY = REGISTRY.register(Histogram(
+    'os_vol_operation_duration_seconds', 'Latency of volume operations.',
+    ('layer', 'name', 'operation')))
+ERRORS = REGISTRY.register(Counter(
+    'os_vol_operation_errors_total', 'Volume operations that raised.',
+    ('layer', 'name', 'operation', 'error')))
+BYTES_COPIED = REGISTRY.register(Counter(
+    'os_vol_bytes_copied_total', 'Bytes copied by volume operations.',
+    ('layer', 'name', 'operation')))
+
+_enabled = False
+_span_hooks: ty.List[SpanHook] = []
+# true while either metrics or span hooks need instrumented calls observed
+_active = False
+
+
+class _Local(threading.local):
+    def __init__(self):
+        # the layers whose operations are running in this thread
+        self.layers: ty.Set[str] = set()
+
+
+_local = _Local()
+
+
+def _update() -> None:
+    global _active
+    _active = _enabled or bool(_span_hooks)
+
+
+def enable() -> None:
+    """Start recording metrics."""
+    global _enabled
+    _enabled = True
+    _update()
+
+
+def disable() -> None:
+    """Stop recording metrics, recorded values are kept."""
+    global _enabled
+    _enabled = False
+    _update()
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+def add_span_hook(hook: SpanHook) -> None:
+    """Trace operations with hook.
+
+    hook is called with the span name and attributes of each operation and
+    returns a context manager that is entered for its duration.
+    """
+    _span_hooks.append(hook)
+    _update()
+
+
+def remove_span_hook(hook: SpanHook) -> None:
+    _span_hooks.remove(hook)
+    _update()
+
+
+def otel_hook(tracer: ty.Any) -> SpanHook:
+    """Return a span hook that starts spans with an OpenTelemetry tracer."""
+    def hook(name: str,
+             attributes: ty.Dict[str, str]) -> ty.ContextManager:
+        return tracer.start_as_current_span(name, attributes=attributes)
+    return hook
+
+
+def add_bytes(layer: str, name: str, operation: str, count: int) -> None:
+    """Count bytes copied by an operation, a no-op when disabled."""
+    if _enabled and count:
+        BYTES_COPIED.labels(layer, name, operation).inc(count)
+
+
+def _observe(layer: str, name: str, operation: str,
+             copied: ty.Optional[ty.Callable[..., int]],
+             func: ty.Callable, args: tuple, kwargs: dict) -> ty.Any:
+    layers = _local.layers
+    if layer in layers:
+        # the operation is implemented by another operation of the same
+        # layer, such as an override calling super, only count it once
+        return func(*args, **kwargs)
+    with contextlib.ExitStack() as stack:
+        if _span_hooks:
+            attributes = {'os_vol.layer': layer, 'os_vol.name': name,
+                          'os_vol.operation': operation}
+            for hook in list(_span_hooks):
+                stack.enter_context(
+                    hook(f'os_vol.{layer}.{operation}', attributes))
+        layers.add(layer)
+        start = time.perf_counter()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            if _enabled:
+                ERRORS.labels(layer, name, operation, type(e).__name__).inc()
+            raise
+        finally:
+            layers.discard(layer)
+            if _enabled:
+                LATENCY.labels(layer, name, operation).observe(
+                    time.perf_counter() - start)
+    if copied is not None:
+        add_bytes(layer, name, operation, copied(*args, **kwargs))
+    return result
+
+
+def _class_name(obj: ty.Any) -> str:
+    return type(obj).__name__
+
+
+def instrumented(layer: str, operation: ty.Optional[str] = None,
+                 name: ty.Callable[[ty.Any], str] = _class_name,
+                 copied: ty.Optional[ty.Callable[..., int]] = None
+                 ) -> ty.Callable[[ty.Callable], ty.Callable]:
+    """Decorate a method to record its metrics and trace it.
+
+    :param layer: the layer label, LAYER_BACKEND or LAYER_POOL.
+    :param operation: the operation label, defaults to the method name.
+    :param name: returns the name label from the instance.
+    :param copied: returns the bytes copied from the call arguments.
+    """
+    def decorator(func: ty.Callable) -> ty.Callable:
+        op = operation or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            if not _active:
+                return func(self, *args, **kwargs)
+            return _observe(layer, name(self), op, copied, func,
+                            (self,) + args, kwargs)
+        wrapper.__instrumented__ = True
+        return wrapper
+    return decorator
+
+
+def instrument_class(
+        cls: type, layer: str, operations: ty.Iterable[str],
+        copied: ty.Optional[ty.Dict[str, ty.Callable[..., int]]] = None
+) -> None:
+    """Instrument the named operations of cls in place.
+
+    Inherited implementations are wrapped on cls as well, methods that are
+    abstract or already instrumented are left alone.
+    """
+    copied = copied or {}
+    for op in operations:
+        func = getattr(cls, op, None)
+        if (func is None or getattr(func, '__instrumented__', False) or
+                getattr(func, '__isabstractmethod__', False)):
+            continue
+        setattr(cls, op, instrumented(layer, op, copied=copied.get(op))(func))
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value)) if abs(value) < 1e15 else repr(float(value))
+    return repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return (value.replace('\\', '\\\\').replace('\n', '\\n')
+            .replace('"', '\\"'))
+
+
+def exposition(registry: Registry = REGISTRY) -> str:
+    """Render the metrics of registry in the Prometheus text format."""
+    lines = []
+    for metric in registry:
+        lines.append(f'# HELP {metric.name} {metric.documentation}')
+        lines.append(f'# TYPE {metric.name} {metric.type_name}')
+        for sample, labels, value in metric.samples():
+            if labels:
+                rendered = ','.join(
+                    f'{k}="{_escape(str(v))}"' for k, v in labels.items())
+                sample = f'{sample}{{{rendered}}}'
+            lines.append(f'{sample} {_format_value(value)}')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: Apache-2.0
+"""
+Columnar index of the volumes in a storage pool.
+
+The index keeps the id and size of each volume in parallel arrays so bulk
+queries such as filtering by size scan flat machine words instead of
+chasing a pointer to a Volume per row.
+"""
+
+import array
+import bisect
+import heapq
+import typing as ty
+import uuid
+
+_MASK64 = (1 << 64) - 1
+
+
+class VolumeIndex:
+    """
+    VolumeIndex holds the id and size of each volume as columns.
+
+    Rows are removed by moving the last row into the gap, so adding,
+    removing and resizing are O(1) and row order is not stable. Paging in
+    id order uses a sorted list of the ids that is built on first use and
+    kept up to date from then on. The index is not thread safe,
+    StoragePool only touches it under its lock.
+    """
+
+    def __init__(self):
+        # the 128 bit volume ids split into two 64 bit columns
+        self._id_hi = array.array('Q')
+        self._id_lo = array.array('Q')
+        self._sizes = array.array('q')
+        self._rows: ty.Dict[int, int] = {}
+        self._total = 0
+        # the ids as ints in ascending order, None until paged through
+        self._sorted: ty.Optional[ty.List[int]] = None
+
+    def __len__(self) -> int:
+        return len(self._sizes)
+
+    def __contains__(self, volume_id: uuid.UUID) -> bool:
+        return volume_id.int in self._rows
+
+    def _volume_id(self, row: int) -> uuid.UUID:
+        return uuid.UUID(int=self._id_hi[row] << 64 | self._id_lo[row])
+
+    def add(self, volume_id: uuid.UUID, size: int) -> None:
+        """Add a volume, or update its size if it is already indexed."""
+        key = volume_id.int
+        row = self._rows.get(key)
+        if row is not None:
+            self.resize(volume_id, size)
+            return
+        self._rows[key] = len(self._sizes)
+        self._id_hi.append(key >> 64)
+        self._id_lo.append(key & _MASK64)
+        self._sizes.append(size)
+        self._total += size
+        if self._sorted is not None:
+            bisect.insort(self._sorted, key)
+
+    def remove(self, volume_id: uuid.UUID) -> None:
+        """Remove a volume, volumes that are not indexed are ignored."""
+        row = self._rows.pop(volume_id.int, None)
+        if row is None:
+            return
+        self._total -= self._sizes[row]
+        if self._sorted is not None:
+            del self._sorted[bisect.bisect_left(self._sorted, volume_id.int)]
+        last = len(self._sizes) - 1
+        if row != last:
+            self._id_hi[row] = self._id_hi[last]
+            self._id_lo[row] = self._id_lo[last]
+            self._sizes[row] = self._sizes[last]
+            self._rows[self._id_hi[row] << 64 | self._id_lo[row]] = row
+        self._id_hi.pop()
+        self._id_lo.pop()
+        self._sizes.pop()
+
+    def resize(self, volume_id: uuid.UUID, size: int) -> None:
+        row = self._rows[volume_id.int]
+        self._total += size - self._sizes[row]
+        self._sizes[row] = size
+
+    def size(self, volume_id: uuid.UUID) -> int:
+        return self._sizes[self._rows[volume_id.int]]
+
+    @property
+    def total_size(self) -> int:
+        """The sum of the sizes of all indexed volumes."""
+        return self._total
+
+    def ids(self) -> ty.List[uuid.UUID]:
+        return [self._volume_id(row) for row in range(len(self._sizes))]
+
+    def page(self, limit: ty.Optional[int] = None,
+             marker: ty.Optional[uuid.UUID] = None) -> ty.List[uuid.UUID]:
+        """Return up to limit ids in ascending order, after marker.
+
+        The marker does not have to be indexed, so paging carries on past
+        a volume removed in the meantime.
+        """
+        if self._sorted is None:
+            self._sorted = sorted(self._rows)
+        start = 0
+        if marker is not None:
+            start = bisect.bisect_right(self._sorted, marker.int)
+        end = None if limit is None else start + limit
+        return [uuid.UUID(int=key) for key in self._sorted[start:end]]
+
+    def sizes(self) -> array.array:
+        """Return a copy of the size column, in row order."""
+        return array.array('q', self._sizes)
+
+    def select(self, min_size: int = 0,
+               max_size: ty.Optional[int] = None) -> ty.List[uuid.UUID]:
+        """Return the ids of volumes with min_size <= size <= max_size."""
+        sizes = self._sizes
+        if max_size is None:
+            rows = [r for r in range(len(sizes)) if sizes[r] >= min_size]
+        else:
+            rows = [r for r in range(len(sizes))
+                    if min_size <= sizes[r] <= max_size]
+        return [self._volume_id(row) for row in rows]
+
+    def largest(self, count: int) -> ty.List[ty.Tuple[uuid.UUID, int]]:
+        """Return the ids and sizes of the count largest volumes."""
+        rows = heapq.nlargest(
+            count, range(len(self._sizes)), key=self._sizes.__getitem__)
+        return [(self._volume_id(row), self._sizes[row]) for row in rows]
@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: Apache-2.0
+"""
+Serializers for volume and pool records.
+
+Records are the plain dicts returned by Volume.to_dict and
+StoragePool.storage_summary. They can be written as JSON, which is easy to
+read, or in a compact binary format with a fixed struct packed header.
+Records in either format carry a schema version and their kind so readers
+can reject or convert records written by other versions: binary records
+start with a magic number and both in their header, JSON records are
+wrapped in an envelope holding them. loads() detects the format of its
+input so both can be read back without knowing which one was used.
+"""
+
+import abc
+import json
+import struct
+import typing as ty
+import uuid
+
+Record = ty.Dict[str, ty.Any]
+
+FORMAT_JSON = 'json'
+FORMAT_BINARY = 'binary'
+
+KIND_VOLUME = 1
+KIND_POOL = 2
+
+MAGIC = b'OV'
+# version 2 added the provisioning string to volume records
+VERSION = 2
+
+# keys of the JSON envelope, JSON without one is an unversioned record
+# such as the output of Volume.volume_summary
+_JSON_VERSION = 'version'
+_JSON_KIND = 'kind'
+_JSON_RECORD = 'record'
+
+# magic, schema version and record kind
+_HEADER = struct.Struct('>2sBB')
+# volume: size, flags, volume_id and parent_id
+_VOLUME = struct.Struct('>QB16s16s')
+# pool: capacity, usage and the number of volumes
+_POOL = struct.Struct('>QQQ')
+_STR_LEN = struct.Struct('>H')
+# a string length of _NONE encodes None
+_NONE = 0xFFFF
+_HAS_PARENT = 0x01
+
+_VOLUME_STRINGS = (
+    'name', 'volume_type', 'path', 'device_path', 'clone_strategy',
+    'provisioning')
+# the strings of volume records by schema version, if they differ
+_VOLUME_STRINGS_V = {1: _VOLUME_STRINGS[:5]}
+_POOL_STRINGS = ('name', 'pool_type')
+
+
+def _check_version(version: int) -> None:
+    if version > VERSION:
+        raise ValueError(
+            f'record schema version {version} is newer than {VERSION}')
+
+
+class Serializer(abc.ABC):
+    """
+    Serializer converts volume and pool records to and from bytes.
+    """
+
+    name: str
+
+    @abc.abstractmethod
+    def dumps(self, record: Record, kind: int = KIND_VOLUME) -> bytes:
+        pass
+
+    @abc.abstractmethod
+    def loads(self, data: bytes) -> Record:
+        pass
+
+    def dump_volume(self, vol: ty.Any) -> bytes:
+        """Serialize a Volume, implementations may read its slots directly."""
+        return self.dumps(vol.to_dict(), KIND_VOLUME)
+
+    def load_volume(self, data: bytes) -> Record:
+        """Return the Volume constructor arguments stored in data.
+
+        Unlike loads the ids may be returned as ints, which Volume accepts
+        and stores without converting them.
+        """
+        return self.loads(data)
+
+
+class JSONSerializer(Serializer):
+    """
+    JSONSerializer writes records as compact JSON.
+
+    The record is wrapped in an object with the schema version and kind,
+    records without one are read back as they are.
+    """
+
+    name = FORMAT_JSON
+
+    def __init__(self):
+        self._encoder = json.JSONEncoder(separators=(',', ':'))
+        self._decoder = json.JSONDecoder()
+
+    def dumps(self, record: Record, kind: int = KIND_VOLUME) -> bytes:
+        if kind not in (KIND_VOLUME, KIND_POOL):
+            raise ValueError(f'unknown record kind {kind}')
+        return self._encoder.encode({
+            _JSON_VERSION: VERSION, _JSON_KIND: kind, _JSON_RECORD: record,
+        }).encode()
+
+    def loads(self, data: ty.Union[bytes, str]) -> Record:
+        if isinstance(data, bytes):
+            data = data.decode()
+        envelope = self._decoder.decode(data)
+        if _JSON_RECORD not in envelope:
+            return envelope
+        _check_version(envelope[_JSON_VERSION])
+        record = envelope[_JSON_RECORD]
+        if envelope[_JSON_KIND] == KIND_VOLUME:
+            # strings added after the version of the record are None
+            for name in _VOLUME_STRINGS:
+                record.setdefault(name, None)
+        elif envelope[_JSON_KIND] != KIND_POOL:
+            raise ValueError(f'unknown record kind {envelope[_JSON_KIND]}')
+        return record
+
+
+def _pack_str(parts: ty.List[bytes], value: ty.Optional[str]) -> None:
+    if value is None:
+        parts.append(_STR_LEN.pack(_NONE))
+        return
+    encoded = value.encode()
+    if len(encoded) >= _NONE:
+        raise ValueError(f'string too long to serialize: {value[:32]}...')
+    parts.append(_STR_LEN.pack(len(encoded)))
+    parts.append(encoded)
+
+
+def _unpack_strs(data: bytes, offset: int, names: ty.Sequence[str],
+                 record: Record) -> int:
+    view = memoryview(data)
+    for name in names:
+        (length,) = _STR_LEN.unpack_from(view, offset)
+        offset += _STR_LEN.size
+        if length == _NONE:
+            record[name] = None
+        else:
+            record[name] = bytes(view[offset:offset + length]).decode()
+            offset += length
+    return offset
+
+
+class BinarySerializer(Serializer):
+    """
+    BinarySerializer writes records in a compact struct packed format.
+
+    A volume record is the header, the size, a flags byte, the volume and
+    parent ids as 16 raw bytes each, then its strings each prefixed with a
+    16 bit length.
+    """
+
+    name = FORMAT_BINARY
+
+    def dumps(self, record: Record, kind: int = KIND_VOLUME) -> bytes:
+        parts = [_HEADER.pack(MAGIC, VERSION, kind)]
+        if kind == KIND_VOLUME:
+            parent_id = record.get('parent_id')
+            parts.append(_VOLUME.pack(
+                record['size'], _HAS_PARENT if parent_id else 0,
+                uuid.UUID(str(record['volume_id'])).bytes,
+                uuid.UUID(str(parent_id)).bytes if parent_id else bytes(16)))
+            strings = _VOLUME_STRINGS
+        elif kind == KIND_POOL:
+            parts.append(_POOL.pack(
+                record['capacity'], record['usage'], record['volumes']))
+            strings = _POOL_STRINGS
+        else:
+            raise ValueError(f'unknown record kind {kind}')
+        for name in strings:
+            _pack_str(parts, record.get(name))
+        return b''.join(parts)
+
+    def dump_volume(self, vol: ty.Any) -> bytes:
+        parent_id = vol._parent_id
+        parts = [
+            _HEADER.pack(MAGIC, VERSION, KIND_VOLUME),
+            _VOLUME.pack(
+                vol.size, _HAS_PARENT if parent_id is not None else 0,
+                vol._volume_id.to_bytes(16, 'big'),
+                parent_id.to_bytes(16, 'big') if parent_id is not None
+                else bytes(16)),
+        ]
+        for name in _VOLUME_STRINGS:
+            _pack_str(parts, getattr(vol, name))
+        return b''.join(parts)
+
+    def _load(self, data: bytes, raw_ids: bool) -> Record:
+        magic, version, kind = _HEADER.unpack_from(data)
+        if magic != MAGIC:
+            raise ValueError('not a binary os-vol record')
+        _check_version(version)
+        offset = _HEADER.size
+        if kind == KIND_VOLUME:
+            size, flags, volume_id, parent_id = _VOLUME.unpack_from(
+                data, offset)
+            volume_id = int.from_bytes(volume_id, 'big')
+            parent_id = (int.from_bytes(parent_id, 'big')
+                         if flags & _HAS_PARENT else None)
+            if not raw_ids:
+                volume_id = str(uuid.UUID(int=volume_id))
+                if parent_id is not None:
+                    parent_id = str(uuid.UUID(int=parent_id))
+            record = {
+                'volume_id': volume_id, 'size': size, 'parent_id': parent_id}
+            # strings added after the version of the record are None
+            record.update(dict.fromkeys(_VOLUME_STRINGS))
+            strings = _VOLUME_STRINGS_V.get(version, _VOLUME_STRINGS)
+            _unpack_strs(data, offset + _VOLUME.size, strings, record)
+        elif kind == KIND_POOL:
+            capacity, usage, volumes = _POOL.unpack_from(data, offset)
+            record = {'capacity': capacity, 'usage': usage,
+                      'volumes': volumes}
+            _unpack_strs(data, offset + _POOL.size, _POOL_STRINGS, record)
+        else:
+            raise ValueError(f'unknown record kind {kind}')
+        return record
+
+    def loads(self, data: bytes) -> Record:
+        return self._load(data, raw_ids=False)
+
+    def load_volume(self, data: bytes) -> Record:
+        return self._load(data, raw_ids=True)
+
+
+SERIALIZERS: ty.Dict[str, Serializer] = {
+    FORMAT_JSON: JSONSerializer(),
+    FORMAT_BINARY: BinarySerializer(),
+}
+
+
+def get_serializer(name: str) -> Serializer:
+    try:
+        return SERIALIZERS[name]
+    except KeyError:
+        raise ValueError(f'unknown serialization format {name}') from None
+
+
+def register(serializer: Serializer) -> None:
+    """Make a serializer available under its name."""
+    SERIALIZERS[serializer.name] = serializer
+
+
+def dumps(record: Record, fmt: str = FORMAT_JSON,
+          kind: int = KIND_VOLUME) -> bytes:
+    return get_serializer(fmt).dumps(record, kind)
+
+
+def _detect(data: ty.Union[bytes, str]) -> Serializer:
+    if isinstance(data, (bytes, bytearray)) and data[:2] == MAGIC:
+        return SERIALIZERS[FORMAT_BINARY]
+    return SERIALIZERS[FORMAT_JSON]
+
+
+def loads(data: ty.Union[bytes, str]) -> Record:
+    """Load a record written by any of the built in serializers."""
+    return _detect(data).loads(data)
+
+
+def dump_volume(vol: ty.Any, fmt: str = FORMAT_BINARY) -> bytes:
+    return get_serializer(fmt).dump_volume(vol)
+
+
+def load_volume(data: ty.Union[bytes, str]) -> Record:
+    """Load the Volume constructor arguments from any built in format."""
+    return _detect(data).load_volume(data)
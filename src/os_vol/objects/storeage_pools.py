@@ -1,53 +1,724 @@
 # -*- coding: utf-8 -*-
 # SPDX-License-Identifier: Apache-2.0
 
+import collections.abc
+import contextlib
 import dataclasses
+import threading
+import time
 import typing as ty
 import uuid
+import weakref
 
+from os_vol.backends import api
+from os_vol.backends import cbt
+from os_vol import copy_engine
+from os_vol import locking
+from os_vol import metrics
+from os_vol.objects import index
+from os_vol.objects import serialization
 from os_vol.objects import types
 from os_vol.objects import volume
 
 
+@dataclasses.dataclass(frozen=True)
+class PoolSnapshot:
+    """
+    PoolSnapshot is a point in time view of the capacity of a storage pool.
+    """
+
+    name: str
+    capacity: types.SIZE_MB
+    used: types.SIZE_MB
+    free: types.SIZE_MB
+    volumes: int
+    # bytes physically allocated, at most used for thin volumes, None
+    # unless asked for as finding them out may scan every volume
+    allocated: ty.Optional[types.SIZE_MB] = None
+    # bytes held by reservations for allocations in flight
+    reserved: types.SIZE_MB = 0
+    # the most that can be provisioned, None if overcommit is unlimited
+    limit: ty.Optional[types.SIZE_MB] = None
+
+    @property
+    def available(self) -> ty.Optional[types.SIZE_MB]:
+        """The bytes that can still be provisioned, None if unlimited."""
+        if self.limit is None:
+            return None
+        return max(0, self.limit - self.used - self.reserved)
+
+
+@dataclasses.dataclass
+class MigrationStats:
+    """
+    MigrationStats records the progress of a volume migration.
+
+    downtime is the time writes were paused for the final pass and the
+    cut-over, final the bytes that pass copied.
+    """
+
+    total: int
+    # copy passes made, the initial bulk copy included
+    passes: int = 0
+    copied: int = 0
+    final: int = 0
+    downtime: float = 0.0
+    start_time: float = dataclasses.field(default_factory=time.monotonic)
+    end_time: ty.Optional[float] = None
+
+    @property
+    def elapsed(self) -> float:
+        end = self.end_time if self.end_time is not None else time.monotonic()
+        return end - self.start_time
+
+
+class InsufficientCapacity(ValueError):
+    """
+    An allocation would exceed the provisioning limit of a pool.
+    """
+
+
+class Reservation:
+    """
+    Reservation holds pool capacity for an allocation that is in flight.
+
+    The capacity is returned to the pool when the reservation is passed to
+    an allocation, released or used as a context manager and exited.
+    """
+
+    def __init__(self, pool: 'StoragePool', size: types.SIZE_MB):
+        self.pool = pool
+        self.size = size
+        self.active = True
+
+    def __repr__(self):
+        return (f'Reservation(pool={self.pool.name}, size={self.size}, '
+                f'active={self.active})')
+
+    def release(self) -> None:
+        """Return the capacity to the pool, releasing twice is a no-op."""
+        self.pool._release(self)
+
+    def __enter__(self) -> 'Reservation':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.release()
+
+
+class VolumeMap(collections.abc.MutableMapping):
+    """
+    VolumeMap is a lazy mapping of volume id to Volume for a storage pool.
+
+    Volumes are read from a persistent backend when they are accessed
+    rather than loaded up front, so a pool over a large catalog starts in
+    constant time. Materialised volumes are cached for as long as they are
+    referenced elsewhere, so looking up a volume twice gives the same
+    object while it is in use.
+    """
+
+    PAGE_SIZE = 1000
+
+    def __init__(self, pool: 'StoragePool'):
+        self.pool = pool
+        self.backend = pool.backend
+        self._lock = threading.Lock()
+        self._volumes: ty.MutableMapping[uuid.UUID, volume.Volume] = (
+            weakref.WeakValueDictionary())
+
+    def _materialise(self, vol: volume.Volume) -> volume.Volume:
+        with self._lock:
+            cached = self._volumes.get(vol.volume_id)
+            if cached is not None:
+                return cached
+            vol.pool_ref = self.pool
+            self._volumes[vol.volume_id] = vol
+            return vol
+
+    def __getitem__(self, volume_id: uuid.UUID) -> volume.Volume:
+        with self._lock:
+            cached = self._volumes.get(volume_id)
+        if cached is not None:
+            return cached
+        vol = self.backend.get_volume(volume_id)
+        if vol is None:
+            raise KeyError(volume_id)
+        return self._materialise(vol)
+
+    def __setitem__(self, volume_id: uuid.UUID, vol: volume.Volume) -> None:
+        # the backend has already recorded the volume, only cache it
+        with self._lock:
+            self._volumes[volume_id] = vol
+
+    def __delitem__(self, volume_id: uuid.UUID) -> None:
+        with self._lock:
+            self._volumes.pop(volume_id, None)
+
+    def __contains__(self, volume_id: object) -> bool:
+        with self._lock:
+            if volume_id in self._volumes:
+                return True
+        return self.backend.get_volume(volume_id) is not None
+
+    def __len__(self) -> int:
+        return self.backend.count_volumes()
+
+    def __iter__(self) -> ty.Iterator[uuid.UUID]:
+        return (vol.volume_id for vol in self.iter_volumes())
+
+    def values(self) -> ty.Iterator[volume.Volume]:
+        """Iterate over the volumes one page at a time."""
+        return self.iter_volumes()
+
+    def page(self, limit: ty.Optional[int] = None,
+             marker: ty.Optional[uuid.UUID] = None) -> ty.List[volume.Volume]:
+        """Return up to limit volumes ordered by id, after marker."""
+        return [self._materialise(vol)
+                for vol in self.backend.list_volumes(limit, marker)]
+
+    def iter_volumes(
+            self, page_size: ty.Optional[int] = None
+    ) -> ty.Iterator[volume.Volume]:
+        page_size = page_size or self.PAGE_SIZE
+        marker = None
+        while True:
+            volumes = self.page(page_size, marker)
+            yield from volumes
+            if len(volumes) < page_size:
+                return
+            marker = volumes[-1].volume_id
+
+
+def _pool_name(pool: 'StoragePool') -> str:
+    return pool.name
+
+
 @dataclasses.dataclass
 class StoragePool:
     """
     StoragePool is an abstract class that represents a storage pool instance.
+
+    The used space and volume count are maintained incrementally as volumes
+    are allocated, grown and deallocated so usage queries are O(1).
+
+    A pool may be shared between threads. Backend calls hold a per volume
+    lock, so operations on different volumes run concurrently while
+    operations on the same volume, or creating volumes with the same name,
+    are serialised. Cloning holds the lock of the source volume. The
+    allocations and counters are guarded by a metadata lock that is only
+    held while they are updated, never across a backend call, and
+    snapshot() reads them under that lock so it is always consistent. Pools
+    reading their usage from a backend catalog take both aggregates from it
+    in one query instead.
+
+    A pool over a persistent backend with no allocations given reads its
+    volumes from the backend on demand through a VolumeMap, and its usage
+    from the aggregates of the backend catalog. Creating such a pool does
+    no I/O.
+
+    Bulk queries over volume ids and sizes are answered from a columnar
+    VolumeIndex, which for such pools is built on first use.
+
+    Volumes are thin provisioned, so the sum of their sizes may exceed the
+    capacity of the backend. With overcommit_ratio set, allocations that
+    would provision more than capacity * overcommit_ratio bytes, including
+    the capacity held by reservations, raise InsufficientCapacity.
+
+    Volumes are moved between pools with migrate_volume while they stay in
+    use, writes are only paused to copy what changed during the last pass.
     """
 
+    # catch-up passes copying the blocks written during the previous pass,
+    # after the last one whatever is still dirty is copied with writes
+    # paused.
+    MIGRATION_PASSES = 8
+    # stop the catch-up passes once this few bytes are left to copy
+    MIGRATION_CUTOVER_BYTES = 16 * 1024 * 1024
+
     name: str = dataclasses.field(default='base')
     pool_type: str = dataclasses.field(default='fake')
-    allocations: ty.Dict[uuid.UUID, volume.Volume] = dataclasses.field(
-        default_factory=dict)
+    allocations: ty.MutableMapping[uuid.UUID, volume.Volume] = (
+        dataclasses.field(default_factory=dict))
     backend: ty.Any = dataclasses.field(default=None)
+    # provisioned bytes allowed per byte of capacity, None for no limit
+    overcommit_ratio: ty.Optional[float] = dataclasses.field(default=None)
+    # None when usage is read from the backend
+    _used: ty.Optional[types.SIZE_MB] = dataclasses.field(
+        default=0, init=False, repr=False, compare=False)
+    _lock: threading.Lock = dataclasses.field(
+        default_factory=threading.Lock, init=False, repr=False, compare=False)
+    _volume_locks: locking.VolumeLocks = dataclasses.field(
+        default_factory=locking.VolumeLocks, init=False, repr=False,
+        compare=False)
+    # None until first used for pools over a persistent backend
+    _index: ty.Optional[index.VolumeIndex] = dataclasses.field(
+        default=None, init=False, repr=False, compare=False)
+    _reservations: ty.Set[Reservation] = dataclasses.field(
+        default_factory=set, init=False, repr=False, compare=False)
+    _reserved: types.SIZE_MB = dataclasses.field(
+        default=0, init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        if (not self.allocations and
+                getattr(self.backend, 'PERSISTENT', False) is True):
+            self.allocations = VolumeMap(self)
+            self._used = None
+        else:
+            self._used = sum(v.size for v in self.allocations.values())
+            self._index = index.VolumeIndex()
+            for vol in self.allocations.values():
+                self._index.add(vol.volume_id, vol.size)
 
     def __str__(self):
-        return self.storage_summary()
+        return str(self.storage_summary())
 
     def __repr__(self):
         return self.name
 
+    def _track(self, vol: volume.Volume) -> volume.Volume:
+        with self._lock:
+            self._add(vol)
+        return vol
+
+    def _untrack(self, vol: volume.Volume) -> None:
+        with self._lock:
+            self._remove(vol)
+
+    def _add(self, vol: volume.Volume) -> None:
+        # called with the metadata lock held
+        vol.pool_ref = self
+        self.allocations[vol.volume_id] = vol
+        if self._used is not None:
+            self._used += vol.size
+        if self._index is not None:
+            self._index.add(vol.volume_id, vol.size)
+
+    def _remove(self, vol: volume.Volume) -> None:
+        # called with the metadata lock held
+        del self.allocations[vol.volume_id]
+        if self._used is not None:
+            self._used -= vol.size
+        if self._index is not None:
+            self._index.remove(vol.volume_id)
+
+    def _resized(self, vol: volume.Volume, old_size: types.SIZE_MB) -> None:
+        with self._lock:
+            if self._used is not None:
+                self._used += vol.size - old_size
+            if self._index is not None:
+                self._index.add(vol.volume_id, vol.size)
+
+    def _get_index(self) -> index.VolumeIndex:
+        # called with the metadata lock held, only pools with a VolumeMap
+        # build their index late.
+        if self._index is None:
+            vol_index = index.VolumeIndex()
+            for vol in self.allocations.iter_volumes():
+                vol_index.add(vol.volume_id, vol.size)
+            self._index = vol_index
+        return self._index
+
+    def provisioning_limit(self) -> ty.Optional[types.SIZE_MB]:
+        """
+        Return the most bytes that can be provisioned, None if unlimited.
+        """
+        if self.overcommit_ratio is None:
+            return None
+        return int(self.get_capacity() * self.overcommit_ratio)
+
+    def _check_capacity(self, size: types.SIZE_MB) -> None:
+        # called with the metadata lock held
+        limit = self.provisioning_limit()
+        if limit is None:
+            return
+        used = self.usage()
+        if used + self._reserved + size > limit:
+            raise InsufficientCapacity(
+                f'pool {self.name} cannot provision {size} bytes, '
+                f'{used} provisioned and {self._reserved} reserved of '
+                f'{limit}')
+
+    def reserve(self, size: types.SIZE_MB) -> Reservation:
+        """
+        Hold `size` bytes of the pool for an allocation that is in flight.
+
+        Raises InsufficientCapacity if the pool cannot provision them.
+        """
+        if size < 0:
+            raise ValueError('cannot reserve a negative size')
+        with self._lock:
+            self._check_capacity(size)
+            reservation = Reservation(self, size)
+            self._reservations.add(reservation)
+            self._reserved += size
+        return reservation
+
+    def _release(self, reservation: Reservation) -> None:
+        with self._lock:
+            if reservation in self._reservations:
+                self._reservations.remove(reservation)
+                self._reserved -= reservation.size
+            reservation.active = False
+
+    def reserved(self) -> types.SIZE_MB:
+        """
+        Get the bytes held by reservations.
+        """
+        return self._reserved
+
+    @contextlib.contextmanager
+    def _provision(self, size: types.SIZE_MB,
+                   reservation: ty.Optional[Reservation] = None
+                   ) -> ty.Iterator[None]:
+        """Hold size bytes while an allocation runs.
+
+        An existing reservation is used if one is given, otherwise one is
+        taken if the pool has a provisioning limit.
+        """
+        if reservation is None:
+            if self.overcommit_ratio is None:
+                yield
+                return
+            reservation = self.reserve(size)
+        elif (reservation.pool is not self or not reservation.active or
+                reservation.size < size):
+            raise ValueError(
+                f'{reservation!r} cannot be used for {size} bytes in pool '
+                f'{self.name}')
+        with reservation:
+            yield
+
+    @metrics.instrumented(metrics.LAYER_POOL, name=_pool_name)
     def allocate_volume(
-            self, volume_name: str, size: types.SIZE_MB) -> volume.Volume:
+            self, volume_name: str, size: types.SIZE_MB,
+            reservation: ty.Optional[Reservation] = None,
+            provisioning: str = api.PROVISION_SPARSE) -> volume.Volume:
         """
         Create a volume in the storage pool.
+
+        The capacity can be held beforehand with `reserve` and the
+        reservation passed in, it is released once the volume is created.
+        `provisioning` is the backend provisioning mode of the volume.
+
+        Backends such as FlatFile journal the creation, and pools over them
+        read their allocations from the backend, so a crash can't leave the
+        two out of step. If tracking the volume fails it is deleted again.
         """
-        vol = self.backend.allocate_volume(volume_name, size)
-        self.allocations[vol.volume_id] = vol
-        return vol
+        with self._volume_locks.hold(locking.name_key(volume_name)), \
+                self._provision(size, reservation):
+            vol = self.backend.create_volume(size, volume_name, provisioning)
+            try:
+                return self._track(vol)
+            except BaseException:
+                self.backend.delete_volume(vol)
+                raise
 
+    @metrics.instrumented(metrics.LAYER_POOL, name=_pool_name)
     def deallocate_volume(self, volume: volume.Volume) -> None:
         """
         Delete a volume from the storage pool.
         """
-        self.backend.deallocate_volume(volume)
-        del self.allocations[volume.volume_id]
+        with self._volume_locks.hold(volume.volume_id):
+            self.backend.delete_volume(volume)
+            self._untrack(volume)
+
+    @metrics.instrumented(metrics.LAYER_POOL, name=_pool_name)
+    def allocate_volumes(
+            self, specs: ty.Iterable[ty.Tuple[str, types.SIZE_MB]]
+    ) -> ty.List[ty.Any]:
+        """
+        Create a volume for each (volume_name, size[, provisioning]) spec in
+        one batch.
+
+        Returns a BatchResult per spec, in order. Volumes that were created
+        are tracked by the pool even if other items in the batch failed.
+        The capacity for the whole batch is checked up front. A volume that
+        can't be tracked is deleted again and its item fails.
+        """
+        specs = list(specs)
+        with self._volume_locks.hold(
+                *[locking.name_key(spec[0]) for spec in specs]), \
+                self._provision(sum(spec[1] for spec in specs)):
+            results = self.backend.create_volumes(specs)
+            for result in results:
+                if result.ok:
+                    try:
+                        self._track(result.volume)
+                    except Exception as e:
+                        self.backend.delete_volume(result.volume)
+                        result.volume, result.error = None, e
+        return results
+
+    @metrics.instrumented(metrics.LAYER_POOL, name=_pool_name)
+    def deallocate_volumes(
+            self, volumes: ty.Iterable[volume.Volume]) -> ty.List[ty.Any]:
+        """
+        Delete many volumes from the storage pool in one batch.
+
+        Returns a BatchResult per volume, in order.
+        """
+        volumes = list(volumes)
+        with self._volume_locks.hold(*[v.volume_id for v in volumes]):
+            results = self.backend.delete_volumes(volumes)
+            for result in results:
+                if result.ok:
+                    self._untrack(result.item)
+        return results
+
+    @metrics.instrumented(metrics.LAYER_POOL, name=_pool_name)
+    def clone_volume(self, volume: volume.Volume, name: str) -> volume.Volume:
+        """
+        Clone the volume with a new name.
+
+        If tracking the clone fails it is deleted again.
+        """
+        with self._volume_locks.hold(
+                volume.volume_id, locking.name_key(name)), \
+                self._provision(volume.size):
+            clone = self.backend.clone_volume(volume, name)
+            try:
+                return self._track(clone)
+            except BaseException:
+                self.backend.delete_volume(clone)
+                raise
+
+    @metrics.instrumented(metrics.LAYER_POOL, name=_pool_name)
+    def migrate_volume(
+            self, volume: volume.Volume, target_pool: 'StoragePool',
+            copier: ty.Optional[copy_engine.CopyEngine] = None,
+            quiesce: ty.Optional[ty.Callable[[], ty.ContextManager]] = None,
+            progress: ty.Optional[ty.Callable[[MigrationStats], None]] = None,
+            cancel: ty.Optional[threading.Event] = None
+    ) -> volume.Volume:
+        """
+        Move the volume to target_pool while it stays in use.
+
+        The volume is copied to a new volume of target_pool by copier, then
+        the blocks written meanwhile are copied again, pass after pass,
+        until few enough are left or MIGRATION_PASSES have been made. The
+        rest is copied inside quiesce(), which should pause the writers, so
+        the downtime depends on the writes made during the last pass rather
+        than the size of the volume. Still inside quiesce() the volume is
+        moved from the allocations of this pool to those of target_pool in
+        one step, writers must use the returned volume from then on. The
+        old volume is deleted once quiesce() exits.
+
+        Writes are seen through the changed block tracking of the backend,
+        which covers every file object and handle it opens, including those
+        opened before the migration started. Volumes of backends that don't
+        track changes are copied inside quiesce() in one pass. Checkpoints
+        are not migrated.
+
+        :param progress: called with the MigrationStats after every pass.
+        :param cancel: abandon the migration once this event is set, the
+            volume is left in this pool.
+        :returns: the volume in target_pool.
+        :raises ValueError: if the volume is attached to the host, has
+            shallow clones or is already in target_pool.
+        :raises concurrent.futures.CancelledError: if cancel was set.
+        """
+        if target_pool is self:
+            raise ValueError(
+                f'volume {volume.volume_id} is already in pool {self.name}')
+        if volume.device_path:
+            raise ValueError(
+                f'volume {volume.volume_id} is attached to the host, '
+                'detach it before migrating it')
+        copier = copier or copy_engine.CopyEngine()
+        stats = MigrationStats(total=volume.size)
+        with self._volume_locks.hold(volume.volume_id), \
+                target_pool._volume_locks.hold(
+                    locking.name_key(volume.name)), \
+                target_pool._provision(volume.size):
+            # the old volume is only deleted after the move, which its
+            # shallow clones would prevent
+            if self.backend.has_shallow_clones(volume):
+                raise ValueError(
+                    f'volume {volume.volume_id} has shallow clones, '
+                    'flatten them before migrating it')
+            new_vol = target_pool.backend.create_volume(
+                volume.size, volume.name,
+                volume.provisioning or api.PROVISION_SPARSE)
+            try:
+                self._migrate(volume, new_vol, target_pool, copier,
+                              quiesce or contextlib.nullcontext, stats,
+                              progress, cancel)
+            except BaseException:
+                target_pool.backend.delete_volume(new_vol)
+                raise
+            self.backend.delete_volume(volume)
+        stats.end_time = time.monotonic()
+        return new_vol
+
+    def _migrate(self, vol: volume.Volume, new_vol: volume.Volume,
+                 target_pool: 'StoragePool',
+                 copier: copy_engine.CopyEngine,
+                 quiesce: ty.Callable[[], ty.ContextManager],
+                 stats: MigrationStats,
+                 progress: ty.Optional[ty.Callable[[MigrationStats], None]],
+                 cancel: ty.Optional[threading.Event]) -> None:
+        try:
+            tracker = self.backend.get_tracker(vol)
+        except NotImplementedError:
+            tracker = None
+        with self.backend.open_handle(vol) as src, \
+                target_pool.backend.open_handle(new_vol) as dst:
+
+            def copy(extents: ty.Optional[copy_engine.Extents],
+                     final: bool = False) -> None:
+                copied = copier.copy(src, dst, extents, cancel=cancel).copied
+                stats.copied += copied
+                stats.passes += 1
+                if final:
+                    stats.final = copied
+                if progress is not None:
+                    progress(stats)
+
+            if tracker is None:
+                with quiesce():
+                    paused = time.monotonic()
+                    copy(None, final=True)
+                    dst.flush()
+                    self._move(vol, new_vol, target_pool)
+                    stats.downtime = time.monotonic() - paused
+                return
+
+            prefix = f'migrate-{uuid.uuid4()}'
+            since = f'{prefix}-0'
+            self.backend.create_checkpoint(vol, since)
+            try:
+                # the first pass copies every extent of the volume
+                extents = None
+                while True:
+                    copy(extents)
+                    checkpoint = f'{prefix}-{stats.passes}'
+                    dirty = tracker.changed_since(since, checkpoint)
+                    self.backend.delete_checkpoint(vol, since)
+                    since = checkpoint
+                    if (len(dirty) * cbt.BLOCK_SIZE <=
+                            self.MIGRATION_CUTOVER_BYTES or
+                            stats.passes > self.MIGRATION_PASSES):
+                        break
+                    extents = dirty.extents(vol.size)
+                with quiesce():
+                    paused = time.monotonic()
+                    dirty.update(tracker.changed_since(since))
+                    copy(dirty.extents(vol.size), final=True)
+                    dst.flush()
+                    self._move(vol, new_vol, target_pool)
+                    stats.downtime = time.monotonic() - paused
+            except BaseException:
+                self.backend.delete_checkpoint(vol, since)
+                raise
+
+    def _move(self, vol: volume.Volume, new_vol: volume.Volume,
+              target_pool: 'StoragePool') -> None:
+        # both metadata locks are taken in a stable order, so concurrent
+        # migrations in opposite directions can't deadlock
+        first, second = sorted((self, target_pool), key=id)
+        with first._lock, second._lock:
+            self._remove(vol)
+            target_pool._add(new_vol)
+
+    @metrics.instrumented(metrics.LAYER_POOL, name=_pool_name)
+    def discard_volume(self, volume: volume.Volume, offset: int = 0,
+                       length: ty.Optional[int] = None) -> None:
+        """
+        Discard a range of the volume, releasing its storage.
+        """
+        self.backend.discard_volume(volume, offset, length)
+
+    @metrics.instrumented(metrics.LAYER_POOL, name=_pool_name)
+    def open_volume(self, volume: volume.Volume) -> ty.IO:
+        """
+        Open the volume for reading and writing in binary mode.
+        """
+        return self.backend.open_volume(volume)
+
+    @metrics.instrumented(metrics.LAYER_POOL, name=_pool_name)
+    def open_handle(self, volume: volume.Volume) -> ty.Any:
+        """
+        Open the volume for positional, zero-copy I/O.
+        """
+        return self.backend.open_handle(volume)
+
+    @metrics.instrumented(metrics.LAYER_POOL, name=_pool_name)
+    def create_checkpoint(self, volume: volume.Volume, name: str) -> None:
+        """
+        Create a named checkpoint to track the changes to the volume from.
+        """
+        self.backend.create_checkpoint(volume, name)
+
+    @metrics.instrumented(metrics.LAYER_POOL, name=_pool_name)
+    def delete_checkpoint(self, volume: volume.Volume, name: str) -> None:
+        """
+        Delete a checkpoint of the volume.
+        """
+        self.backend.delete_checkpoint(volume, name)
 
-    def list_volumes(self) -> ty.List[volume.Volume]:
+    def export_incremental(
+            self, volume: volume.Volume, since: str,
+            checkpoint: ty.Optional[str] = None
+    ) -> ty.Iterator[ty.Tuple[int, bytes]]:
         """
-        List all volumes in the storage pool.
+        Return the data of the volume changed since a checkpoint.
         """
-        return list(self.allocations.values())
+        return self.backend.export_incremental(volume, since, checkpoint)
+
+    def list_volumes(
+            self, limit: ty.Optional[int] = None,
+            marker: ty.Optional[uuid.UUID] = None) -> ty.List[volume.Volume]:
+        """
+        List the volumes in the storage pool.
+
+        Returns up to `limit` volumes with an id greater than `marker`, or
+        all of them, ordered by id. The marker volume may have been deleted
+        since it was listed.
+        """
+        if isinstance(self.allocations, VolumeMap):
+            return self.allocations.page(limit, marker)
+        with self._lock:
+            return [self.allocations[volume_id]
+                    for volume_id in self._index.page(limit, marker)]
+
+    def iter_volumes(
+            self, page_size: int = VolumeMap.PAGE_SIZE
+    ) -> ty.Iterator[volume.Volume]:
+        """
+        Iterate over the volumes in the storage pool a page at a time.
+        """
+        marker = None
+        while True:
+            volumes = self.list_volumes(page_size, marker)
+            yield from volumes
+            if len(volumes) < page_size:
+                return
+            marker = volumes[-1].volume_id
+
+    def volume_ids(self) -> ty.List[uuid.UUID]:
+        """
+        Return the ids of all volumes in the storage pool.
+        """
+        with self._lock:
+            return self._get_index().ids()
+
+    def select_volumes(
+            self, min_size: types.SIZE_MB = 0,
+            max_size: ty.Optional[types.SIZE_MB] = None
+    ) -> ty.List[uuid.UUID]:
+        """
+        Return the ids of the volumes with a size in [min_size, max_size].
+        """
+        with self._lock:
+            return self._get_index().select(min_size, max_size)
+
+    def largest_volumes(
+            self, count: int) -> ty.List[ty.Tuple[uuid.UUID, types.SIZE_MB]]:
+        """
+        Return the ids and sizes of the `count` largest volumes.
+        """
+        with self._lock:
+            return self._get_index().largest(count)
 
     def get_capacity(self) -> types.SIZE_MB:
         """
@@ -59,22 +730,75 @@ class StoragePool:
         """
         Get the total usage of the storage pool.
         """
-        return sum([v.size for v in self.allocations.values()])
+        if self._used is None:
+            return self.backend.get_provisioned()
+        return self._used
+
+    def allocated(self) -> types.SIZE_MB:
+        """
+        Get the bytes physically allocated to the volumes of the pool.
 
+        Backends that cannot tell are assumed to allocate volumes fully.
+        Unlike usage this is not maintained incrementally, backends may
+        have to visit every volume, or cache the result.
+        """
+        try:
+            return self.backend.get_allocated()
+        except NotImplementedError:
+            return self.usage()
+
+    @metrics.instrumented(metrics.LAYER_POOL, name=_pool_name)
     def grow_volume(self, volume: volume.Volume, size: types.SIZE_MB) -> None:
         """
         Grow the volume by `size`.
         """
-        self.backend.grow_volume(volume, size)
+        with self._volume_locks.hold(volume.volume_id), \
+                self._provision(size):
+            old_size = volume.size
+            self.backend.grow_volume(volume, size)
+            self._resized(volume, old_size)
+
+    def snapshot(self, allocated: bool = False) -> PoolSnapshot:
+        """
+        Return the capacity, usage and volume count of the storage pool.
+
+        The counters are maintained incrementally and the backend caches its
+        capacity, so this is cheap enough to poll from a scheduler loop. The
+        allocated bytes are only filled in when `allocated` is set, as they
+        cost as much as allocated().
+        """
+        capacity = self.get_capacity()
+        allocated = self.allocated() if allocated else None
+        if self._used is None:
+            # the catalog reads both aggregates in one query, which needs
+            # no pool lock to be consistent.
+            count, used = self.backend.get_totals()
+            reserved = self._reserved
+        else:
+            with self._lock:
+                used, count = self._used, len(self.allocations)
+                reserved = self._reserved
+        return PoolSnapshot(
+            name=self.name, capacity=capacity, used=used,
+            free=capacity - used, volumes=count, allocated=allocated,
+            reserved=reserved, limit=self.provisioning_limit())
+
+    def serialize(self, fmt: str = serialization.FORMAT_BINARY) -> bytes:
+        """
+        Serialize the storage summary of the pool.
+        """
+        return serialization.dumps(
+            self.storage_summary(), fmt, serialization.KIND_POOL)
 
     def storage_summary(self) -> ty.Dict[str, ty.Any]:
         """
         Return a summary of the storage pool.
         """
+        snapshot = self.snapshot()
         return {
             'name': self.name,
             'pool_type': self.pool_type,
-            'volumes': len(self.allocations),
-            'capacity': self.get_capacity(),
-            'usage': self.usage(),
+            'volumes': snapshot.volumes,
+            'capacity': snapshot.capacity,
+            'usage': snapshot.used,
         }
@@ -1,31 +1,99 @@
 # -*- coding: utf-8 -*-
 # SPDX-License-Identifier: Apache-2.0
 
-import dataclasses
 import json
 import os
 import typing as ty
 import uuid
 
+from os_vol.objects import serialization
 from os_vol.objects import types
 
 SIZE_MB = types.SIZE_MB
 
 
-@dataclasses.dataclass
+def _uuid_int(value: ty.Union[uuid.UUID, str, int]) -> int:
+    if isinstance(value, uuid.UUID):
+        return value.int
+    if isinstance(value, int):
+        return value
+    return uuid.UUID(value).int
+
+
 class Volume:
     """
-    Volume is an abstract dataclass that represents a volume instance.
+    Volume is an abstract class that represents a volume instance.
+
+    Pools can track hundreds of thousands of volumes so instances are
+    slotted, and volume_id and parent_id are stored as 128 bit ints and
+    converted to uuid.UUID on access. volume_id is looked up on every
+    pool operation, so its UUID is kept once it has been made.
     """
 
-    path: str
-    name: ty.Optional[str] = None
-    volume_id: uuid.UUID = dataclasses.field(default_factory=uuid.uuid4)
-    size: SIZE_MB = dataclasses.field(default=SIZE_MB(0))
-    volume_type: str = dataclasses.field(default='base')
-    pool_ref: ty.Any = dataclasses.field(default=None)
-    backend: ty.Any = dataclasses.field(default=None)
-    device_path: ty.Optional[str] = None
+    __slots__ = (
+        'path', 'name', '_volume_id', '_volume_uuid', 'size', 'volume_type',
+        'pool_ref', 'backend', 'device_path', 'clone_strategy', '_parent_id',
+        'provisioning', '__weakref__',
+    )
+
+    # volumes are mutable, like the dataclass they replace they compare by
+    # value and are not hashable.
+    __hash__ = None  # type: ignore[assignment]
+
+    def __init__(self, path: str, name: ty.Optional[str] = None,
+                 volume_id: ty.Optional[uuid.UUID] = None,
+                 size: SIZE_MB = SIZE_MB(0), volume_type: str = 'base',
+                 pool_ref: ty.Any = None, backend: ty.Any = None,
+                 device_path: ty.Optional[str] = None,
+                 clone_strategy: ty.Optional[str] = None,
+                 parent_id: ty.Optional[uuid.UUID] = None,
+                 provisioning: ty.Optional[str] = None):
+        self.path = path
+        self.name = name
+        self.volume_id = volume_id if volume_id is not None else uuid.uuid4()
+        self.size = size
+        self.volume_type = volume_type
+        self.pool_ref = pool_ref
+        self.backend = backend
+        self.device_path = device_path
+        self.clone_strategy = clone_strategy
+        self.parent_id = parent_id
+        # how the backend allocated the storage of the volume, None for
+        # volumes recorded before provisioning modes existed
+        self.provisioning = provisioning
+
+    @property
+    def volume_id(self) -> uuid.UUID:
+        if self._volume_uuid is None:
+            self._volume_uuid = uuid.UUID(int=self._volume_id)
+        return self._volume_uuid
+
+    @volume_id.setter
+    def volume_id(self, value: ty.Union[uuid.UUID, str, int]) -> None:
+        self._volume_id = _uuid_int(value)
+        self._volume_uuid = value if isinstance(value, uuid.UUID) else None
+
+    @property
+    def parent_id(self) -> ty.Optional[uuid.UUID]:
+        if self._parent_id is None:
+            return None
+        return uuid.UUID(int=self._parent_id)
+
+    @parent_id.setter
+    def parent_id(
+            self, value: ty.Optional[ty.Union[uuid.UUID, str, int]]) -> None:
+        self._parent_id = None if value is None else _uuid_int(value)
+
+    def _astuple(self) -> tuple:
+        return (
+            self.path, self.name, self._volume_id, self.size,
+            self.volume_type, self.pool_ref, self.backend, self.device_path,
+            self.clone_strategy, self._parent_id, self.provisioning)
+
+    def __eq__(self, other: object) -> bool:
+        if other.__class__ is not self.__class__:
+            return NotImplemented
+        return self._astuple() == other._astuple()
 
     def __str__(self):
         return self.volume_summary()
@@ -33,18 +101,42 @@ class Volume:
     def __repr__(self):
         return self.name
 
-    def volume_summary(self) -> str:
+    def to_dict(self) -> ty.Dict[str, ty.Any]:
         """
-        Return a summary of the volume.
+        Return the persistent attributes of the volume as a dict.
         """
-        return json.dumps({
+        return {
             'name': self.name,
             'volume_id': str(self.volume_id),
             'size': self.size,
             'volume_type': self.volume_type,
             'path': self.path,
             'device_path': self.device_path,
-        })
+            'clone_strategy': self.clone_strategy,
+            'parent_id': str(self.parent_id) if self.parent_id else None,
+            'provisioning': self.provisioning,
+        }
+
+    def volume_summary(self) -> str:
+        """
+        Return a summary of the volume.
+        """
+        return json.dumps(self.to_dict())
+
+    def serialize(self, fmt: str = serialization.FORMAT_BINARY) -> bytes:
+        """
+        Serialize the persistent attributes of the volume.
+        """
+        return serialization.dump_volume(self, fmt)
+
+    @classmethod
+    def from_summary(cls, data: ty.Union[str, bytes], backend: ty.Any = None,
+                     pool_ref: ty.Any = None) -> 'Volume':
+        """
+        Build a volume from the output of volume_summary or serialize.
+        """
+        record = serialization.load_volume(data)
+        return cls(backend=backend, pool_ref=pool_ref, **record)
 
     def delete(self) -> None:
         """
@@ -65,9 +157,31 @@ class Volume:
         """
         return self.pool_ref.clone_volume(self, name)
 
+    def migrate(self, pool: ty.Any, **kwargs: ty.Any) -> 'Volume':
+        """
+        Move the volume to another storage pool while it stays in use.
+
+        returns: the volume in the new pool
+        """
+        return self.pool_ref.migrate_volume(self, pool, **kwargs)
+
+    def discard(self, offset: int = 0,
+                length: ty.Optional[int] = None) -> None:
+        """
+        Discard a range of the volume, releasing its storage.
+        """
+        self.pool_ref.discard_volume(self, offset, length)
+
     def open(self) -> os.PathLike:
         """
         Open the volume.
         returns: file object
         """
         return self.pool_ref.open_volume(self)
+
+    def open_handle(self) -> ty.Any:
+        """
+        Open the volume for positional I/O.
+        returns: VolumeHandle
+        """
+        return self.pool_ref.open_handle(self)
@@ -0,0 +1,477 @@
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: Apache-2.0
+"""
+Placement of volumes across many storage pools.
+
+PoolScheduler chooses the pool for each new volume. Pools that cannot take
+the volume are removed by filters and the rest are ranked by weighers, as
+in the OpenStack schedulers. Pools are tracked through cached PoolSnapshots
+in an index sorted by free space, so only pools with room for a volume are
+ever looked at, and weighers that rank purely by free space walk the index
+from one end instead of scoring every pool.
+"""
+
+import abc
+import bisect
+import dataclasses
+import heapq
+import threading
+import time
+import typing as ty
+
+from os_vol.backends import api
+from os_vol.objects import storeage_pools
+from os_vol.objects import types
+from os_vol.objects import volume
+
+InsufficientCapacity = storeage_pools.InsufficientCapacity
+
+# index_order hints of weighers ranking pools by free space alone
+MOST_FREE = 'most_free'
+LEAST_FREE = 'least_free'
+
+
+class PlacementRequest(ty.NamedTuple):
+    """A volume to place, pool_type restricts the pools it may go to."""
+    name: str
+    size: types.SIZE_BYTES
+    pool_type: ty.Optional[str] = None
+    provisioning: str = api.PROVISION_SPARSE
+
+
+@dataclasses.dataclass
+class PoolState:
+    """
+    PoolState is the view of a pool the scheduler places volumes with.
+
+    placed is the size of the volumes the scheduler placed on the pool
+    since the snapshot was taken, free and used account for them.
+    """
+
+    pool: storeage_pools.StoragePool
+    snapshot: storeage_pools.PoolSnapshot
+    taken_at: float
+    free: types.SIZE_BYTES
+    placed: types.SIZE_BYTES = 0
+
+    @property
+    def name(self) -> str:
+        return self.pool.name
+
+    @property
+    def used(self) -> types.SIZE_BYTES:
+        return self.snapshot.used + self.placed
+
+
+def _free(snapshot: storeage_pools.PoolSnapshot) -> types.SIZE_BYTES:
+    if snapshot.limit is not None:
+        return snapshot.available
+    return snapshot.capacity - snapshot.used - snapshot.reserved
+
+
+class Filter(abc.ABC):
+    """
+    Filter removes the pools a volume cannot be placed on.
+    """
+
+    @abc.abstractmethod
+    def passes(self, state: PoolState, request: PlacementRequest) -> bool:
+        pass
+
+    def filter_all(self, states: ty.List[PoolState],
+                   request: PlacementRequest) -> ty.List[PoolState]:
+        """Return the states that pass, filters can override this to skip
+        the per pool calls when the request lets them."""
+        return [state for state in states if self.passes(state, request)]
+
+
+class FreeSpaceFilter(Filter):
+    """
+    FreeSpaceFilter keeps pools that have room for the volume.
+
+    headroom is the fraction of the capacity of a pool that must stay free
+    after placing the volume.
+    """
+
+    def __init__(self, headroom: float = 0.0):
+        self.headroom = headroom
+
+    def passes(self, state, request):
+        return (state.free - request.size >=
+                state.snapshot.capacity * self.headroom)
+
+    def filter_all(self, states, request):
+        if not self.headroom:
+            # the scheduler only offers pools with room for the volume
+            return states
+        return super().filter_all(states, request)
+
+
+class PoolTypeFilter(Filter):
+    """
+    PoolTypeFilter keeps pools of the pool_type requested, if any.
+    """
+
+    def passes(self, state, request):
+        return (request.pool_type is None or
+                state.pool.pool_type == request.pool_type)
+
+    def filter_all(self, states, request):
+        if request.pool_type is None:
+            return states
+        return [s for s in states if s.pool.pool_type == request.pool_type]
+
+
+class OvercommitFilter(Filter):
+    """
+    OvercommitFilter limits the provisioned bytes to capacity * ratio.
+
+    Pools with their own overcommit_ratio enforce it themselves, this
+    applies a limit to pools without one.
+    """
+
+    def __init__(self, ratio: float = 1.0):
+        self.ratio = ratio
+
+    def passes(self, state, request):
+        return (state.used + request.size <=
+                state.snapshot.capacity * self.ratio)
+
+
+class Weigher(abc.ABC):
+    """
+    Weigher ranks the pools that passed the filters, higher is better.
+
+    The weights of each weigher are normalised to [0, 1] across the
+    candidates and scaled by multiplier before they are summed. Weighers
+    that only rank by free space set index_order so the scheduler can take
+    the first pool that passes the filters from that end of its index.
+    """
+
+    index_order: ty.Optional[str] = None
+
+    def __init__(self, multiplier: float = 1.0):
+        self.multiplier = multiplier
+
+    @abc.abstractmethod
+    def weigh(self, state: PoolState, request: PlacementRequest) -> float:
+        pass
+
+    def weigh_all(self, states: ty.List[PoolState],
+                  request: PlacementRequest) -> ty.List[float]:
+        return [self.weigh(state, request) for state in states]
+
+
+class LeastUsedWeigher(Weigher):
+    """
+    LeastUsedWeigher prefers the pools with the lowest utilisation.
+    """
+
+    def weigh(self, state, request):
+        capacity = state.snapshot.capacity
+        return -state.used / capacity if capacity else 0.0
+
+    def weigh_all(self, states, request):
+        return [-(s.snapshot.used + s.placed) / s.snapshot.capacity
+                if s.snapshot.capacity else 0.0 for s in states]
+
+
+class SpreadWeigher(Weigher):
+    """
+    SpreadWeigher prefers the pools with the most free space.
+    """
+
+    index_order = MOST_FREE
+
+    def weigh(self, state, request):
+        return float(state.free)
+
+
+class PackWeigher(Weigher):
+    """
+    PackWeigher prefers the pools with the least free space that fits.
+
+    Packing fills pools one after another and keeps large contiguous free
+    space on the others for big volumes.
+    """
+
+    index_order = LEAST_FREE
+
+    def weigh(self, state, request):
+        return -float(state.free)
+
+
+class PoolScheduler:
+    """
+    PoolScheduler places volumes on a set of storage pools.
+
+    Snapshots of the pools are cached for SNAPSHOT_TTL seconds and adjusted
+    for the volumes the scheduler places. Every placement first refreshes
+    the snapshots that expired, found from a heap ordered by age, so a pool
+    that was too full to be a candidate is seen again once space is freed
+    on it. A snapshot is also refreshed when an allocation finds the pool
+    fuller than it said. Snapshots are taken without holding the scheduler
+    lock, so a slow pool doesn't hold up placements on the others. The
+    scheduler is thread safe.
+    """
+
+    # seconds a pool snapshot is used for placement before it is refreshed
+    SNAPSHOT_TTL = 5.0
+    # pools tried for an allocation before giving up
+    MAX_ATTEMPTS = 3
+
+    def __init__(self, pools: ty.Iterable[storeage_pools.StoragePool] = (),
+                 filters: ty.Optional[ty.Sequence[Filter]] = None,
+                 weighers: ty.Optional[ty.Sequence[Weigher]] = None):
+        self.filters = list(
+            filters if filters is not None
+            else [FreeSpaceFilter(), PoolTypeFilter()])
+        self.weighers = list(
+            weighers if weighers is not None else [SpreadWeigher()])
+        self._states: ty.Dict[str, PoolState] = {}
+        # (free, name) of every pool, sorted
+        self._index: ty.List[ty.Tuple[int, str]] = []
+        # heap of (taken_at, name), entries of replaced snapshots are
+        # skipped when they come up
+        self._expiry: ty.List[ty.Tuple[float, str]] = []
+        self._lock = threading.RLock()
+        for pool in pools:
+            self.add_pool(pool)
+
+    def __len__(self) -> int:
+        return len(self._states)
+
+    @property
+    def pools(self) -> ty.List[storeage_pools.StoragePool]:
+        with self._lock:
+            return [state.pool for state in self._states.values()]
+
+    def get_pool(self, name: str) -> storeage_pools.StoragePool:
+        return self._states[name].pool
+
+    def add_pool(self, pool: storeage_pools.StoragePool) -> None:
+        """Add a pool, or replace the pool of that name if one is known."""
+        state = self._take_snapshot(pool)
+        with self._lock:
+            if pool.name in self._states:
+                self._unindex(self._states[pool.name])
+            self._install(state)
+
+    def remove_pool(self, name: str) -> None:
+        with self._lock:
+            self._unindex(self._states.pop(name))
+
+    def refresh(self, name: ty.Optional[str] = None) -> None:
+        """Refresh the snapshot of a pool, or of all pools."""
+        with self._lock:
+            states = ([self._states[name]] if name is not None
+                      else list(self._states.values()))
+        self._refresh(states)
+
+    def _refresh_expired(self) -> None:
+        with self._lock:
+            expired = []
+            deadline = time.monotonic() - self.SNAPSHOT_TTL
+            while self._expiry and self._expiry[0][0] <= deadline:
+                taken_at, name = heapq.heappop(self._expiry)
+                state = self._states.get(name)
+                if state is not None and state.taken_at == taken_at:
+                    expired.append(state)
+        if expired:
+            self._refresh(expired, expired=True)
+
+    def _refresh(self, states: ty.List[PoolState],
+                 expired: bool = False) -> None:
+        fresh = []
+        try:
+            for state in states:
+                fresh.append((state, state.placed,
+                              self._take_snapshot(state.pool)))
+        finally:
+            with self._lock:
+                for state, placed, new in fresh:
+                    # skip pools removed or refreshed meanwhile
+                    if self._states.get(state.name) is not state:
+                        continue
+                    self._unindex(state)
+                    # placements made while the snapshot was taken may not
+                    # be in it yet
+                    new.placed += state.placed - placed
+                    new.free -= state.placed - placed
+                    self._install(new)
+                if expired:
+                    # pools whose snapshot failed are tried again next time
+                    for state in states[len(fresh):]:
+                        heapq.heappush(
+                            self._expiry, (state.taken_at, state.name))
+
+    def _install(self, state: PoolState) -> None:
+        # called with the lock held
+        self._states[state.name] = state
+        self._reindex(state)
+        heapq.heappush(self._expiry, (state.taken_at, state.name))
+
+    def _take_snapshot(self, pool: storeage_pools.StoragePool) -> PoolState:
+        taken_at = time.monotonic()
+        snapshot = pool.snapshot()
+        return PoolState(pool, snapshot, taken_at, _free(snapshot))
+
+    def _unindex(self, state: PoolState) -> None:
+        i = bisect.bisect_left(self._index, (state.free, state.name))
+        if i < len(self._index) and self._index[i] == (
+                state.free, state.name):
+            del self._index[i]
+
+    def _reindex(self, state: PoolState) -> None:
+        bisect.insort(self._index, (state.free, state.name))
+
+    def _adjust(self, state: PoolState, size: types.SIZE_BYTES) -> None:
+        self._unindex(state)
+        state.free -= size
+        state.placed += size
+        self._reindex(state)
+
+    def _start(self, request: PlacementRequest) -> int:
+        # entries of the index before this have no room for the volume
+        return bisect.bisect_left(self._index, (request.size, ''))
+
+    def _candidates(self, request: PlacementRequest,
+                    reverse: bool) -> ty.Iterator[PoolState]:
+        # the index is not modified while the candidates are consumed
+        start = self._start(request)
+        rows = (range(len(self._index) - 1, start - 1, -1) if reverse
+                else range(start, len(self._index)))
+        for row in rows:
+            yield self._states[self._index[row][1]]
+
+    def _passes(self, state: PoolState, request: PlacementRequest) -> bool:
+        for f in self.filters:
+            if not f.passes(state, request):
+                return False
+        return True
+
+    def _select(self, request: PlacementRequest) -> ty.Optional[PoolState]:
+        # called with the lock held
+        if len(self.weighers) == 1 and self.weighers[0].index_order:
+            reverse = self.weighers[0].index_order == MOST_FREE
+            for state in self._candidates(request, reverse):
+                if self._passes(state, request):
+                    return state
+            return None
+        states = [self._states[name]
+                  for _, name in self._index[self._start(request):]]
+        for f in self.filters:
+            states = f.filter_all(states, request)
+        if len(states) < 2:
+            return states[0] if states else None
+        scores = [0.0] * len(states)
+        for weigher in self.weighers:
+            weights = weigher.weigh_all(states, request)
+            low, high = min(weights), max(weights)
+            if high == low:
+                continue
+            scale = weigher.multiplier / (high - low)
+            scores = [score + (weight - low) * scale
+                      for score, weight in zip(scores, weights)]
+        return states[max(range(len(states)), key=scores.__getitem__)]
+
+    def _place(self, request: PlacementRequest) -> PoolState:
+        # called with the lock held
+        state = self._select(request)
+        if state is None:
+            raise InsufficientCapacity(
+                f'no pool can take volume {request.name} of '
+                f'{request.size} bytes')
+        self._adjust(state, request.size)
+        return state
+
+    def place(self, request: PlacementRequest
+              ) -> storeage_pools.StoragePool:
+        """Choose the pool for a volume and count it against the pool.
+
+        Raises InsufficientCapacity if no pool passes the filters.
+        """
+        self._refresh_expired()
+        with self._lock:
+            return self._place(request).pool
+
+    def place_volumes(self, requests: ty.Iterable[PlacementRequest]
+                      ) -> ty.List[storeage_pools.StoragePool]:
+        """Choose the pools for many volumes, in order.
+
+        Each placement counts against its pool before the next one is
+        made, so a batch is spread or packed like the same volumes placed
+        one at a time. If any volume cannot be placed none of them are.
+        """
+        placed: ty.List[ty.Tuple[PoolState, int]] = []
+        self._refresh_expired()
+        with self._lock:
+            try:
+                for request in requests:
+                    placed.append((self._place(request), request.size))
+            except InsufficientCapacity:
+                for state, size in placed:
+                    self._adjust(state, -size)
+                raise
+        return [state.pool for state, _ in placed]
+
+    def release(self, pool: storeage_pools.StoragePool,
+                size: types.SIZE_BYTES) -> None:
+        """Give back space counted by place for a volume never created."""
+        with self._lock:
+            state = self._states.get(pool.name)
+            if state is not None and state.pool is pool:
+                self._adjust(state, -size)
+
+    def allocate_volume(
+            self, name: str, size: types.SIZE_BYTES,
+            pool_type: ty.Optional[str] = None,
+            provisioning: str = api.PROVISION_SPARSE) -> volume.Volume:
+        """Create a volume on the pool chosen for it.
+
+        If the pool turns out to be full its snapshot is refreshed and the
+        volume placed again, up to MAX_ATTEMPTS times.
+        """
+        request = PlacementRequest(name, size, pool_type, provisioning)
+        attempts = self.MAX_ATTEMPTS
+        while True:
+            pool = self.place(request)
+            try:
+                return pool.allocate_volume(
+                    name, size, provisioning=provisioning)
+            except InsufficientCapacity:
+                self.refresh(pool.name)
+                attempts -= 1
+                if not attempts:
+                    raise
+            except Exception:
+                self.release(pool, size)
+                raise
+
+    def allocate_volumes(
+            self, requests: ty.Iterable[PlacementRequest]
+    ) -> ty.List[api.BatchResult]:
+        """Place and create many volumes.
+
+        The volumes are placed together, then created with one batch per
+        pool. Returns a BatchResult per request, in order.
+        """
+        requests = list(requests)
+        pools = self.place_volumes(requests)
+        batches: ty.Dict[str, ty.List[int]] = {}
+        for i, pool in enumerate(pools):
+            batches.setdefault(pool.name, []).append(i)
+        results: ty.List[ty.Any] = [None] * len(requests)
+        for indexes in batches.values():
+            pool = pools[indexes[0]]
+            specs = [(requests[i].name, requests[i].size,
+                      requests[i].provisioning) for i in indexes]
+            try:
+                batch = pool.allocate_volumes(specs)
+            except Exception as e:
+                batch = [api.BatchResult(spec, error=e) for spec in specs]
+            for i, result in zip(indexes, batch):
+                results[i] = result
+                if not result.ok:
+                    self.release(pool, requests[i].size)
+        return results